@@ -0,0 +1,139 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from contextlib import nullcontext
+from generate import generate, batch_names
+from scenarios import REPO_ROOT, SIZES, percentile, run, throwaway_server, throwaway_database
+
+"""
+Size and scan time of raw_data stored as JSONB documents vs the compact format (see database/compact.py).
+
+Saves the synthetic samples (see generate.py) into a throwaway database, measures raw_data's size and scan times,
+converts it with `falcon_multiqc compact`, and measures again. Scans (median of --repeat runs):
+    metric_filter -- count of verifybamid rows with AVG_DP < 30, through raw_data.metrics.
+    documents -- every metrics document read in full (total number of metrics).
+    query_filter -- `falcon_multiqc query` of samples and their AVG_DP filtered on it, in a fresh process.
+    view_metric -- metric_filter through the view's value array columns, as query does (compact only).
+    compact_metric -- metric_filter reading raw_data_compact's value array directly (compact only).
+Also times saving one more batch into each format (it's removed again before converting).
+
+Usage (from the repository root):
+    python benchmarks/compact.py --size 100k --tools 6 --metrics 20
+    python benchmarks/compact.py --server-uri postgres+psycopg2://postgres@/postgres?host=/tmp --json compact.json
+"""
+
+SCANS = {
+    "metric_filter": "SELECT count(*) FROM raw_data WHERE qc_tool = 'verifybamid' AND (metrics ->> 'AVG_DP')::float8 < 30",
+    "documents": "SELECT sum((SELECT count(*) FROM jsonb_object_keys(metrics))) FROM raw_data",
+}
+
+COMPACT_SCANS = {
+    "view_metric": "SELECT count(*) FROM raw_data WHERE qc_tool = 'verifybamid' "
+                   "AND CAST(raw_data_metric(metric_keys, metric_values, extra, 'AVG_DP') AS float8) < 30",
+    "compact_metric": "SELECT count(*) FROM raw_data_compact r JOIN raw_data_key k ON k.qc_tool = r.qc_tool "
+                      "WHERE r.qc_tool = 'verifybamid' AND r.metric_values[array_position(k.metrics, 'AVG_DP')] < 30",
+}
+
+QUERY_FILTER = ["query", "-s", "sample", "-s", "tool-metric", "-tm", "verifybamid", "AVG_DP", "<", "30",
+                "--csv", "-o", "out", "-f", "query_filter"]
+
+def storage(engine):
+    sys.path.insert(0, REPO_ROOT)
+    from database.compact import storage_sizes
+    with engine.connect() as connection:
+        return storage_sizes(connection)
+
+# Returns {scan: (median seconds, result)}.
+def time_scans(engine, scans, repeat):
+    timings = {}
+    with engine.connect() as connection:
+        for name, sql in scans.items():
+            seconds = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                result = connection.execute(sql).scalar()
+                seconds.append(time.perf_counter() - start)
+            timings[name] = (percentile(seconds, 50), result)
+    return timings
+
+def measure(engine, database_uri, work_dir, scans, repeat, extra_input, extra_batch):
+    sizes = storage(engine)
+    timings = time_scans(engine, scans, repeat)
+    query = [run(QUERY_FILTER, database_uri, work_dir)[0] for _ in range(repeat)]
+    timings["query_filter"] = (percentile(query, 50), None)
+    save_seconds, _ = run(["save", "-i", extra_input], database_uri, work_dir)
+    run(["remove", "-b", "BENCH", extra_batch, "--no-vacuum"], database_uri, work_dir)
+    return {"bytes": sizes, "scans": {name: {"p50_s": round(seconds, 4), "result": result} for name, (seconds, result) in timings.items()},
+            "save_batch_s": round(save_seconds, 3)}
+
+def print_result(name, result):
+    tables = ", ".join(f"{table} {size / 2 ** 20:.1f} MB" for table, size in result["bytes"].items())
+    print(f"{name}: {sum(result['bytes'].values()) / 2 ** 20:.1f} MB ({tables}), saving a batch {result['save_batch_s']:.2f}s")
+    for scan, timing in result["scans"].items():
+        print(f"  {scan:<15} {timing['p50_s'] * 1000:10.1f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="falcon_multiqc compact storage benchmark")
+    parser.add_argument("--size", default="10k", help=f"Number of samples, one of {', '.join(SIZES)}.")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each scan.")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Samples per batch.")
+    parser.add_argument("--tools", type=int, default=6, help="QC tools per sample.")
+    parser.add_argument("--metrics", type=int, default=20, help="Metrics per tool.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the synthetic data.")
+    parser.add_argument("--server-uri", help="Existing PostgreSQL server to create the throwaway database on.")
+    parser.add_argument("--pg-bin", help="Directory of initdb / pg_ctl, for a throwaway cluster (default: the PATH).")
+    parser.add_argument("--work-dir", help="Directory for the synthetic data and outputs (default: a temporary directory).")
+    parser.add_argument("--json", help="Also write the results to this json file.")
+    options = parser.parse_args()
+    if options.size not in SIZES:
+        parser.error(f"unknown size {options.size}, choose from {', '.join(SIZES)}")
+
+    from sqlalchemy import create_engine
+
+    samples = SIZES[options.size]
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix="falcon_bench_")
+    try:
+        input_csv = generate(os.path.join(work_dir, "data"), samples, options.batch_size, options.tools, options.metrics,
+                             seed=options.seed)
+        extra_batch = batch_names(1, samples // options.batch_size + 1)[0]
+        extra_input = generate(os.path.join(work_dir, "extra"), options.batch_size, options.batch_size, options.tools,
+                               options.metrics, seed=options.seed + 1, first_batch=samples // options.batch_size + 1)
+        os.makedirs(os.path.join(work_dir, "out"), exist_ok=True)
+
+        with (nullcontext(options.server_uri) if options.server_uri else throwaway_server(options.pg_bin)) as server_uri:
+            with throwaway_database(server_uri, f"falcon_bench_{os.getpid()}_compact") as database_uri:
+                start = time.perf_counter()
+                run(["save", "-i", input_csv], database_uri, work_dir)
+                print(f"Saved {samples} samples in {time.perf_counter() - start:.1f}s")
+                engine = create_engine(database_uri, isolation_level="AUTOCOMMIT")
+                engine.execute("VACUUM ANALYZE")
+
+                results = {"jsonb": measure(engine, database_uri, work_dir, SCANS, options.repeat, extra_input, extra_batch)}
+                print_result("jsonb", results["jsonb"])
+
+                compact_seconds, _ = run(["compact"], database_uri, work_dir)
+                print(f"Compacted in {compact_seconds:.1f}s")
+                engine.execute("VACUUM ANALYZE")
+                results["compact"] = measure(engine, database_uri, work_dir, {**SCANS, **COMPACT_SCANS}, options.repeat,
+                                             extra_input, extra_batch)
+                results["compact"]["convert_s"] = round(compact_seconds, 3)
+                print_result("compact", results["compact"])
+                engine.dispose()
+    finally:
+        if not options.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    for scan in SCANS:
+        if results["jsonb"]["scans"][scan]["result"] != results["compact"]["scans"][scan]["result"]:
+            raise Exception(f"{scan} differs between the formats.")
+    print(f"Size ratio (compact / jsonb): {sum(results['compact']['bytes'].values()) / sum(results['jsonb']['bytes'].values()):.2f}")
+    if options.json:
+        with open(options.json, "w") as json_file:
+            json.dump({"size": options.size, "tools": options.tools, "metrics": options.metrics, "results": results}, json_file, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import os
+import csv
+import json
+import random
+import argparse
+
+"""
+Synthetic input generator for the falcon_multiqc benchmarks (see scenarios.py).
+
+Writes batch directories in the layout `save` reads, a sample_metadata csv per batch, and an input csv
+(directory,sample_metadata) to save them all at once with `falcon_multiqc save -i`:
+    <output>/<batch>/multiqc_data/multiqc_data.json
+    <output>/<batch>_meta.csv
+    <output>/input.csv
+Metric values are drawn from per metric distributions like the real tools' (coverage, insert size,
+duplication rates, read counts), plus a few non-numeric values, so query filters select a realistic fraction.
+With --sample-files, each batch directory also gets small per sample files for `query --multiqc` to find.
+
+Usage (from the repository root):
+    python benchmarks/generate.py -o /tmp/bench --samples 10000
+    python benchmarks/generate.py -o /tmp/bench --samples 2000 --batch-size 500 --tools 6 --metrics 20 --seed 1
+"""
+
+# multiqc section : {metric : (kind, mean, standard deviation)}, in the order tools and metrics are added.
+TOOLS = {
+    "multiqc_verifybamid": {
+        "AVG_DP": ("float", 35, 5), "#READS": ("int", 2.5e6, 2e5), "FREEMIX": ("ratio", 0.005, 0.004),
+        "CHIPMIX": ("text", "NA", None), "#SNPS": ("int", 1e5, 5e3)},
+    "multiqc_picard_insertSize": {
+        "MEAN_INSERT_SIZE": ("float", 410, 25), "MEDIAN_INSERT_SIZE": ("int", 400, 25),
+        "STANDARD_DEVIATION": ("float", 110, 10), "READ_PAIRS": ("int", 4e8, 4e7), "PAIR_ORIENTATION": ("text", "FR", None)},
+    "multiqc_picard_wgsmetrics": {
+        "MEAN_COVERAGE": ("float", 38, 5), "PCT_EXC_DUPE": ("ratio", 0.05, 0.03), "PCT_EXC_MAPQ": ("ratio", 0.04, 0.01),
+        "PCT_30X": ("ratio", 0.75, 0.1), "GENOME_TERRITORY": ("int", 2.9e9, 0)},
+    "multiqc_picard_dups": {
+        "PERCENT_DUPLICATION": ("ratio", 0.08, 0.03), "READ_PAIRS_EXAMINED": ("int", 4e8, 4e7),
+        "UNPAIRED_READS_EXAMINED": ("int", 1e5, 3e4), "LIBRARY": ("text", "", None)},
+    "multiqc_picard_AlignmentSummaryMetrics": {
+        "PCT_PF_READS_ALIGNED": ("ratio", 0.98, 0.01), "TOTAL_READS": ("int", 8e8, 8e7), "MEAN_READ_LENGTH": ("float", 150, 0.5),
+        "STRAND_BALANCE": ("ratio", 0.5, 0.01), "CATEGORY": ("text", "PAIR", None)},
+    "multiqc_fastqc": {
+        "%GC": ("int", 41, 1), "Total Sequences": ("int", 4e8, 4e7), "avg_sequence_length": ("float", 150, 0.2),
+        "total_deduplicated_percentage": ("float", 88, 4), "basic_statistics": ("text", "pass", None)},
+}
+
+PLATFORMS = ["HiSeqX", "NovaSeq"]
+CENTRES = ["KCCG", "AGRF"]
+
+def batch_names(batches, first=0):
+    return [f"B{i:05d}" for i in range(first, first + batches)]
+
+# Returns {section: [(metric, kind, mean, sd)]} for the first `tools` tools with `metrics` metrics each,
+# making up extra tools / metrics (normally distributed floats) past the built in ones.
+def tool_metrics(tools, metrics):
+    sections = list(TOOLS.items())[:tools]
+    sections += [(f"multiqc_synthetic{i}", {}) for i in range(len(sections), tools)]
+    chosen = {}
+    for section, section_metrics in sections:
+        columns = [(metric, *spec) for metric, spec in section_metrics.items()][:metrics]
+        columns += [(f"METRIC_{i}", "float", 100, 15) for i in range(len(columns), metrics)]
+        chosen[section] = columns
+    return chosen
+
+def metric_value(rng, kind, mean, sd):
+    if kind == "text":
+        return mean
+    value = rng.gauss(mean, sd)
+    if kind == "int":
+        return max(int(value), 0)
+    if kind == "ratio":
+        return min(max(value, 0.0), 1.0)
+    return value
+
+# Writes one batch directory and its sample_metadata csv. Returns (batch directory, sample_metadata path).
+def generate_batch(output, cohort, batch, samples, columns, rng, sample_files=False):
+    batch_dir = os.path.join(output, batch)
+    os.makedirs(os.path.join(batch_dir, "multiqc_data"), exist_ok=True)
+    metadata_path = os.path.join(output, f"{batch}_meta.csv")
+    sample_names = [f"S{batch}{i:07d}" for i in range(samples)]
+
+    with open(metadata_path, "w", newline="") as metadata:
+        writer = csv.writer(metadata)
+        writer.writerow(["Sample Name", "Cohort Name", "Batch Name", "Flowcell.Lane", "Library ID",
+                         "Platform", "Centre", "Reference", "Type", "Description"])
+        for i, sample in enumerate(sample_names):
+            writer.writerow([sample, cohort, batch, f"FC{i % 8}.{i % 4 + 1}", f"LIB{batch}{i}",
+                             PLATFORMS[i % len(PLATFORMS)], CENTRES[i % len(CENTRES)], "hs37d5", "WGS",
+                             f"synthetic sample {sample}"])
+
+    # Sample names can't contain "_", save takes the name from the key's text before the first one.
+    raw_data = {"multiqc_general_stats": {f"{sample}_L001": {"total_sequences": metric_value(rng, "int", 4e8, 4e7)}
+                                          for sample in sample_names}}
+    for section, metrics in columns.items():
+        raw_data[section] = {f"{sample}_L001": {metric: metric_value(rng, kind, mean, sd) for metric, kind, mean, sd in metrics}
+                             for sample in sample_names}
+    with open(os.path.join(batch_dir, "multiqc_data", "multiqc_data.json"), "w") as multiqc_data:
+        json.dump({"report_saved_raw_data": raw_data}, multiqc_data)
+
+    if sample_files:
+        for sample in sample_names:
+            with open(os.path.join(batch_dir, f"{sample}_L001.txt"), "w") as sample_file:
+                sample_file.write(f"{sample}\n")
+    return batch_dir, metadata_path
+
+# Writes `samples` samples split into batches of `batch_size` (the last may be smaller).
+# Returns the path of the input csv listing every batch.
+# first_batch numbers the batches after ones already generated (e.g. to save more into the same cohort).
+def generate(output, samples, batch_size=1000, tools=3, metrics=5, cohort="BENCH", seed=0, sample_files=False, first_batch=0):
+    rng = random.Random(seed)
+    columns = tool_metrics(tools, metrics)
+    os.makedirs(output, exist_ok=True)
+    batches = batch_names((samples + batch_size - 1) // batch_size, first_batch)
+    input_csv = os.path.join(output, "input.csv")
+    with open(input_csv, "w", newline="") as input_file:
+        writer = csv.writer(input_file)
+        writer.writerow(["directory", "sample_metadata"])
+        for i, batch in enumerate(batches):
+            batch_samples = min(batch_size, samples - i * batch_size)
+            writer.writerow(generate_batch(output, cohort, batch, batch_samples, columns, rng, sample_files))
+    return input_csv
+
+def main():
+    parser = argparse.ArgumentParser(description="falcon_multiqc synthetic input generator")
+    parser.add_argument("-o", "--output", required=True, help="Directory the batches are written to.")
+    parser.add_argument("--samples", type=int, default=1000, help="Number of samples.")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Samples per batch.")
+    parser.add_argument("--tools", type=int, default=3, help=f"QC tools per sample (the first {len(TOOLS)} are modelled on real tools).")
+    parser.add_argument("--metrics", type=int, default=5, help="Metrics per tool.")
+    parser.add_argument("--cohort", default="BENCH", help="Cohort name.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed, the same seed writes the same data.")
+    parser.add_argument("--sample-files", action="store_true", help="Also write a small file per sample (for query --multiqc).")
+    options = parser.parse_args()
+
+    input_csv = generate(options.output, options.samples, options.batch_size, options.tools, options.metrics,
+                         options.cohort, options.seed, options.sample_files)
+    print(f"Wrote {options.samples} samples, save them with: falcon_multiqc save -i {input_csv}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import os
+import re
+import subprocess
+import sys
+import argparse
+
+"""
+Import-time benchmark for the falcon_multiqc command line.
+
+Runs falcon_multiqc in a fresh interpreter with `python -X importtime` and sums the self import time
+of every module imported, for `falcon_multiqc --help` and `falcon_multiqc query --help` (which imports the
+query command and its database modules, but does not connect).
+Fails (exit code 1) if a scenario goes over its budget, or imports a module it should never need.
+Also checks the static command registry (falcon_multiqc.cli.COMMANDS) against falcon_multiqc/commands.
+
+Usage (from the repository root):
+    python benchmarks/importtime.py
+    python benchmarks/importtime.py --budget-help-ms 80 --budget-query-ms 300 --repeat 10 --top 15
+"""
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Scenario name : (cli arguments, budget option name, modules that must not be imported).
+SCENARIOS = {
+    "--help": (["--help"], "budget_help_ms", ["pandas", "plotly", "tabulate", "sqlalchemy", "psycopg2"]),
+    "query": (["query", "--help"], "budget_query_ms", ["pandas", "plotly", "tabulate", "psycopg2"]),
+}
+
+IMPORT_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s+)(\S+)")
+
+# Runs the cli once and returns {module: (self us, cumulative us, depth)}.
+def import_times(args):
+    code = ("import sys; from falcon_multiqc.cli import cli; "
+            f"sys.argv = ['falcon_multiqc'] + {args!r}; cli.main(standalone_mode=False)")
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                             cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if process.returncode != 0:
+        raise Exception(f"falcon_multiqc {' '.join(args)} failed:\n{process.stderr[-2000:]}")
+    modules = {}
+    for line in process.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            modules[match.group(4)] = (int(match.group(1)), int(match.group(2)), len(match.group(3)) // 2)
+    return modules
+
+# Returns problems with the command registry: unregistered command modules, and short help that isn't
+# a prefix of the command's docstring (the registry help is shown by --help instead of the docstring).
+def registry_problems():
+    sys.path.insert(0, REPO_ROOT)
+    from falcon_multiqc.cli import COMMANDS
+    problems = []
+    commands_dir = os.path.join(REPO_ROOT, "falcon_multiqc", "commands")
+    registered = {module for module, _ in COMMANDS.values()}
+    for filename in sorted(os.listdir(commands_dir)):
+        module, extension = os.path.splitext(filename)
+        if extension == ".py" and module != "__init__" and module not in registered:
+            problems.append(f"falcon_multiqc/commands/{filename} is not registered in COMMANDS")
+    for name, (module, short_help) in sorted(COMMANDS.items()):
+        mod = __import__(f"falcon_multiqc.commands.{module}", None, None, ["cli"])
+        if not (mod.cli.help or "").startswith(short_help):
+            problems.append(f"COMMANDS['{name}'] help is not a prefix of the {module} command docstring")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description="falcon_multiqc import-time benchmark")
+    parser.add_argument("--budget-help-ms", type=float, default=100, help="Budget for falcon_multiqc --help.")
+    parser.add_argument("--budget-query-ms", type=float, default=400, help="Budget for falcon_multiqc query.")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per scenario, the fastest is reported.")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest top level imports to print.")
+    options = parser.parse_args()
+
+    failed = False
+    for problem in registry_problems():
+        print(f"registry: {problem}")
+        failed = True
+
+    for name, (args, budget_option, forbidden) in SCENARIOS.items():
+        budget = getattr(options, budget_option)
+        runs = [import_times(args) for _ in range(options.repeat)]
+        totals = [sum(self_us for self_us, _, _ in modules.values()) / 1000 for modules in runs]
+        best = runs[totals.index(min(totals))]
+
+        status = "ok" if min(totals) <= budget else "OVER BUDGET"
+        print(f"falcon_multiqc {' '.join(args)}: {min(totals):.1f} ms (median {sorted(totals)[len(totals) // 2]:.1f} ms, budget {budget:g} ms) {status}")
+        failed = failed or min(totals) > budget
+
+        top_level = sorted(((cumulative, module) for module, (_, cumulative, depth) in best.items() if depth == 0), reverse=True)
+        for cumulative, module in top_level[:options.top]:
+            print(f"    {cumulative / 1000:8.1f} ms  {module}")
+
+        imported = [module for module in forbidden if module in best]
+        if imported:
+            print(f"    should not import: {', '.join(imported)}")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
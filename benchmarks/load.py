@@ -0,0 +1,294 @@
+import os
+import sys
+import json
+import time
+import shlex
+import random
+import shutil
+import argparse
+import datetime
+import tempfile
+import threading
+from collections import Counter, defaultdict
+from contextlib import nullcontext
+from generate import generate, batch_names
+from scenarios import SQL, percentile, run_process, throwaway_server, throwaway_database
+
+"""
+Concurrent load benchmark: many falcon_multiqc clients against one database.
+
+Saves --samples synthetic samples (see generate.py) into a throwaway database, then --workers threads each run
+falcon_multiqc operations, one process at a time, for --duration seconds. Operations are drawn from a mix of
+weighted command templates, by default:
+    query -- a batch's samples, or samples filtered on a random AVG_DP threshold, to csv.
+    sql -- a raw SQL join of sample and raw_data to csv.
+    save -- a new synthetic batch.
+    remove -- a batch saved by an earlier save of this run.
+While it runs, pg_stat_activity and pg_locks are sampled (every --sample-interval seconds) for connections and
+backends waiting on locks (and what they waited on), and pg_stat_database's deadlock count is compared before / after.
+Reported per operation: count, errors, p50 / p95 / p99 latency and throughput. Latency includes process start-up.
+
+--mix <file> replays recorded or templated operations instead, one per line as `<weight> <falcon_multiqc arguments>`
+(`#` starts a comment). Arguments may use the placeholders {cohort}, {batch} (a random saved batch), {out} (the
+worker's output directory), {sql_file} (a .txt of a raw SQL join, for sql -s), {threshold} (a random AVG_DP),
+{save_input} (an input csv of a new batch, for save -i) and {saved_batch} (a batch saved by this run, for remove). E.g.
+    10 query -c {cohort} -b {batch} --csv -o {out} -f batch
+    1 remove --batch {cohort} {saved_batch} --no-vacuum
+
+Usage (from the repository root):
+    python benchmarks/load.py --workers 16 --duration 60 --samples 10000
+    python benchmarks/load.py --server-uri postgres+psycopg2://postgres@/postgres?host=/tmp --mix mix.txt --json load.json
+"""
+
+COHORT = "BENCH"
+
+DEFAULT_MIX = """
+40 query -c {cohort} -b {batch} --csv -o {out} -f batch
+20 query -s sample -s tool-metric -tm verifybamid AVG_DP < {threshold} --csv -o {out} -f filtered
+20 sql -s {sql_file} --csv -o {out} -f sql
+10 save -i {save_input}
+10 remove --batch {cohort} {saved_batch}
+"""
+
+# Returns [(weight, argument templates)] of a mix file's text.
+def parse_mix(text):
+    mix = []
+    for number, line in enumerate(text.splitlines(), 1):
+        args = shlex.split(line, comments=True)
+        if not args:
+            continue
+        if len(args) < 2 or not args[0].isdigit():
+            raise Exception(f"Mix line {number} should be '<weight> <falcon_multiqc arguments>': {line}")
+        mix.append((int(args[0]), args[1:]))
+    if not mix:
+        raise Exception("The mix has no operations.")
+    return mix
+
+# Batches the workers share: saved ones (for {batch}), new ones to save, and ones saved by this run to remove.
+class Batches:
+    def __init__(self, saved, new_inputs):
+        self.lock = threading.Lock()
+        self.saved = list(saved)
+        self.new_inputs = list(new_inputs) # [(batch name, input csv)]
+        self.removable = []
+
+    def random_saved(self, rng):
+        with self.lock:
+            return rng.choice(self.saved) if self.saved else None
+
+    def take_new(self):
+        with self.lock:
+            return self.new_inputs.pop(0) if self.new_inputs else None
+
+    def take_removable(self):
+        with self.lock:
+            return self.removable.pop(0) if self.removable else None
+
+    def saved_batch(self, batch):
+        with self.lock:
+            self.saved.append(batch)
+            self.removable.append(batch)
+
+    def removed_batch(self, batch):
+        with self.lock:
+            if batch in self.saved:
+                self.saved.remove(batch)
+
+# Fills in an operation's placeholders. Returns (arguments, batch saved, batch removed), or None when it can't run
+# (no new batch left to save, or no batch of this run left to remove).
+def render(template, batches, out, sql_file, rng):
+    text = " ".join(template)
+    values = {"cohort": COHORT, "out": out, "sql_file": sql_file, "threshold": f"{rng.uniform(25, 45):.1f}"}
+    saving = removing = None
+    if "{batch}" in text:
+        values["batch"] = batches.random_saved(rng)
+        if values["batch"] is None:
+            return None
+    if "{save_input}" in text:
+        new = batches.take_new()
+        if new is None:
+            return None
+        saving, values["save_input"] = new
+    if "{saved_batch}" in text:
+        removing = values["saved_batch"] = batches.take_removable()
+        if removing is None:
+            return None
+    return [arg.format(**values) for arg in template], saving, removing
+
+# Samples the database's activity from its own connection until stopped.
+class ActivitySampler(threading.Thread):
+    ACTIVITY = """
+        SELECT count(*) AS connections, count(*) FILTER (WHERE wait_event_type = 'Lock') AS lock_waits
+        FROM pg_stat_activity WHERE datname = current_database() AND pid <> pg_backend_pid()"""
+    WAITING_ON = """
+        SELECT COALESCE(c.relname, l.locktype) AS target, l.mode
+        FROM pg_locks l JOIN pg_stat_activity a ON a.pid = l.pid LEFT JOIN pg_class c ON c.oid = l.relation
+        WHERE NOT l.granted AND a.datname = current_database()"""
+
+    def __init__(self, database_uri, interval):
+        super().__init__(daemon=True)
+        from sqlalchemy import create_engine
+        self.engine = create_engine(database_uri, isolation_level="AUTOCOMMIT")
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.samples = 0
+        self.peak_connections = 0
+        self.peak_lock_waits = 0
+        self.lock_wait_samples = 0 # backends waiting on a lock, summed over the samples
+        self.waiting_on = Counter() # (relation or lock type, mode) : samples
+
+    def deadlocks(self):
+        return self.engine.execute("SELECT deadlocks FROM pg_stat_database WHERE datname = current_database()").scalar()
+
+    def run(self):
+        with self.engine.connect() as connection:
+            while not self.stopped.wait(self.interval):
+                connections, lock_waits = connection.execute(self.ACTIVITY).first()
+                self.samples += 1
+                self.peak_connections = max(self.peak_connections, connections)
+                self.peak_lock_waits = max(self.peak_lock_waits, lock_waits)
+                self.lock_wait_samples += lock_waits
+                if lock_waits:
+                    self.waiting_on.update((target, mode) for target, mode in connection.execute(self.WAITING_ON))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.engine.dispose()
+
+def worker(number, mix, batches, database_uri, work_dir, deadline, results, seed):
+    rng = random.Random(seed + number)
+    out = os.path.join(work_dir, f"worker{number}")
+    os.makedirs(out, exist_ok=True)
+    weights = [weight for weight, _ in mix]
+    while time.monotonic() < deadline:
+        _, template = rng.choices(mix, weights)[0]
+        operation = template[0]
+        rendered = render(template, batches, out, os.path.join(work_dir, "query.txt"), rng)
+        if rendered is None:
+            results[operation]["skipped"] += 1
+            time.sleep(0.01)
+            continue
+        args, saving, removing = rendered
+        seconds, _, exit_code, error = run_process(args, database_uri, work_dir)
+        result = results[operation]
+        if exit_code == 0:
+            result["seconds"].append(seconds)
+            if saving:
+                batches.saved_batch(saving)
+            if removing:
+                batches.removed_batch(removing)
+        else:
+            result["errors"] += 1
+            result["deadlocks"] += "deadlock detected" in error
+            result["last_error"] = error.strip().splitlines()[-1] if error.strip() else f"exit code {exit_code}"
+
+def summarise(results, duration):
+    summary = {}
+    for operation, result in sorted(results.items()):
+        seconds = result["seconds"]
+        summary[operation] = {
+            "ok": len(seconds),
+            "errors": result["errors"],
+            "deadlocks": result["deadlocks"],
+            "skipped": result["skipped"],
+            "p50_s": round(percentile(seconds, 50), 4) if seconds else None,
+            "p95_s": round(percentile(seconds, 95), 4) if seconds else None,
+            "p99_s": round(percentile(seconds, 99), 4) if seconds else None,
+            "ops_per_s": round(len(seconds) / duration, 2),
+            "last_error": result["last_error"],
+        }
+    return summary
+
+def print_report(summary, activity, workers, duration):
+    print(f"{workers} workers for {duration:.1f}s:")
+    for operation, result in summary.items():
+        latency = (f"p50 {result['p50_s']:7.3f}s  p95 {result['p95_s']:7.3f}s  p99 {result['p99_s']:7.3f}s"
+                   if result["ok"] else f"{'no successful runs':<44}")
+        print(f"  {operation:<8} {result['ok']:6} ok {result['errors']:4} errors {result['skipped']:4} skipped  "
+              f"{latency}  {result['ops_per_s']:7.2f} ops/s")
+        if result["last_error"]:
+            print(f"           last error: {result['last_error'][:160]}")
+    print(f"  peak connections {activity['peak_connections']}, peak backends waiting on locks {activity['peak_lock_waits']}, "
+          f"lock wait ~{activity['lock_wait_s']:.1f}s in total")
+    for target in activity["waiting_on"]:
+        print(f"    waited on {target['target']} ({target['mode']}) in {target['samples']} samples")
+    print(f"  deadlocks: {activity['deadlocks']} (server), {sum(r['deadlocks'] for r in summary.values())} (seen by clients)")
+
+def main():
+    parser = argparse.ArgumentParser(description="falcon_multiqc concurrent load benchmark")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent clients.")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to start operations for.")
+    parser.add_argument("--samples", type=int, default=10000, help="Samples saved before the load starts.")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Samples per batch (also of the batches saved by the load).")
+    parser.add_argument("--new-batches", type=int, default=50, help="New batches generated for the load's save operations.")
+    parser.add_argument("--mix", help="File of '<weight> <falcon_multiqc arguments>' lines (default: a built in mix).")
+    parser.add_argument("--sample-interval", type=float, default=0.1, help="Seconds between activity samples.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the data and the operation order.")
+    parser.add_argument("--server-uri", help="Existing PostgreSQL server to create the throwaway database on.")
+    parser.add_argument("--pg-bin", help="Directory of initdb / pg_ctl, for a throwaway cluster (default: the PATH).")
+    parser.add_argument("--work-dir", help="Directory for the synthetic data and outputs (default: a temporary directory).")
+    parser.add_argument("--json", help="Also write the results to this json file.")
+    options = parser.parse_args()
+
+    if options.mix:
+        with open(options.mix) as mix_file:
+            mix = parse_mix(mix_file.read())
+    else:
+        mix = parse_mix(DEFAULT_MIX)
+
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix="falcon_load_")
+    try:
+        input_csv = generate(os.path.join(work_dir, "data"), options.samples, options.batch_size, seed=options.seed)
+        saved = batch_names((options.samples + options.batch_size - 1) // options.batch_size)
+        new_inputs = []
+        for i, batch in enumerate(batch_names(options.new_batches, len(saved))):
+            new_inputs.append((batch, generate(os.path.join(work_dir, "new", batch), options.batch_size, options.batch_size,
+                                               seed=options.seed + i + 1, first_batch=len(saved) + i)))
+        with open(os.path.join(work_dir, "query.txt"), "w") as sql_file:
+            sql_file.write(SQL)
+
+        with (nullcontext(options.server_uri) if options.server_uri else throwaway_server(options.pg_bin)) as server_uri:
+            with throwaway_database(server_uri, f"falcon_load_{os.getpid()}") as database_uri:
+                seconds, _, exit_code, error = run_process(["save", "-i", input_csv], database_uri, work_dir)
+                if exit_code != 0:
+                    raise Exception(f"Saving the synthetic data failed:\n{error[-2000:]}")
+                print(f"Saved {options.samples} samples in {seconds:.1f}s, starting {options.workers} workers...")
+
+                batches = Batches(saved, new_inputs)
+                results = defaultdict(lambda: {"seconds": [], "errors": 0, "deadlocks": 0, "skipped": 0, "last_error": None})
+                sampler = ActivitySampler(database_uri, options.sample_interval)
+                deadlocks_before = sampler.deadlocks()
+                sampler.start()
+                start = time.monotonic()
+                threads = [threading.Thread(target=worker, args=(number, mix, batches, database_uri, work_dir,
+                                                                 start + options.duration, results, options.seed))
+                           for number in range(options.workers)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                duration = time.monotonic() - start
+                sampler.stop()
+                activity = {
+                    "peak_connections": sampler.peak_connections,
+                    "peak_lock_waits": sampler.peak_lock_waits,
+                    "lock_wait_s": round(sampler.lock_wait_samples * options.sample_interval, 2),
+                    "waiting_on": [{"target": target, "mode": mode, "samples": samples}
+                                   for (target, mode), samples in sampler.waiting_on.most_common(10)],
+                    "deadlocks": sampler.deadlocks() - deadlocks_before,
+                }
+    finally:
+        if not options.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    summary = summarise(results, duration)
+    print_report(summary, activity, options.workers, duration)
+    if options.json:
+        with open(options.json, "w") as json_file:
+            json.dump({"created": datetime.datetime.now().isoformat(timespec="seconds"), "workers": options.workers,
+                       "duration_s": round(duration, 2), "operations": summary, "activity": activity}, json_file, indent=2)
+    sys.exit(1 if any(result["errors"] for result in summary.values()) else 0)
+
+if __name__ == "__main__":
+    main()
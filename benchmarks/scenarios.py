@@ -0,0 +1,238 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import datetime
+import tempfile
+import subprocess
+from contextlib import contextmanager, nullcontext
+from generate import generate, batch_names
+
+"""
+Scaling benchmark for save, query, sql, chart and multiqc report creation, on synthetic data (see generate.py).
+
+For each size, a throwaway database is created, the synthetic batches are saved into it, and each scenario is run
+as a falcon_multiqc command in a fresh process (as users run it), --repeat times:
+    save -- `save -i` of every batch (run once).
+    query_cohort -- every sample of the cohort to csv.
+    query_filter -- samples and their verifybamid metrics, filtered on AVG_DP, to csv.
+    sql -- a raw SQL join of sample and raw_data to csv.
+    chart -- histogram of query_filter's csv.
+    report -- `query --multiqc` of one batch (only when multiqc is installed).
+Reported per scenario: latency percentiles, throughput (samples or output rows per second) and peak RSS.
+
+The database server is either an existing one (--server-uri, a throwaway database is created and dropped on it),
+or a throwaway cluster started with initdb / pg_ctl (from --pg-bin or the PATH, can't be run as root).
+Results can be saved as a baseline (--save-baseline) and later runs compared against it (--compare, fails
+when a scenario's median is over --max-regression times the baseline's).
+
+Usage (from the repository root):
+    python benchmarks/scenarios.py --sizes 1k,10k --save-baseline benchmarks/baseline.json
+    python benchmarks/scenarios.py --server-uri postgres+psycopg2://postgres@/postgres?host=/tmp --compare benchmarks/baseline.json
+"""
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+SIZES = {"1k": 1000, "10k": 10000, "100k": 100000, "1M": 1000000}
+
+SQL = ("SELECT sample.sample_name, batch.path, raw_data.metrics FROM sample JOIN batch ON sample.batch_id = batch.id "
+       "JOIN raw_data ON raw_data.sample_id = sample.id WHERE raw_data.qc_tool = 'verifybamid'")
+
+# Scenario name : (falcon_multiqc arguments, csv the output rows are counted from), run in the work directory.
+def scenarios(cohort, first_batch, report):
+    chosen = {
+        "query_cohort": (["query", "-c", cohort, "--csv", "-o", "out", "-f", "query_cohort"], "out/query_cohort.csv"),
+        "query_filter": (["query", "-s", "sample", "-s", "tool-metric", "-tm", "verifybamid", "AVG_DP", "<", "30",
+                          "--csv", "-o", "out", "-f", "query_filter"], "out/query_filter.csv"),
+        "sql": (["sql", "-s", "query.txt", "--csv", "-o", "out", "-f", "sql"], "out/sql.csv"),
+        "chart": (["chart", "-d", "out/query_filter.csv", "-t", "histogram", "-o", "out", "-f", "chart"], "out/query_filter.csv"),
+    }
+    if report:
+        chosen["report"] = (["query", "-c", cohort, "-b", first_batch, "--multiqc", "-o", "out", "-f", "report"], None)
+    return chosen
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered) + 0.5) - 1))]
+
+# Runs falcon_multiqc in a new process. Returns (seconds, peak RSS in bytes, exit code, stderr).
+def run_process(args, database_uri, cwd):
+    code = "import sys; from falcon_multiqc.cli import safe_entry_point; sys.argv = ['falcon_multiqc'] + sys.argv[1:]; safe_entry_point()"
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""),
+               FALCON_MULTIQC_DATABASE_URI=database_uri, FALCON_MULTIQC_DAEMON="0")
+    env.pop("FALCON_MULTIQC_REPLICA_URI", None)
+    with tempfile.TemporaryFile() as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, "-c", code, *args], cwd=cwd, env=env,
+                                   stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=stderr)
+        # wait4 gives this process's own resource usage (getrusage(RUSAGE_CHILDREN) is the maximum of them all).
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+        stderr.seek(0)
+        error = stderr.read().decode(errors="replace")
+    exit_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS.
+    return seconds, usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024), exit_code, error
+
+# Runs falcon_multiqc in a new process, raising if it fails. Returns (seconds, peak RSS in bytes).
+def run(args, database_uri, cwd):
+    seconds, rss, exit_code, error = run_process(args, database_uri, cwd)
+    if exit_code != 0:
+        raise Exception(f"falcon_multiqc {' '.join(args)} failed:\n{error[-2000:]}")
+    return seconds, rss
+
+def count_rows(path):
+    with open(path) as csv_file:
+        return max(sum(1 for _ in csv_file) - 1, 0)
+
+def summarise(timings, items):
+    seconds = [s for s, _ in timings]
+    return {
+        "runs": len(timings),
+        "p50_s": round(percentile(seconds, 50), 4),
+        "p90_s": round(percentile(seconds, 90), 4),
+        "p99_s": round(percentile(seconds, 99), 4),
+        "items": items,
+        "items_per_s": round(items / percentile(seconds, 50), 1) if items else None,
+        "peak_rss_mb": round(max(rss for _, rss in timings) / 2 ** 20, 1),
+    }
+
+# Starts a PostgreSQL cluster in a temporary directory, listening only on a Unix socket there. Yields its URI.
+@contextmanager
+def throwaway_server(pg_bin=None):
+    initdb = shutil.which("initdb", path=pg_bin)
+    pg_ctl = shutil.which("pg_ctl", path=pg_bin)
+    if not initdb or not pg_ctl:
+        raise Exception("initdb / pg_ctl not found, set --pg-bin or use --server-uri.")
+    if hasattr(os, "geteuid") and os.geteuid() == 0:
+        raise Exception("initdb can't be run as root, use --server-uri.")
+    data_dir = tempfile.mkdtemp(prefix="falcon_bench_pg_")
+    try:
+        subprocess.run([initdb, "-D", data_dir, "-U", "postgres", "--auth=trust"], check=True, stdout=subprocess.DEVNULL)
+        subprocess.run([pg_ctl, "-D", data_dir, "-l", os.path.join(data_dir, "server.log"), "-w",
+                        "-o", f"-k {data_dir} -c listen_addresses='' -F", "start"], check=True, stdout=subprocess.DEVNULL)
+        try:
+            yield f"postgres+psycopg2://postgres@/postgres?host={data_dir}"
+        finally:
+            subprocess.run([pg_ctl, "-D", data_dir, "-m", "immediate", "stop"], stdout=subprocess.DEVNULL)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+# Creates an empty database on the server (with the falcon_multiqc tables) and drops it afterwards. Yields its URI.
+@contextmanager
+def throwaway_database(server_uri, name):
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.engine.url import make_url
+
+    admin = create_engine(server_uri, isolation_level="AUTOCOMMIT")
+    database_uri = make_url(server_uri)
+    database_uri.database = name
+    admin.execute(text(f'CREATE DATABASE "{name}"'))
+    try:
+        subprocess.run([sys.executable, "-c", "from database.crud import create_database; create_database()"], check=True,
+                       cwd=REPO_ROOT, env=dict(os.environ, FALCON_MULTIQC_DATABASE_URI=str(database_uri)))
+        yield str(database_uri)
+    finally:
+        admin.execute(text("SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = :name"), name=name)
+        admin.execute(text(f'DROP DATABASE IF EXISTS "{name}"'))
+        admin.dispose()
+
+def run_size(server_uri, size, samples, options, work_dir):
+    results = {}
+    data_dir = os.path.join(work_dir, size)
+    report = shutil.which("multiqc") is not None
+
+    start = time.perf_counter()
+    input_csv = generate(os.path.join(data_dir, "data"), samples, options.batch_size, options.tools, options.metrics,
+                         seed=options.seed, sample_files=report)
+    print(f"{size}: generated {samples} samples in {time.perf_counter() - start:.1f}s")
+    os.makedirs(os.path.join(data_dir, "out"), exist_ok=True)
+    with open(os.path.join(data_dir, "query.txt"), "w") as sql_file:
+        sql_file.write(SQL)
+
+    with throwaway_database(server_uri, f"falcon_bench_{os.getpid()}_{size.lower()}") as database_uri:
+        results["save"] = summarise([run(["save", "-i", input_csv], database_uri, data_dir)], samples)
+        print_result(size, "save", results["save"])
+        for name, (args, rows_csv) in scenarios("BENCH", batch_names(1)[0], report).items():
+            timings = [run(args, database_uri, data_dir) for _ in range(options.repeat)]
+            results[name] = summarise(timings, count_rows(os.path.join(data_dir, rows_csv)) if rows_csv else None)
+            print_result(size, name, results[name])
+    return results
+
+def print_result(size, name, result):
+    throughput = f"{result['items_per_s']:>10.0f}/s" if result["items_per_s"] else f"{'':>12}"
+    print(f"  {size:>4} {name:<13} p50 {result['p50_s']:8.3f}s  p90 {result['p90_s']:8.3f}s  p99 {result['p99_s']:8.3f}s  "
+          f"{throughput}  peak RSS {result['peak_rss_mb']:7.1f} MB")
+
+# Returns [(size, scenario, ratio)] of scenarios whose median is over max_regression times the baseline's.
+def regressions(results, baseline, max_regression):
+    slower = []
+    for size, size_results in results.items():
+        for name, result in size_results.items():
+            previous = baseline.get("results", {}).get(size, {}).get(name)
+            if previous and previous["p50_s"] > 0:
+                ratio = result["p50_s"] / previous["p50_s"]
+                print(f"  {size:>4} {name:<13} {ratio:5.2f}x baseline ({previous['p50_s']:.3f}s -> {result['p50_s']:.3f}s)")
+                if ratio > max_regression:
+                    slower.append((size, name, ratio))
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser(description="falcon_multiqc scaling benchmark")
+    parser.add_argument("--sizes", default="1k,10k", help=f"Comma separated sizes to run, of {', '.join(SIZES)}.")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each scenario after save.")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Samples per batch.")
+    parser.add_argument("--tools", type=int, default=3, help="QC tools per sample.")
+    parser.add_argument("--metrics", type=int, default=5, help="Metrics per tool.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the synthetic data.")
+    parser.add_argument("--server-uri", help="Existing PostgreSQL server to create the throwaway databases on.")
+    parser.add_argument("--pg-bin", help="Directory of initdb / pg_ctl, for a throwaway cluster (default: the PATH).")
+    parser.add_argument("--work-dir", help="Directory for the synthetic data and outputs (default: a temporary directory).")
+    parser.add_argument("--save-baseline", help="Save the results to this json file.")
+    parser.add_argument("--compare", help="Compare the results against this baseline json file.")
+    parser.add_argument("--max-regression", type=float, default=1.25, help="Fail when a median is over this times the baseline's.")
+    options = parser.parse_args()
+
+    sizes = [size.strip() for size in options.sizes.split(",") if size.strip()]
+    unknown = [size for size in sizes if size not in SIZES]
+    if unknown:
+        parser.error(f"unknown sizes {', '.join(unknown)}, choose from {', '.join(SIZES)}")
+
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix="falcon_bench_")
+    results = {}
+    try:
+        with (nullcontext(options.server_uri) if options.server_uri else throwaway_server(options.pg_bin)) as server_uri:
+            for size in sizes:
+                results[size] = run_size(server_uri, size, SIZES[size], options, work_dir)
+    finally:
+        if not options.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    run_info = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "options": {name: getattr(options, name) for name in ["repeat", "batch_size", "tools", "metrics", "seed"]},
+        "results": results,
+    }
+    if options.save_baseline:
+        with open(options.save_baseline, "w") as baseline_file:
+            json.dump(run_info, baseline_file, indent=2)
+        print(f"Saved baseline to {options.save_baseline}")
+
+    failed = False
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print(f"Compared with {options.compare} ({baseline.get('created')}):")
+        for size, name, ratio in regressions(results, baseline, options.max_regression):
+            print(f"REGRESSION {size} {name}: {ratio:.2f}x the baseline median")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import math
+from collections import defaultdict
+from sqlalchemy import text, tuple_
+from .models import Batch, BatchMetricBaseline, MetricBaseline, RawData, Sample
+from .sketch import merge_moments, moments, std_dev, is_numeric
+
+"""
+Running per-group metric baselines (see the baseline command), so save can report whether a new batch drifts
+from the history of the same centre, platform and reference genome without scanning that history.
+
+metric_baseline has the moments (count, mean, M2, min, max, see database/sketch.py) of each (centre, platform,
+reference genome, qc_tool, metric) over every saved sample. save merges each batch's moments into it (the parallel
+form of Welford's update, inside an INSERT ... ON CONFLICT so concurrent saves don't lose each other's updates), and
+keeps the batch's share in batch_metric_baseline. Removing a batch takes its share back out of the baseline in the
+transaction deleting the batch row (see database/delete.py), so an interrupted remove never unmerges it twice.
+min / max can't be unmerged, they're recomputed from the group's other shares (indexed on the group).
+
+The drift report compares each new batch's mean with its group's baseline, before the batch is merged into it:
+    shift = (batch mean - baseline mean) / baseline standard deviation
+A metric drifts when |shift| >= the threshold (save --drift-threshold), once the baseline has MIN_BASELINE_COUNT
+samples. With shards (see database/crud.py) each shard has the baselines of its own cohorts' samples.
+"""
+
+# Baseline standard deviations a batch mean has to shift by to be reported.
+DRIFT_THRESHOLD = 1.0
+# Samples a baseline needs before batches are compared with it.
+MIN_BASELINE_COUNT = 10
+
+GROUP = ("centre", "platform", "reference_genome", "qc_tool", "metric")
+
+# Merges a batch's moments into its group's baseline (count * count is cast to float8, it can overflow integer).
+MERGE = """
+INSERT INTO metric_baseline (centre, platform, reference_genome, qc_tool, metric, count, mean, m2, min, max)
+VALUES (:centre, :platform, :reference_genome, :qc_tool, :metric, :count, :mean, :m2, :min, :max)
+ON CONFLICT (centre, platform, reference_genome, qc_tool, metric) DO UPDATE SET
+    count = metric_baseline.count + EXCLUDED.count,
+    mean = metric_baseline.mean + (EXCLUDED.mean - metric_baseline.mean) * EXCLUDED.count / (metric_baseline.count + EXCLUDED.count),
+    m2 = metric_baseline.m2 + EXCLUDED.m2 + (EXCLUDED.mean - metric_baseline.mean) ^ 2
+        * CAST(metric_baseline.count AS float8) * EXCLUDED.count / (metric_baseline.count + EXCLUDED.count),
+    min = LEAST(metric_baseline.min, EXCLUDED.min),
+    max = GREATEST(metric_baseline.max, EXCLUDED.max)
+"""
+
+# The baseline's mean without the batch's share b.
+REMAINING_MEAN = "(m.mean * m.count - b.mean * b.count) / (m.count - b.count)"
+# A group's other shares than b's.
+OTHER_SHARES = ("FROM batch_metric_baseline o WHERE o.centre = b.centre AND o.platform = b.platform AND "
+                "o.reference_genome = b.reference_genome AND o.qc_tool = b.qc_tool AND o.metric = b.metric AND o.batch_id <> b.batch_id")
+
+# Takes a batch's shares out of their baselines (the inverse of MERGE). Emptied baselines are deleted after.
+UNMERGE = f"""
+UPDATE metric_baseline m SET
+    count = m.count - b.count,
+    mean = CASE WHEN m.count > b.count THEN {REMAINING_MEAN} ELSE 0 END,
+    m2 = CASE WHEN m.count > b.count THEN GREATEST(0, m.m2 - b.m2 - (b.mean - {REMAINING_MEAN}) ^ 2
+        * CAST(m.count - b.count AS float8) * b.count / m.count) ELSE 0 END,
+    min = COALESCE((SELECT min(o.min) {OTHER_SHARES}), m.min),
+    max = COALESCE((SELECT max(o.max) {OTHER_SHARES}), m.max)
+FROM batch_metric_baseline b
+WHERE b.batch_id = :batch_id AND m.centre = b.centre AND m.platform = b.platform AND m.reference_genome = b.reference_genome
+    AND m.qc_tool = b.qc_tool AND m.metric = b.metric
+"""
+
+# Returns the drift report rows, the metrics of the batches whose mean shifted from their group's baseline by at least
+# threshold baseline standard deviations, largest shift first:
+# (batch id, centre, platform, reference genome, qc_tool, metric, batch count, batch mean, baseline count,
+#  baseline mean, baseline standard deviation, shift).
+# shares is {(batch id, *GROUP): (count, mean, m2, min, max)}, baselines is {GROUP: (count, mean, m2)}.
+def drift(shares, baselines, threshold=DRIFT_THRESHOLD):
+    report = []
+    for (batch_id, *group), (count, mean, _, _, _) in shares.items():
+        baseline = baselines.get(tuple(group))
+        if baseline is None or baseline[0] < MIN_BASELINE_COUNT:
+            continue
+        baseline_count, baseline_mean, baseline_m2 = baseline
+        sd = std_dev(baseline_count, baseline_m2)
+        if sd > 0:
+            shift = (mean - baseline_mean) / sd
+        else:
+            # Every sample so far had the same value.
+            shift = 0.0 if mean == baseline_mean else math.copysign(math.inf, mean - baseline_mean)
+        if abs(shift) >= threshold:
+            report.append((batch_id, *group, count, mean, baseline_count, baseline_mean, sd, shift))
+    return sorted(report, key=lambda row: (-abs(row[-1]), row[:6]))
+
+# Merges the values of the saved batches into the baselines, keeping each batch's share (see unmerge_batch).
+# group_values is {(batch id, centre, platform, reference genome, qc_tool): {metric: [numeric values]}}.
+# Returns the drift report (see drift) of the batches against the baselines before they were merged.
+def save_baselines(session, group_values, threshold=DRIFT_THRESHOLD):
+    shares = {}
+    for key, metrics in group_values.items():
+        for metric, values in metrics.items():
+            if values:
+                shares[(*key, metric)] = moments(values)
+    if not shares:
+        return []
+
+    # The input's moments of each group (several of its batches can be of the same one).
+    merged = {}
+    for (batch_id, *group), (count, mean, m2, minimum, maximum) in shares.items():
+        group = tuple(group)
+        if group in merged:
+            previous = merged[group]
+            merged[group] = (*merge_moments(previous[:3], (count, mean, m2)), min(previous[3], minimum), max(previous[4], maximum))
+        else:
+            merged[group] = (count, mean, m2, minimum, maximum)
+
+    columns = [getattr(MetricBaseline, column) for column in GROUP]
+    baselines = {tuple(row[:5]): tuple(row[5:]) for row in
+                 session.query(*columns, MetricBaseline.count, MetricBaseline.mean, MetricBaseline.m2)
+                 .filter(tuple_(*columns).in_(list(merged)))}
+    report = drift(shares, baselines, threshold)
+
+    session.execute(BatchMetricBaseline.__table__.insert(), [
+        dict(zip(("batch_id",) + GROUP + ("count", "mean", "m2", "min", "max"), key + share)) for key, share in shares.items()])
+    # In the same order in every save, so concurrent saves of a group wait for each other rather than deadlock.
+    session.execute(text(MERGE), [dict(zip(GROUP + ("count", "mean", "m2", "min", "max"), group + merged[group]))
+                                  for group in sorted(merged)])
+    return report
+
+# Takes the batch's shares out of the baselines (nothing once they're taken out). Returns the number of shares.
+def unmerge_batch(session, batch_id):
+    unmerged = session.execute(text(UNMERGE), {"batch_id": batch_id}).rowcount
+    if unmerged:
+        session.execute(text("DELETE FROM metric_baseline WHERE count <= 0"))
+        session.execute(text("DELETE FROM batch_metric_baseline WHERE batch_id = :batch_id"), {"batch_id": batch_id})
+    return unmerged
+
+# Builds the baseline shares of the batches that have none (e.g. saved before baselines existed), from their raw_data.
+# Returns the number of batches built.
+def rebuild_baselines(session):
+    shared = session.query(BatchMetricBaseline.batch_id).distinct()
+    missing = [batch_id for batch_id, in session.query(Batch.id).filter(~Batch.id.in_(shared)).order_by(Batch.id)]
+    for batch_id in missing:
+        group_values = defaultdict(lambda: defaultdict(list)) # (batch id, centre, platform, reference genome, qc_tool) : metric : values
+        rows = session.query(Sample.centre, Sample.platform, Sample.reference_genome, RawData.qc_tool, RawData.metrics).\
+            join(RawData, RawData.sample_id == Sample.id).filter(Sample.batch_id == batch_id).yield_per(1000)
+        for centre, platform, reference_genome, qc_tool, metrics in rows:
+            for metric, value in metrics.items():
+                if is_numeric(value):
+                    group_values[(batch_id, centre, platform, reference_genome, qc_tool)][metric].append(value)
+        save_baselines(session, group_values)
+        session.flush()
+    return len(missing)
+
+# Merges the batches' stored shares (e.g. of an imported cohort, see database/transfer.py) into the baselines.
+# Returns the number of baselines merged into.
+def merge_shares(session, batch_ids):
+    columns = [getattr(BatchMetricBaseline, column) for column in GROUP]
+    merged = {}
+    for row in session.query(*columns, BatchMetricBaseline.count, BatchMetricBaseline.mean, BatchMetricBaseline.m2,
+                             BatchMetricBaseline.min, BatchMetricBaseline.max).filter(BatchMetricBaseline.batch_id.in_(batch_ids)):
+        group, (count, mean, m2, minimum, maximum) = tuple(row[:5]), row[5:]
+        if group in merged:
+            previous = merged[group]
+            merged[group] = (*merge_moments(previous[:3], (count, mean, m2)), min(previous[3], minimum), max(previous[4], maximum))
+        else:
+            merged[group] = (count, mean, m2, minimum, maximum)
+    if merged:
+        # Sorted, as in save_baselines.
+        session.execute(text(MERGE), [dict(zip(GROUP + ("count", "mean", "m2", "min", "max"), group + merged[group]))
+                                      for group in sorted(merged)])
+    return len(merged)
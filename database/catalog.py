@@ -0,0 +1,46 @@
+import time
+import difflib
+from collections import defaultdict
+from .models import MetricSummary
+from .crud import is_sharded
+from .federation import fan_out
+
+"""
+Cached catalog of the numeric metrics saved for each tool ({qc_tool: set of metric names}).
+Built from the metric_summary table (see save), so it never scans raw_data.
+Used to check --tool-metric names (query, distribution) and suggest close matches for misspelt ones.
+
+The catalog is cached for the life of the process (up to CATALOG_TTL seconds), which matters for the daemon
+(see the serve command) where it stays warm between requests. Call invalidate() after changing the data.
+With shards (see database/crud.py) it's the catalog of every shard.
+"""
+
+CATALOG_TTL = 60 # seconds
+
+_catalog = None
+_loaded_at = 0
+
+def tool_metrics(session, shard=None):
+    return session.query(MetricSummary.qc_tool, MetricSummary.metric).distinct().all()
+
+def get_catalog(session):
+    global _catalog, _loaded_at
+    if _catalog is None or time.time() - _loaded_at > CATALOG_TTL:
+        catalog = defaultdict(set)
+        for rows in (fan_out(tool_metrics) if is_sharded() else [tool_metrics(session)]):
+            for qc_tool, metric in rows:
+                catalog[qc_tool].add(metric)
+        _catalog, _loaded_at = dict(catalog), time.time()
+    return _catalog
+
+# Returns " Did you mean ...?" for a tool / metric missing from the catalog, or "" without a close match.
+def suggest(catalog, tool, metric):
+    if tool not in catalog:
+        matches = difflib.get_close_matches(tool, catalog.keys(), n=3)
+    else:
+        matches = difflib.get_close_matches(metric, catalog[tool], n=3)
+    return f" Did you mean {' / '.join(matches)}?" if matches else ""
+
+def invalidate():
+    global _catalog
+    _catalog = None
@@ -0,0 +1,191 @@
+from sqlalchemy import text
+
+"""
+Opt-in compact storage of raw_data (see the compact command).
+
+Every raw_data.metrics JSONB document repeats its tool's metric names and stores numbers as JSON text. Compacted,
+each tool's numeric metric names are stored once, in order, in a dictionary table, and each row's numbers in a
+double precision array in that order, with a JSONB sidecar for everything else (strings, booleans, nulls, nested
+values and numbers a double can't hold exactly, so nothing is lost):
+    raw_data_key (qc_tool, metrics text[]) -- the tool's metric names, new names are appended.
+    raw_data_compact (id, sample_id, qc_tool, metric_values float8[], extra jsonb)
+      -- metric_values[i] is the value of metrics[i] (NULL when missing / not numeric).
+raw_data itself becomes a view with the same columns, rebuilding metrics from the two, with INSTEAD OF triggers
+for inserts, updates and deletes. So save, remove and existing sql scripts keep working unchanged.
+
+Rebuilding the JSON makes reads of raw_data.metrics through the view slower than reading stored JSONB. The view
+also has the metric_keys, metric_values and extra columns, to read single metrics without rebuilding the document,
+which query does (see metric_text in the query command):
+    SELECT sample_id, raw_data_metric(metric_keys, metric_values, extra, 'AVG_DP') AS avg_dp
+    FROM raw_data WHERE qc_tool = 'verifybamid'
+Compacting (and expanding back) rewrites the whole table in one transaction that blocks writes (reads carry on).
+See benchmarks/compact.py for the size and scan time difference.
+"""
+
+COMPACT_TABLES = ["raw_data_compact", "raw_data_key"]
+
+# Functions and trigger shared by the compact table and its view. Numbers are only compacted when the double
+# converts back to the same JSON number.
+FUNCTIONS = """
+CREATE FUNCTION raw_data_compact_number(value jsonb) RETURNS boolean LANGUAGE sql IMMUTABLE AS $$
+    SELECT jsonb_typeof(value) = 'number' AND to_jsonb((value #>> '{}')::float8) = value
+$$;
+
+-- A metric's value as text (as metrics ->> metric), inlined by the planner.
+CREATE FUNCTION raw_data_metric(keys text[], metric_values float8[], extra jsonb, metric text) RETURNS text
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT COALESCE(CAST(metric_values[array_position(keys, metric)] AS text), extra ->> metric)
+$$;
+
+CREATE FUNCTION raw_data_compact_metrics(keys text[], metrics jsonb, OUT metric_values float8[], OUT extra jsonb)
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT ARRAY(SELECT CASE WHEN raw_data_compact_number(metrics -> k.key) THEN (metrics ->> k.key)::float8 END
+                 FROM unnest(keys) WITH ORDINALITY AS k(key, position) ORDER BY k.position),
+           (SELECT jsonb_object_agg(m.key, m.value) FROM jsonb_each(metrics) AS m
+            WHERE NOT (m.key = ANY(keys) AND raw_data_compact_number(m.value)))
+$$;
+
+-- The tool's metric names, after appending the document's new numeric ones. New names are added under the tool's
+-- raw_data_key row lock (held until commit), so concurrent saves agree on their positions.
+CREATE FUNCTION raw_data_key_metrics(tool text, metrics jsonb) RETURNS text[] LANGUAGE plpgsql AS $$
+DECLARE
+    keys text[];
+    missing text[];
+BEGIN
+    SELECT k.metrics INTO keys FROM raw_data_key k WHERE k.qc_tool = tool;
+    missing := ARRAY(SELECT m.key FROM jsonb_each(metrics) AS m
+                     WHERE raw_data_compact_number(m.value) AND NOT m.key = ANY(COALESCE(keys, '{}')) ORDER BY m.key);
+    IF keys IS NOT NULL AND cardinality(missing) = 0 THEN
+        RETURN keys;
+    END IF;
+    INSERT INTO raw_data_key (qc_tool, metrics) VALUES (tool, '{}') ON CONFLICT DO NOTHING;
+    SELECT k.metrics INTO keys FROM raw_data_key k WHERE k.qc_tool = tool FOR UPDATE;
+    missing := ARRAY(SELECT m.key FROM jsonb_each(metrics) AS m
+                     WHERE raw_data_compact_number(m.value) AND NOT m.key = ANY(keys) ORDER BY m.key);
+    IF cardinality(missing) > 0 THEN
+        keys := keys || missing;
+        UPDATE raw_data_key SET metrics = keys WHERE qc_tool = tool;
+    END IF;
+    RETURN keys;
+END
+$$;
+
+CREATE FUNCTION raw_data_view_write() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        DELETE FROM raw_data_compact WHERE id = OLD.id;
+        RETURN OLD;
+    END IF;
+    NEW.id := COALESCE(NEW.id, nextval('{sequence}'));
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO raw_data_compact (id, sample_id, qc_tool, metric_values, extra)
+        SELECT NEW.id, NEW.sample_id, NEW.qc_tool, c.metric_values, c.extra
+        FROM raw_data_compact_metrics(raw_data_key_metrics(NEW.qc_tool, NEW.metrics), NEW.metrics) AS c;
+    ELSE
+        UPDATE raw_data_compact AS r
+        SET id = NEW.id, sample_id = NEW.sample_id, qc_tool = NEW.qc_tool, metric_values = c.metric_values, extra = c.extra
+        FROM raw_data_compact_metrics(raw_data_key_metrics(NEW.qc_tool, NEW.metrics), NEW.metrics) AS c
+        WHERE r.id = OLD.id;
+    END IF;
+    RETURN NEW;
+END
+$$;
+"""
+
+DROP_FUNCTIONS = """
+DROP FUNCTION IF EXISTS raw_data_view_write() CASCADE;
+DROP FUNCTION IF EXISTS raw_data_key_metrics(text, jsonb);
+DROP FUNCTION IF EXISTS raw_data_compact_metrics(text[], jsonb);
+DROP FUNCTION IF EXISTS raw_data_compact_number(jsonb);
+DROP FUNCTION IF EXISTS raw_data_metric(text[], float8[], jsonb, text);
+"""
+
+# raw_data rows rebuilt from the compact table (expanding back to a table).
+EXPANDED_ROWS = """
+SELECT r.id, r.sample_id, r.qc_tool,
+    COALESCE((SELECT jsonb_object_agg(m.key, m.value) FROM unnest(k.metrics, r.metric_values) AS m(key, value)
+              WHERE m.value IS NOT NULL), '{}'::jsonb) || COALESCE(r.extra, '{}'::jsonb) AS metrics
+FROM raw_data_compact r LEFT JOIN raw_data_key k ON k.qc_tool = r.qc_tool
+"""
+
+# The raw_data view, its metrics are only rebuilt when selected.
+VIEW_ROWS = EXPANDED_ROWS.replace("AS metrics\n", "AS metrics,\n    k.metrics AS metric_keys, r.metric_values, r.extra\n")
+
+def is_compact(connection):
+    return connection.execute(text("SELECT to_regclass('raw_data_compact') IS NOT NULL")).scalar()
+
+# The sequence numbering raw_data ids, owned by whichever table holds the rows.
+def id_sequence(connection):
+    table = "raw_data_compact" if is_compact(connection) else "raw_data"
+    return connection.execute(text("SELECT pg_get_serial_sequence(:table, 'id')"), table=table).scalar()
+
+# Returns {table: bytes} of raw_data's storage (including TOAST and indexes) in its current format.
+def storage_sizes(connection):
+    tables = COMPACT_TABLES if is_compact(connection) else ["raw_data"]
+    return {table: connection.execute(text("SELECT pg_total_relation_size(CAST(:table AS regclass))"), table=table).scalar()
+            for table in tables}
+
+# Converts raw_data to the compact format, in the connection's transaction.
+def compact(connection):
+    if is_compact(connection):
+        raise Exception("raw_data is already compact.")
+    connection.execute("LOCK TABLE raw_data IN SHARE MODE")
+    sequence = id_sequence(connection)
+    connection.execute(text(FUNCTIONS.replace("{sequence}", sequence)))
+    connection.execute("CREATE TABLE raw_data_key (qc_tool varchar(50) PRIMARY KEY, metrics text[] NOT NULL)")
+    connection.execute("""
+        INSERT INTO raw_data_key (qc_tool, metrics)
+        SELECT r.qc_tool, COALESCE(array_agg(DISTINCT m.key ORDER BY m.key) FILTER (WHERE raw_data_compact_number(m.value)), '{}')
+        FROM raw_data r LEFT JOIN LATERAL jsonb_each(r.metrics) AS m ON true GROUP BY r.qc_tool""")
+    connection.execute(f"""
+        CREATE TABLE raw_data_compact (
+            id integer PRIMARY KEY DEFAULT nextval('{sequence}'),
+            sample_id integer NOT NULL REFERENCES sample (id) ON DELETE CASCADE,
+            qc_tool varchar(50) NOT NULL,
+            metric_values float8[] NOT NULL,
+            extra jsonb)""")
+    connection.execute("""
+        INSERT INTO raw_data_compact (id, sample_id, qc_tool, metric_values, extra)
+        SELECT r.id, r.sample_id, r.qc_tool, c.metric_values, c.extra
+        FROM raw_data r JOIN raw_data_key k ON k.qc_tool = r.qc_tool,
+            LATERAL raw_data_compact_metrics(k.metrics, r.metrics) AS c""")
+    connection.execute(f"ALTER SEQUENCE {sequence} OWNED BY raw_data_compact.id")
+    connection.execute("DROP TABLE raw_data")
+    connection.execute("CREATE INDEX ix_raw_data_compact_sample_id ON raw_data_compact (sample_id)")
+    connection.execute(text(f"CREATE VIEW raw_data AS {VIEW_ROWS}"))
+    connection.execute(f"ALTER VIEW raw_data ALTER COLUMN id SET DEFAULT nextval('{sequence}')")
+    connection.execute("CREATE TRIGGER raw_data_write INSTEAD OF INSERT OR UPDATE OR DELETE ON raw_data "
+                       "FOR EACH ROW EXECUTE FUNCTION raw_data_view_write()")
+    connection.execute("ANALYZE raw_data_key")
+    connection.execute("ANALYZE raw_data_compact")
+
+# Converts compact raw_data back to a table of JSONB documents (as in database/models.py), in the connection's transaction.
+def expand(connection):
+    if not is_compact(connection):
+        raise Exception("raw_data is not compact.")
+    connection.execute("LOCK TABLE raw_data_compact IN SHARE MODE")
+    sequence = id_sequence(connection)
+    connection.execute("DROP VIEW raw_data")
+    connection.execute(f"""
+        CREATE TABLE raw_data (
+            id integer NOT NULL DEFAULT nextval('{sequence}'),
+            sample_id integer NOT NULL,
+            qc_tool varchar(50) NOT NULL,
+            metrics jsonb NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY (sample_id) REFERENCES sample (id) ON DELETE CASCADE)""")
+    connection.execute(text(f"INSERT INTO raw_data (id, sample_id, qc_tool, metrics) {EXPANDED_ROWS}"))
+    connection.execute(f"ALTER SEQUENCE {sequence} OWNED BY raw_data.id")
+    connection.execute("DROP TABLE raw_data_compact")
+    connection.execute("DROP TABLE raw_data_key")
+    connection.execute(DROP_FUNCTIONS)
+    connection.execute("CREATE INDEX ix_raw_data_sample_id ON raw_data (sample_id)")
+    connection.execute("ANALYZE raw_data")
+
+# Drops the compact storage (rows included), e.g. before the tables are recreated.
+def drop_compact(connection):
+    if is_compact(connection):
+        connection.execute("DROP VIEW raw_data")
+        connection.execute("DROP TABLE raw_data_compact")
+        connection.execute("DROP TABLE raw_data_key")
+        connection.execute(DROP_FUNCTIONS)
@@ -1,3 +1,33 @@
 ### config.py ###
 
-DATABASE_URI = "postgres+psycopg2://USERNAME:PASSWORD@IP_ADDRESS:0/DATABASE_NAME"
\ No newline at end of file
+DATABASE_URI = "postgres+psycopg2://USERNAME:PASSWORD@IP_ADDRESS:0/DATABASE_NAME"
+
+# Optional read replica. Read-only commands (query, sql, check_db, distribution) connect to it, writes
+# (save, remove ...) always go to DATABASE_URI. None sends everything to DATABASE_URI.
+REPLICA_URI = None
+
+# Optional sharding by cohort: more databases (shards) by name, and the shard each cohort is stored in, e.g.
+# SHARDS = {"shard1": "postgres+psycopg2://USERNAME:PASSWORD@IP_ADDRESS:0/DATABASE_NAME"} and COHORT_SHARDS = {"MGRB": "shard1"}.
+# Cohorts not in COHORT_SHARDS are stored in DATABASE_URI. query, sql --federated and --overview read every shard.
+SHARDS = {}
+COHORT_SHARDS = {}
+
+# Connection profile of each role's engine (see database/crud.py for the defaults of missing keys).
+PROFILES = {
+    "primary": {
+        "pool_size": 5,
+        "max_overflow": 10,
+        "pool_timeout": 30, # seconds to wait for a free pooled connection
+        "statement_timeout_ms": 0, # 0 is no limit
+        "application_name": "falcon_multiqc",
+        "executemany_mode": "values", # batch INSERTs with psycopg2's execute_values
+    },
+    "replica": {
+        "pool_size": 5,
+        "max_overflow": 10,
+        "pool_timeout": 30,
+        "statement_timeout_ms": 0,
+        "application_name": "falcon_multiqc (read only)",
+        "executemany_mode": "values",
+    },
+}
@@ -1,21 +1,103 @@
+import os
 from sqlalchemy import create_engine, MetaData
 from sqlalchemy.orm import sessionmaker
 from contextlib import contextmanager
-from .config import DATABASE_URI
+from . import config
 from .models import Base
+from .compact import drop_compact
 
-engine = create_engine(DATABASE_URI)
+"""
+Engines and sessions for the two connection roles:
+    PRIMARY -- writes (save, remove, ...) and everything by default.
+    REPLICA -- read-only commands (query, sql, check_db, distribution), using config.REPLICA_URI when set.
 
-# Global Session object factory.
-# Create new sessions using Session(), which is done for you in session_scope() below.
-Session = sessionmaker(bind=engine)
+Each role's engine uses its connection profile in config.PROFILES (pool size / overflow / timeout,
+statement_timeout, application_name and the psycopg2 executemany mode).
+$FALCON_MULTIQC_DATABASE_URI and $FALCON_MULTIQC_REPLICA_URI override the URIs in config.py.
+
+Cohorts can be split across databases (shards, config.SHARDS), each cohort stored in the shard config.COHORT_SHARDS
+maps it to, and cohorts not mapped in DATABASE_URI (the default shard). Every shard has the full falcon_multiqc
+schema. Engines and sessions take the shard to connect to (default: DATABASE_URI), see database/federation.py
+for reading every shard at once. A shard's replica role connects to the shard's own URI.
+"""
+
+PRIMARY = "primary"
+REPLICA = "replica"
+
+DEFAULT_SHARD = "default"
+
+# Used for keys missing from config.PROFILES (e.g. a config.py written by an older falcon_multiqc).
+DEFAULT_PROFILE = {
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_timeout": 30,
+    "statement_timeout_ms": 0,
+    "application_name": "falcon_multiqc",
+    "executemany_mode": "values",
+}
+
+# Engines are created on first use (see get_engine), not at import time,
+# so commands which never touch the database don't pay for creating them.
+engines = {} # (role, shard) : engine
+
+# Global Session object factories, one per role.
+# Create new sessions using session_scope() below, which binds them with get_engine() (of the session's shard).
+Session = sessionmaker()
+ReplicaSession = sessionmaker()
+
+# The shards' names, the default shard (DATABASE_URI) first.
+def shard_names():
+    return [DEFAULT_SHARD] + list(getattr(config, "SHARDS", {}))
+
+def is_sharded():
+    return len(shard_names()) > 1
+
+# The shard the cohort is stored in.
+def cohort_shard(cohort_id):
+    shard = getattr(config, "COHORT_SHARDS", {}).get(cohort_id, DEFAULT_SHARD)
+    if shard not in shard_names():
+        raise Exception(f"Cohort {cohort_id} is mapped to the shard {shard}, which isn't in SHARDS in database/config.py.")
+    return shard
+
+def database_uri(role=PRIMARY, shard=DEFAULT_SHARD):
+    if shard != DEFAULT_SHARD:
+        if shard not in shard_names():
+            raise Exception(f"Unknown shard {shard}, the shards are {', '.join(shard_names())} (see SHARDS in database/config.py).")
+        return config.SHARDS[shard]
+    if role == REPLICA:
+        replica_uri = os.environ.get("FALCON_MULTIQC_REPLICA_URI") or getattr(config, "REPLICA_URI", None)
+        if replica_uri:
+            return replica_uri
+    return os.environ.get("FALCON_MULTIQC_DATABASE_URI") or config.DATABASE_URI
+
+def profile(role=PRIMARY):
+    return dict(DEFAULT_PROFILE, **getattr(config, "PROFILES", {}).get(role, {}))
+
+# Returns the role's engine of the shard, creating it (and binding the default shard's Session factory) the first time.
+# Without a replica, the replica role gets its own engine (and profile) on the primary database.
+def get_engine(role=PRIMARY, shard=DEFAULT_SHARD):
+    if (role, shard) not in engines:
+        settings = profile(role)
+        options = f"-c statement_timeout={int(settings['statement_timeout_ms'])}"
+        engines[(role, shard)] = create_engine(
+            database_uri(role, shard),
+            pool_size=settings["pool_size"],
+            max_overflow=settings["max_overflow"],
+            pool_timeout=settings["pool_timeout"],
+            pool_pre_ping=role == REPLICA, # replicas are more likely to be restarted / failed over
+            executemany_mode=settings["executemany_mode"],
+            connect_args={"application_name": settings["application_name"], "options": options})
+        if shard == DEFAULT_SHARD:
+            (ReplicaSession if role == REPLICA else Session).configure(bind=engines[(role, shard)])
+    return engines[(role, shard)]
 
 # Import session_scope to use the database.
-# Doing so will run the above engine binding and create the global Session.
-# Use it by "with session_scope() as session:"
+# Use it by "with session_scope() as session:", or "with session_scope(REPLICA) as session:" for read-only work.
+# With shards, pass the shard to use, e.g. session_scope(shard=cohort_shard(cohort_id)).
 @contextmanager
-def session_scope():
-    session = Session()
+def session_scope(role=PRIMARY, shard=DEFAULT_SHARD):
+    engine = get_engine(role, shard)
+    session = (ReplicaSession if role == REPLICA else Session)(bind=engine)
     try:
         yield session
         session.commit()
@@ -25,11 +107,15 @@ def session_scope():
     finally:
         session.close()
 
-# Create a new database
+# Create a new database (the tables of every shard).
 def create_database():
-    Base.metadata.create_all(engine)
+    for shard in shard_names():
+        Base.metadata.create_all(get_engine(shard=shard))
 
-# Recreate the database tables.
+# Recreate the database tables (of every shard).
 def recreate_database():
-    Base.metadata.drop_all(engine)
+    for shard in shard_names():
+        with get_engine(shard=shard).begin() as connection:
+            drop_compact(connection)
+        Base.metadata.drop_all(get_engine(shard=shard))
     create_database()
@@ -0,0 +1,97 @@
+from sqlalchemy import text
+from . import crud
+from .ingest import lock_cohort
+from .baselines import unmerge_batch
+from .compact import is_compact
+from .models import Batch, Cohort
+
+"""
+Chunked deletion of batches and cohorts (see the remove command).
+
+Rather than one DELETE cascading through batch, sample and raw_data in a single long transaction,
+a batch's raw_data rows are deleted, then its sample rows, chunk_size rows per transaction,
+so locks are only held briefly. The batch row (and its metric summaries, through ON DELETE CASCADE)
+goes last, with the cohort's sample_count / batch_count updated and the batch's share of the metric baselines
+taken out of them (see database/baselines.py) in the same transaction.
+
+Every step only deletes what is left, so an interrupted delete is resumed by running it again.
+Each function works on one shard's database (see database/crud.py), the one the batch / cohort is stored in.
+"""
+
+DEFAULT_CHUNK_SIZE = 10000
+
+# Indexes the chunked (and cascading) deletes look rows up by. Databases created before they were added
+# to the models get them with CREATE INDEX CONCURRENTLY, which doesn't block writes.
+DELETE_INDEXES = [("ix_raw_data_sample_id", "raw_data", "sample_id"), ("ix_sample_batch_id", "sample", "batch_id")]
+
+# Rows to delete for each table of a batch, "WHERE" conditions on that table.
+BATCH_ROWS = [
+    ("raw_data", "sample_id IN (SELECT id FROM sample WHERE batch_id = :batch_id)"),
+    ("sample", "batch_id = :batch_id"),
+]
+
+def ensure_delete_indexes(shard=crud.DEFAULT_SHARD):
+    with crud.get_engine(shard=shard).connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for name, table, column in DELETE_INDEXES:
+            if table == "raw_data" and is_compact(connection):
+                # A view, its rows are in raw_data_compact (indexed on sample_id), see database/compact.py.
+                continue
+            connection.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({column})")
+
+# Returns {table: number of rows left to delete} for the batch.
+def batch_row_counts(session, batch_id):
+    return {table: session.execute(text(f"SELECT count(*) FROM {table} WHERE {where}"), {"batch_id": batch_id}).scalar()
+            for table, where in BATCH_ROWS}
+
+# Deletes the table's rows matching where, chunk_size rows per transaction.
+# Calls on_chunk(number deleted) after each chunk and returns the total deleted.
+def delete_in_chunks(table, where, params, chunk_size, on_chunk=None, shard=crud.DEFAULT_SHARD):
+    statement = text(f"DELETE FROM {table} WHERE id IN (SELECT id FROM {table} WHERE {where} LIMIT :chunk_size)")
+    total = 0
+    while True:
+        with crud.session_scope(shard=shard) as session:
+            deleted = session.execute(statement, dict(params, chunk_size=chunk_size)).rowcount
+        if not deleted:
+            return total
+        total += deleted
+        if on_chunk:
+            on_chunk(deleted)
+
+# Deletes the batch's rows of one of the BATCH_ROWS tables, chunk by chunk.
+def delete_batch_rows(batch_id, table, chunk_size=DEFAULT_CHUNK_SIZE, on_chunk=None, shard=crud.DEFAULT_SHARD):
+    return delete_in_chunks(table, dict(BATCH_ROWS)[table], {"batch_id": batch_id}, chunk_size, on_chunk, shard)
+
+# Deletes the batch's rows chunk by chunk, then the batch itself, updating its cohort's counts.
+# on_chunk(table, number deleted) is called after each chunk.
+def delete_batch(batch_id, chunk_size=DEFAULT_CHUNK_SIZE, on_chunk=None, shard=crud.DEFAULT_SHARD):
+    for table, _ in BATCH_ROWS:
+        delete_batch_rows(batch_id, table, chunk_size, on_chunk and (lambda deleted, table=table: on_chunk(table, deleted)), shard)
+    delete_batch_row(batch_id, shard)
+
+# Deletes the batch row (once its rows are gone), updating its cohort's counts and the metric baselines in the same transaction.
+def delete_batch_row(batch_id, shard=crud.DEFAULT_SHARD):
+    with crud.session_scope(shard=shard) as session:
+        batch = session.query(Batch).filter(Batch.id == batch_id).one_or_none()
+        if batch is None:
+            return
+        # Lock the cohort so a concurrent save / remove can't interleave its count updates.
+        lock_cohort(session, batch.cohort_id)
+        cohort = session.query(Cohort).filter(Cohort.id == batch.cohort_id).with_for_update().one()
+        cohort.sample_count = (cohort.sample_count or 0) - (batch.sample_count or 0)
+        cohort.batch_count = (cohort.batch_count or 0) - 1
+        unmerge_batch(session, batch_id)
+        session.query(Batch).filter(Batch.id == batch_id).delete()
+
+# Deletes the cohort row and its remaining rows (e.g. patients), once its batches are deleted (see delete_batch).
+def delete_cohort_row(cohort_id, shard=crud.DEFAULT_SHARD):
+    with crud.session_scope(shard=shard) as session:
+        session.query(Cohort).filter(Cohort.id == cohort_id).delete()
+
+# Reclaims the deleted rows' space for reuse and refreshes the planner statistics.
+# VACUUM can't run inside a transaction, so this uses an autocommit connection.
+def vacuum_analyze(tables=("raw_data", "sample", "batch", "metric_summary", "cohort"), shard=crud.DEFAULT_SHARD):
+    with crud.get_engine(shard=shard).connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for table in tables:
+            if table == "raw_data" and is_compact(connection):
+                table = "raw_data_compact"
+            connection.execute(f"VACUUM (ANALYZE) {table}")
@@ -0,0 +1,87 @@
+from concurrent.futures import ThreadPoolExecutor
+from . import crud, stats
+
+"""
+Reading every shard (see database/crud.py) at once, for query, sql --federated and --overview.
+
+fan_out() runs a function against each shard's session in parallel, one thread (and connection) per shard, and
+returns the results in shard order. A cohort is stored in one shard only, so no two shards have rows of the same
+cohort, batch or sample: the shards' rows together are the whole result of a query with a row per sample / batch /
+cohort, or aggregating per cohort or finer. What does span shards is merged after:
+    merge_aggregates() -- combines rows aggregated over several cohorts (sum, count, min, max).
+    merge_order() -- orders the merged rows, as each shard's ORDER BY only orders its own rows.
+    merge_limit() -- keeps the first rows, as each shard's LIMIT only limits its own rows.
+Ids (sample.id, batch.id ...) are numbered per shard, so rows of different shards may have the same ones.
+"""
+
+AGGREGATES = {
+    "sum": sum,
+    "count": sum, # of the shards' counts
+    "min": min,
+    "max": max,
+}
+
+# Runs function(session, shard) with a session of every shard, in parallel when there are several.
+# Returns the results in shard order. An exception raised for a shard is re-raised naming the shard.
+def fan_out(function, role=crud.REPLICA, shards=None):
+    shards = shards or crud.shard_names()
+    if len(shards) == 1:
+        with crud.session_scope(role, shards[0]) as session:
+            return [function(session, shards[0])]
+
+    command_stats = stats.current()
+
+    def run(shard):
+        stats.use_stats(command_stats)
+        try:
+            with crud.session_scope(role, shard) as session:
+                return function(session, shard)
+        except Exception as e:
+            raise Exception(f"Shard {shard}: {e}") from e
+        finally:
+            stats.use_stats(None)
+
+    with ThreadPoolExecutor(max_workers=len(shards), thread_name_prefix="falcon_multiqc_shard") as executor:
+        return list(executor.map(run, shards))
+
+# Returns the index of the column in the header (the exact name, else ignoring case).
+def column_index(header, name):
+    header = list(header)
+    if name in header:
+        return header.index(name)
+    lower = [column.lower() for column in header]
+    if name.lower() in lower:
+        return lower.index(name.lower())
+    raise Exception(f"No column {name} in the result, the columns are: {', '.join(header)}.")
+
+# Combines rows with the same values in every column but the aggregate ones.
+# aggregates is [(column, function)], the function one of AGGREGATES. Rows keep their first row's position.
+def merge_aggregates(header, rows, aggregates):
+    functions = {column_index(header, column): AGGREGATES[function.lower()] for column, function in aggregates}
+    groups = {}
+    for row in rows:
+        key = tuple(value for i, value in enumerate(row) if i not in functions)
+        groups.setdefault(key, []).append(row)
+    merged = []
+    for group in groups.values():
+        row = list(group[0])
+        for i, function in functions.items():
+            values = [other[i] for other in group if other[i] is not None]
+            row[i] = function(values) if values else None
+        merged.append(tuple(row))
+    return merged
+
+# Sorts the rows by the columns, order_by is [(column, descending)].
+# NULLs sort as in PostgreSQL: last when ascending, first when descending.
+def merge_order(header, rows, order_by):
+    rows = list(rows)
+    # Stable sorts, least significant column first.
+    for column, descending in reversed(order_by):
+        i = column_index(header, column)
+        nulls = [row for row in rows if row[i] is None]
+        ordered = sorted((row for row in rows if row[i] is not None), key=lambda row: row[i], reverse=descending)
+        rows = nulls + ordered if descending else ordered + nulls
+    return rows
+
+def merge_limit(rows, limit):
+    return rows if limit is None else rows[:limit]
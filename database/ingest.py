@@ -0,0 +1,83 @@
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from . import crud
+from .models import Batch, Cohort
+
+"""
+Concurrency safe writes for save, so several pipeline nodes can save into the database (and the same cohort) at once.
+
+- Cohorts are created with INSERT ... ON CONFLICT DO NOTHING, so two saves of a new cohort don't both try to create it.
+- Batches are created with INSERT ... ON CONFLICT DO NOTHING against the unique (cohort_id, batch_name) constraint,
+  a save of a batch that already exists inserts nothing and is reported as a duplicate (a save of a batch another
+  save is in the middle of saving waits for that one to commit first).
+- A cohort's sample_count, batch_count and type list are updated with UPDATE ... SET count = count + n
+  once all of a save's rows are written, under a per cohort advisory lock (also taken by remove when it updates
+  the counts), in cohort id order so saves of several cohorts can't deadlock. Saves of different batches only
+  wait for each other for that last update, not for each other's samples and raw data.
+"""
+
+# Key space of the advisory locks ("FALC"). Cohort locks are (LOCK_NAMESPACE, hashtext(cohort id)) key pairs,
+# a separate space from the single key LOCK_NAMESPACE lock taken while adding the batch constraint.
+LOCK_NAMESPACE = 0x46414C43
+
+# PostgreSQL's (default) name for the models' Batch UniqueConstraint('cohort_id', 'batch_name').
+BATCH_CONSTRAINT = "batch_cohort_id_batch_name_key"
+
+# Adds the unique (cohort_id, batch_name) constraint to batch tables created before it was in the models.
+# The index is built CONCURRENTLY (without blocking saves), under an advisory lock so only one save builds it.
+def ensure_batch_constraint(shard=crud.DEFAULT_SHARD):
+    with crud.get_engine(shard=shard).connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        exists = text("SELECT 1 FROM pg_constraint WHERE conname = :name")
+        if connection.execute(exists, name=BATCH_CONSTRAINT).scalar():
+            return
+        connection.execute(text("SELECT pg_advisory_lock(:key)"), key=LOCK_NAMESPACE)
+        try:
+            if connection.execute(exists, name=BATCH_CONSTRAINT).scalar():
+                return
+            duplicates = connection.execute(text("SELECT cohort_id, batch_name FROM batch GROUP BY cohort_id, batch_name "
+                                                 "HAVING count(*) > 1 ORDER BY cohort_id, batch_name")).fetchall()
+            if duplicates:
+                raise Exception(f"Batches saved more than once: {', '.join(f'{cohort} {batch}' for cohort, batch in duplicates)}."
+                                "\nRemove the duplicates (see the remove command) before saving again.")
+            # A failed earlier build leaves an invalid index behind.
+            connection.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {BATCH_CONSTRAINT}")
+            connection.execute(f"CREATE UNIQUE INDEX CONCURRENTLY {BATCH_CONSTRAINT} ON batch (cohort_id, batch_name)")
+            connection.execute(f"ALTER TABLE batch ADD CONSTRAINT {BATCH_CONSTRAINT} UNIQUE USING INDEX {BATCH_CONSTRAINT}")
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), key=LOCK_NAMESPACE)
+
+# Waits for the cohort's advisory lock, held until the end of the session's transaction.
+def lock_cohort(session, cohort_id):
+    session.execute(text("SELECT pg_advisory_xact_lock(:namespace, hashtext(:cohort_id))"),
+                    {"namespace": LOCK_NAMESPACE, "cohort_id": cohort_id})
+
+# Creates the cohort, unless it already exists.
+def insert_cohort(session, cohort_id, description):
+    session.execute(insert(Cohort.__table__).values(id=cohort_id, description=description, sample_count=0, batch_count=0)
+                    .on_conflict_do_nothing(index_elements=["id"]))
+
+# Creates the batch and returns its id, or None when the cohort already has a batch of that name.
+# Waits for a concurrent save of the same batch to finish first (None if it's committed).
+def insert_batch(session, cohort_id, batch_name, path, description):
+    table = Batch.__table__
+    return session.execute(insert(table).values(cohort_id=cohort_id, batch_name=batch_name, path=path, description=description)
+                           .on_conflict_do_nothing(index_elements=["cohort_id", "batch_name"])
+                           .returning(table.c.id)).scalar()
+
+# Adds the types missing from the comma separated type list.
+def merge_types(type_list, types):
+    merged = type_list.split(",") if type_list else []
+    merged += [type for type in types if type not in merged]
+    return ",".join(merged) or None
+
+# Adds {cohort id: (samples, batches, types)} to the cohorts' counts and type lists, each under its cohort lock.
+def update_cohorts(session, counts):
+    for cohort_id in sorted(counts):
+        samples, batches, types = counts[cohort_id]
+        lock_cohort(session, cohort_id)
+        type_list = session.execute(text("UPDATE cohort SET sample_count = COALESCE(sample_count, 0) + :samples, "
+                                         "batch_count = COALESCE(batch_count, 0) + :batches WHERE id = :cohort_id RETURNING type"),
+                                    {"samples": samples, "batches": batches, "cohort_id": cohort_id}).scalar()
+        merged = merge_types(type_list, types)
+        if merged != type_list:
+            session.execute(text("UPDATE cohort SET type = :type WHERE id = :cohort_id"), {"type": merged, "cohort_id": cohort_id})
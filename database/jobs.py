@@ -0,0 +1,69 @@
+import datetime
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from .models import IngestJob
+
+"""
+The job table of the watch command (ingest_job, see falcon_multiqc/watcher.py): a row per multiqc output directory
+found in a landing area (and per change of its files), with its save's outcome.
+
+- Jobs are queued with INSERT ... ON CONFLICT against the unique (directory, fingerprint), so a directory seen again
+  (after a restart, or by a rescan) is the same job, and is only saved again once its files change.
+- A job is claimed with UPDATE ... WHERE status = 'queued', so only one worker (or watcher) saves it.
+- Jobs are kept in the default shard's database. A save to the default shard marks its job saved in the save's own
+  transaction, so a job is saved exactly when its rows are (see run_job in falcon_multiqc/watcher.py).
+"""
+
+QUEUED = "queued"
+RUNNING = "running"
+SAVED = "saved"
+FAILED = "failed"
+
+# Queues the directory's job. Returns (job id, status): a new job is queued, an existing one keeps its status.
+# Queued jobs of the directory's earlier files are failed, they're replaced by this one.
+def queue_job(session, directory, sample_metadata, fingerprint):
+    table = IngestJob.__table__
+    session.execute(text("UPDATE ingest_job SET status = :failed, finished_at = now(), error = 'Its files changed before it was saved.' "
+                         "WHERE directory = :directory AND fingerprint <> :fingerprint AND status = :queued"),
+                    {"failed": FAILED, "queued": QUEUED, "directory": directory, "fingerprint": fingerprint})
+    statement = insert(table).values(directory=directory, sample_metadata=sample_metadata, fingerprint=fingerprint,
+                                     status=QUEUED, queued_at=datetime.datetime.now())
+    # DO UPDATE (of nothing) rather than DO NOTHING, to return the existing job.
+    statement = statement.on_conflict_do_update(index_elements=["directory", "fingerprint"],
+                                                set_={"directory": statement.excluded.directory})
+    return tuple(session.execute(statement.returning(table.c.id, table.c.status)).first())
+
+# Marks the queued job running. Returns False when it isn't queued (another worker has it).
+def claim_job(session, job_id):
+    return session.execute(text("UPDATE ingest_job SET status = :running, started_at = now() WHERE id = :id AND status = :queued "
+                                "RETURNING id"), {"running": RUNNING, "queued": QUEUED, "id": job_id}).scalar() is not None
+
+def finish_job(session, job_id, status, cohort_id=None, sample_count=None, batch_count=None, error=None):
+    session.execute(text("UPDATE ingest_job SET status = :status, cohort_id = :cohort_id, sample_count = :sample_count, "
+                         "batch_count = :batch_count, error = :error, finished_at = now() WHERE id = :id"),
+                    {"status": status, "cohort_id": cohort_id, "sample_count": sample_count, "batch_count": batch_count,
+                     "error": error, "id": job_id})
+
+# Recovers the jobs of directories under root left running by a watcher that stopped. Without shards their saves were
+# rolled back with them (see above), so they're queued again. With shards it's unknown whether their save finished,
+# so they're failed. With retry_failed, failed jobs are queued again too. Returns (jobs failed, jobs queued).
+def recover_jobs(session, root, sharded=False, retry_failed=False):
+    escaped = root.rstrip("/").replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    values = {"queued": QUEUED, "running": RUNNING, "failed": FAILED, "prefix": escaped + "/%"}
+    failed = 0
+    if sharded:
+        failed = session.execute(text("UPDATE ingest_job SET status = :failed, finished_at = now(), error = "
+                                      "'Interrupted, the watcher stopped during its save.' WHERE directory LIKE :prefix AND status = :running"),
+                                 values).rowcount
+    statuses = [RUNNING] + ([FAILED] if retry_failed else [])
+    queued = session.execute(text("UPDATE ingest_job SET status = :queued, started_at = NULL, error = NULL "
+                                  "WHERE directory LIKE :prefix AND status IN :statuses"),
+                             dict(values, statuses=tuple(statuses))).rowcount
+    return failed, queued
+
+# The last jobs, most recent first.
+def recent_jobs(session, limit=20, status=None):
+    query = session.query(IngestJob)
+    if status:
+        query = query.filter(IngestJob.status == status)
+    return query.order_by(IngestJob.id.desc()).limit(limit).all()
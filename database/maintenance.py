@@ -0,0 +1,118 @@
+from sqlalchemy import text
+from . import crud
+from .models import get_tables
+from .compact import COMPACT_TABLES
+
+"""
+Table and index health of the falcon_multiqc tables (see the maintain command), from PostgreSQL's statistics views,
+and the maintenance they need:
+    VACUUM (ANALYZE) -- tables with many dead rows (space left by updates / deletes, e.g. after remove).
+    ANALYZE -- tables with many rows changed since their planner statistics were gathered (e.g. after save).
+    REINDEX INDEX CONCURRENTLY -- indexes with a low leaf density (bloated). Measured with pgstatindex,
+        so only when the pgstattuple extension is installed (PostgreSQL 12+ for CONCURRENTLY).
+    CREATE INDEX CONCURRENTLY -- with --trigram-indexes, pg_trgm GIN indexes on the description columns, for the
+        query --description-match icontains / similar filters (creating the pg_trgm extension if needed).
+None of these take locks that block reads or writes for long, so maintenance is safe to run while in use.
+"""
+
+DEFAULT_DEAD_RATIO = 0.2 # dead rows / all rows
+DEFAULT_STALE_RATIO = 0.1 # rows changed since the last analyze / live rows
+DEFAULT_MIN_LEAF_DENSITY = 50 # percent
+DEFAULT_LOCK_TIMEOUT = "5s" # give up rather than queue behind (and block) other work
+
+TABLE_STATS = text("""
+    SELECT s.relname AS table, s.relid,
+        pg_relation_size(s.relid) AS table_bytes,
+        pg_indexes_size(s.relid) AS index_bytes,
+        CASE WHEN c.reltoastrelid = 0 THEN 0 ELSE pg_total_relation_size(c.reltoastrelid) END AS toast_bytes,
+        s.n_live_tup AS live_rows, s.n_dead_tup AS dead_rows, s.n_mod_since_analyze AS modified_rows,
+        s.seq_scan, COALESCE(s.idx_scan, 0) AS idx_scan,
+        GREATEST(s.last_vacuum, s.last_autovacuum) AS last_vacuum,
+        GREATEST(s.last_analyze, s.last_autoanalyze) AS last_analyze
+    FROM pg_stat_user_tables s JOIN pg_class c ON c.oid = s.relid
+    WHERE s.schemaname = current_schema() AND s.relname IN :tables
+    ORDER BY s.relname""")
+
+# (index, table, column) of the optional trigram indexes.
+TRIGRAM_INDEXES = [("ix_sample_description_trgm", "sample", "description"), ("ix_batch_description_trgm", "batch", "description"),
+                   ("ix_cohort_description_trgm", "cohort", "description")]
+
+INDEX_STATS = text("""
+    SELECT s.relname AS table, s.indexrelname AS index, s.idx_scan,
+        pg_relation_size(s.indexrelid) AS index_bytes, i.indisunique AS is_unique, i.indisprimary AS is_primary
+    FROM pg_stat_user_indexes s JOIN pg_index i ON i.indexrelid = s.indexrelid
+    WHERE s.schemaname = current_schema() AND s.relname IN :tables
+    ORDER BY s.relname, s.indexrelname""")
+
+def human_bytes(size):
+    for unit in ["B", "kB", "MB", "GB", "TB"]:
+        if abs(size) < 1024 or unit == "TB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+# Autocommit connection to the primary (VACUUM and REINDEX CONCURRENTLY can't run inside a transaction).
+def maintenance_connection(lock_timeout=DEFAULT_LOCK_TIMEOUT):
+    connection = crud.get_engine().connect().execution_options(isolation_level="AUTOCOMMIT")
+    connection.execute(text("SELECT set_config('lock_timeout', :timeout, false)"), timeout=lock_timeout)
+    return connection
+
+def table_stats(connection, tables=None):
+    tables = tuple(tables or get_tables() + COMPACT_TABLES)
+    return [dict(row) for row in connection.execute(TABLE_STATS, tables=tables)]
+
+# Index statistics, with leaf_density (percent) when pgstattuple is installed (None otherwise).
+def index_stats(connection, tables=None):
+    tables = tuple(tables or get_tables() + COMPACT_TABLES)
+    indexes = [dict(row) for row in connection.execute(INDEX_STATS, tables=tables)]
+    has_pgstattuple = has_extension(connection, "pgstattuple")
+    for index in indexes:
+        index["leaf_density"] = None
+        if has_pgstattuple and index["index_bytes"] > 0:
+            index["leaf_density"] = connection.execute(
+                text("SELECT avg_leaf_density FROM pgstatindex(CAST(quote_ident(:index) AS regclass))"), index=index["index"]).scalar()
+    return indexes
+
+def has_extension(connection, name):
+    return bool(connection.execute(text("SELECT 1 FROM pg_extension WHERE extname = :name"), name=name).scalar())
+
+# Returns [(statement, reason)] creating the trigram indexes (and pg_trgm) missing from indexes.
+def plan_trigram_indexes(indexes, has_pg_trgm):
+    existing = {index["index"] for index in indexes}
+    actions = [] if has_pg_trgm else [("CREATE EXTENSION IF NOT EXISTS pg_trgm", "needed by the trigram indexes")]
+    for name, table, column in TRIGRAM_INDEXES:
+        if name not in existing:
+            actions.append((f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{name}" ON "{table}" USING gin ("{column}" gin_trgm_ops)',
+                            f"trigram index for {table} description filters"))
+    return actions
+
+# Indexes never used for a scan since the statistics were reset (primary keys and unique constraints are always kept).
+def unused_indexes(indexes):
+    return [index for index in indexes if index["idx_scan"] == 0 and not index["is_unique"] and not index["is_primary"]]
+
+# Returns [(statement, reason)] of the maintenance the tables / indexes need.
+def plan_maintenance(tables, indexes, dead_ratio=DEFAULT_DEAD_RATIO, stale_ratio=DEFAULT_STALE_RATIO,
+                     min_leaf_density=DEFAULT_MIN_LEAF_DENSITY, can_reindex_concurrently=True):
+    actions = []
+    for table in tables:
+        rows = table["live_rows"] + table["dead_rows"]
+        if table["dead_rows"] and table["dead_rows"] / rows >= dead_ratio:
+            actions.append((f'VACUUM (ANALYZE) "{table["table"]}"', f"{table['dead_rows']} dead rows ({table['dead_rows'] / rows:.0%})"))
+        elif table["modified_rows"] and table["modified_rows"] / max(table["live_rows"], 1) >= stale_ratio:
+            actions.append((f'ANALYZE "{table["table"]}"', f"{table['modified_rows']} rows changed since the last analyze"))
+    if can_reindex_concurrently:
+        for index in indexes:
+            if index["leaf_density"] is not None and index["leaf_density"] < min_leaf_density:
+                actions.append((f'REINDEX INDEX CONCURRENTLY "{index["index"]}"', f"leaf density {index['leaf_density']:.0f}%"))
+    return actions
+
+# Runs the actions, carrying on past failures (e.g. a lock timeout). Returns [(statement, error)] of the failures.
+def run_maintenance(connection, actions, on_action=None):
+    failed = []
+    for statement, reason in actions:
+        if on_action:
+            on_action(statement, reason)
+        try:
+            connection.execute(statement)
+        except Exception as e:
+            failed.append((statement, str(e).splitlines()[0]))
+    return failed
@@ -0,0 +1,239 @@
+import io
+import os
+import json
+import glob
+import uuid
+import hashlib
+import datetime
+from contextlib import ExitStack
+from . import crud
+from .compact import is_compact
+from .snapshot import batch_fingerprints, quote, sql_string
+
+"""
+Local cache of (samples x metrics) matrices (see the matrix command and Client.matrix in falcon_multiqc/api.py), for
+analyses (correlation, PCA, outlier scans ...) that use the same metrics over and over, without fetching them from
+raw_data and parsing them again each time.
+
+A matrix is a chosen list of (qc_tool, metric) as float32 / float64 columns, a row per sample of the database
+(every shard's), NaN where a sample has no numeric value. Layout of its directory (named by a hash of the databases'
+URIs, the metrics and the dtype, in matrix_dir()):
+    values-<generation>.npy -- the matrix, C order (a sample's metrics are contiguous).
+    sample_id-<generation>.npy, shard-<generation>.npy -- each row's sample id, and its shard (index in the manifest's).
+    manifest.json -- the metrics, the current generation and each batch's fingerprint and rows.
+The .npy files are memory-mapped read only, so opening a matrix doesn't read it, and processes using the same matrix
+share its pages in the page cache.
+
+Like the snapshot's (see database/snapshot.py), a batch's rows only change with its samples: a batch saved or removed
+since the matrix was written has a new / no fingerprint (sample count and sample id range). Refreshing extracts those
+batches only, copies the unchanged batches' rows from the previous generation and writes a new generation. The manifest
+is replaced last, so readers see the old or the new matrix whole. Files of the old generation are deleted (processes
+that mapped them keep reading them until they close them).
+
+A batch is extracted with one COPY ... TO STDOUT (FORMAT binary) of its samples, a column per metric (each tool's
+metrics read from its rows in one pass, see query's tool_table), with every value a non null float8 so the rows have a
+fixed size and are converted to floats by numpy without going through Python objects. A sample with several rows of a
+tool (e.g. lanes) gets the largest value, like query's tool-metric columns.
+"""
+
+MANIFEST = "manifest.json"
+DTYPES = ["float32", "float64"]
+
+def matrix_dir():
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.environ.get("FALCON_MULTIQC_MATRIX") or os.path.join(cache_dir, "falcon_multiqc", "matrix")
+
+# The directory of the matrix of these [(qc_tool, metric)] and dtype, for the configured databases.
+def matrix_path(tool_metrics, dtype="float32", directory=None):
+    databases = [crud.database_uri(crud.REPLICA, shard) for shard in crud.shard_names()]
+    key = json.dumps([databases, [list(tool_metric) for tool_metric in tool_metrics], dtype])
+    return os.path.join(directory or matrix_dir(), hashlib.sha1(key.encode()).hexdigest()[:16])
+
+def read_manifest(path):
+    try:
+        with open(os.path.join(path, MANIFEST)) as manifest:
+            return json.load(manifest)
+    except (OSError, ValueError):
+        return {"batches": {}}
+
+def array_path(path, name, generation):
+    return os.path.join(path, f"{name}-{generation}.npy")
+
+# A metric's value as float8 (NULL when missing or not a number), of the raw_data row r and its record rec.
+def metric_value(metric, compact):
+    if compact:
+        return f"r.metric_values[array_position(r.metric_keys, {sql_string(metric)})]"
+    value = f"rec.{quote(metric)}" if len(metric.encode()) < 64 else f"r.metrics -> {sql_string(metric)}"
+    return f"CASE WHEN jsonb_typeof({value}) = 'number' THEN CAST({value} AS float8) END"
+
+# The COPY of a batch's samples (ordered by id): sample id then a float8 per metric, NaN when missing.
+def batch_copy(batch_id, tool_metrics, compact):
+    tools = {}
+    for i, (qc_tool, metric) in enumerate(tool_metrics):
+        tools.setdefault(qc_tool, []).append((i, metric))
+    joins = []
+    columns = {}
+    for t, (qc_tool, metrics) in enumerate(tools.items()):
+        record_names = sorted({metric for _, metric in metrics if len(metric.encode()) < 64})
+        record = "" if compact or not record_names else \
+            f", jsonb_to_record(r.metrics) AS rec({', '.join(f'{quote(metric)} jsonb' for metric in record_names)})"
+        values = ", ".join(f"max({metric_value(metric, compact)}) AS c{i}" for i, metric in metrics)
+        joins.append(f"LEFT JOIN (SELECT r.sample_id, {values} FROM raw_data r JOIN sample rs ON rs.id = r.sample_id{record} "
+                     f"WHERE rs.batch_id = {int(batch_id)} AND r.qc_tool = {sql_string(qc_tool)} GROUP BY r.sample_id) t{t} "
+                     f"ON t{t}.sample_id = s.id")
+        for i, _ in metrics:
+            columns[i] = f"COALESCE(t{t}.c{i}, 'NaN')"
+    columns = ["CAST(s.id AS int8)"] + [columns[i] for i in range(len(tool_metrics))]
+    return (f"COPY (SELECT {', '.join(columns)} FROM sample s {' '.join(joins)} WHERE s.batch_id = {int(batch_id)} "
+            f"ORDER BY s.id) TO STDOUT WITH (FORMAT binary)")
+
+# Returns (sample ids, values (rows x metrics, float8)) of the binary COPY of batch_copy.
+def parse_copy(data, metric_count):
+    import numpy as np
+    # Each row: field count (int16), then for each field its length (int32) and value (8 bytes), all big endian.
+    row_size = 2 + 12 * (1 + metric_count)
+    body = memoryview(data)[19:len(data) - 2] # after the header, before the trailer
+    rows = np.frombuffer(body, dtype=np.dtype({
+        "names": ["sample_id"] + [f"v{i}" for i in range(metric_count)],
+        "formats": [">i8"] + [">f8"] * metric_count,
+        "offsets": [6] + [18 + 12 * i for i in range(metric_count)],
+        "itemsize": row_size,
+    }))
+    from numpy.lib.recfunctions import structured_to_unstructured
+    values = structured_to_unstructured(rows[[f"v{i}" for i in range(metric_count)]], dtype=np.float64) if metric_count \
+        else np.empty((len(rows), 0))
+    return rows["sample_id"].astype(np.int64), values
+
+# Returns (sample ids, values) of the batch's samples.
+def extract_batch(session, batch_id, tool_metrics):
+    data = io.BytesIO()
+    cursor = session.connection().connection.cursor()
+    cursor.copy_expert(batch_copy(batch_id, tool_metrics, is_compact(session)), data)
+    return parse_copy(data.getbuffer(), len(tool_metrics))
+
+
+class MetricMatrix:
+    """A cached (samples x metrics) matrix (see open_matrix), memory-mapped read only.
+    values[row, column] is the metric columns[column] of the sample sample_ids[row] (of the shard shards[sample_shards[row]])."""
+
+    def __init__(self, path):
+        import numpy as np
+        manifest = read_manifest(path)
+        if "generation" not in manifest:
+            raise Exception(f"There is no metric matrix in {path}, create it with: falcon_multiqc matrix")
+        self.path = path
+        self.metrics = [tuple(tool_metric) for tool_metric in manifest["metrics"]]
+        self.columns = [f"{qc_tool}.{metric}" for qc_tool, metric in self.metrics]
+        self.shards = manifest["shards"]
+        # numpy can't map an empty file.
+        mmap_mode = "r" if manifest["rows"] else None
+        self.values = np.load(array_path(path, "values", manifest["generation"]), mmap_mode=mmap_mode)
+        self.sample_ids = np.load(array_path(path, "sample_id", manifest["generation"]), mmap_mode=mmap_mode)
+        self.sample_shards = np.load(array_path(path, "shard", manifest["generation"]), mmap_mode=mmap_mode)
+        self.refreshed = None # (batches extracted, removed, unchanged) of the refresh that opened it
+        self._order = {}
+
+    def __len__(self):
+        return len(self.sample_ids)
+
+    # Returns the rows of these sample ids of the shard (-1 for samples not in the matrix).
+    def rows(self, sample_ids, shard=crud.DEFAULT_SHARD):
+        import numpy as np
+        if shard not in self._order:
+            # The shard's rows and their sample ids, sorted by sample id (built once).
+            shard_rows = np.flatnonzero(self.sample_shards == self.shards.index(shard)) if shard in self.shards \
+                else np.array([], dtype=np.int64)
+            shard_rows = shard_rows[np.argsort(self.sample_ids[shard_rows], kind="stable")]
+            self._order[shard] = (shard_rows, np.asarray(self.sample_ids[shard_rows]))
+        shard_rows, ids = self._order[shard]
+        sample_ids = np.asarray(sample_ids, dtype=np.int64)
+        if not len(ids):
+            return np.full(len(sample_ids), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(ids, sample_ids), len(ids) - 1)
+        return np.where(ids[positions] == sample_ids, shard_rows[positions], -1)
+
+
+# Brings the matrix in path up to date with the databases: extracts the batches saved since it was written and drops
+# the removed ones. on_batch(action, shard, batch_id) is called for each batch extracted ("write") or dropped
+# ("delete"). Returns (batches extracted, removed, unchanged).
+def refresh_matrix(path, tool_metrics, dtype="float32", on_batch=None):
+    import numpy as np
+    if dtype not in DTYPES:
+        raise Exception(f"Unknown dtype {dtype}, use one of {', '.join(DTYPES)}.")
+    tool_metrics = [tuple(tool_metric) for tool_metric in tool_metrics]
+    os.makedirs(path, exist_ok=True)
+    manifest = read_manifest(path)
+    previous = manifest["batches"] if manifest.get("metrics") == [list(tm) for tm in tool_metrics] else {}
+    shards = crud.shard_names()
+
+    with ExitStack() as stack:
+        # One consistent view of each shard's database for the whole refresh.
+        sessions = {}
+        batches = {} # "<shard>:<batch id>" : fingerprint, in row order
+        for shard in shards:
+            sessions[shard] = stack.enter_context(crud.session_scope(crud.REPLICA, shard))
+            sessions[shard].connection(execution_options={"isolation_level": "REPEATABLE READ"})
+            for batch_id, fingerprint in sorted(batch_fingerprints(sessions[shard]).items(), key=lambda item: int(item[0])):
+                batches[f"{shard}:{batch_id}"] = fingerprint
+        unchanged = [key for key, fingerprint in batches.items() if previous.get(key, {}).get("fingerprint") == fingerprint]
+        removed = [key for key in previous if key not in batches]
+        if "generation" in manifest and len(unchanged) == len(batches) and not removed:
+            return 0, 0, len(batches)
+
+        old = MetricMatrix(path) if previous and "generation" in manifest else None
+        generation = uuid.uuid4().hex[:12]
+        row_count = sum(fingerprint[0] for fingerprint in batches.values())
+        values = np.lib.format.open_memmap(array_path(path, "values", generation), mode="w+", dtype=dtype,
+                                           shape=(row_count, len(tool_metrics)))
+        sample_ids = np.lib.format.open_memmap(array_path(path, "sample_id", generation), mode="w+", dtype=np.int64, shape=(row_count,))
+        sample_shards = np.lib.format.open_memmap(array_path(path, "shard", generation), mode="w+", dtype=np.int16, shape=(row_count,))
+        rows = {}
+        start = 0
+        for key, fingerprint in batches.items():
+            shard, batch_id = key.rsplit(":", 1)
+            stop = start + fingerprint[0]
+            if key in unchanged:
+                old_start, old_stop = previous[key]["rows"]
+                values[start:stop] = old.values[old_start:old_stop]
+                sample_ids[start:stop] = old.sample_ids[old_start:old_stop]
+            else:
+                batch_sample_ids, batch_values = extract_batch(sessions[shard], batch_id, tool_metrics)
+                values[start:stop] = batch_values
+                sample_ids[start:stop] = batch_sample_ids
+                if on_batch:
+                    on_batch("write", shard, batch_id)
+            sample_shards[start:stop] = shards.index(shard)
+            rows[key] = {"fingerprint": fingerprint, "rows": [start, stop]}
+            start = stop
+        for array in (values, sample_ids, sample_shards):
+            array.flush()
+        del values, sample_ids, sample_shards, old
+
+    if on_batch:
+        for key in removed:
+            on_batch("delete", *key.rsplit(":", 1))
+    manifest = {
+        "written_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "metrics": [list(tool_metric) for tool_metric in tool_metrics],
+        "dtype": dtype,
+        "shards": shards,
+        "rows": row_count,
+        "generation": generation,
+        "batches": rows,
+    }
+    with open(os.path.join(path, MANIFEST + ".tmp"), "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(os.path.join(path, MANIFEST + ".tmp"), os.path.join(path, MANIFEST))
+    for old_path in glob.glob(os.path.join(path, "*.npy")):
+        if not old_path.endswith(f"-{generation}.npy"):
+            os.remove(old_path)
+    return len(batches) - len(unchanged), len(removed), len(unchanged)
+
+# Returns the matrix of these [(qc_tool, metric)] (see MetricMatrix), brought up to date first (see refresh_matrix)
+# unless refresh is False, which opens the cached matrix without connecting to the database.
+def open_matrix(tool_metrics, dtype="float32", directory=None, refresh=True, on_batch=None):
+    path = matrix_path(tool_metrics, dtype, directory)
+    counts = refresh_matrix(path, tool_metrics, dtype, on_batch) if refresh else None
+    matrix = MetricMatrix(path)
+    matrix.refreshed = counts
+    return matrix
@@ -1,5 +1,5 @@
-from sqlalchemy import Column, Integer, String, Date, ForeignKey, Table, Text
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy import Column, Integer, String, Date, DateTime, ForeignKey, Table, Text, Float, UniqueConstraint, Index
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, backref
 
@@ -19,12 +19,12 @@ class Sample(Base):
     id = Column(Integer, primary_key=True, nullable=False)
 
     patient_id = Column(Integer, ForeignKey("patient.id", ondelete="CASCADE"), nullable=True)
-    batch_id = Column(Integer, ForeignKey("batch.id", ondelete="CASCADE"), nullable=False)
+    batch_id = Column(Integer, ForeignKey("batch.id", ondelete="CASCADE"), nullable=False, index=True)
     cohort_id = Column(String, ForeignKey("cohort.id", ondelete="CASCADE"), nullable=False)
     # Non-unique sample ID/name given in input.
-    sample_name = Column(String, nullable=False)
+    sample_name = Column(String, nullable=False, index=True)
     flowcell_lane = Column(String, nullable=False)
-    library_id = Column(String, nullable=False)
+    library_id = Column(String, nullable=False, index=True)
     platform = Column(String, nullable=False)
     centre = Column(String, nullable=False)
     reference_genome = Column(String, nullable=False)
@@ -46,7 +46,7 @@ class RawData(Base):
 
     id = Column(Integer, primary_key=True, nullable=False)
 
-    sample_id = Column(Integer, ForeignKey('sample.id', ondelete="CASCADE"), nullable=False)
+    sample_id = Column(Integer, ForeignKey('sample.id', ondelete="CASCADE"), nullable=False, index=True)
     qc_tool = Column(String(50), nullable=False)
     metrics = Column(JSONB, nullable=False)
 
@@ -92,6 +92,9 @@ class Batch(Base):
     sample_count = Column(Integer)
     description = Column(Text)
 
+    # Concurrent saves of the same batch conflict here (see database/ingest.py).
+    __table_args__ = (UniqueConstraint('cohort_id', 'batch_name'),)
+
     # Batch-Patients many to many
     patients = relationship("Patient", secondary=PatientBatch, backref=backref("batch", cascade = "all, delete"))
     # Sample-Batch many to 1
@@ -121,6 +124,161 @@ class Cohort(Base):
         return "<Cohort(id='{}', description='{}'>" \
             .format(self.id, self.description)
 
+class MetricSummary(Base):
+    __tablename__ = 'metric_summary'
+
+    id = Column(Integer, primary_key=True, nullable=False)
+
+    batch_id = Column(Integer, ForeignKey('batch.id', ondelete="CASCADE"), nullable=False, index=True)
+    qc_tool = Column(String(50), nullable=False)
+    metric = Column(String, nullable=False)
+
+    # Moment summary (merge with database.sketch.merge_moments).
+    count = Column(Integer, nullable=False)
+    mean = Column(Float, nullable=False)
+    m2 = Column(Float, nullable=False)
+    min = Column(Float, nullable=False)
+    max = Column(Float, nullable=False)
+    # t-digest centroids [[mean, weight], ...] (see database.sketch.TDigest).
+    sketch = Column(JSONB, nullable=False)
+
+    __table_args__ = (UniqueConstraint('batch_id', 'qc_tool', 'metric'),)
+
+    def __repr__(self):
+        return "<MetricSummary(batch_id='{}', qc_tool='{}', metric='{}', count='{}', mean='{}'>" \
+            .format(self.batch_id, self.qc_tool, self.metric, self.count, self.mean)
+
+class QcRuleSet(Base):
+    __tablename__ = 'qc_rule_set'
+
+    id = Column(Integer, primary_key=True, nullable=False)
+
+    name = Column(String, nullable=False, unique=True)
+    description = Column(Text)
+
+    rules = relationship("QcRule", backref="rule_set", cascade="all, delete")
+
+    def __repr__(self):
+        return "<QcRuleSet(id='{}', name='{}', description='{}'>" \
+            .format(self.id, self.name, self.description)
+
+
+# A threshold of a rule set that samples have to meet (see database/rules.py).
+class QcRule(Base):
+    __tablename__ = 'qc_rule'
+
+    id = Column(Integer, primary_key=True, nullable=False)
+
+    rule_set_id = Column(Integer, ForeignKey('qc_rule_set.id', ondelete="CASCADE"), nullable=False, index=True)
+    qc_tool = Column(String(50), nullable=False)
+    metric = Column(String, nullable=False)
+    operator = Column(String(2), nullable=False)
+    value = Column(Float, nullable=False)
+    # Only applies to samples of this cohort / platform / reference genome when set.
+    cohort_id = Column(String)
+    platform = Column(String)
+    reference_genome = Column(String)
+
+    def __repr__(self):
+        return "<QcRule(rule_set_id='{}', qc_tool='{}', metric='{}', operator='{}', value='{}'>" \
+            .format(self.rule_set_id, self.qc_tool, self.metric, self.operator, self.value)
+
+
+# A sample that failed a rule set (passing samples have no row).
+class SampleQcFlag(Base):
+    __tablename__ = 'sample_qc_flag'
+
+    rule_set_id = Column(Integer, ForeignKey('qc_rule_set.id', ondelete="CASCADE"), primary_key=True, nullable=False)
+    sample_id = Column(Integer, ForeignKey('sample.id', ondelete="CASCADE"), primary_key=True, nullable=False, index=True)
+    # The thresholds failed, e.g. "verifybamid.AVG_DP >= 30".
+    failed = Column(ARRAY(Text), nullable=False)
+
+    def __repr__(self):
+        return "<SampleQcFlag(rule_set_id='{}', sample_id='{}', failed='{}'>" \
+            .format(self.rule_set_id, self.sample_id, self.failed)
+
+
+# Running moments of a metric over every saved sample of a (centre, platform, reference genome) group
+# (see database/baselines.py), merged with each saved batch's and unmerged when a batch is removed.
+class MetricBaseline(Base):
+    __tablename__ = 'metric_baseline'
+
+    id = Column(Integer, primary_key=True, nullable=False)
+
+    centre = Column(String, nullable=False)
+    platform = Column(String, nullable=False)
+    reference_genome = Column(String, nullable=False)
+    qc_tool = Column(String(50), nullable=False)
+    metric = Column(String, nullable=False)
+
+    # Moment summary (merge with database.sketch.merge_moments).
+    count = Column(Integer, nullable=False)
+    mean = Column(Float, nullable=False)
+    m2 = Column(Float, nullable=False)
+    min = Column(Float, nullable=False)
+    max = Column(Float, nullable=False)
+
+    __table_args__ = (UniqueConstraint('centre', 'platform', 'reference_genome', 'qc_tool', 'metric'),)
+
+    def __repr__(self):
+        return "<MetricBaseline(centre='{}', platform='{}', reference_genome='{}', qc_tool='{}', metric='{}', count='{}', mean='{}'>" \
+            .format(self.centre, self.platform, self.reference_genome, self.qc_tool, self.metric, self.count, self.mean)
+
+
+# A batch's share of a metric baseline, taken back out of it when the batch is removed.
+class BatchMetricBaseline(Base):
+    __tablename__ = 'batch_metric_baseline'
+
+    id = Column(Integer, primary_key=True, nullable=False)
+
+    batch_id = Column(Integer, ForeignKey('batch.id', ondelete="CASCADE"), nullable=False, index=True)
+    centre = Column(String, nullable=False)
+    platform = Column(String, nullable=False)
+    reference_genome = Column(String, nullable=False)
+    qc_tool = Column(String(50), nullable=False)
+    metric = Column(String, nullable=False)
+
+    count = Column(Integer, nullable=False)
+    mean = Column(Float, nullable=False)
+    m2 = Column(Float, nullable=False)
+    min = Column(Float, nullable=False)
+    max = Column(Float, nullable=False)
+
+    __table_args__ = (UniqueConstraint('batch_id', 'centre', 'platform', 'reference_genome', 'qc_tool', 'metric'),
+                      Index('ix_batch_metric_baseline_group', 'centre', 'platform', 'reference_genome', 'qc_tool', 'metric'))
+
+    def __repr__(self):
+        return "<BatchMetricBaseline(batch_id='{}', centre='{}', platform='{}', reference_genome='{}', qc_tool='{}', metric='{}', count='{}'>" \
+            .format(self.batch_id, self.centre, self.platform, self.reference_genome, self.qc_tool, self.metric, self.count)
+
+
+# A multiqc output directory found in a watched landing area, and its save (see database/jobs.py and the watch command).
+class IngestJob(Base):
+    __tablename__ = 'ingest_job'
+
+    id = Column(Integer, primary_key=True, nullable=False)
+
+    directory = Column(String, nullable=False)
+    sample_metadata = Column(String)
+    # Sizes and modification times of the directory's files when it was queued, a changed directory is a new job.
+    fingerprint = Column(String, nullable=False)
+    # queued, running, saved or failed.
+    status = Column(String(10), nullable=False, index=True)
+    cohort_id = Column(String)
+    sample_count = Column(Integer)
+    batch_count = Column(Integer)
+    error = Column(Text)
+    queued_at = Column(DateTime, nullable=False)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+    __table_args__ = (UniqueConstraint('directory', 'fingerprint'),)
+
+    def __repr__(self):
+        return "<IngestJob(id='{}', directory='{}', status='{}', cohort_id='{}', error='{}'>" \
+            .format(self.id, self.directory, self.status, self.cohort_id, self.error)
+
+
 def get_tables():
     tables = []
     for name, model_class in Base._decl_class_registry.items():
@@ -4,10 +4,14 @@ import subprocess
 import glob
 import click
 import sys
+from .models import Batch, Sample
+from .crud import REPLICA, is_sharded
+from .federation import fan_out
+from .stats import file_io
 
 # Creates new csv with the sqlalchemy query result in the given output directory.
 def create_csv(query_header, query_result, output_path, filename):
-    with open(f"{output_path}/{filename}.csv", 'w') as csv_file:
+    with file_io(), open(f"{output_path}/{filename}.csv", 'w') as csv_file:
         csv_writer = csv.writer(csv_file, delimiter = ',')
 
         csv_writer.writerow(query_header)
@@ -22,6 +26,35 @@ def print_csv(query_header, query_result):
     for row in query_result:
         csv_writer.writerow(row)
 
+# Returns [[cohort, batch, number of samples]] of the session's database.
+def overview_rows(session, shard=None):
+    overview = []
+
+    # Make a nice list which we can give to tabulate
+    for cohort_id, batch_name in session.query(Batch.cohort_id, Batch.batch_name):
+        temp_line = [cohort_id, batch_name]
+        temp_line.append(session.query(Sample).join(Batch, Batch.id == Sample.batch_id).\
+        filter(Batch.batch_name == batch_name, Sample.cohort_id == cohort_id).count())
+        overview.append(temp_line)
+
+    return overview
+
+# Prints a table of the number of samples in each cohort/batch.
+# With shards (see database/crud.py), of every shard, read with sessions of the role.
+def print_overview(session, role=REPLICA):
+    if is_sharded():
+        print_overview_rows([row for rows in fan_out(overview_rows, role) for row in rows])
+    else:
+        print_overview_rows(overview_rows(session))
+
+# Prints [[cohort, batch, number of samples]] as a table.
+def print_overview_rows(overview):
+    from tabulate import tabulate
+
+    overview.sort()
+    # Print a pretty table
+    click.echo(tabulate(overview, headers=["Cohort", "Batch", "Number of Samples"], tablefmt="pretty"))
+
 # Requires list containing tuples in the form (sample_name, path), and requires user specified output directory path 
 # Function will find and save all files matching sample_name and return file
 def create_new_multiqc(path_sample_list, output_dir, filename):
@@ -43,10 +76,10 @@ def create_new_multiqc(path_sample_list, output_dir, filename):
     
     with open(output_dir + "/falconqc_query.txt", 'w') as sample_filenames: # creates new file to store all sample_name absolute paths 
         for path in map_path_sample.keys(): # for each batch folder path
-            os.chdir(path) # change directory to path
+            # Glob inside path rather than changing directory (the working directory is shared by the daemon's threads).
             for sample_name in map_path_sample[path]: # go through each sample_name in given batch folder path
-                for file_name in glob.glob(sample_name + '*'): # find every file assoicated with sample_name
-                    sample_filenames.write(path + '/' + file_name + '\n') # write into file
+                for file_path in glob.glob(os.path.join(glob.escape(path), sample_name + '*')): # find every file assoicated with sample_name
+                    sample_filenames.write(path + '/' + os.path.basename(file_path) + '\n') # write into file
 
     # Run command to create new multiqc report with sample files specified
     process = subprocess.run(['multiqc', '-l', output_dir + '/falconqc_query.txt', '-c', config, '-o', output_dir, '-n', output_name])
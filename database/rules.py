@@ -0,0 +1,124 @@
+from sqlalchemy import text
+from .compact import is_compact
+from .models import QcRule, QcRuleSet
+
+"""
+Stored QC rule sets (see the rules command), evaluated in bulk when batches are saved.
+
+A rule set is named thresholds "<qc_tool> <metric> <operator> <value>" that samples have to meet to pass it, e.g.
+verifybamid AVG_DP >= 20. A threshold can be limited to a cohort, platform and / or reference genome, and then
+overrides the rule set's less specific threshold of the same tool, metric and operator for those samples (the most
+specific one applies). A sample fails the rule set when a numeric value of a threshold's metric doesn't meet it.
+Samples without the metric, or with a non-numeric value (e.g. 'NA'), don't fail that threshold.
+
+Results are kept in sample_qc_flag, a row per (rule set, failed sample) with the thresholds it failed, so
+query --failed-rule looks the failed samples up by the rule set's primary key instead of casting metrics across
+raw_data. Flags are evaluated with one INSERT ... SELECT over the samples of the evaluation:
+    save -- every rule set, for the batches saved (in the save's transaction).
+    rules reevaluate -- all samples, after a rule set changes (its flags are replaced).
+With shards (see database/crud.py) every shard has the rule sets, and flags its own samples.
+"""
+
+# The query command's operators, as SQL.
+OPERATORS = {
+    '>': '>',
+    '>=': '>=',
+    '<': '<',
+    '<=': '<=',
+    '==': '=',
+    '!=': '<>',
+}
+
+# A metric's value as a double (NULL when missing or not a number), of a raw_data row r.
+METRIC_VALUE = "CASE WHEN jsonb_typeof(r.metrics -> t.metric) = 'number' THEN CAST(r.metrics ->> t.metric AS float8) END"
+# Compact raw_data's value array only has the numbers (see database/compact.py).
+COMPACT_METRIC_VALUE = "r.metric_values[array_position(r.metric_keys, t.metric)]"
+
+# Failed thresholds of the samples. t is the threshold applying to each (rule set, sample, tool, metric, operator),
+# the most specific one (the latest added on a tie).
+EVALUATE = """
+INSERT INTO sample_qc_flag (rule_set_id, sample_id, failed)
+SELECT t.rule_set_id, t.sample_id, array_agg(DISTINCT t.qc_tool || '.' || t.metric || ' ' || t.operator || ' ' || t.value)
+FROM (
+    SELECT DISTINCT ON (q.rule_set_id, s.id, q.qc_tool, q.metric, q.operator)
+        q.rule_set_id, s.id AS sample_id, q.qc_tool, q.metric, q.operator, q.value
+    FROM sample s JOIN qc_rule q ON (q.cohort_id IS NULL OR q.cohort_id = s.cohort_id)
+        AND (q.platform IS NULL OR q.platform = s.platform)
+        AND (q.reference_genome IS NULL OR q.reference_genome = s.reference_genome)
+    WHERE {where}
+    ORDER BY q.rule_set_id, s.id, q.qc_tool, q.metric, q.operator,
+        CAST(q.cohort_id IS NOT NULL AS int) + CAST(q.platform IS NOT NULL AS int) + CAST(q.reference_genome IS NOT NULL AS int) DESC,
+        q.id DESC
+) t
+JOIN raw_data r ON r.sample_id = t.sample_id AND r.qc_tool = t.qc_tool
+CROSS JOIN LATERAL (SELECT {value} AS value) m
+WHERE m.value IS NOT NULL AND NOT (CASE t.operator {comparisons} END)
+GROUP BY t.rule_set_id, t.sample_id
+"""
+
+def check_operator(operator):
+    if operator not in OPERATORS:
+        raise Exception(f"Invalid operator {operator}, use one of {' '.join(OPERATORS)}.")
+
+# Returns [rule set ids] of the names.
+def rule_set_ids(session, names):
+    ids = dict(session.query(QcRuleSet.name, QcRuleSet.id).filter(QcRuleSet.name.in_(names)))
+    for name in names:
+        if name not in ids:
+            raise Exception(f"The rule set {name} is not present in the database, see: falcon_multiqc rules list")
+    return [ids[name] for name in names]
+
+# Adds a threshold to the rule set (created if new), or changes the value of the same threshold (same tool, metric,
+# operator, cohort, platform and reference genome). Returns the rule set.
+def set_rule(session, name, qc_tool, metric, operator, value, cohort_id=None, platform=None, reference_genome=None,
+             description=None):
+    check_operator(operator)
+    rule_set = session.query(QcRuleSet).filter(QcRuleSet.name == name).with_for_update().one_or_none()
+    if rule_set is None:
+        rule_set = QcRuleSet(name=name)
+        session.add(rule_set)
+        session.flush()
+    if description is not None:
+        rule_set.description = description
+    scope = {"cohort_id": cohort_id, "platform": platform, "reference_genome": reference_genome}
+    rule = session.query(QcRule).filter(QcRule.rule_set_id == rule_set.id, QcRule.qc_tool == qc_tool, QcRule.metric == metric,
+                                        QcRule.operator == operator,
+                                        *[getattr(QcRule, column).is_(None) if scope_value is None else getattr(QcRule, column) == scope_value
+                                          for column, scope_value in scope.items()]).one_or_none()
+    if rule is None:
+        session.add(QcRule(rule_set_id=rule_set.id, qc_tool=qc_tool, metric=metric, operator=operator, value=value, **scope))
+    else:
+        rule.value = value
+    return rule_set
+
+# Removes the rule set's thresholds of the tool / metric, or the whole rule set (and its flags) without them.
+# Returns the number of thresholds removed.
+def remove_rules(session, name, qc_tool=None, metric=None):
+    rule_set_id, = rule_set_ids(session, [name])
+    rules = session.query(QcRule).filter(QcRule.rule_set_id == rule_set_id)
+    if qc_tool:
+        rules = rules.filter(QcRule.qc_tool == qc_tool)
+    if metric:
+        rules = rules.filter(QcRule.metric == metric)
+    removed = rules.delete(synchronize_session=False)
+    if not qc_tool and not metric:
+        session.query(QcRuleSet).filter(QcRuleSet.id == rule_set_id).delete(synchronize_session=False)
+    return removed
+
+# (Re)evaluates the rule sets (all without rule_set_ids) for the samples of the batches (all without batch_ids),
+# replacing their flags. Returns the number of (rule set, sample) failures.
+def evaluate(session, rule_set_ids=None, batch_ids=None):
+    # The session's pending rows (e.g. the batches being saved) are evaluated too.
+    session.flush()
+    params = {"rule_set_ids": list(rule_set_ids or []), "batch_ids": list(batch_ids or [])}
+    conditions = {}
+    if batch_ids is not None:
+        conditions["s.batch_id = ANY(:batch_ids)"] = "f.sample_id IN (SELECT s.id FROM sample s WHERE s.batch_id = ANY(:batch_ids))"
+    if rule_set_ids is not None:
+        conditions["q.rule_set_id = ANY(:rule_set_ids)"] = "f.rule_set_id = ANY(:rule_set_ids)"
+    session.execute(text("DELETE FROM sample_qc_flag f WHERE " + (" AND ".join(conditions.values()) or "true")), params)
+
+    comparisons = " ".join(f"WHEN '{operator}' THEN m.value {sql} t.value" for operator, sql in OPERATORS.items())
+    sql = EVALUATE.format(where=" AND ".join(conditions) or "true", comparisons=comparisons,
+                          value=COMPACT_METRIC_VALUE if is_compact(session) else METRIC_VALUE)
+    return session.execute(text(sql), params).rowcount
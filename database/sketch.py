@@ -0,0 +1,150 @@
+import math
+
+"""
+Mergeable distribution summaries used for the per batch/tool/metric summaries (see MetricSummary in models.py).
+
+TDigest is a merging t-digest (Dunning & Ertl), stored as a list of [mean, weight] centroids.
+Digests built for separate batches can be merged into a cohort-wide (or cross-cohort) digest
+without going back to the raw values.
+
+Moments are kept as (count, mean, m2) and merged with Chan et al.'s parallel variant of Welford's algorithm.
+"""
+
+# Higher compression keeps more centroids (more accurate quantiles, bigger sketches).
+DEFAULT_COMPRESSION = 100
+
+
+# Scale function k1 from the t-digest paper and its inverse.
+def _k(q, compression):
+    return compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+def _q(k, compression):
+    if k >= compression / 4:
+        return 1.0
+    return (math.sin(k * 2 * math.pi / compression) + 1) / 2
+
+
+class TDigest:
+    def __init__(self, centroids=None, compression=DEFAULT_COMPRESSION):
+        self.compression = compression
+        self.centroids = []
+        self.total = 0
+        if centroids:
+            self._compress([(float(m), float(w)) for m, w in centroids])
+
+    @classmethod
+    def from_values(cls, values, compression=DEFAULT_COMPRESSION):
+        return cls([(v, 1) for v in values], compression)
+
+    @classmethod
+    def from_list(cls, centroids, compression=DEFAULT_COMPRESSION):
+        return cls(centroids, compression)
+
+    @classmethod
+    def merge(cls, digests, compression=DEFAULT_COMPRESSION):
+        centroids = []
+        for digest in digests:
+            centroids.extend(digest.centroids)
+        return cls(centroids, compression)
+
+    def to_list(self):
+        return [[m, w] for m, w in self.centroids]
+
+    # Greedily merge sorted centroids while they stay inside one unit of the scale function.
+    def _compress(self, centroids):
+        centroids.sort()
+        total = sum(w for _, w in centroids)
+        self.total = total
+        self.centroids = []
+        if not centroids:
+            return
+
+        cur_mean, cur_weight = centroids[0]
+        weight_so_far = 0
+        q_limit = _q(_k(0, self.compression) + 1, self.compression)
+        for mean, weight in centroids[1:]:
+            if (weight_so_far + cur_weight + weight) / total <= q_limit:
+                cur_weight += weight
+                cur_mean += (mean - cur_mean) * weight / cur_weight
+            else:
+                self.centroids.append((cur_mean, cur_weight))
+                weight_so_far += cur_weight
+                q_limit = _q(_k(weight_so_far / total, self.compression) + 1, self.compression)
+                cur_mean, cur_weight = mean, weight
+        self.centroids.append((cur_mean, cur_weight))
+
+    # Approximate value at quantile q (0 <= q <= 1), interpolating between centroid midpoints.
+    def quantile(self, q):
+        if not self.centroids:
+            return None
+        if len(self.centroids) == 1:
+            return self.centroids[0][0]
+        target = q * self.total
+        cumulative = 0
+        previous_mid, previous_mean = None, None
+        for mean, weight in self.centroids:
+            mid = cumulative + weight / 2
+            if target <= mid:
+                if previous_mid is None:
+                    return mean
+                return previous_mean + (mean - previous_mean) * (target - previous_mid) / (mid - previous_mid)
+            previous_mid, previous_mean = mid, mean
+            cumulative += weight
+        return self.centroids[-1][0]
+
+    # Approximate fraction of values <= x.
+    def cdf(self, x):
+        if not self.centroids:
+            return None
+        if x < self.centroids[0][0]:
+            return 0.0
+        if x >= self.centroids[-1][0]:
+            return 1.0
+        cumulative = 0
+        previous_mid, previous_mean = None, None
+        for mean, weight in self.centroids:
+            mid = cumulative + weight / 2
+            if x < mean:
+                return (previous_mid + (mid - previous_mid) * (x - previous_mean) / (mean - previous_mean)) / self.total
+            previous_mid, previous_mean = mid, mean
+            cumulative += weight
+        return 1.0
+
+    # Approximate counts of values falling into each [edges[i], edges[i+1]) bin.
+    def histogram(self, edges):
+        cdfs = [self.cdf(edge) for edge in edges]
+        return [self.total * (cdfs[i + 1] - cdfs[i]) for i in range(len(edges) - 1)]
+
+
+# Returns (count, mean, m2, min, max) for a list of numbers (min and max are None for an empty list).
+def moments(values):
+    count, mean, m2 = 0, 0.0, 0.0
+    if not values:
+        return count, mean, m2, None, None
+    for value in values:
+        count += 1
+        delta = value - mean
+        mean += delta / count
+        m2 += delta * (value - mean)
+    return count, mean, m2, min(values), max(values)
+
+# Merges two (count, mean, m2) summaries.
+def merge_moments(a, b):
+    count_a, mean_a, m2_a = a
+    count_b, mean_b, m2_b = b
+    count = count_a + count_b
+    if count == 0:
+        return 0, 0.0, 0.0
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / count
+    m2 = m2_a + m2_b + delta * delta * count_a * count_b / count
+    return count, mean, m2
+
+def std_dev(count, m2):
+    if count < 2:
+        return 0.0
+    return math.sqrt(m2 / (count - 1))
+
+# Metric values worth summarising (JSON numbers, excluding booleans, NaN and infinity).
+def is_numeric(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
@@ -0,0 +1,256 @@
+import os
+import re
+import json
+import glob
+import datetime
+from sqlalchemy import text
+from .models import Batch, Cohort, Sample
+from .sketch import is_numeric
+
+"""
+Local columnar snapshot of the database (see the snapshot command), for heavy analytical queries that shouldn't
+load the PostgreSQL server. query, sql and chart run against it with --engine duckdb.
+
+Layout of a snapshot directory:
+    cohort.parquet, batch.parquet -- the whole tables (small, rewritten by every snapshot).
+    sample/batch_<id>.parquet -- the samples of each batch.
+    raw_data/<qc_tool>/batch_<id>.parquet -- one row per sample with a column per metric (flattened from the
+        JSONB metrics: integer, double or text columns).
+    manifest.json -- when the snapshot was taken, and a fingerprint of each batch's samples.
+Batches are only written again when their fingerprint (sample count and sample id range) changes, since raw_data is
+only ever added or deleted with its samples (see save / remove). Batches no longer in the database are deleted.
+
+In DuckDB, the tables are views of the parquet files: cohort, batch, sample, raw_data_<qc_tool> (flattened), and
+raw_data (sample_id, qc_tool, metrics as JSON) so SQL written for PostgreSQL (metrics ->> 'AVG_DP') runs unchanged.
+duckdb is an optional dependency, only imported when a snapshot is written or read.
+"""
+
+MANIFEST = "manifest.json"
+
+def snapshot_dir():
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.environ.get("FALCON_MULTIQC_SNAPSHOT") or os.path.join(cache_dir, "falcon_multiqc", "snapshot")
+
+def import_duckdb():
+    try:
+        import duckdb
+    except ImportError:
+        raise Exception("The duckdb engine and snapshots require the duckdb package (pip install duckdb).")
+    return duckdb
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as manifest:
+            return json.load(manifest)
+    except (OSError, ValueError):
+        return {"batches": {}}
+
+def tool_dir(qc_tool):
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", qc_tool)
+
+def quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+def sql_string(value):
+    return "'" + value.replace("'", "''") + "'"
+
+# Writes {column: values} (with pandas dtypes {column: dtype}) to a parquet file, replacing it atomically.
+def write_parquet(connection, path, columns, dtypes=None):
+    import pandas as pd
+
+    frame = pd.DataFrame({name: pd.array(values, dtype=(dtypes or {}).get(name)) for name, values in columns.items()})
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection.register("snapshot_rows", frame)
+    try:
+        connection.execute(f"COPY snapshot_rows TO {sql_string(path + '.tmp')} (FORMAT PARQUET)")
+    finally:
+        connection.unregister("snapshot_rows")
+    os.replace(path + ".tmp", path)
+
+# Returns {column: values} of a model's table for the given rows.
+def table_columns(model, rows):
+    return {column.name: [getattr(row, column.name) for row in rows] for column in model.__table__.columns}
+
+# Returns the pandas dtype of a metric's values: Int64 or Float64 if every value is numeric, else string.
+def metric_dtype(values):
+    numbers = [value for value in values if value is not None]
+    if all(is_numeric(value) for value in numbers):
+        return "Int64" if all(isinstance(value, int) for value in numbers) else "Float64"
+    return "string"
+
+# Returns {qc_tool: {column: values}} with one row per sample and a column per metric.
+def flatten_metrics(rows):
+    tools = {}
+    for sample_id, qc_tool, metrics in rows:
+        tool = tools.setdefault(qc_tool, {"sample_id": []})
+        row = len(tool["sample_id"])
+        tool["sample_id"].append(sample_id)
+        for metric, value in metrics.items():
+            if metric == "sample_id":
+                continue
+            column = tool.setdefault(metric, [None] * row)
+            column.append(value if value is None or is_numeric(value) else str(value))
+        for column in tool.values():
+            if len(column) == row:
+                column.append(None)
+    return tools
+
+# {batch id (as a string, like the manifest's json keys): [sample count, min sample id, max sample id]}
+def batch_fingerprints(session):
+    rows = session.execute(text("SELECT batch_id, count(*), min(id), max(id) FROM sample GROUP BY batch_id"))
+    return {str(batch_id): [count, min_id, max_id] for batch_id, count, min_id, max_id in rows}
+
+def remove_batch_files(directory, batch_id):
+    for path in glob.glob(os.path.join(directory, "sample", f"batch_{batch_id}.parquet")) + \
+            glob.glob(os.path.join(directory, "raw_data", "*", f"batch_{batch_id}.parquet")):
+        os.remove(path)
+
+# Writes one batch's samples and flattened raw_data. Returns the batch's tools.
+def export_batch(session, connection, directory, batch_id):
+    remove_batch_files(directory, batch_id)
+    samples = session.query(Sample).filter(Sample.batch_id == int(batch_id)).order_by(Sample.id).all()
+    write_parquet(connection, os.path.join(directory, "sample", f"batch_{batch_id}.parquet"), table_columns(Sample, samples),
+                  {"id": "Int64", "patient_id": "Int64", "batch_id": "Int64"})
+    rows = session.execute(text(
+        "SELECT raw_data.sample_id, raw_data.qc_tool, raw_data.metrics FROM raw_data JOIN sample ON sample.id = raw_data.sample_id "
+        "WHERE sample.batch_id = :batch_id ORDER BY raw_data.sample_id"), {"batch_id": int(batch_id)})
+    tools = flatten_metrics(rows)
+    for qc_tool, columns in tools.items():
+        dtypes = {metric: metric_dtype(values) for metric, values in columns.items()}
+        dtypes["sample_id"] = "Int64"
+        write_parquet(connection, os.path.join(directory, "raw_data", tool_dir(qc_tool), f"batch_{batch_id}.parquet"), columns, dtypes)
+    return sorted(tools)
+
+# Brings the snapshot in directory up to date with the database (every batch with full).
+# on_batch(action, batch_id) is called for each batch written ("write") or deleted ("delete").
+# Returns (batches written, batches deleted, batches unchanged).
+def take_snapshot(session, directory, full=False, on_batch=None):
+    duckdb = import_duckdb()
+    # One consistent view of the database for the whole snapshot.
+    session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+    manifest = read_manifest(directory)
+    previous = {} if full else manifest.get("batches", {})
+    fingerprints = batch_fingerprints(session)
+    batches = {}
+    written = deleted = 0
+
+    with duckdb.connect() as connection:
+        write_parquet(connection, os.path.join(directory, "cohort.parquet"), table_columns(Cohort, session.query(Cohort).all()),
+                      {"sample_count": "Int64", "batch_count": "Int64"})
+        write_parquet(connection, os.path.join(directory, "batch.parquet"), table_columns(Batch, session.query(Batch).all()),
+                      {"id": "Int64", "sample_count": "Int64"})
+        for batch_id in set(previous) - set(fingerprints):
+            remove_batch_files(directory, batch_id)
+            deleted += 1
+            if on_batch:
+                on_batch("delete", batch_id)
+        if full:
+            for path in glob.glob(os.path.join(directory, "sample", "*.parquet")) + \
+                    glob.glob(os.path.join(directory, "raw_data", "*", "*.parquet")):
+                os.remove(path)
+        for batch_id, fingerprint in sorted(fingerprints.items(), key=lambda item: int(item[0])):
+            if previous.get(batch_id, {}).get("fingerprint") == fingerprint:
+                batches[batch_id] = previous[batch_id]
+                continue
+            batches[batch_id] = {"fingerprint": fingerprint, "tools": export_batch(session, connection, directory, batch_id)}
+            written += 1
+            if on_batch:
+                on_batch("write", batch_id)
+
+    tools = sorted({qc_tool for batch in batches.values() for qc_tool in batch["tools"]})
+    manifest = {
+        "taken_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "batches": batches,
+        "tools": {qc_tool: tool_dir(qc_tool) for qc_tool in tools},
+    }
+    with open(os.path.join(directory, MANIFEST + ".tmp"), "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(os.path.join(directory, MANIFEST + ".tmp"), os.path.join(directory, MANIFEST))
+    return written, deleted, len(batches) - written
+
+# Returns an in-memory DuckDB connection with the snapshot's tables as views (see above).
+def connect(directory):
+    duckdb = import_duckdb()
+    manifest = read_manifest(directory)
+    if "taken_at" not in manifest:
+        raise Exception(f"There is no snapshot in {directory}, create one with: falcon_multiqc snapshot")
+    connection = duckdb.connect()
+    # SQL written for PostgreSQL may name the public schema.
+    connection.execute("CREATE SCHEMA public")
+    connection.execute("SET schema = 'public'")
+
+    def parquet(pattern):
+        return f"read_parquet({sql_string(os.path.join(directory, pattern))}, union_by_name = true)"
+
+    connection.execute(f"CREATE VIEW cohort AS SELECT * FROM {parquet('cohort.parquet')}")
+    connection.execute(f"CREATE VIEW batch AS SELECT * FROM {parquet('batch.parquet')}")
+    if manifest["batches"]:
+        connection.execute(f"CREATE VIEW sample AS SELECT * FROM {parquet(os.path.join('sample', '*.parquet'))}")
+    else:
+        connection.execute("CREATE VIEW sample AS SELECT NULL::BIGINT AS id, NULL::BIGINT AS patient_id, NULL::BIGINT AS batch_id, "
+                           "NULL::VARCHAR AS cohort_id, NULL::VARCHAR AS sample_name, NULL::VARCHAR AS flowcell_lane, "
+                           "NULL::VARCHAR AS library_id, NULL::VARCHAR AS platform, NULL::VARCHAR AS centre, "
+                           "NULL::VARCHAR AS reference_genome, NULL::VARCHAR AS type, NULL::VARCHAR AS description WHERE false")
+
+    raw_data = []
+    for qc_tool, directory_name in manifest["tools"].items():
+        view = tool_view(qc_tool)
+        connection.execute(f"CREATE VIEW {view} AS SELECT * FROM {parquet(os.path.join('raw_data', directory_name, '*.parquet'))}")
+        metrics = [name for name, *_ in connection.execute(f"DESCRIBE {view}").fetchall() if name != "sample_id"]
+        pairs = ", ".join(f"{sql_string(metric)}, {quote(metric)}" for metric in metrics)
+        raw_data.append(f"SELECT sample_id, {sql_string(qc_tool)} AS qc_tool, json_object({pairs}) AS metrics FROM {view}")
+    connection.execute("CREATE VIEW raw_data AS " + (" UNION ALL ".join(raw_data) if raw_data else
+                       "SELECT NULL::BIGINT AS sample_id, NULL::VARCHAR AS qc_tool, NULL::JSON AS metrics WHERE false"))
+    return connection
+
+# Returns {qc_tool: set of metrics} in the snapshot (the shape of database.catalog's catalog).
+def snapshot_catalog(connection):
+    catalog = {}
+    for qc_tool, metrics in connection.execute(
+            "SELECT qc_tool, list_distinct(flatten(list(json_keys(metrics)))) FROM raw_data GROUP BY qc_tool").fetchall():
+        catalog[qc_tool] = set(metrics)
+    return catalog
+
+# Returns {qc_tool: [metrics]}, the columns of the snapshot's raw_data_<qc_tool> views (without reading them).
+def tool_catalog(connection, directory):
+    return {qc_tool: [name for name, *_ in connection.execute(f"DESCRIBE {tool_view(qc_tool)}").fetchall() if name != "sample_id"]
+            for qc_tool in read_manifest(directory).get("tools", {})}
+
+# Returns {metric: DuckDB type} of the snapshot's raw_data_<qc_tool> view (empty without the tool).
+def metric_types(connection, directory, qc_tool):
+    if qc_tool not in read_manifest(directory).get("tools", {}):
+        return {}
+    return {name: type for name, type, *_ in connection.execute(f"DESCRIBE {tool_view(qc_tool)}").fetchall() if name != "sample_id"}
+
+def tool_view(qc_tool):
+    return quote(f"raw_data_{tool_dir(qc_tool)}")
+
+# PostgreSQL's float is double precision and its numeric has no fixed scale, but DuckDB's FLOAT is single precision
+# and NUMERIC has 3 decimal places, so casts to them (e.g. (metrics ->> 'AVG_DP')::numeric::float) become DOUBLE.
+CASTS = re.compile(r"(::\s*)(float8?|double precision|numeric|decimal)\b(?!\s*\()|(\bAS\s+)(float8?|double precision|numeric|decimal)(\s*\))",
+                   re.IGNORECASE)
+
+def postgres_casts(sql):
+    return CASTS.sub(lambda match: f"{match.group(1)}DOUBLE" if match.group(1) else f"{match.group(3)}DOUBLE{match.group(5)}", sql)
+
+# Runs a SQLAlchemy query (built for PostgreSQL, e.g. by the query command) in DuckDB. Returns its rows.
+def execute_query(connection, query):
+    return query_result(connection, query).fetchall()
+
+# Runs a SQLAlchemy query (built for PostgreSQL) in DuckDB. Returns the DuckDB result (e.g. for its .df() / .arrow()).
+def query_result(connection, query):
+    from sqlalchemy.dialects import postgresql
+    # Named paramstyle, so the literals' % aren't doubled for psycopg2.
+    sql = query.statement.compile(dialect=postgresql.dialect(paramstyle="named"), compile_kwargs={"literal_binds": True})
+    return connection.execute(postgres_casts(str(sql)))
+
+# Runs raw SQL in DuckDB. Returns (column names, rows).
+def execute_sql(connection, sql):
+    result = connection.execute(postgres_casts(sql))
+    return [column[0] for column in result.description], result.fetchall()
+
+# [[cohort, batch, number of samples]] like process_query.print_overview's.
+def overview(connection):
+    return [list(row) for row in connection.execute(
+        "SELECT batch.cohort_id, batch.batch_name, count(sample.id) FROM batch LEFT JOIN sample ON sample.batch_id = batch.id "
+        "GROUP BY batch.cohort_id, batch.batch_name").fetchall()]
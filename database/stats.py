@@ -0,0 +1,174 @@
+import json
+import time
+import heapq
+import datetime
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+
+"""
+Per command statement counts and timings (falcon_multiqc --stats / --stats-log, see cli.py).
+
+start_stats() attaches SQLAlchemy engine event listeners which record, for the calling thread's command:
+    statements -- SQL statements executed (an executemany counts once).
+    round trips -- statements plus commits / rollbacks.
+    rows -- rows returned (or changed, for INSERT / UPDATE / DELETE).
+    connections -- new database connections opened.
+    time in the database, in file I/O (code wrapped in file_io()) and in Python (the rest).
+Statements are also grouped by their SQL, so N+1 patterns (the same statement run once per row) show up
+as the most repeated statements.
+
+Collectors are per thread, so the daemon's concurrent commands (see daemon.py) are recorded separately.
+A command's worker threads (e.g. reading every shard at once, see federation.py) record into its collector with
+use_stats(), their database time adds up, so it can be more than the command's wall time.
+This module doesn't import SQLAlchemy until start_stats() is called.
+"""
+
+# Slowest statements kept (with their SQL) per command, --stats-top can't report more.
+MAX_SLOWEST = 100
+
+_local = threading.local()
+_listening = False
+_listen_lock = threading.Lock()
+
+class Stats:
+    def __init__(self, command):
+        self.command = command
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.round_trips = 0
+        self.rows = 0
+        self.connections = 0
+        self.db_seconds = 0.0
+        self.io_seconds = 0.0
+        self.slowest = [] # heap of the MAX_SLOWEST slowest (seconds, sql, rows)
+        self.by_sql = defaultdict(lambda: [0, 0.0]) # sql : [count, seconds]
+        self.lock = threading.Lock() # a command's worker threads record into the same collector
+
+    def add_statement(self, sql, seconds, rows):
+        with self.lock:
+            self._add_statement(sql, seconds, rows)
+
+    def add_round_trip(self):
+        with self.lock:
+            self.round_trips += 1
+
+    def add_connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def _add_statement(self, sql, seconds, rows):
+        self.statements += 1
+        self.round_trips += 1
+        self.rows += max(rows, 0)
+        self.db_seconds += seconds
+        if len(self.slowest) < MAX_SLOWEST:
+            heapq.heappush(self.slowest, (seconds, sql, rows))
+        else:
+            heapq.heappushpop(self.slowest, (seconds, sql, rows))
+        self.by_sql[sql][0] += 1
+        self.by_sql[sql][1] += seconds
+
+    def summary(self, top=5):
+        wall = time.perf_counter() - self.started
+        slowest = heapq.nlargest(top, self.slowest, key=lambda timing: timing[0])
+        repeated = sorted(self.by_sql.items(), key=lambda item: item[1][0], reverse=True)[:top]
+        return {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "command": self.command,
+            "statements": self.statements,
+            "round_trips": self.round_trips,
+            "rows": self.rows,
+            "connections": self.connections,
+            "wall_s": round(wall, 6),
+            "db_s": round(self.db_seconds, 6),
+            "io_s": round(self.io_seconds, 6),
+            "python_s": round(max(wall - self.db_seconds - self.io_seconds, 0), 6),
+            "slowest": [{"ms": round(seconds * 1000, 3), "rows": rows, "sql": sql} for seconds, sql, rows in slowest],
+            "repeated": [{"count": count, "ms": round(seconds * 1000, 3), "sql": sql}
+                         for sql, (count, seconds) in repeated if count > 1],
+        }
+
+def current():
+    return getattr(_local, "stats", None)
+
+def _listen():
+    global _listening
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    with _listen_lock:
+        if _listening:
+            return
+        _listening = True
+
+    @event.listens_for(Engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info["falcon_stats_start"] = time.perf_counter()
+
+    @event.listens_for(Engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        stats = current()
+        if stats:
+            seconds = time.perf_counter() - conn.info["falcon_stats_start"]
+            stats.add_statement(" ".join(statement.split()), seconds, cursor.rowcount)
+
+    @event.listens_for(Engine, "commit")
+    def commit(conn):
+        if current():
+            current().add_round_trip()
+
+    @event.listens_for(Engine, "rollback")
+    def rollback(conn):
+        if current():
+            current().add_round_trip()
+
+    @event.listens_for(Engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        if current():
+            current().add_connection()
+
+# Starts recording the calling thread's statements and timings.
+def start_stats(command):
+    _listen()
+    _local.stats = Stats(command)
+    return _local.stats
+
+def stop_stats():
+    stats = current()
+    _local.stats = None
+    return stats
+
+# Records the calling (worker) thread's statements into the collector of the command it works for (None stops).
+def use_stats(stats):
+    _local.stats = stats
+
+# Counts the time spent in the block as file I/O (when stats are being recorded).
+@contextmanager
+def file_io():
+    stats = current()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats:
+            stats.io_seconds += time.perf_counter() - start
+
+def format_summary(summary):
+    lines = [
+        f"{summary['command']}: {summary['statements']} statements, {summary['round_trips']} round trips, "
+        f"{summary['rows']} rows, {summary['connections']} new connections",
+        f"time: {summary['wall_s']:.3f}s total, {summary['db_s']:.3f}s database, {summary['io_s']:.3f}s file I/O, "
+        f"{summary['python_s']:.3f}s python",
+    ]
+    if summary["slowest"]:
+        lines.append("slowest statements:")
+        lines.extend(f"  {s['ms']:10.3f} ms {s['rows']:8} rows  {s['sql'][:200]}" for s in summary["slowest"])
+    if summary["repeated"]:
+        lines.append("most repeated statements:")
+        lines.extend(f"  {s['count']:8}x {s['ms']:10.3f} ms  {s['sql'][:200]}" for s in summary["repeated"])
+    return "\n".join(lines)
+
+def append_log(path, summary):
+    with open(path, "a") as log:
+        log.write(json.dumps(summary) + "\n")
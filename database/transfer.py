@@ -0,0 +1,272 @@
+import io
+import os
+import gzip
+import json
+import hashlib
+import tarfile
+import datetime
+import tempfile
+from sqlalchemy import text
+from .models import Base, Cohort
+from .baselines import merge_shares
+from .compact import is_compact
+from .rules import evaluate as evaluate_rules
+from .snapshot import quote, sql_string
+
+"""
+Portable export / import of a cohort between databases (see the export and import commands), in bulk with
+PostgreSQL's binary COPY rather than row by row.
+
+An export is a tar archive of:
+    manifest.json -- the cohort, and for each table its file, columns, column types, row count and the sha256 of its
+        COPY data (before compression).
+    <table>.copy.zst (or .gz) -- the cohort's rows of the table, COPY ... TO STDOUT (FORMAT binary), compressed.
+The tables are TABLES: the cohort, its batches, patients, samples and their raw_data, and the batches' metric summaries
+and baseline shares. QC rule flags aren't exported, the rule sets of the database imported into apply instead.
+Every table is read in one REPEATABLE READ transaction, so the export is consistent with concurrent saves.
+
+An import COPYs each table into a temporary table of the same columns (checking the column types match the export's,
+and its row count and checksum), then inserts the rows with new ids from the database's sequences: a table of old to
+new ids is made for batches, patients and samples, and every reference to them is remapped with a join, one
+INSERT ... SELECT per table. It's all one transaction, nothing is imported when anything fails.
+The imported batches are merged into the metric baselines and evaluated against the QC rule sets, as save would.
+"""
+
+MANIFEST = "manifest.json"
+FORMAT_VERSION = 1
+COMPRESSIONS = ["zstd", "gzip"]
+SUFFIXES = {"zstd": ".zst", "gzip": ".gz"}
+
+COHORT_BATCHES = "batch_id IN (SELECT id FROM batch WHERE cohort_id = {cohort})"
+# Tables of a cohort in insertion order, with the condition on the table's rows of the cohort.
+TABLES = [
+    ("cohort", "id = {cohort}"),
+    ("batch", "cohort_id = {cohort}"),
+    ("patient", "cohort_id = {cohort}"),
+    ("PatientBatch", COHORT_BATCHES),
+    ("sample", "cohort_id = {cohort}"),
+    ("raw_data", "sample_id IN (SELECT id FROM sample WHERE cohort_id = {cohort})"),
+    ("metric_summary", COHORT_BATCHES),
+    ("batch_metric_baseline", COHORT_BATCHES),
+]
+# Tables whose ids are referenced (and given new ids on import), and the columns referencing them.
+REMAPPED = ["batch", "patient", "sample"]
+REFERENCES = {"batch_id": "batch", "patient_id": "patient", "sample_id": "sample"}
+
+def default_compression():
+    try:
+        import zstandard
+        return "zstd"
+    except ImportError:
+        return "gzip"
+
+def import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception("zstd compressed exports require the zstandard package (pip install zstandard), or use --compression gzip.")
+    return zstandard
+
+def compressed_writer(file, compression):
+    if compression == "zstd":
+        return import_zstandard().ZstdCompressor(level=3, threads=-1).stream_writer(file, closefd=False)
+    return gzip.GzipFile(fileobj=file, mode="wb", compresslevel=1)
+
+def decompressed_reader(file, compression):
+    if compression == "zstd":
+        return import_zstandard().ZstdDecompressor().stream_reader(file, closefd=False)
+    return gzip.GzipFile(fileobj=file, mode="rb")
+
+
+class HashingFile:
+    """Wraps a file, hashing (sha256) what is written to / read from it."""
+
+    def __init__(self, file):
+        self.file = file
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self.file.write(data)
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.sha256.update(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self.file.readline(size)
+        self.sha256.update(data)
+        return data
+
+
+def table_columns(table):
+    return [column.name for column in Base.metadata.tables[table].columns]
+
+# Returns the types of the table's columns (as format_type names them).
+def column_types(session, table, columns):
+    types = dict(session.execute(text("SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute "
+                                      "WHERE attrelid = CAST(:table AS regclass) AND attnum > 0 AND NOT attisdropped"),
+                                 {"table": quote(table)}).fetchall())
+    return [types.get(column) for column in columns]
+
+# Writes the cohort's export archive to path (see above). on_table(table, rows) is called as each table is exported.
+# Returns the manifest.
+def export_cohort(session, cohort_id, path, compression=None, on_table=None):
+    compression = compression or default_compression()
+    if compression == "zstd":
+        import_zstandard()
+    # One consistent view of the cohort for the whole export.
+    session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+    if session.query(Cohort.id).filter(Cohort.id == cohort_id).first() is None:
+        raise Exception(f"The cohort {cohort_id} is not present in the database.")
+    cursor = session.connection().connection.cursor()
+    manifest = {
+        "format": FORMAT_VERSION,
+        "cohort": cohort_id,
+        "exported_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "server_version": session.connection().connection.server_version,
+        "compression": compression,
+        "tables": {},
+    }
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        with tarfile.open(path + ".tmp", "w") as archive:
+            for table, where in TABLES:
+                columns = table_columns(table)
+                name = f"{table}.copy{SUFFIXES[compression]}"
+                # Each table is compressed to a temporary file first, a tar member's size comes before its data.
+                with tempfile.TemporaryFile(dir=directory) as data:
+                    with compressed_writer(data, compression) as writer:
+                        hashing = HashingFile(writer)
+                        cursor.copy_expert(f"COPY (SELECT {', '.join(quote(column) for column in columns)} FROM {quote(table)} "
+                                           f"WHERE {where.format(cohort=sql_string(cohort_id))}) TO STDOUT WITH (FORMAT binary)", hashing)
+                        rows = cursor.rowcount
+                    info = tarfile.TarInfo(name)
+                    info.size = data.tell()
+                    info.mtime = int(datetime.datetime.now().timestamp())
+                    data.seek(0)
+                    archive.addfile(info, data)
+                manifest["tables"][table] = {"file": name, "columns": columns, "types": column_types(session, table, columns),
+                                             "rows": rows, "sha256": hashing.sha256.hexdigest()}
+                if on_table:
+                    on_table(table, rows)
+            data = json.dumps(manifest, indent=2).encode()
+            info = tarfile.TarInfo(MANIFEST)
+            info.size = len(data)
+            info.mtime = int(datetime.datetime.now().timestamp())
+            archive.addfile(info, io.BytesIO(data))
+    except BaseException:
+        if os.path.exists(path + ".tmp"):
+            os.remove(path + ".tmp")
+        raise
+    os.replace(path + ".tmp", path)
+    return manifest
+
+# The manifest of the archive (an open tarfile).
+def read_manifest(archive):
+    try:
+        manifest = json.load(archive.extractfile(MANIFEST))
+    except KeyError:
+        raise Exception("This file isn't a falcon_multiqc export (it has no manifest.json).")
+    if manifest.get("format") != FORMAT_VERSION:
+        raise Exception(f"Unsupported export format {manifest.get('format')} (this version reads format {FORMAT_VERSION}).")
+    return manifest
+
+# The manifest of the archive at path.
+def archive_manifest(path):
+    with tarfile.open(path, "r:") as archive:
+        return read_manifest(archive)
+
+# With compact storage (see database/compact.py), raw_data is inserted into raw_data_compact directly rather than row by
+# row through the view's trigger: the numeric metric names of each tool are appended to its keys once, then every row
+# is compacted with those keys.
+COMPACT_KEYS = """
+SELECT raw_data_key_metrics(t.qc_tool, COALESCE(jsonb_object_agg(n.key, n.value) FILTER (WHERE n.key IS NOT NULL), '{}'))
+FROM (SELECT DISTINCT qc_tool FROM import_raw_data) t
+LEFT JOIN (SELECT DISTINCT ON (r.qc_tool, m.key) r.qc_tool, m.key, m.value FROM import_raw_data r, jsonb_each(r.metrics) m
+           WHERE raw_data_compact_number(m.value)) n ON n.qc_tool = t.qc_tool
+GROUP BY t.qc_tool
+"""
+COMPACT_RAW_DATA = """
+INSERT INTO raw_data_compact (sample_id, qc_tool, metric_values, extra)
+SELECT sample_ids.new_id, t.qc_tool, c.metric_values, c.extra
+FROM import_raw_data t JOIN import_sample_ids sample_ids ON sample_ids.old_id = t.sample_id
+JOIN raw_data_key k ON k.qc_tool = t.qc_tool
+CROSS JOIN LATERAL raw_data_compact_metrics(k.metrics, t.metrics) c
+"""
+
+# The INSERT ... SELECT of the table's imported rows into the database, with the new ids (see above).
+def insert_rows(table, columns):
+    targets = []
+    values = []
+    joins = []
+    for column in columns:
+        if column == "id" and table not in REMAPPED:
+            if table == "cohort":
+                targets.append(quote(column))
+                values.append(":cohort")
+            # Nothing references these ids, they're numbered by the table's default.
+            continue
+        targets.append(quote(column))
+        if column == "id":
+            values.append("ids.new_id")
+            joins.append(f"JOIN import_{table}_ids ids ON ids.old_id = t.id")
+        elif column == "cohort_id":
+            values.append(":cohort")
+        elif column in REFERENCES:
+            values.append(f"{column}s.new_id")
+            # LEFT JOIN, a sample's patient is optional.
+            joins.append(f"LEFT JOIN import_{REFERENCES[column]}_ids {column}s ON {column}s.old_id = t.{quote(column)}")
+        else:
+            values.append(f"t.{quote(column)}")
+    return (f"INSERT INTO {quote(table)} ({', '.join(targets)}) SELECT {', '.join(values)} "
+            f"FROM {quote('import_' + table)} t {' '.join(joins)}")
+
+# Imports the export archive at path (see above) into the session's database, as cohort_id (the exported cohort's id
+# by default). on_table(table, rows) is called as each table is loaded. Returns (cohort id, {table: rows}).
+def import_cohort(session, path, cohort_id=None, on_table=None):
+    with tarfile.open(path, "r:") as archive:
+        manifest = read_manifest(archive)
+        cohort_id = cohort_id or manifest["cohort"]
+        if session.query(Cohort.id).filter(Cohort.id == cohort_id).first() is not None:
+            raise Exception(f"The cohort {cohort_id} already exists in the database. Remove it first, or import it under "
+                            "another name with --cohort.")
+        cursor = session.connection().connection.cursor()
+        tables = manifest["tables"]
+        for table, _ in TABLES:
+            columns = tables[table]["columns"]
+            session.execute(text(f"CREATE TEMPORARY TABLE {quote('import_' + table)} ON COMMIT DROP AS "
+                            f"SELECT {', '.join(quote(column) for column in columns)} FROM {quote(table)} WITH NO DATA"))
+            types = column_types(session, "import_" + table, columns)
+            if types != tables[table]["types"]:
+                raise Exception(f"The {table} table of the export has columns {columns} of types {tables[table]['types']}, "
+                                f"but this database's are {types}.")
+            hashing = HashingFile(decompressed_reader(archive.extractfile(tables[table]["file"]), manifest["compression"]))
+            cursor.copy_expert(f"COPY {quote('import_' + table)} FROM STDIN WITH (FORMAT binary)", hashing)
+            # The rest of the stream (past the COPY trailer), so all of it is checked.
+            while hashing.read(1 << 20):
+                pass
+            if cursor.rowcount != tables[table]["rows"] or hashing.sha256.hexdigest() != tables[table]["sha256"]:
+                raise Exception(f"The {table} data of {path} is corrupt (its row count or checksum doesn't match the manifest's).")
+            if on_table:
+                on_table(table, cursor.rowcount)
+
+        for table in REMAPPED:
+            sequence = session.execute(text("SELECT pg_get_serial_sequence(:table, 'id')"), {"table": table}).scalar()
+            session.execute(text(f"CREATE TEMPORARY TABLE import_{table}_ids ON COMMIT DROP AS SELECT id AS old_id, "
+                                 f"nextval(CAST({sql_string(sequence)} AS regclass)) AS new_id FROM import_{table}"))
+            session.execute(text(f"CREATE INDEX ON import_{table}_ids (old_id)"))
+            session.execute(text(f"ANALYZE import_{table}_ids"))
+        compact = is_compact(session)
+        for table, _ in TABLES:
+            if table == "raw_data" and compact:
+                session.execute(text(COMPACT_KEYS))
+                session.execute(text(COMPACT_RAW_DATA))
+            else:
+                session.execute(text(insert_rows(table, tables[table]["columns"])), {"cohort": cohort_id})
+
+        batch_ids = [batch_id for batch_id, in session.execute(text("SELECT new_id FROM import_batch_ids ORDER BY new_id"))]
+        merge_shares(session, batch_ids)
+        evaluate_rules(session, batch_ids=batch_ids)
+        return cohort_id, {table: tables[table]["rows"] for table, _ in TABLES}
@@ -0,0 +1,61 @@
+import io
+from sqlalchemy import Column, MetaData, Table, Text, bindparam, func, select, text
+from sqlalchemy.dialects.postgresql import ARRAY
+from . import crud
+
+"""
+Value lists for filtering query by thousands of values (--sample-list / --library-id-list files), joined against
+instead of a long IN (...) list.
+
+The values are bulk loaded (COPY) into a session temp table with a primary key, analysed so the planner knows
+its size, and joined against the indexed sample column: a handful of values are index lookups, tens of thousands
+a hash join, either way about one scan's worth of work rather than a comparison per listed value.
+Temp tables can't be created on a read only replica, there the values are one array parameter joined with unnest().
+"""
+
+# Indexes of the sample columns lists are joined against. Databases created before they were added to the models
+# get them with CREATE INDEX CONCURRENTLY, which doesn't block writes.
+LIST_INDEXES = [("ix_sample_sample_name", "sample", "sample_name"), ("ix_sample_library_id", "sample", "library_id")]
+
+STRIP_CHARS = " \n\r\t\'\""
+
+def ensure_list_indexes(shard=crud.DEFAULT_SHARD):
+    with crud.get_engine(shard=shard).connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        existing = {name for name, in connection.execute(text("SELECT indexname FROM pg_indexes WHERE tablename = 'sample'"))}
+        for name, table, column in LIST_INDEXES:
+            if name not in existing:
+                connection.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({column})")
+
+# Returns the file's values, one per line (blank lines skipped), without duplicates.
+def read_values(path):
+    with open(path) as values_file:
+        values = (line.strip(STRIP_CHARS) for line in values_file)
+        return list(dict.fromkeys(value for value in values if value))
+
+# The list's table (joined on its value column).
+def value_table(name):
+    return Table(name, MetaData(), Column("value", Text, primary_key=True))
+
+# Escapes a value for COPY's text format.
+def copy_text(value):
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+# Loads the values into the session's temp table name (dropped when the transaction ends) and returns the table
+# to join against, or their unnest() on a read only replica.
+def load_values(session, name, values):
+    if session.execute(text("SELECT pg_is_in_recovery()")).scalar():
+        return select([func.unnest(bindparam(f"{name}_values", values, type_=ARRAY(Text))).label("value")]).alias(name)
+    session.execute(f"CREATE TEMPORARY TABLE {name} (value text NOT NULL) ON COMMIT DROP")
+    cursor = session.connection().connection.cursor()
+    cursor.copy_expert(f"COPY {name} (value) FROM STDIN", io.StringIO("".join(copy_text(value) + "\n" for value in values)))
+    session.execute(f"ALTER TABLE {name} ADD PRIMARY KEY (value)")
+    session.execute(f"ANALYZE {name}")
+    return value_table(name)
+
+# Loads the values into a temp table of the (snapshot) DuckDB connection.
+def load_duckdb_values(connection, name, values):
+    import pandas as pd
+    connection.register(f"{name}_values", pd.DataFrame({"value": values}, dtype=object))
+    connection.execute(f"CREATE OR REPLACE TEMPORARY TABLE {name} (value VARCHAR PRIMARY KEY)")
+    connection.execute(f"INSERT INTO {name} SELECT value FROM {name}_values")
+    connection.unregister(f"{name}_values")
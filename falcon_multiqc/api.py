@@ -0,0 +1,222 @@
+from database import crud, snapshot
+from database.catalog import get_catalog
+from database.federation import fan_out
+from database.models import Sample
+from database.rules import rule_set_ids
+from database.value_lists import ensure_list_indexes, load_duckdb_values
+from sqlalchemy import Float, Integer, Numeric, cast
+from .commands.query import build_query, check_engine_options, result_header, select_tool_metrics
+
+"""
+Python API of the query command, for notebooks and pipelines to query the database in-process rather than running
+falcon_multiqc query --csv and parsing its output:
+
+    from falcon_multiqc.api import Client
+
+    client = Client()
+    frame = client.query(select=["sample"], tool_metric=[("verifybamid", "AVG_DP", "<", 30)], cohort=["MGRB"])
+    table = client.query(select_tool=["picard_wgsmetrics:PCT_*"], batch=["AAA"], output="arrow")
+
+Client.query takes the query command's options as keyword arguments (lists for the options used multiple times, see
+falcon_multiqc query --help) and builds the same query (see build_query in commands/query.py). Its result is a pandas
+DataFrame (or a pyarrow Table with output="arrow", which needs the pyarrow package), with the query command's column
+names (e.g. sample.sample_name, raw_data.AVG_DP, verifybamid.AVG_DP) and typed columns:
+    integers -- Int64 (nullable), floats and --select-tool metrics -- float64,
+    --tool-metric metrics -- float64 if the metric is numeric (in the metric catalog, see database/catalog.py),
+        its non-numeric values (e.g. 'NA') as missing, else strings.
+Rows are fetched from a server-side cursor batch_size rows at a time, each batch converted to columns as it arrives,
+so neither the rows nor a text rendering of them are held whole. Clients use the process's pooled engines (see
+database/crud.py), so a notebook's queries reuse their connections. With shards, every shard is queried at once.
+
+Client(engine="duckdb") queries the local snapshot instead (see the snapshot command), converted by DuckDB itself.
+
+Client.matrix returns chosen metrics as a cached, memory-mapped NumPy matrix (see the matrix command), for analyses that
+read the same metrics repeatedly.
+"""
+
+# Rows fetched from the cursor at a time.
+DEFAULT_BATCH_SIZE = 10000
+
+# Column kinds (see column_kinds): pandas dtype and pyarrow type name.
+KINDS = {
+    "integer": ("Int64", "int64"),
+    "float": ("float64", "float64"),
+    "string": (object, "string"),
+}
+
+def import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise Exception("output='arrow' requires the pyarrow package (pip install pyarrow).")
+    return pyarrow
+
+# Returns the kind (see KINDS) of each column of the query's result.
+# numeric_metrics is the tool-metric columns' names (raw_data.<metric>) whose metric is numeric.
+def column_kinds(query, header, numeric_metrics):
+    kinds = []
+    for col, name in zip(query.column_descriptions, header):
+        if isinstance(col["type"], Integer):
+            kinds.append("integer")
+        elif isinstance(col["type"], (Float, Numeric)) or name in numeric_metrics:
+            kinds.append("float")
+        else:
+            kinds.append("string")
+    return kinds
+
+# Converts a column's values to its kind (the database's decimals and the metrics' text to floats).
+def typed_values(values, kind):
+    if kind != "float":
+        return values
+    typed = []
+    for value in values:
+        try:
+            typed.append(None if value is None else float(value))
+        except ValueError:
+            typed.append(None)
+    return typed
+
+# Returns the rows as a DataFrame / pyarrow RecordBatch of the columns' kinds.
+def rows_chunk(rows, header, kinds, output):
+    columns = [typed_values(values, kind) for values, kind in zip(zip(*rows), kinds)] if rows else [[] for _ in header]
+    if output == "arrow":
+        pa = import_pyarrow()
+        return pa.RecordBatch.from_arrays([pa.array(values, type=getattr(pa, KINDS[kind][1])())
+                                           for values, kind in zip(columns, kinds)], names=header)
+    import pandas as pd
+    return pd.DataFrame({name: pd.Series(values, dtype=KINDS[kind][0]) for name, values, kind in zip(header, columns, kinds)},
+                        columns=header)
+
+# Combines the chunks (at least one) into the result.
+def combine(chunks, output):
+    if output == "arrow":
+        return import_pyarrow().Table.from_batches(chunks)
+    import pandas as pd
+    return pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+
+# Fetches the query's rows from a server-side cursor, batch_size at a time. Returns the chunks (see rows_chunk).
+def fetch_chunks(session, query, header, kinds, output, batch_size):
+    result = session.connection().execution_options(stream_results=True).execute(query.statement)
+    chunks = []
+    while True:
+        rows = result.fetchmany(batch_size)
+        if rows or not chunks:
+            chunks.append(rows_chunk(rows, header, kinds, output))
+        if len(rows) < batch_size:
+            return chunks
+
+
+class Client:
+    """Queries the falcon_multiqc database (or its snapshot with engine="duckdb") from Python, see Client.query."""
+
+    def __init__(self, engine="postgres", snapshot_dir=None):
+        self.duckdb = engine.lower() == "duckdb"
+        self.snapshot_dir = snapshot_dir or snapshot.snapshot_dir()
+        # The snapshot's DuckDB connection, opened on first use.
+        self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Closes the snapshot connection (the database engines stay pooled for the process).
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def connection(self):
+        if self._connection is None:
+            self._connection = snapshot.connect(self.snapshot_dir)
+        return self._connection
+
+    def query(self, select=("sample",), tool_metric=(), select_tool=(), batch=(), cohort=(), batch_description=(),
+              cohort_description=(), sample_description=(), description_match="contains", flowcell_lane=(), library_id=(),
+              sample_list=(), library_id_list=(), failed_rule=(), platform=(), centre=(), reference=(), type=(),
+              output="pandas", batch_size=DEFAULT_BATCH_SIZE):
+        """Returns the result of the query command with these options, as a pandas DataFrame (or pyarrow Table with
+        output="arrow"). tool_metric is [(tool, metric, operator, value)], or (tool, metric) to select a metric
+        without filtering on it. sample_list / library_id_list are the sample names / library ids themselves."""
+        if output not in ("pandas", "arrow"):
+            raise Exception(f"Unknown output {output}, use pandas or arrow.")
+        if output == "arrow":
+            import_pyarrow()
+        tool_metric = [tuple(tm) if len(tm) == 4 else (*tm, "", "") for tm in tool_metric]
+        check_engine_options(self.duckdb, failed_rule, description_match)
+        value_lists = {}
+        if sample_list:
+            value_lists["sample_name_list"] = (Sample.sample_name, list(dict.fromkeys(sample_list)))
+        if library_id_list:
+            value_lists["library_id_list"] = (Sample.library_id, list(dict.fromkeys(library_id_list)))
+        options = dict(select=select, tool_metric=tool_metric, batch=batch, cohort=cohort, batch_description=batch_description,
+                       cohort_description=cohort_description, sample_description=sample_description,
+                       description_match=description_match, flowcell_lane=flowcell_lane, library_id=library_id,
+                       value_lists=value_lists, failed_rule=failed_rule, platform=platform, centre=centre, reference=reference,
+                       type=type, duckdb=self.duckdb)
+
+        if self.duckdb:
+            connection = self.connection()
+            if select_tool:
+                options["select_tools"] = select_tool_metrics(snapshot.tool_catalog(connection, self.snapshot_dir), select_tool)
+            query, _ = build_query(None, **options)
+            for name, (column, values) in value_lists.items():
+                load_duckdb_values(connection, name, values)
+            header = result_header(query)
+            # The --tool-metric columns are text (metrics ->> metric), numeric when the snapshot's metric is.
+            numeric_metrics = {f"raw_data.{metric}" for tool, metric, _, _ in tool_metric
+                               if snapshot.metric_types(connection, self.snapshot_dir, tool).get(metric, "VARCHAR") != "VARCHAR"}
+            result = snapshot.query_result(connection, query)
+            if output == "arrow":
+                pa = import_pyarrow()
+                table = result.arrow()
+                # A RecordBatchReader in newer DuckDB versions.
+                table = (table.read_all() if hasattr(table, "read_all") else table).rename_columns(header)
+                for name in numeric_metrics & set(header):
+                    table = table.set_column(header.index(name), name, pa.array(typed_values(table[name].to_pylist(), "float"), pa.float64()))
+                return table
+            import pandas as pd
+            frame = result.df()
+            frame.columns = header
+            for name in numeric_metrics & set(header):
+                frame[name] = pd.to_numeric(frame[name], errors="coerce").astype("float64")
+            return frame
+
+        if value_lists:
+            for shard in crud.shard_names():
+                ensure_list_indexes(shard)
+        with crud.session_scope(crud.REPLICA) as session:
+            if failed_rule:
+                rule_set_ids(session, failed_rule)
+            catalog = get_catalog(session)
+            if select_tool:
+                options["select_tools"] = select_tool_metrics(catalog, select_tool)
+            numeric_metrics = {f"raw_data.{metric}" for tool, metric, _, _ in tool_metric if metric in catalog.get(tool, ())}
+
+        # Each shard's rows (see database/federation.py), ordered by the similar descriptions' rankings after.
+        def run(session, shard):
+            query, rankings = build_query(session, **options)
+            header = result_header(query)
+            query = query.add_columns(*[cast(ranking, Float).label(f"ranking_{i}") for i, ranking in enumerate(rankings)])
+            header += [f"ranking_{i}" for i in range(len(rankings))]
+            return header, fetch_chunks(session, query, header, column_kinds(query, header, numeric_metrics), output, batch_size)
+        results = fan_out(run)
+        header = results[0][0]
+        combined = combine([chunk for _, chunks in results for chunk in chunks], output)
+        rankings = [name for name in header if name.startswith("ranking_")]
+        if not rankings:
+            return combined
+        if output == "arrow":
+            return combined.sort_by([(ranking, "descending") for ranking in rankings]).drop_columns(rankings)
+        return combined.sort_values(rankings, ascending=False, kind="stable", ignore_index=True).drop(columns=rankings)
+
+    def matrix(self, tool_metric=(), select_tool=(), dtype="float32", matrix_dir=None, refresh=True):
+        """Returns the cached (samples x metrics) matrix of these metrics (see database/matrix.py), extracting the
+        batches saved or removed since it was cached first (unless refresh=False). tool_metric is [(tool, metric)],
+        select_tool the query command's --select-tool options."""
+        from database.matrix import open_matrix
+        from .commands.matrix import matrix_metrics
+        with crud.session_scope(crud.REPLICA) as session:
+            tool_metrics = matrix_metrics(get_catalog(session), tool_metric, select_tool)
+        return open_matrix(tool_metrics, dtype, matrix_dir, refresh)
@@ -1,37 +1,92 @@
-import os
+import sys
 import click
 import traceback
 
+# Static command registry: command name -> (module in falcon_multiqc.commands, short help).
+# Listing commands (e.g. falcon_multiqc --help) uses this instead of importing every command module,
+# so only the invoked command pays for its imports (sqlalchemy, pandas, plotly...).
+# Add new commands here; the short help must be a prefix of the command's docstring
+# (checked by benchmarks/importtime.py and tests/test_cli.py).
+COMMANDS = {
+    "baseline": ("baseline", "Prints the running metric baselines of each centre / platform / reference genome, that save reports drift against."),
+    "chart": ("chart", "Chart data from the query command."),
+    "check_db": ("check_db", "Checks the paths in the database are still valid and prompts for an update."),
+    "compact": ("compact", "Converts raw_data to the compact metric storage format (or back with --expand), reporting the size change."),
+    "connect": ("connect", "Connects the user to a postgres database, creates a new database if one doesn't exist"),
+    "distribution": ("distribution", "Summarise metric distributions from the saved per batch sketches"),
+    "export": ("export_cohort", "Exports a cohort's rows to a portable compressed archive (binary COPY), for the import command."),
+    "import": ("import_cohort", "Imports a cohort archive written by the export command, giving its rows new ids."),
+    "maintain": ("maintain", "Reports table / index sizes, bloat and usage, and runs the VACUUM / ANALYZE / REINDEX they need."),
+    "matrix": ("matrix", "Caches a (samples x metrics) NumPy matrix of chosen metrics locally, memory-mapped, refreshed per changed batch."),
+    "query": ("query", "Query the falcon qc database"),
+    "recreate_tables": ("recreate_tables", "Creates new database tables, overwriting the last."),
+    "remove": ("remove", "Removes all associated rows of specified batch/cohort from database."),
+    "rules": ("rules", "Manages the stored QC rule sets that save evaluates against each new batch."),
+    "save": ("save", "Saves the given cohort directory to the falcon_multiqc database"),
+    "serve": ("serve", "Runs a local daemon that keeps database connections and imports warm."),
+    "snapshot": ("snapshot", "Exports a local Parquet snapshot of the database for the duckdb engine (--engine duckdb)."),
+    "sql": ("sql", "SQL query tool"),
+    "watch": ("watch", "Watches a landing directory and saves the multiqc output directories that land in it, recording each as a job."),
+}
+
+# Commands that run through the local daemon (falcon_multiqc serve, see daemon.py) when it is running.
+# They never prompt the user or read stdin. chart is left out as its dashboard mode forks a process pool,
+# which isn't safe from the multi-threaded daemon.
+DAEMON_COMMANDS = ["distribution", "query", "remove", "save", "sql"]
+
 # ComplexCLI code mainly from Click example.
 # https://github.com/pallets/click/blob/master/examples/complex/complex/cli.py#L31
 class ComplexCLI(click.MultiCommand):
     def list_commands(self, ctx):
-        commands = []
-        commands_folder = os.path.abspath(os.path.join(os.path.dirname(__file__), "commands"))
-        for filename in os.listdir(commands_folder):
-            if filename.endswith(".py") and not filename.startswith("__"):
-                commands.append(filename.replace(".py", ""))
-
-        commands.sort()
-        return commands
+        return sorted(COMMANDS)
 
     def get_command(self, ctx, name):
+        if name not in COMMANDS:
+            return
         try:
-            mod = __import__(f"falcon_multiqc.commands.{name}", None, None, ["cli"])
+            mod = __import__(f"falcon_multiqc.commands.{COMMANDS[name][0]}", None, None, ["cli"])
         except ImportError as e:
             print(e)
             return
         return mod.cli
 
+    # Same output as click's default, but with the registry's help so no command module is imported.
+    def format_commands(self, ctx, formatter):
+        rows = [(name, COMMANDS[name][1]) for name in self.list_commands(ctx)]
+        with formatter.section("Commands"):
+            formatter.write_dl(rows)
+
 @click.command(cls=ComplexCLI)
-def cli():
+@click.option("--stats", is_flag=True, help="Print the command's SQL statement counts and timings (to stderr).")
+@click.option("--stats-log", type=click.Path(dir_okay=False), help="Append the command's stats as a JSON line to this file.")
+@click.option("--stats-top", type=click.IntRange(0, 100), default=5, help="Number of slowest / most repeated statements to report.")
+@click.pass_context
+def cli(ctx, stats, stats_log, stats_top):
     """Welcome to Falcon multiQC!"""
-    pass
+    if stats or stats_log:
+        # database.stats is only imported when asked for, see database/stats.py.
+        from database.stats import start_stats, stop_stats, format_summary, append_log
+        start_stats(ctx.invoked_subcommand)
+
+        def report():
+            summary = stop_stats().summary(stats_top)
+            if stats:
+                click.echo(format_summary(summary), err=True)
+            if stats_log:
+                append_log(stats_log, summary)
+        ctx.call_on_close(report)
 
 # Ensures exceptions are printed nicely.
+# DAEMON_COMMANDS are run by the local daemon when one is running (daemon.py is only imported for them).
 def safe_entry_point():
+    if len(sys.argv) > 1 and sys.argv[1] in DAEMON_COMMANDS:
+        from .daemon import daemon_enabled, run_remote
+        if daemon_enabled():
+            exit_code = run_remote(sys.argv[1:])
+            if exit_code is not None:
+                sys.exit(exit_code)
     try:
         cli()
     except Exception as e:
         click.echo(traceback.format_exc()) # Remove this line if you don't want to print stack trace.
-        click.echo(click.style(str(e), fg="red"))
\ No newline at end of file
+        click.echo(click.style(str(e), fg="red"))
@@ -0,0 +1,71 @@
+import click
+from database.baselines import GROUP, rebuild_baselines
+from database.crud import session_scope, shard_names
+from database.federation import fan_out
+from database.models import MetricBaseline
+from database.sketch import merge_moments, std_dev
+
+"""
+This command prints the running metric baselines that save compares each new batch with (see database/baselines.py),
+one per (centre, platform, reference genome, tool, metric). They're kept up to date by save and remove, so this
+reads them without scanning raw_data.
+
+--tool <tool name> / --tool-metric <tool name> <metric> Only print the baselines of these tools / metrics.
+--centre / --platform / --reference <value> Only print the baselines of these groups (behaves like OR when multiple).
+--rebuild Build the baselines of batches saved before baselines existed (scans their raw_data once).
+
+With shards (see database/crud.py), each shard's baselines of a group are merged.
+
+Example (the depth baseline of each KCCG group):
+    falcon_multiqc baseline -tm verifybamid AVG_DP --centre KCCG
+"""
+
+@click.command()
+@click.option("-t", "--tool", multiple=True, required=False, help="Only print the baselines of this tool.")
+@click.option("-tm", "--tool-metric", multiple=True, type=(str, str), required=False, help="Only print the baselines of this tool and metric, e.g. 'verifybamid AVG_DP'.")
+@click.option("-ctr", "--centre", multiple=True, required=False, help="Only print the baselines of this centre.")
+@click.option("-pl", "--platform", multiple=True, required=False, help="Only print the baselines of this platform.")
+@click.option("-rf", "--reference", multiple=True, required=False, help="Only print the baselines of this reference genome.")
+@click.option("--rebuild", is_flag=True, required=False, help="Build the baselines of batches saved before baselines existed.")
+def cli(tool, tool_metric, centre, platform, reference, rebuild):
+    """Prints the running metric baselines of each centre / platform / reference genome, that save reports drift against."""
+
+    if rebuild:
+        click.echo("Building missing metric baselines...")
+        built = 0
+        for shard in shard_names():
+            with session_scope(shard=shard) as session:
+                built += rebuild_baselines(session)
+        click.echo(f"Built metric baselines for {built} batches.")
+
+    def baselines(session, shard):
+        query = session.query(MetricBaseline)
+        for column, values in [(MetricBaseline.qc_tool, tool), (MetricBaseline.centre, centre),
+                               (MetricBaseline.platform, platform), (MetricBaseline.reference_genome, reference)]:
+            if values:
+                query = query.filter(column.in_(values))
+        if tool_metric:
+            query = query.filter(MetricBaseline.qc_tool.in_([tool for tool, _ in tool_metric]),
+                                 MetricBaseline.metric.in_([metric for _, metric in tool_metric]))
+        return [(tuple(getattr(baseline, column) for column in GROUP), (baseline.count, baseline.mean, baseline.m2),
+                 baseline.min, baseline.max) for baseline in query
+                if not tool_metric or (baseline.qc_tool, baseline.metric) in tool_metric]
+
+    merged = {}
+    for rows in fan_out(baselines):
+        for group, baseline_moments, minimum, maximum in rows:
+            if group in merged:
+                previous_moments, previous_min, previous_max = merged[group]
+                merged[group] = (merge_moments(previous_moments, baseline_moments), min(previous_min, minimum), max(previous_max, maximum))
+            else:
+                merged[group] = (baseline_moments, minimum, maximum)
+    if not merged:
+        click.echo("No metric baselines match this selection. Baselines are built as batches are saved, see --rebuild.")
+        return
+
+    from tabulate import tabulate
+    table = []
+    for group, ((count, mean, m2), minimum, maximum) in sorted(merged.items()):
+        table.append([*group, count, mean, std_dev(count, m2), minimum, maximum])
+    click.echo(tabulate(table, ["Centre", "Platform", "Reference", "Tool", "Metric", "Count", "Mean", "SD", "Min", "Max"],
+                        tablefmt="pretty"))
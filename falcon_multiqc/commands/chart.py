@@ -2,10 +2,9 @@ import sys
 import os
 import click
 import math
-import plotly.express as px
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
-import pandas as pd
+import html
+from concurrent.futures import ProcessPoolExecutor
+from database.stats import file_io
 
 """
 This command allows you to visualise the output of the `query` command. 
@@ -13,6 +12,8 @@ The output will be a html file (path and name specified by `--output`),
 with each value hoverable for extra details. 
 
 - Input should be a csv from `query` command: supports stdin or `--data path/to/query_output.csv`
+- Or `--sql path/to/query.txt` charts the result of raw SQL (see the sql command), run against the database or,
+  with `--engine duckdb`, the local snapshot (see the snapshot command). Alias metric columns as "raw_data.<metric>".
 - `--output` specifies where to save the output (include filename).
 - `--type` [histogram / box / bar] type of chart.
 - `--compare` x-axis of box and bar, overlapped group on histogram. **Required for bar**. Must be a column header of the query output e.g. `raw_data.PCT_EXC_DUPE` or `batch.description`
@@ -29,55 +30,58 @@ Types:
 - Box (use for metrics [vs groups])
   - `--compare` column that will be plotted on the x-axis [Optional].
   - Supports multiple metrics (will be plotted as separate graphs).
+
+Dashboard (`--spec dashboard.yaml` instead of `--type`):
+  Loads the input once and renders every panel of the spec into one html file (sharing one plotly.js).
+  Panels are laid out in a grid of `columns` (default SUBPLOT_COLS) and rendered in parallel (`--workers`).
+
+    title: Weekly QC
+    data: path/to/query_output.csv   # Optional, otherwise --data or stdin. Relative to the spec file.
+    columns: 2                       # Optional.
+    panels:
+      - type: histogram
+        metrics: [raw_data.AVG_DP]   # Optional, defaults to every raw_data column of the input.
+        compare: batch.batch_name    # Optional (required for bar).
+        title: AVG_DP per batch      # Optional.
+      - type: box
+        metrics: [raw_data.MEAN_INSERT_SIZE, raw_data.PCT_EXC_DUPE]
 """
 
+# pandas and plotly are imported inside the functions that use them, so importing this
+# command (e.g. for falcon_multiqc chart --help) stays fast.
+
 SUBPLOT_ROWS = 2
 SUBPLOT_COLS = 2
 
 def subplot(metrics):
+  from plotly.subplots import make_subplots
   return make_subplots(
     rows=(math.ceil(len(metrics) / SUBPLOT_ROWS)),
     cols=SUBPLOT_COLS,
     start_cell="top-left",
     subplot_titles=metrics)
 
-def getRow(i):
-  return (i//SUBPLOT_ROWS) + 1
-
-def getCol(i):
-  return ((i%SUBPLOT_COLS) + 1)
-
-@click.command()
-@click.option("-d", "--data", type=click.File(), help="Input CSV data to chart.")
-@click.option("-o", "--output", type=click.Path(), required=True, help="Path where output should be saved.")
-@click.option("-f", "--filename", required=True, help="Name of the file output.")
-@click.option("-t", "--type", type=click.Choice(["histogram", "box", "bar"], case_sensitive=False), required=True, help="Type of chart.")
-@click.option("-c", "--compare", required=False, help="What column you want to compare or group by")
-def cli(data, output, filename, type, compare):
-  """Chart data from the query command. Requires csv input (--data or stdin)."""
-  if data:
-    input_df = pd.read_csv(data)
-  elif not sys.stdin.isatty(): # Stdin
-    input_df = pd.read_csv(click.get_text_stream('stdin'))
-  else:
-    raise Exception("Chart requires csv data input via --data or stdin.")  
-
-  # Check output and filename for validity.
-  if (output):
-      output = os.path.abspath(output)
-      if (not os.path.isdir(output)):
-          raise Exception(f"Output path {output} is NOT a directory. Please use a directory path with --output.")
-      if (not os.path.exists(output)):
-          raise Exception(f"Output path {output} does not exist.")
+def getRow(i, columns=SUBPLOT_COLS):
+  return (i//columns) + 1
 
-  click.echo("First 5 lines of your input...")
-  click.echo(input_df.head(5))
+def getCol(i, columns=SUBPLOT_COLS):
+  return ((i%columns) + 1)
 
+def getMetrics(input_df):
   metrics = []
   for col in input_df.columns:
     if col.split(".")[0] == "raw_data":
       # Column is a metric.
       metrics.append(col)
+  return metrics
+
+# Returns the plotly figure of the given chart type for the given metrics of input_df.
+def build_figure(input_df, type, compare, metrics):
+  import plotly.express as px
+  import plotly.graph_objects as go
+
+  if not metrics:
+    raise Exception("The input has no raw_data metric columns to chart.")
 
   if compare and compare not in input_df.columns:
     raise Exception(f"Selected to compare '{compare}' but {compare} is not in the input csv.")
@@ -139,4 +143,141 @@ def cli(data, output, filename, type, compare):
 
       fig.update_layout(showlegend=False)
 
-  fig.write_html(f"{output}/{filename}.html")
+  else:
+    raise Exception(f"Unknown chart type '{type}', use one of histogram / box / bar.")
+
+  return fig
+
+### ================================= DASHBOARD  ==========================================####
+
+# The dashboard input is loaded once per worker process (see ProcessPoolExecutor initializer).
+_dashboard_df = None
+
+def _init_dashboard_worker(input_df):
+  global _dashboard_df
+  _dashboard_df = input_df
+
+# Renders one dashboard panel as a html div (without plotly.js).
+# Pool workers use the dataframe given to their initializer, in-process rendering passes it in
+# (so concurrent callers in one process don't share the global).
+def render_panel(panel, input_df=None):
+  if input_df is None:
+    input_df = _dashboard_df
+  fig = build_figure(input_df, panel["type"], panel.get("compare"), panel["metrics"])
+  if panel.get("title"):
+    fig.update_layout(title=panel["title"])
+  return fig.to_html(full_html=False, include_plotlyjs=False)
+
+def read_spec(spec, input_df):
+  panels = spec.get("panels")
+  if not panels:
+    raise Exception("Dashboard spec requires a list of panels.")
+  columns = spec.get("columns", SUBPLOT_COLS)
+  if not isinstance(columns, int) or isinstance(columns, bool) or columns < 1:
+    raise Exception(f"Dashboard spec columns must be a whole number of at least 1, not '{columns}'.")
+  for i, panel in enumerate(panels):
+    # Case insensitive, like --type.
+    panel["type"] = str(panel.get("type", "")).lower()
+    if panel["type"] not in ["histogram", "box", "bar"]:
+      raise Exception(f"Panel {i + 1} of the spec needs a type of histogram / box / bar.")
+    metrics = panel.get("metrics", getMetrics(input_df))
+    panel["metrics"] = [metrics] if isinstance(metrics, str) else metrics
+    for col in panel["metrics"] + ([panel["compare"]] if panel.get("compare") else []):
+      if col not in input_df.columns:
+        raise Exception(f"Panel {i + 1} of the spec uses '{col}' but {col} is not in the input csv.")
+  return panels
+
+def write_dashboard(input_df, spec, output, filename, workers):
+  from plotly.offline import get_plotlyjs
+  panels = read_spec(spec, input_df)
+  columns = spec.get("columns", SUBPLOT_COLS)
+
+  click.echo(f"Rendering {len(panels)} panels...")
+  if workers > 1 and len(panels) > 1:
+    with ProcessPoolExecutor(max_workers=min(workers, len(panels)), initializer=_init_dashboard_worker, initargs=(input_df,)) as pool:
+      divs = list(pool.map(render_panel, panels))
+  else:
+    divs = [render_panel(panel, input_df) for panel in panels]
+
+  # Place each panel in a css grid, in the same order as the subplot layout (getRow / getCol).
+  cells = []
+  for i, div in enumerate(divs):
+    row, col = getRow(i, columns), getCol(i, columns)
+    cells.append(f'<div style="grid-row: {row}; grid-column: {col}; min-width: 0;">{div}</div>')
+
+  title = html.escape(str(spec.get("title", filename)))
+  with open(f"{output}/{filename}.html", "w") as dashboard:
+    dashboard.write(f"<html>\n<head><meta charset=\"utf-8\"/><title>{title}</title>\n")
+    dashboard.write(f'<script type="text/javascript">{get_plotlyjs()}</script>\n</head>\n<body>\n')
+    dashboard.write(f"<h1>{title}</h1>\n")
+    dashboard.write(f'<div style="display: grid; grid-template-columns: repeat({columns}, 1fr);">\n')
+    dashboard.write("\n".join(cells))
+    dashboard.write("\n</div>\n</body>\n</html>\n")
+
+# Returns the result of the raw SQL in sql_path as a DataFrame, from the database or the local snapshot (--engine duckdb).
+def read_sql(sql_path, engine, snapshot_dir):
+  with open(sql_path) as sql_file:
+    sql = sql_file.read()
+  if engine.lower() == "duckdb":
+    from database import snapshot
+    return snapshot.connect(snapshot_dir or snapshot.snapshot_dir()).execute(snapshot.postgres_casts(sql)).df()
+  import pandas as pd
+  from sqlalchemy import text
+  from database.crud import session_scope, REPLICA
+  with session_scope(REPLICA) as session:
+    result = session.execute(text(sql))
+    return pd.DataFrame(result.fetchall(), columns=result.keys())
+
+@click.command()
+@click.option("-d", "--data", type=click.File(), help="Input CSV data to chart.")
+@click.option("-o", "--output", type=click.Path(), required=True, help="Path where output should be saved.")
+@click.option("-f", "--filename", required=True, help="Name of the file output.")
+@click.option("-t", "--type", type=click.Choice(["histogram", "box", "bar"], case_sensitive=False), required=False, help="Type of chart (required unless --spec).")
+@click.option("-c", "--compare", required=False, help="What column you want to compare or group by")
+@click.option("-s", "--spec", type=click.File(), required=False, help="Dashboard spec (yaml) to render many charts into one html file.")
+@click.option("-w", "--workers", type=click.IntRange(1), default=os.cpu_count() or 1, help="Processes used to render dashboard panels.")
+@click.option("-q", "--sql", type=click.Path(exists=True, dir_okay=False), required=False, help="Chart the result of the raw SQL in this .txt instead of csv input.")
+@click.option("--engine", type=click.Choice(["postgres", "duckdb"], case_sensitive=False), default="postgres", help="Run --sql against the database (postgres) or the local snapshot (duckdb, see the snapshot command).")
+@click.option("--snapshot-dir", type=click.Path(exists=True, file_okay=False), required=False, help="Snapshot directory for --engine duckdb.")
+def cli(data, output, filename, type, compare, spec, workers, sql, engine, snapshot_dir):
+  """Chart data from the query command. Requires csv input (--data or stdin)."""
+  import pandas as pd
+  import yaml
+
+  if not type and not spec:
+    raise Exception("Chart requires either --type or a dashboard --spec.")
+  spec_dir = None
+  if spec:
+    spec_dir = os.path.dirname(os.path.abspath(spec.name))
+    spec = yaml.safe_load(spec) or {}
+
+  if sql:
+    input_df = read_sql(sql, engine, snapshot_dir)
+  else:
+    with file_io():
+      if data:
+        input_df = pd.read_csv(data)
+      elif spec and spec.get("data"):
+        input_df = pd.read_csv(os.path.join(spec_dir, os.path.expanduser(spec["data"])))
+      elif not sys.stdin.isatty(): # Stdin
+        input_df = pd.read_csv(click.get_text_stream('stdin'))
+      else:
+        raise Exception("Chart requires csv data input via --data, --sql or stdin.")
+
+  # Check output and filename for validity.
+  if (output):
+      output = os.path.abspath(output)
+      if (not os.path.isdir(output)):
+          raise Exception(f"Output path {output} is NOT a directory. Please use a directory path with --output.")
+      if (not os.path.exists(output)):
+          raise Exception(f"Output path {output} does not exist.")
+
+  click.echo("First 5 lines of your input...")
+  click.echo(input_df.head(5))
+
+  if spec:
+    write_dashboard(input_df, spec, output, filename, workers)
+  else:
+    fig = build_figure(input_df, type, compare, getMetrics(input_df))
+    with file_io():
+      fig.write_html(f"{output}/{filename}.html")
@@ -1,57 +1,163 @@
 import click
 import importlib
+import json
+import os
+import queue
+import threading
+import time
 from database import config
 from database import crud
-from sqlalchemy.orm import Query
-from sqlalchemy import update
+from sqlalchemy import or_, func
 from database.models import Base, Batch
 from os.path import exists, basename, abspath
 
 """
 Command for checking paths saved in the database are still valid.
 --skip-update to stop the program from prompting the user for a valid path in the case of an invalid db bath.
+--remap <old prefix> <new prefix> Moves every batch path under old prefix to new prefix (one UPDATE per remap, no prompts),
+    e.g. after a mount point changed. Can be used multiple times.
+--workers <number> Number of paths checked at once (default 16).
+--timeout <seconds> Time allowed to check one path, before it is reported as timed out (default 10).
+--cache-ttl <seconds> Valid paths checked within this time are not checked again (default 3600, 0 to always check).
+    Results are cached in $XDG_CACHE_HOME/falcon_multiqc/path_check.json (~/.cache by default).
 """
 
-def check_db_paths(skip_update):
+DEFAULT_WORKERS = 16
+DEFAULT_TIMEOUT = 10 # seconds
+DEFAULT_CACHE_TTL = 3600 # seconds
+
+def cache_path():
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "falcon_multiqc", "path_check.json")
+
+# Returns {path: checked at} of the paths found to exist (invalid paths are always checked again).
+def read_cache():
+    try:
+        with open(cache_path()) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+def write_cache(cache):
+    path = cache_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as cache_file:
+            json.dump(cache, cache_file)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        click.echo(f"Could not save the path check cache: {e}")
+
+# Checks paths exist, several at once. Returns {path: True / False, or None if the check timed out}.
+# Daemon threads are used so a path stuck on a hung mount can't stop falcon_multiqc from exiting,
+# and each timed out check is replaced by a new thread so the others carry on.
+def check_paths(paths, workers=DEFAULT_WORKERS, timeout=DEFAULT_TIMEOUT):
+    pending = queue.Queue()
+    for path in paths:
+        pending.put(path)
+    results = {}
+    started = {} # path : time its check started
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                path = pending.get_nowait()
+            except queue.Empty:
+                return
+            with lock:
+                started[path] = time.monotonic()
+            path_exists = exists(path)
+            with lock:
+                if path not in results:
+                    results[path] = path_exists
+                if results[path] is None:
+                    # Timed out, another thread has taken this one's place.
+                    return
+
+    def start_worker():
+        threading.Thread(target=worker, daemon=True).start()
+
+    for _ in range(min(workers, len(paths))):
+        start_worker()
+    while True:
+        with lock:
+            if len(results) == len(paths):
+                return results
+            now = time.monotonic()
+            timed_out = [path for path, start in started.items() if path not in results and now - start > timeout]
+            for path in timed_out:
+                results[path] = None
+        for _ in timed_out:
+            start_worker()
+        time.sleep(0.01)
+
+# Moves every batch path equal to / under old_prefix to new_prefix in one UPDATE. Returns the number of batches updated.
+def remap_paths(session, old_prefix, new_prefix):
+    old_prefix, new_prefix = old_prefix.rstrip("/"), new_prefix.rstrip("/")
+    # Match whole directory names, so /data/a doesn't remap /data/ab.
+    under_old = Batch.path.startswith(old_prefix + "/", autoescape=True)
+    return session.query(Batch).filter(or_(Batch.path == old_prefix, under_old)).\
+        update({Batch.path: new_prefix + func.substr(Batch.path, len(old_prefix) + 1)}, synchronize_session=False)
+
+def check_db_paths(skip_update, remap=(), workers=DEFAULT_WORKERS, timeout=DEFAULT_TIMEOUT, cache_ttl=DEFAULT_CACHE_TTL):
     importlib.reload(config)
     importlib.reload(crud)
+
+    if remap:
+        with crud.session_scope() as session:
+            for old_prefix, new_prefix in remap:
+                updated = remap_paths(session, old_prefix, new_prefix)
+                print(f"Remapped {updated} batch paths from '{old_prefix}' to '{new_prefix}'")
+
+    # Read the paths from the replica (when there is one), updates go to the primary.
+    with crud.session_scope(crud.REPLICA) as session:
+        # Query the distinct paths in the batch table
+        paths = [path for path, in session.query(Batch.path).distinct()]
+
+    print(f"Checking {len(paths)} database paths...")
+    cache = read_cache() if cache_ttl > 0 else {}
+    now = time.time()
+    results = {path: True for path in paths if path in cache and now - cache[path] <= cache_ttl}
+    to_check = [path for path in paths if path not in results]
+    results.update(check_paths(to_check, workers, timeout))
+    if cache_ttl > 0:
+        # Only keep paths still in the database.
+        cache = {path: cache[path] for path in paths if path in cache and path not in to_check}
+        cache.update({path: now for path in to_check if results[path]})
+        write_cache(cache)
+
+    timed_out = sorted(path for path in paths if results[path] is None)
+    for path in timed_out:
+        print(f"Timed out after {timeout}s checking path '{path}'")
+    invalid = sorted(path for path in paths if results[path] is False)
+
     with crud.session_scope() as session:
-        # Query the paths in the batch table
-        paths = session.query(Batch.path)
-
-        # We don't want to re-check the same path
-        checked = []
-        print("Checking database paths...")
-        for path_tuple in paths:
-            old_path = path_tuple[0]
-            if old_path not in checked:
-                # check it exists
-                if exists(old_path):
-                    # add it to checked
-                    checked.append(old_path)
-                else:
-                    print(f"File '{basename(old_path)}' no longer exists at path '{old_path}'")
-                    if not skip_update:
-                        # Prompt for update
-                        if click.confirm('Would you like to update this path now?'):
-                            new_path = click.prompt(f"Please enter the correct path for the directory '{basename(old_path)}'")
-                            # check the new path actually exists
-                            new_path = abspath(new_path)
-                            if exists(new_path):
-                                print(f"Updating old path '{old_path}' to new path '{new_path}'")
-
-                                session.query(Batch).filter(Batch.path == old_path).\
-                                update({Batch.path: new_path}, synchronize_session = False)
-                                
-                                checked.append(old_path)
-                            else:
-                                print(f"Aborting update... file path '{new_path}' does not exist")
-        print("Database check complete!")
+        for old_path in invalid:
+            print(f"File '{basename(old_path)}' no longer exists at path '{old_path}'")
+            if not skip_update:
+                # Prompt for update
+                if click.confirm('Would you like to update this path now?'):
+                    new_path = click.prompt(f"Please enter the correct path for the directory '{basename(old_path)}'")
+                    # check the new path actually exists
+                    new_path = abspath(new_path)
+                    if exists(new_path):
+                        print(f"Updating old path '{old_path}' to new path '{new_path}'")
+
+                        session.query(Batch).filter(Batch.path == old_path).\
+                        update({Batch.path: new_path}, synchronize_session = False)
+                    else:
+                        print(f"Aborting update... file path '{new_path}' does not exist")
+    print(f"Database check complete! {len(paths) - len(invalid) - len(timed_out)} valid, {len(invalid)} invalid, "
+          f"{len(timed_out)} timed out ({len(paths) - len(to_check)} from cache).")
 
 @click.option("-s", "--skip-update",is_flag=True, required=False, help="Skip update prompts for invalid paths while checking the database.")
+@click.option("-r", "--remap", type=(str, str), multiple=True, required=False, help="Move batch paths under an old prefix to a new prefix, e.g. '/old/mount /new/mount'.")
+@click.option("-w", "--workers", type=click.IntRange(1), default=DEFAULT_WORKERS, help="Number of paths checked at once.")
+@click.option("-t", "--timeout", type=click.FloatRange(0.1), default=DEFAULT_TIMEOUT, help="Seconds allowed to check one path.")
+@click.option("--cache-ttl", type=click.IntRange(0), default=DEFAULT_CACHE_TTL, help="Seconds a path check is cached for (0 to always check).")
 @click.command()
-def cli(skip_update):
+def cli(skip_update, remap, workers, timeout, cache_ttl):
     """Checks the paths in the database are still valid and prompts for an update."""
 
-    check_db_paths(skip_update)
-        
\ No newline at end of file
+    check_db_paths(skip_update, remap, workers, timeout, cache_ttl)
@@ -0,0 +1,38 @@
+import click
+import time
+from database.crud import get_engine
+from database.compact import compact, expand, is_compact, storage_sizes
+from database.maintenance import human_bytes
+
+"""
+Converts raw_data to the compact metric storage format, or back with --expand (see database/compact.py).
+
+Compact, each tool's metric names are stored once in raw_data_key, and each row's numeric values as an array
+in raw_data_compact (with a JSONB sidecar for the rest). raw_data becomes a view with the same columns,
+so the other commands and existing sql scripts work the same either way.
+
+--expand Convert back to raw_data rows of JSONB metrics.
+--status Only print the current format and its size.
+
+The conversion rewrites every raw_data row in one transaction, blocking saves / removes (not reads) until it's done.
+"""
+
+@click.command()
+@click.option("--expand", "expand_back", is_flag=True, required=False, help="Convert compact raw_data back to JSONB documents.")
+@click.option("--status", is_flag=True, required=False, help="Only print the current format and its size.")
+def cli(expand_back, status):
+    """Converts raw_data to the compact metric storage format (or back with --expand), reporting the size change."""
+
+    with get_engine().connect() as connection:
+        before = storage_sizes(connection)
+        current = "compact" if is_compact(connection) else "JSONB"
+        if status:
+            click.echo(f"raw_data is stored as {current}: " + ", ".join(f"{table} {human_bytes(size)}" for table, size in before.items()))
+            return
+
+        start = time.perf_counter()
+        with connection.begin():
+            (expand if expand_back else compact)(connection)
+            after = storage_sizes(connection)
+        click.echo(f"Converted raw_data from {current} to {'JSONB' if expand_back else 'compact'} in {time.perf_counter() - start:.1f}s: "
+                   f"{human_bytes(sum(before.values()))} -> {human_bytes(sum(after.values()))}.")
@@ -0,0 +1,192 @@
+import click
+import os
+from collections import defaultdict
+from database.crud import session_scope, REPLICA
+from database.models import Batch, Sample, RawData, MetricSummary
+from database.sketch import TDigest, merge_moments, std_dev, is_numeric
+from database.catalog import get_catalog, suggest, invalidate
+from .save import save_metric_summaries
+
+"""
+This command summarises metric distributions from the per batch/tool/metric sketches saved by `save`.
+It merges the sketches on the fly, so it never scans the raw_data table.
+
+--tool-metric <tool name> <metric> Metric to summarise (can be used multiple times).
+--cohort <cohort id> / --batch <batch name> Only merge sketches of these cohorts / batches (behaves like OR when multiple).
+--group-by [none / cohort / batch] Merge everything into one distribution (none) or one distribution per cohort / batch.
+--percentile <number> Percentiles to report (default 5, 25, 50, 75, 95).
+--chart [histogram / bands] Also chart the distributions (requires --output and --filename).
+    histogram: approximate histogram of each group, overlayed.
+    bands: percentile bands of each group (outer and inner percentile ranges, and the median when 50 is requested).
+--rebuild Build the missing summaries of batches saved before summaries existed (scans their raw_data once).
+
+Batches without summaries are left out of the distributions, with a warning.
+
+Example (how does batch AAB compare to the rest of MGRB):
+    falcon_multiqc distribution -tm verifybamid AVG_DP --cohort MGRB --group-by batch --chart bands -o output -f avg_dp
+"""
+
+# Builds the metric summaries of every batch that has none, from its raw_data.
+def rebuild_summaries(session):
+    summarised = session.query(MetricSummary.batch_id).distinct()
+    missing = [batch_id for batch_id, in session.query(Batch.id).filter(~Batch.id.in_(summarised))]
+    for batch_id in missing:
+        metric_values = defaultdict(lambda: defaultdict(list)) # (batch id, qc_tool) : metric : values
+        rows = session.query(RawData.qc_tool, RawData.metrics).join(Sample, Sample.id == RawData.sample_id).\
+            filter(Sample.batch_id == batch_id).yield_per(1000)
+        for qc_tool, metrics in rows:
+            for metric, value in metrics.items():
+                if is_numeric(value):
+                    metric_values[(batch_id, qc_tool)][metric].append(value)
+        save_metric_summaries(session, metric_values)
+        session.flush()
+    if missing:
+        invalidate()
+    return len(missing)
+
+# Merges the saved summaries into one (count, mean, m2, min, max, digest) per (group, tool, metric).
+def merge_summaries(rows, group_by):
+    groups = defaultdict(lambda: {"moments": (0, 0.0, 0.0), "min": None, "max": None, "digests": []})
+    for summary, cohort_id, batch_name in rows:
+        if group_by == "cohort":
+            group = cohort_id
+        elif group_by == "batch":
+            group = f"{cohort_id} {batch_name}"
+        else:
+            group = "all"
+        merged = groups[(group, summary.qc_tool, summary.metric)]
+        merged["moments"] = merge_moments(merged["moments"], (summary.count, summary.mean, summary.m2))
+        merged["min"] = summary.min if merged["min"] is None else min(merged["min"], summary.min)
+        merged["max"] = summary.max if merged["max"] is None else max(merged["max"], summary.max)
+        merged["digests"].append(TDigest.from_list(summary.sketch))
+
+    for merged in groups.values():
+        merged["digest"] = TDigest.merge(merged["digests"])
+        del merged["digests"]
+    return groups
+
+def chart_histogram(groups, tool_metrics, bins):
+    import plotly.graph_objects as go
+    fig = go.Figure()
+    for tool, metric in tool_metrics:
+        keys = [key for key in groups if key[1] == tool and key[2] == metric]
+        if not keys:
+            continue
+        low = min(groups[key]["min"] for key in keys)
+        high = max(groups[key]["max"] for key in keys)
+        if high == low:
+            # One distinct value, centre the bins around it.
+            low, high = low - 0.5, high + 0.5
+        width = (high - low) / bins
+        edges = [low + i * width for i in range(bins + 1)]
+        centres = [(edges[i] + edges[i + 1]) / 2 for i in range(bins)]
+        for key in keys:
+            digest = groups[key]["digest"]
+            counts = digest.histogram(edges)
+            fig.add_trace(go.Bar(
+                x=centres,
+                y=[100 * count / digest.total for count in counts],
+                width=width,
+                opacity=0.6,
+                name=f"{key[0]} {metric}"))
+    fig.update_layout(barmode="overlay", yaxis_title="Count (Percent)")
+    return fig
+
+def chart_bands(groups, tool_metrics, percentiles):
+    import plotly.graph_objects as go
+    fig = go.Figure()
+    percentiles = sorted(percentiles)
+    for tool, metric in tool_metrics:
+        keys = sorted(key for key in groups if key[1] == tool and key[2] == metric)
+        if not keys:
+            continue
+        x = [key[0] for key in keys]
+        # Pair the percentiles from the outside in, e.g. (5, 95) then (25, 75).
+        for i in range(len(percentiles) // 2):
+            low, high = percentiles[i], percentiles[-1 - i]
+            fig.add_trace(go.Scatter(
+                x=x, y=[groups[key]["digest"].quantile(low / 100) for key in keys],
+                mode="lines", line=dict(width=0), showlegend=False, hoverinfo="skip"))
+            fig.add_trace(go.Scatter(
+                x=x, y=[groups[key]["digest"].quantile(high / 100) for key in keys],
+                mode="lines", line=dict(width=0), fill="tonexty", name=f"{metric} p{low:g}-p{high:g}"))
+        if 50 in percentiles:
+            fig.add_trace(go.Scatter(
+                x=x, y=[groups[key]["digest"].quantile(0.5) for key in keys], mode="lines+markers", name=f"{metric} median"))
+    fig.update_xaxes(type="category")
+    return fig
+
+@click.command()
+@click.option("-tm", "--tool-metric", multiple=True, type=(str, str), required=False, help="Tool and metric to summarise, e.g. 'verifybamid AVG_DP'.")
+@click.option("-c", "--cohort", multiple=True, required=False, help="Only include these cohorts.")
+@click.option("-b", "--batch", multiple=True, required=False, help="Only include these batches (batch name).")
+@click.option("-g", "--group-by", type=click.Choice(["none", "cohort", "batch"], case_sensitive=False), default="none", help="Merge into one distribution or one per cohort / batch.")
+@click.option("-p", "--percentile", multiple=True, type=click.FloatRange(0, 100), default=[5, 25, 50, 75, 95], help="Percentiles to report.")
+@click.option("--chart", type=click.Choice(["histogram", "bands"], case_sensitive=False), required=False, help="Chart the distributions as a html file.")
+@click.option("--bins", type=click.IntRange(1), default=40, help="Number of histogram bins.")
+@click.option("-o", "--output", type=click.Path(exists=True), required=False, help="Output directory for --chart.")
+@click.option("-f", "--filename", required=False, help="Output filename (no extension) for --chart.")
+@click.option("--rebuild", is_flag=True, required=False, help="Build missing summaries of batches saved before summaries existed.")
+def cli(tool_metric, cohort, batch, group_by, percentile, chart, bins, output, filename, rebuild):
+    """Summarise metric distributions from the saved per batch sketches (no raw_data scan)."""
+
+    if chart and not (output and filename):
+        raise Exception("--chart requires --output and --filename.")
+    if not tool_metric and not rebuild:
+        raise Exception("Distribution requires at least one --tool-metric (or --rebuild).")
+
+    if rebuild:
+        with session_scope() as session:
+            click.echo("Building missing metric summaries...")
+            click.echo(f"Built metric summaries for {rebuild_summaries(session)} batches.")
+        if not tool_metric:
+            return
+
+    with session_scope(REPLICA) as session:
+        # Warn about batches in this selection which have no summaries (saved before summaries existed).
+        unsummarised = session.query(Batch.cohort_id, Batch.batch_name).\
+            filter(~Batch.id.in_(session.query(MetricSummary.batch_id).distinct()))
+        if cohort:
+            unsummarised = unsummarised.filter(Batch.cohort_id.in_(cohort))
+        if batch:
+            unsummarised = unsummarised.filter(Batch.batch_name.in_(batch))
+        unsummarised = unsummarised.all()
+        if unsummarised:
+            click.echo(click.style(f"Warning: {len(unsummarised)} batches have no metric summaries and are left out "
+                f"(e.g. {unsummarised[0][0]} {unsummarised[0][1]}). Run with --rebuild to build them.", fg="yellow"))
+
+        query = session.query(MetricSummary, Batch.cohort_id, Batch.batch_name).join(Batch, Batch.id == MetricSummary.batch_id)
+        query = query.filter(MetricSummary.qc_tool.in_([tool for tool, _ in tool_metric]),
+                             MetricSummary.metric.in_([metric for _, metric in tool_metric]))
+        if cohort:
+            query = query.filter(Batch.cohort_id.in_(cohort))
+        if batch:
+            query = query.filter(Batch.batch_name.in_(batch))
+
+        # Only keep the requested (tool, metric) pairs.
+        rows = [row for row in query if (row[0].qc_tool, row[0].metric) in tool_metric]
+        if not rows:
+            catalog = get_catalog(session)
+            for tool, metric in tool_metric:
+                if metric not in catalog.get(tool, ()):
+                    raise Exception(f"No metric summaries for {tool} {metric}, please check its validity.{suggest(catalog, tool, metric)}")
+            raise Exception("No metric summaries match this selection. Check the tool / metric names and filters.")
+        groups = merge_summaries(rows, group_by)
+
+    from tabulate import tabulate
+    table = []
+    for (group, tool, metric), merged in sorted(groups.items()):
+        count, mean, m2 = merged["moments"]
+        table.append([group, tool, metric, count, mean, std_dev(count, m2), merged["min"], merged["max"]]
+                     + [merged["digest"].quantile(p / 100) for p in percentile])
+    headers = ["Group", "Tool", "Metric", "Count", "Mean", "SD", "Min", "Max"] + [f"p{p:g}" for p in percentile]
+    click.echo(tabulate(table, headers=headers, tablefmt="pretty"))
+
+    if chart == "histogram":
+        fig = chart_histogram(groups, tool_metric, bins)
+    elif chart == "bands":
+        fig = chart_bands(groups, tool_metric, percentile)
+    if chart:
+        output = os.path.abspath(output)
+        fig.write_html(f"{output}/{filename}.html")
+        click.echo(f"Chart saved to {output}/{filename}.html")
@@ -0,0 +1,34 @@
+import click
+import os
+import time
+from database.crud import session_scope, cohort_shard, REPLICA
+from database.transfer import COMPRESSIONS, default_compression, export_cohort
+
+"""
+Exports a cohort to a single portable archive, to copy it to another falcon_multiqc database with the import command
+(see database/transfer.py). The cohort, its batches, patients, samples, raw_data, metric summaries and baseline
+shares are dumped with PostgreSQL's binary COPY, each table compressed, with a manifest of their columns, row counts
+and checksums. Reads one consistent view of the cohort, from the read replica when there is one (see database/crud.py).
+
+--cohort <cohortID> The cohort to export.
+--output <path> The archive to write (<cohortID>.falcon.tar by default).
+--compression zstd / gzip How each table is compressed (zstd when the zstandard package is installed, else gzip).
+
+Example:
+    falcon_multiqc export --cohort MGRB -o MGRB.falcon.tar
+"""
+
+@click.command()
+@click.option("-c", "--cohort", required=True, help="The cohort to export. E.g. <MGRB>")
+@click.option("-o", "--output", type=click.Path(dir_okay=False), required=False, help="The archive to write (<cohort>.falcon.tar by default).")
+@click.option("--compression", type=click.Choice(COMPRESSIONS), required=False, help="How each table is compressed (zstd when available, else gzip).")
+def cli(cohort, output, compression):
+    """Exports a cohort's rows to a portable compressed archive (binary COPY), for the import command."""
+
+    output = output or f"{cohort}.falcon.tar"
+    start = time.perf_counter()
+    with session_scope(REPLICA, cohort_shard(cohort)) as session:
+        manifest = export_cohort(session, cohort, output, compression or default_compression(),
+                                 lambda table, rows: click.echo(f"Exported {rows} {table} rows"))
+    click.echo(f"Exported cohort {cohort} to {output} ({os.path.getsize(output) / 1e6:.1f}MB, "
+               f"{manifest['compression']} compressed) in {time.perf_counter() - start:.1f}s.")
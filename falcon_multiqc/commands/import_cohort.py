@@ -0,0 +1,32 @@
+import click
+import time
+from database.crud import session_scope, cohort_shard
+from database.transfer import archive_manifest, import_cohort
+
+"""
+Imports a cohort exported by the export command (see database/transfer.py) into the database, in one transaction.
+Every table is loaded with PostgreSQL's binary COPY and checked against the archive's manifest (column types, row
+counts and checksums), then inserted with new batch, patient and sample ids, so it can go into a database that
+already has other cohorts. The imported samples are evaluated against this database's QC rule sets, and their
+batches merged into its metric baselines. With shards, the cohort goes to its own shard (see database/crud.py).
+
+ARCHIVE The exported archive.
+--cohort <cohortID> Import it under this cohort id (the exported cohort's id by default), e.g. to keep both.
+
+Example:
+    falcon_multiqc import MGRB.falcon.tar
+    falcon_multiqc import MGRB.falcon.tar --cohort MGRB_COPY
+"""
+
+@click.command()
+@click.argument("archive", type=click.Path(exists=True, dir_okay=False))
+@click.option("-c", "--cohort", required=False, help="Import under this cohort id (the exported cohort's by default).")
+def cli(archive, cohort):
+    """Imports a cohort archive written by the export command, giving its rows new ids."""
+
+    cohort = cohort or archive_manifest(archive)["cohort"]
+    start = time.perf_counter()
+    with session_scope(shard=cohort_shard(cohort)) as session:
+        cohort, rows = import_cohort(session, archive, cohort, lambda table, count: click.echo(f"Loaded {count} {table} rows"))
+    click.echo(f"Imported cohort {cohort} ({rows['batch']} batches, {rows['sample']} samples, {rows['raw_data']} raw_data rows) "
+               f"in {time.perf_counter() - start:.1f}s.")
@@ -0,0 +1,71 @@
+import click
+from database.maintenance import (DEFAULT_DEAD_RATIO, DEFAULT_STALE_RATIO, DEFAULT_MIN_LEAF_DENSITY, DEFAULT_LOCK_TIMEOUT,
+    human_bytes, maintenance_connection, table_stats, index_stats, unused_indexes, plan_maintenance, run_maintenance,
+    has_extension, plan_trigram_indexes)
+
+"""
+Reports the size and health of the falcon_multiqc tables (database/models.py get_tables()) and their indexes,
+then runs the maintenance they need (see database/maintenance.py):
+    VACUUM (ANALYZE) tables whose dead rows are over --dead-ratio of their rows,
+    ANALYZE tables whose rows changed since the last analyze are over --stale-ratio of their live rows,
+    REINDEX INDEX CONCURRENTLY indexes with a leaf density under --min-leaf-density (needs the pgstattuple extension).
+
+--dry-run Only report, and list the maintenance that would run.
+--lock-timeout <time> Skip an action rather than wait longer than this for its locks (default 5s).
+--trigram-indexes Also create the (optional) pg_trgm indexes of the description columns that are missing,
+    for fast query --description-match icontains / similar filters.
+
+Unused indexes (no scans since the statistics were last reset) are reported but never dropped.
+Safe to schedule nightly (e.g. cron `falcon_multiqc maintain`), it exits with code 1 if any maintenance failed.
+"""
+
+@click.command()
+@click.option("--dry-run", is_flag=True, required=False, help="Only report, and list the maintenance that would run.")
+@click.option("--dead-ratio", type=click.FloatRange(0, 1), default=DEFAULT_DEAD_RATIO, help="VACUUM tables with at least this fraction of dead rows.")
+@click.option("--stale-ratio", type=click.FloatRange(0), default=DEFAULT_STALE_RATIO, help="ANALYZE tables with at least this fraction of rows changed since the last analyze.")
+@click.option("--min-leaf-density", type=click.FloatRange(0, 100), default=DEFAULT_MIN_LEAF_DENSITY, help="REINDEX indexes with a lower leaf density (percent).")
+@click.option("--lock-timeout", default=DEFAULT_LOCK_TIMEOUT, help="Longest wait for a lock, e.g. 5s.")
+@click.option("--trigram-indexes", is_flag=True, required=False, help="Create the pg_trgm indexes of the description columns.")
+def cli(dry_run, dead_ratio, stale_ratio, min_leaf_density, lock_timeout, trigram_indexes):
+    """Reports table / index sizes, bloat and usage, and runs the VACUUM / ANALYZE / REINDEX they need."""
+    from tabulate import tabulate
+
+    with maintenance_connection(lock_timeout) as connection:
+        tables = table_stats(connection)
+        indexes = index_stats(connection)
+        version = connection.execute("SHOW server_version_num").scalar()
+
+        click.echo(tabulate(
+            [[t["table"], human_bytes(t["table_bytes"]), human_bytes(t["index_bytes"]), human_bytes(t["toast_bytes"]),
+              t["live_rows"], t["dead_rows"], t["modified_rows"], t["seq_scan"], t["idx_scan"], t["last_vacuum"], t["last_analyze"]]
+             for t in tables],
+            headers=["Table", "Size", "Indexes", "TOAST", "Live rows", "Dead rows", "Changed", "Seq scans", "Index scans",
+                     "Last vacuum", "Last analyze"], tablefmt="pretty"))
+        click.echo(tabulate(
+            [[i["table"], i["index"], human_bytes(i["index_bytes"]), i["idx_scan"],
+              "" if i["leaf_density"] is None else f"{i['leaf_density']:.0f}%"] for i in indexes],
+            headers=["Table", "Index", "Size", "Scans", "Leaf density"], tablefmt="pretty"))
+
+        for index in unused_indexes(indexes):
+            click.echo(f"Unused index: {index['index']} on {index['table']} ({human_bytes(index['index_bytes'])}, no scans).")
+        if all(index["leaf_density"] is None for index in indexes):
+            click.echo("Index bloat not measured (install the pgstattuple extension to enable REINDEX).")
+
+        actions = plan_maintenance(tables, indexes, dead_ratio, stale_ratio, min_leaf_density,
+                                   can_reindex_concurrently=int(version) >= 120000)
+        if trigram_indexes:
+            actions += plan_trigram_indexes(indexes, has_extension(connection, "pg_trgm"))
+        if not actions:
+            click.echo("No maintenance needed.")
+            return
+        if dry_run:
+            for statement, reason in actions:
+                click.echo(f"Would run: {statement} -- {reason}")
+            return
+
+        failed = run_maintenance(connection, actions, lambda statement, reason: click.echo(f"Running: {statement} -- {reason}"))
+        for statement, error in failed:
+            click.echo(click.style(f"Failed: {statement} -- {error}", fg="red"))
+        click.echo(f"Maintenance complete, {len(actions) - len(failed)} of {len(actions)} actions succeeded.")
+        if failed:
+            raise SystemExit(1)
@@ -0,0 +1,74 @@
+import click
+import os
+import time
+import shutil
+from database.crud import session_scope, DEFAULT_SHARD, REPLICA
+from database.catalog import get_catalog
+from database.matrix import DTYPES, matrix_dir, open_matrix
+from .query import select_tool_metrics, suggest
+
+"""
+Builds (or brings up to date) a local cache of a chosen set of metrics as a (samples x metrics) NumPy matrix, for
+analyses that read the same metrics over and over (see database/matrix.py). Load it in Python with:
+
+    from falcon_multiqc.api import Client
+    matrix = Client().matrix(tool_metric=[("verifybamid", "AVG_DP")], select_tool=["picard_wgsmetrics:PCT_*"])
+    matrix.values        # samples x metrics (memory-mapped), NaN where a sample has no numeric value
+    matrix.sample_ids    # each row's sample id
+    matrix.columns       # each column's <tool>.<metric>
+
+The matrix is stored as memory-mapped .npy files, so opening it reads nothing up front and processes opening the same
+matrix share its pages. Only batches saved or removed since it was last written are extracted again.
+
+--tool-metric <tool> <metric> A numeric metric to cache (multiple allowed).
+--select-tool <tool>[:<metric glob>] Every numeric metric of the tool (matching the glob), like query --select-tool.
+--dtype float32 / float64 The matrix's type (float32 by default, half the size).
+--matrix-dir <path> Where matrices are cached. Defaults to $FALCON_MULTIQC_MATRIX, else
+    $XDG_CACHE_HOME/falcon_multiqc/matrix (~/.cache by default).
+--clear Delete every cached matrix.
+
+Example:
+    falcon_multiqc matrix -st picard_wgsmetrics -tm verifybamid AVG_DP
+"""
+
+# Returns the [(tool, metric)] of the options, -tm ones first, without duplicates.
+def matrix_metrics(catalog, tool_metric=(), select_tool=()):
+    for tool, metric in tool_metric:
+        if metric not in catalog.get(tool, ()):
+            raise Exception(f"The metric {metric} of tool {tool} is not a numeric metric in the database, please check its "
+                            f"validity.{suggest(catalog, tool, metric)}")
+    tool_metrics = [tuple(tm) for tm in tool_metric]
+    for tool, metrics in select_tool_metrics(catalog, select_tool).items():
+        tool_metrics.extend((tool, metric) for metric in metrics)
+    if not tool_metrics:
+        raise Exception("Choose the metrics of the matrix with --tool-metric and / or --select-tool.")
+    return list(dict.fromkeys(tool_metrics))
+
+@click.command()
+@click.option("-tm", "--tool-metric", multiple=True, type=(str, str), required=False, help="A metric to cache, e.g. 'verifybamid AVG_DP'.")
+@click.option("-st", "--select-tool", multiple=True, required=False, help="Cache the tool's numeric metrics (matching <tool>:<metric glob>).")
+@click.option("--dtype", type=click.Choice(DTYPES), default="float32", help="The matrix's type.")
+@click.option("-d", "--matrix-dir", "directory", type=click.Path(file_okay=False), required=False, help="Directory of the cached matrices.")
+@click.option("--clear", is_flag=True, required=False, help="Delete every cached matrix.")
+def cli(tool_metric, select_tool, dtype, directory, clear):
+    """Caches a (samples x metrics) NumPy matrix of chosen metrics locally, memory-mapped, refreshed per changed batch."""
+
+    directory = os.path.abspath(directory or matrix_dir())
+    if clear:
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        click.echo(f"Deleted the cached matrices in {directory}.")
+        return
+
+    with session_scope(REPLICA) as session:
+        tool_metrics = matrix_metrics(get_catalog(session), tool_metric, select_tool)
+
+    def on_batch(action, shard, batch_id):
+        click.echo(f"{'Extracted' if action == 'write' else 'Removed'} batch {batch_id}" +
+                   ("" if shard == DEFAULT_SHARD else f" of shard {shard}"))
+
+    start = time.perf_counter()
+    matrix = open_matrix(tool_metrics, dtype, directory, on_batch=on_batch)
+    extracted, removed, unchanged = matrix.refreshed
+    click.echo(f"Matrix of {len(matrix)} samples x {len(tool_metrics)} metrics ({dtype}) in {matrix.path} is up to date "
+               f"({extracted} batches extracted, {removed} removed, {unchanged} unchanged) in {time.perf_counter() - start:.1f}s.")
@@ -2,16 +2,24 @@ import click
 import subprocess
 import sys
 import operator
+import fnmatch
 import os.path
 
-from database.crud import session_scope
-from database.models import Base, Sample, Batch, Cohort, RawData
-from sqlalchemy import Float, Text, or_, and_, func, distinct
+from database.crud import session_scope, REPLICA, shard_names, is_sharded
+from database.models import Base, Sample, Batch, Cohort, RawData, QcRuleSet, SampleQcFlag
+from sqlalchemy import Float, Integer, Numeric, Text, or_, and_, func, distinct, literal, literal_column, text, column
 from sqlalchemy.orm import load_only, Load, Query
+from sqlalchemy.orm.attributes import QueryableAttribute
 from sqlalchemy.orm.exc import MultipleResultsFound
-from database.process_query import create_new_multiqc, create_csv, print_csv
-from tabulate import tabulate
+from database.process_query import create_new_multiqc, create_csv, print_csv, print_overview, print_overview_rows
+from database import snapshot
+from database.compact import is_compact
+from database.federation import fan_out, merge_order
+from database.value_lists import ensure_list_indexes, read_values, value_table, load_values, load_duckdb_values
+from database.catalog import get_catalog, suggest
+from database.rules import rule_set_ids
 from collections import defaultdict
+from contextlib import nullcontext
 
 """
 This command allows you to query the falcon multiqc database.
@@ -19,10 +27,19 @@ Select columns to include in output (sample [default], batch, cohort, tool-metri
     --select <sample>
     - Add multiple selections by using multiple `--select` options)
     - The order of these --select/s are the column order of output.
+    --select-tool <tool> / <tool>:<metric glob> selects all (matching) numeric metrics of the tool as columns, a row
+    per row of the tool, in one pass over its rows (see tool_table).
 Add optional filtering with --batch, --cohort, or --tool_metric.
     --batch <batch name> (behaves like OR when multiple)
     --cohort <cohort id> (behaves like OR when multiple)
+    --sample-list <file> / --library-id-list <file> (a file of sample names / library ids, one per line,
+    for filtering by thousands of them, see database/value_lists.py)
     --tool-metric <tool name> <metric> <operator> <value> (behaves like AND when multiple)
+    --failed-rule <rule set> samples that failed the stored QC rule set (behaves like OR when multiple), looked up
+    in sample_qc_flag (see the rules command and database/rules.py).
+    --batch-description / --cohort-description / --sample-description <text> (behaves like OR when multiple),
+    matched as --description-match contains (default), icontains (case insensitive) or similar (pg_trgm word
+    similarity, best matches first). See maintain --trigram-indexes for the indexes that make these fast.
     (Add multiple filters by using multiple `--batch` / `--cohort` / `--tool-metric' options)
 Note (--tool_metric): 
     You must always specify 4 values. 
@@ -30,6 +47,8 @@ Note (--tool_metric):
     to simply output all samples with a metric, use <tool> <metric> 0 0.
     Special characters must be escaped (wrapped in single quotes) in bash, like '<'.
 See example equivalent SQL of what this command does at the end of this file.
+--engine duckdb runs the query against the local snapshot (see the snapshot command) instead of the database.
+With shards (see database/crud.py), the query runs on every shard at once and their rows are combined.
 """
 
 ops = {
@@ -41,10 +60,13 @@ ops = {
     '!=': operator.ne
 }
 
+# Name prefix of the --select-tool tables (see tool_table), which can't clash with a table's.
+TOOL_TABLE = "tool:"
+
 # Returns a sqlaclhemy query, selecting on the given columns.
 # Columns supported: 'sample' (sample_name), 'batch', 'cohort', 'tool'.
 # tool_metric is used to determine what metric to select on, if filtered.
-def query_select(session, columns, join, tool_metric_filters, multiqc):
+def query_select(session, columns, join, tool_metric_filters, multiqc, compact=False):
     # Add the Sqlalchemy class columns needed for the given column selection.
     select_cols = []
 
@@ -61,7 +83,7 @@ def query_select(session, columns, join, tool_metric_filters, multiqc):
             if tool_metric_filters:
                 for tm in tool_metric_filters:
                     # Use the metric name as this column's alias.
-                    c = func.max(RawData.metrics[tm[1]].astext).label(tm[1])
+                    c = func.max(metric_text(tm[1], compact)).label(tm[1])
                     c.quote = True
                     select_cols.append(c)
             else:
@@ -116,6 +138,100 @@ def query_select(session, columns, join, tool_metric_filters, multiqc):
 
     return query
 
+# The metric's value as text (raw_data.metrics ->> metric). With compact raw_data it's read from the view's value
+# array, without rebuilding the metrics document (see database/compact.py).
+def metric_text(metric, compact):
+    if compact:
+        return func.raw_data_metric(literal_column("raw_data.metric_keys"), literal_column("raw_data.metric_values"),
+                                    literal_column("raw_data.extra"), metric, type_=Text)
+    return RawData.metrics[metric].astext
+
+# Returns (condition, ranking or None) of a description filter of the column (see --description-match).
+# The ranking is the best word similarity of the descriptions, better matches are higher.
+def description_filter(column, descriptions, match):
+    if match == 'similar':
+        # <% (word similarity over pg_trgm's threshold) and ILIKE can both use the trigram GIN indexes.
+        # Custom operators aren't escaped for psycopg2's % parameters, hence <%%.
+        return (or_(*[literal(d).op('<%%')(column) for d in descriptions]),
+                func.greatest(*[func.word_similarity(d, column) for d in descriptions]))
+    if match == 'icontains':
+        escaped = [d.replace("/", "//").replace("%", "/%").replace("_", "/_") for d in descriptions]
+        return or_(*[column.ilike(f"%{d}%", escape="/") for d in escaped]), None
+    return or_(*[column.contains(d, autoescape=True) for d in descriptions]), None
+
+# Returns {tool: [metrics]} of the --select-tool options (<tool> or <tool>:<metric glob>), the tool's metrics in
+# the catalog matching the glob, sorted.
+def select_tool_metrics(catalog, select_tool):
+    tools = {}
+    for option in select_tool:
+        tool, _, pattern = option.partition(":")
+        if tool not in catalog:
+            raise Exception(f"The tool {tool} is not present in the database, please check its validity.{suggest(catalog, tool, '')}")
+        metrics = fnmatch.filter(catalog[tool], pattern or "*")
+        if not metrics:
+            raise Exception(f"No metric of tool {tool} matches {pattern}, its metrics are: {', '.join(sorted(catalog[tool]))}.")
+        tools[tool] = sorted(set(tools.get(tool, [])) | set(metrics))
+    return tools
+
+# Returns a derived table of the tool's rows, its sample_id and a column per metric (--select-tool), named
+# TOOL_TABLE + tool. Each row is read once for all the metrics, rather than with a ->> (and max()) per metric:
+#   JSONB: jsonb_to_record() splits the metrics document into the columns in one pass. A metric's non-numeric
+#       values (e.g. 'NA') are NULL, the rest numeric (as exact as the JSON number).
+#   Compact: the view's value array (and extra for numbers a double can't hold), see database/compact.py.
+#   DuckDB: the snapshot's flattened raw_data_<tool> view, with the types of the snapshot.
+def tool_table(tool, metrics, compact=False, duckdb=False):
+    names = [snapshot.quote(metric) for metric in metrics]
+    if duckdb:
+        sql = f"SELECT sample_id, {', '.join(names)} FROM {snapshot.tool_view(tool)}"
+    else:
+        def number(value):
+            return f"CASE WHEN jsonb_typeof({value}) = 'number' THEN CAST({value} AS numeric) END"
+        values = []
+        for metric, name in zip(metrics, names):
+            if compact:
+                position = f"array_position(raw_data.metric_keys, {snapshot.sql_string(metric)})"
+                values.append(f"COALESCE(CAST(CAST(raw_data.metric_values[{position}] AS text) AS numeric), "
+                              f"{number(f'raw_data.extra -> {snapshot.sql_string(metric)}')}) AS {name}")
+            elif len(metric.encode()) < 64:
+                values.append(f"{number(f'record.{name}')} AS {name}")
+            else:
+                # Longer than PostgreSQL's identifiers, so not a record column.
+                values.append(f"{number(f'raw_data.metrics -> {snapshot.sql_string(metric)}')} AS {name}")
+        record_names = [name for metric, name in zip(metrics, names) if len(metric.encode()) < 64]
+        record = "" if compact or not record_names else \
+            f", jsonb_to_record(raw_data.metrics) AS record({', '.join(f'{name} jsonb' for name in record_names)})"
+        sql = (f"SELECT raw_data.sample_id, {', '.join(values)} FROM raw_data{record} "
+               f"WHERE raw_data.qc_tool = {snapshot.sql_string(tool)}")
+    # Colons in names would be taken as bind parameters.
+    columns = [column("sample_id", Integer)] + [column(metric, None if duckdb else Numeric) for metric in metrics]
+    return text(sql.replace(":", "\\:")).columns(*columns).alias(TOOL_TABLE + tool)
+
+# Returns the header (table.column) of the query's result.
+def result_header(query):
+    def table_name(col):
+        table = getattr(col["expr"], "table", None)
+        if col["entity"] is None and table is not None and table.name.startswith(TOOL_TABLE):
+            return table.name[len(TOOL_TABLE):]
+        # Compact metric_text columns aren't ORM attributes, they're raw_data's as well.
+        return (col["entity"] or RawData).__tablename__
+    return [table_name(col) + "." + col["name"] for col in query.column_descriptions]
+
+# Returns why the query found nothing, if a tool or metric of the --tool-metric filters isn't in the database
+# (None when they all are).
+def missing_tool_metric(session, catalog, tool_metric):
+    for tm in tool_metric:
+        if tm[1] in catalog.get(tm[0], ()):
+            # Known numeric metric of a known tool, no need to look through raw_data.
+            continue
+        # Check whether tool is valid.
+        if session.query(RawData.id).filter(RawData.qc_tool == tm[0]).first() is None:
+            return f"The tool {tm[0]} is not present in the database, please check its validity.{suggest(catalog, tm[0], tm[1])}"
+
+        metrics = session.query(RawData.metrics).filter(RawData.qc_tool == tm[0]).first()
+        if tm[1] not in metrics[0]:
+            return f"The metric {tm[1]} is not present in the metrics of tool {tm[0]}, please check its validity.{suggest(catalog, tm[0], tm[1])}"
+    return None
+
 # Takes in a tool metric value and determines if we need to cast
 # our db column as a Float or Text
 def cast_type(value):
@@ -129,8 +245,9 @@ def cast_type(value):
 
 # Returns an sqlalchemy query that queries the database with a filter
 # with the given tool, attribute, operator and value.
-def query_metric(query, join, tool_metric):
-    group_by_columns = []
+# The --select-tool tables' columns are grouped as well (a row per tool row).
+def query_metric(query, join, tool_metric, compact=False, tool_tables=()):
+    group_by_columns = [c for table in tool_tables for c in table.c]
     
     if 'batch' in join['joined']:
         group_by_columns.append(Batch.id)
@@ -157,24 +274,126 @@ def query_metric(query, join, tool_metric):
         tool_metric_map[tm[0]].append(tm[1:]) 
 
     # Loop through each tool_metric joining each result on OR that matches the tool name and meets the value condition.
-    return (query.filter(or_(and_(*[RawData.qc_tool == tool, *[ops[operator](RawData.metrics[attribute].astext.cast(cast_type(value)), value) 
+    return (query.filter(or_(and_(*[RawData.qc_tool == tool, *[ops[operator](metric_text(attribute, compact).cast(cast_type(value)), value) 
             for attribute, operator, value in tool_metric_map[tool]]]) 
             for tool in tool_metric_map)).group_by(*group_by_columns).having(func.count(distinct(RawData.qc_tool)) == len(tool_metric_map)))
 
-def print_overview(session):
+# Raises for options the engine doesn't support.
+def check_engine_options(duckdb, failed_rule=(), description_match="contains"):
+    if failed_rule and duckdb:
+        raise Exception("--failed-rule needs the postgres engine, the snapshot has no QC rule flags.")
+    if description_match.lower() == "similar" and duckdb:
+        raise Exception("--description-match similar needs the postgres engine (pg_trgm), use icontains with --engine duckdb.")
+
+# Returns (the query of the session's database, rankings of the similar description filters) of the cli's options
+# (the query command's and the Python API's, see falcon_multiqc/api.py).
+# select_tools is {tool: [metrics]} of --select-tool (see select_tool_metrics), value_lists {list name: (sample
+# column, values)} of --sample-list / --library-id-list. With duckdb, the query is for the snapshot (see
+# snapshot.execute_query), with the value lists loaded by load_duckdb_values.
+def build_query(session, select=("sample",), tool_metric=(), select_tools=None, batch=(), cohort=(), batch_description=(),
+                cohort_description=(), sample_description=(), description_match="contains", flowcell_lane=(), library_id=(),
+                value_lists=None, failed_rule=(), platform=(), centre=(), reference=(), type=(), multiqc=False, duckdb=False):
+    ### ================================= SELECT  ==========================================####
+    # Both select and filter options influence whether certain tables need to be joined, the following handles this.
 
-    overview = []
+    select = list(select)
+    select_tools = select_tools or {}
+    value_lists = value_lists or {}
+    description_match = description_match.lower()
+    join = {'joins': set(), 'joined': set()} # Keeping track of what needs to be joined, and what has been joined.
+    if multiqc and "sample" not in select:
+        select.insert(0, 'sample')
 
-    # Make a nice list which we can give to tabulate
-    for cohort_id, batch_name in session.query(Batch.cohort_id, Batch.batch_name):
-        temp_line = [cohort_id, batch_name]
-        temp_line.append(session.query(Sample).join(Batch, Batch.id == Sample.batch_id).\
-        filter(Batch.batch_name == batch_name, Sample.cohort_id == cohort_id).count())
-        overview.append(temp_line)
+    if sample_description or flowcell_lane or library_id or value_lists or failed_rule or platform or centre or reference or type or 'sample' in select: 
+        join['joins'].add('sample')
+    if cohort or cohort_description or 'cohort' in select:
+        join['joins'].add('cohort')
+    if batch or batch_description or 'batch' in select:
+        join['joins'].add('batch')
+    if tool_metric or 'tool-metric' in select:
+        join['joins'].add('tool-metric')
+    if select_tools:
+        join['joins'].add('sample')
+    [join['joins'].add(s) for s in select]
 
-    overview.sort()
-    # Print a pretty table
-    click.echo(tabulate(overview, headers=["Cohort", "Batch", "Number of Samples"], tablefmt="pretty"))
+    compact = not duckdb and is_compact(session)
+    falcon_query = query_select(session, select, join, tool_metric, multiqc, compact)
+    tool_tables = [tool_table(tool, metrics, compact, duckdb) for tool, metrics in select_tools.items()]
+    for table in tool_tables:
+        falcon_query = falcon_query.join(table, table.c.sample_id == Sample.id).add_columns(*list(table.c)[1:])
+
+    ### ================================= FILTER  ==========================================####
+
+    ## 1. Sample
+    if tool_metric:
+        falcon_query = query_metric(falcon_query, join, tool_metric, compact, tool_tables)
+
+    if description_match == "similar" and session.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'").scalar() is None:
+        raise Exception("--description-match similar needs the pg_trgm extension, "
+                        "create it (and the trigram indexes) with: falcon_multiqc maintain --trigram-indexes")
+    # Ranking of the similar description filters, best matches first.
+    rankings = []
+
+    if sample_description:
+        condition, ranking = description_filter(Sample.description, sample_description, description_match)
+        falcon_query = falcon_query.filter(condition)
+        rankings.append(ranking)
+
+    if flowcell_lane:
+        falcon_query = falcon_query.filter(Sample.flowcell_lane.in_(flowcell_lane))
+
+    if library_id:
+        falcon_query = falcon_query.filter(Sample.library_id.in_(library_id))
+
+    for name, (column, values) in value_lists.items():
+        # Temp table join rather than a long IN (...) list, the DuckDB table is loaded by load_duckdb_values.
+        table = value_table(name) if duckdb else load_values(session, name, values)
+        falcon_query = falcon_query.join(table, table.c.value == column)
+
+    if failed_rule:
+        # The rule sets' flagged samples (see database/rules.py), read by the rule set's primary key.
+        failed_samples = Query(SampleQcFlag.sample_id).join(QcRuleSet, QcRuleSet.id == SampleQcFlag.rule_set_id).\
+            filter(QcRuleSet.name.in_(failed_rule))
+        falcon_query = falcon_query.filter(Sample.id.in_(failed_samples.subquery()))
+
+    if platform:
+        falcon_query = falcon_query.filter(Sample.platform.in_(platform))
+
+    if centre:
+        falcon_query = falcon_query.filter(Sample.centre.in_(centre))
+
+    if reference:
+        falcon_query = falcon_query.filter(Sample.reference_genome.in_(reference))
+
+    if type:
+        falcon_query = falcon_query.filter(Sample.type.in_(type))
+
+    ## 2. Cohort
+    if cohort:
+        falcon_query = falcon_query.filter(Cohort.id.in_(cohort))
+    
+    if cohort_description:
+        condition, ranking = description_filter(Cohort.description, cohort_description, description_match)
+        falcon_query = falcon_query.filter(condition)
+        rankings.append(ranking)
+
+    ## 3. Batch
+    if batch:
+        falcon_query = falcon_query.filter(Batch.batch_name.in_(batch))
+
+    if batch_description:
+        condition, ranking = description_filter(Batch.description, batch_description, description_match)
+        falcon_query = falcon_query.filter(condition)
+        rankings.append(ranking)
+
+    if description_match == "similar":
+        falcon_query = falcon_query.order_by(*[ranking.desc() for ranking in rankings])
+        return falcon_query, rankings
+    if duckdb and tool_metric:
+        # DuckDB needs every selected column grouped, PostgreSQL infers them from the grouped primary keys.
+        falcon_query = falcon_query.group_by(*[col["expr"] for col in falcon_query.column_descriptions
+                                               if isinstance(col["expr"], QueryableAttribute)])
+    return falcon_query, []
 
 @click.command()
 @click.option(
@@ -194,6 +413,13 @@ def print_overview(session):
     required=False, 
     help="Filter by tool, metric, operator and number, e.g. 'verifybamid AVG_DP '<' 30'.")
 
+@click.option(
+    "-st",
+    "--select-tool",
+    multiple=True,
+    required=False,
+    help="Select every metric of a tool as columns, or those matching a glob with <tool>:<glob>, e.g. 'picard_wgsmetrics:PCT_*'.")
+
 @click.option(
     "-b",
     "--batch",
@@ -229,6 +455,12 @@ def print_overview(session):
     required=False,
     help="Filter by sample description contents (contains).")
 
+@click.option(
+    "--description-match",
+    type=click.Choice(["contains", "icontains", "similar"], case_sensitive=False),
+    default="contains",
+    help="How description filters match: contains, icontains (case insensitive) or similar (best matches first, needs pg_trgm).")
+
 @click.option(
     "-fcl",
     "--flowcell-lane",
@@ -243,6 +475,24 @@ def print_overview(session):
     required=False,
     help="Filter by sample library id.")
 
+@click.option(
+    "--sample-list",
+    type=click.Path(exists=True, dir_okay=False),
+    required=False,
+    help="Filter by the sample names in a file (one per line).")
+
+@click.option(
+    "--library-id-list",
+    type=click.Path(exists=True, dir_okay=False),
+    required=False,
+    help="Filter by the library ids in a file (one per line).")
+
+@click.option(
+    "--failed-rule",
+    multiple=True,
+    required=False,
+    help="Filter by samples that failed a stored QC rule set (see the rules command).")
+
 @click.option(
     "-pl",
     "--platform",
@@ -308,16 +558,33 @@ def print_overview(session):
     required=False,
     help="Output filename (required when --csv or --multiqc).")    
 
+@click.option(
+    "--engine",
+    type=click.Choice(["postgres", "duckdb"], case_sensitive=False),
+    default="postgres",
+    help="Query the database (postgres) or the local snapshot (duckdb, see the snapshot command).")
+
+@click.option(
+    "--snapshot-dir",
+    type=click.Path(exists=True, file_okay=False),
+    required=False,
+    help="Snapshot directory for --engine duckdb.")
+
 def cli(
     select,
     tool_metric,
+    select_tool,
     batch,
     cohort,
     batch_description,
     cohort_description,
     sample_description,
+    description_match,
     flowcell_lane,
     library_id,
+    sample_list,
+    library_id_list,
+    failed_rule,
     platform,
     centre,
     reference,
@@ -327,7 +594,9 @@ def cli(
     pretty,
     overview,
     output,
-    filename):
+    filename,
+    engine,
+    snapshot_dir):
 
     """Query the falcon qc database by specifying what you would like to select on by using the --select option, and
     what to filter on (--tool_metric, --batch, or --cohort)."""
@@ -349,107 +618,106 @@ def cli(
         if not filename:
             raise Exception("--output requires --filename (no extension) to name the csv or multiqc report")
 
-    ### ================================= SELECT  ==========================================####
-    # Both select and filter options influence whether certain tables need to be joined, the following handles this.
-
-    select = list(select) 
-    join = {'joins': set(), 'joined': set()} # Keeping track of what needs to be joined, and what has been joined.
-    if multiqc and "sample" not in select:
-        select.insert(0, 'sample')
-    if sample_description or flowcell_lane or library_id or platform or centre or reference or type or 'sample' in select: 
-        join['joins'].add('sample')
-    if cohort or cohort_description or 'cohort' in select:
-        join['joins'].add('cohort')
-    if batch or batch_description or 'batch' in select:
-        join['joins'].add('batch')
-    if tool_metric or 'tool-metric' in select:
-        join['joins'].add('tool-metric')
-    [join['joins'].add(s) for s in select]
-
-    with session_scope() as session:
-        falcon_query = query_select(session, select, join, tool_metric, multiqc)
-
-    ### ================================= FILTER  ==========================================####
-
-    ## 1. Sample
-    if tool_metric:
-        falcon_query = query_metric(falcon_query, join, tool_metric)
-
-    if sample_description:
-        conditions = [Sample.description.contains(d, autoescape=True) for d in sample_description]
-        falcon_query = falcon_query.filter(or_(*conditions))
-    
-    if flowcell_lane:
-        falcon_query = falcon_query.filter(Sample.flowcell_lane.in_(flowcell_lane))
-
-    if library_id:
-        falcon_query = falcon_query.filter(Sample.library_id.in_(library_id))
-    
-    if platform:
-        falcon_query = falcon_query.filter(Sample.platform.in_(platform))
-
-    if centre:
-        falcon_query = falcon_query.filter(Sample.centre.in_(centre))
-
-    if reference:
-        falcon_query = falcon_query.filter(Sample.reference_genome.in_(reference))
-
-    if type:
-        falcon_query = falcon_query.filter(Sample.type.in_(type))
-
-    ## 2. Cohort
-    if cohort:
-        falcon_query = falcon_query.filter(Cohort.id.in_(cohort))
-        
-    if cohort_description:
-        conditions = [Cohort.description.contains(d, autoescape=True) for d in cohort_description]
-        falcon_query = falcon_query.filter(or_(*conditions))
-
-    ## 3. Batch
-    if batch:
-        falcon_query = falcon_query.filter(Batch.batch_name.in_(batch))
-
-    if batch_description:
-        conditions = [Batch.description.contains(d, autoescape=True) for d in batch_description]
-        falcon_query = falcon_query.filter(or_(*conditions))
-
-    ### ============================== RESULT / OUTPUT =======================================####
-    if len(falcon_query.all()) == 0:
-        for tm in tool_metric:
-            # Check whether tool is valid.
-            if session.query(RawData.id).filter(RawData.qc_tool == tm[0]).first() is None:
-                raise Exception(f"The tool {tm[0]} is not present in the database, please check its validity.")
-            
-            metrics = session.query(RawData.metrics).filter(RawData.qc_tool == tm[0]).first()
-            if tm[1] not in metrics[0]:
-                raise Exception(f"The metric {tm[1]} is not present in the metrics of tool {tm[0]}, please check its validity.")
-
-        raise Exception("No results from query")
-
-    # Create header from the current query (falcon_query).
-    query_header = []
-    for col in falcon_query.column_descriptions:
-        query_header.append(col["entity"].__tablename__ + "." + col["name"])
-
-    if multiqc:
-        click.echo("Creating multiqc report...")
-        create_new_multiqc([(row.sample_name, row.path) for row in falcon_query], output, filename)
-
-    if csv:
-        click.echo("Creating csv report...")
-        create_csv(query_header, falcon_query, output, filename)
-
-    if pretty and not csv and not multiqc and not overview:
-        click.echo(f'Query returned {falcon_query.count()} samples.')
-        click.echo(tabulate(falcon_query, query_header, tablefmt="pretty"))
-
-    elif not csv and not multiqc and not overview:
-        # Print result.
-        click.echo(f'Query returned {falcon_query.count()} samples.')
-        print_csv(query_header, falcon_query)
-
-    if overview:
-        print_overview(session)
+    # List name : (sample column, values) of the --sample-list / --library-id-list files.
+    value_lists = {}
+    if sample_list:
+        value_lists["sample_name_list"] = (Sample.sample_name, read_values(sample_list))
+    if library_id_list:
+        value_lists["library_id_list"] = (Sample.library_id, read_values(library_id_list))
+
+    duckdb = engine.lower() == "duckdb"
+    check_engine_options(duckdb, failed_rule, description_match)
+    if value_lists and not duckdb:
+        for shard in shard_names():
+            ensure_list_indexes(shard)
+    # The options of build_query, besides --select-tool's metrics (expanded once connected, below).
+    options = dict(select=select, tool_metric=tool_metric, batch=batch, cohort=cohort, batch_description=batch_description,
+                   cohort_description=cohort_description, sample_description=sample_description,
+                   description_match=description_match, flowcell_lane=flowcell_lane, library_id=library_id,
+                   value_lists=value_lists, failed_rule=failed_rule, platform=platform, centre=centre, reference=reference,
+                   type=type, multiqc=multiqc, duckdb=duckdb)
+
+    with (nullcontext() if duckdb else session_scope(REPLICA)) as session:
+        # Keep the session open until the output is written (closing it returns its connection to the pool).
+        if duckdb:
+            snapshot_directory = snapshot_dir or snapshot.snapshot_dir()
+            connection = snapshot.connect(snapshot_directory)
+        if failed_rule:
+            # Raises for unknown rule sets (every shard has the same ones).
+            rule_set_ids(session, failed_rule)
+        # {tool: [metrics]} of --select-tool, expanded from the tools' metric names (not read from raw_data).
+        select_tools = {}
+        if select_tool:
+            catalog = snapshot.tool_catalog(connection, snapshot_directory) if duckdb else get_catalog(session)
+            select_tools = select_tool_metrics(catalog, select_tool)
+
+        if duckdb or not is_sharded():
+            falcon_query, rankings = build_query(session, select_tools=select_tools, **options)
+            query_header = result_header(falcon_query)
+
+        if duckdb:
+            for name, (column, values) in value_lists.items():
+                load_duckdb_values(connection, name, values)
+            rows = snapshot.execute_query(connection, falcon_query)
+        elif is_sharded():
+            # Every shard's query at once (see database/federation.py). Similar description matches are ordered
+            # by their rankings across the shards, selected as extra columns.
+            def run(shard_session, shard):
+                shard_query, shard_rankings = build_query(shard_session, select_tools=select_tools, **options)
+                rows = shard_query.add_columns(*[ranking.label(f"ranking_{i}") for i, ranking in enumerate(shard_rankings)]).all()
+                return result_header(shard_query), len(shard_rankings), rows
+            results = fan_out(run)
+            query_header, ranking_count, _ = results[0]
+            rows = [row for _, _, shard_rows in results for row in shard_rows]
+            if ranking_count:
+                rankings = [f"ranking_{i}" for i in range(ranking_count)]
+                rows = merge_order(query_header + rankings, rows, [(ranking, True) for ranking in rankings])
+                rows = [row[:len(query_header)] for row in rows]
+        else:
+            rows = falcon_query.all()
+
+        if len(rows) == 0:
+            if duckdb:
+                catalog = snapshot.snapshot_catalog(connection)
+                for tm in tool_metric:
+                    if tm[1] not in catalog.get(tm[0], ()):
+                        # The snapshot's catalog has every metric of every tool (not only the numeric ones).
+                        missing = f"metric {tm[1]}" if tm[0] in catalog else f"tool {tm[0]}"
+                        raise Exception(f"The {missing} is not present in the snapshot, please check its validity.{suggest(catalog, tm[0], tm[1])}")
+            elif tool_metric:
+                catalog = get_catalog(session)
+                # A tool / metric only has to be in one of the shards.
+                missing = (fan_out(lambda shard_session, shard: missing_tool_metric(shard_session, catalog, tool_metric))
+                           if is_sharded() else [missing_tool_metric(session, catalog, tool_metric)])
+                if all(missing):
+                    raise Exception(missing[0])
+
+            raise Exception("No results from query")
+
+        if multiqc:
+            click.echo("Creating multiqc report...")
+            sample_name, path = query_header.index("sample.sample_name"), query_header.index("batch.path")
+            create_new_multiqc([(row[sample_name], row[path]) for row in rows], output, filename)
+
+        if csv:
+            click.echo("Creating csv report...")
+            create_csv(query_header, rows, output, filename)
+
+        if pretty and not csv and not multiqc and not overview:
+            from tabulate import tabulate
+            click.echo(f'Query returned {len(rows)} samples.')
+            click.echo(tabulate(rows, query_header, tablefmt="pretty"))
+
+        elif not csv and not multiqc and not overview:
+            # Print result.
+            click.echo(f'Query returned {len(rows)} samples.')
+            print_csv(query_header, rows)
+
+        if overview:
+            if duckdb:
+                print_overview_rows(snapshot.overview(connection))
+            else:
+                print_overview(session)
 
 """
 Query: 
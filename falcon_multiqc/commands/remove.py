@@ -1,8 +1,10 @@
 import click
-from database.crud import session_scope
+from database.crud import session_scope, cohort_shard, PRIMARY
 from sqlalchemy.orm import Query
-from .query import print_overview
+from database.process_query import print_overview
 from database.models import Base, Batch, Cohort
+from database.delete import DEFAULT_CHUNK_SIZE, ensure_delete_indexes, batch_row_counts, delete_batch_rows, delete_batch_row, \
+    delete_cohort_row, vacuum_analyze
 
 """
 Command for removing entries from database.
@@ -15,45 +17,78 @@ Command for removing entries from database.
 
 NOTE: Don't use --batch or --cohort options in one command, use two seperate commands instead.
 
+Metric summaries (see the distribution command) of removed batches are deleted with them.
+
+Rows are deleted in chunks (see database/delete.py), raw_data then sample then batch, each chunk in its own short
+transaction so saves and queries aren't blocked. If a remove is interrupted, run the same command again to finish it.
+With shards (see database/crud.py), each cohort's rows are removed from the shard it is stored in.
+--chunk-size <number> Rows deleted per transaction (default 10000).
+--no-vacuum Skip the VACUUM ANALYZE of the tables afterwards.
+
 """
 
+# Deletes one batch of the shard, with a progress bar for each of its tables.
+def remove_batch(batch_id, label, chunk_size, shard):
+    with session_scope(shard=shard) as session:
+        counts = batch_row_counts(session, batch_id)
+    for table, count in counts.items():
+        with click.progressbar(length=count, label=f"{label}: {table} ({count} rows)") as bar:
+            delete_batch_rows(batch_id, table, chunk_size, bar.update, shard)
+    delete_batch_row(batch_id, shard)
+
 @click.option("-c", "--cohort", multiple=True, required=False, help="Which cohort to remove from the database. E.g. <MGRB>")
 @click.option ("-b", "--batch", multiple=True, type=(str, str), required=False, help="Which batch you want to remove from the database. E.g. <MGRB BAB>")
 @click.option("--overview", is_flag=True, required=False, help="Prints an overview of the number of samples in each batch/cohort.")
+@click.option("--chunk-size", type=click.IntRange(1), default=DEFAULT_CHUNK_SIZE, help="Rows deleted per transaction.")
+@click.option("--no-vacuum", is_flag=True, required=False, help="Skip the VACUUM ANALYZE of the tables after deleting.")
 @click.command()
-def cli(cohort, batch, overview):
+def cli(cohort, batch, overview, chunk_size, no_vacuum):
     """Removes all associated rows of specified batch/cohort from database."""
 
-    with session_scope() as session:
-        if cohort:
-            for cohort_id in cohort:
-                if session.query(Cohort.id).filter(Cohort.id == cohort_id).scalar() is None:  
-                    # Roll back of all changes made during this session.          
-                    raise Exception(f"No cohort {cohort_id} is present in the database. Nothing has been deleted."
-                                    "\nRun --overview option to see what is currently present.")
-                else:
-                    # Delete all assoicated rows
-                    session.query(Cohort.id).filter(Cohort.id == cohort_id).delete()
-                    if batch:
-                        raise Exception("\nBoth --cohort and --batch used in the same command, please try again as two seperate commands."
+    if cohort and batch:
+        raise Exception("\nBoth --cohort and --batch used in the same command, please try again as two seperate commands."
                         f"\nNothing has been deleted from the database.")
-            click.echo(f"Cohort(s) {list(cohort)} and all assoicated entries have been deleted.")
-        elif batch:
-            for cohort_id, batch_name in batch:
-                if session.query(Batch.id).filter(Batch.batch_name == batch_name,Batch.cohort_id == cohort_id).scalar() is None:
-                    # Roll back of all changes made during this session.          
-                    raise Exception(f"No batch {batch_name} is present in the database. Nothing has been deleted."
-                                    "\nRun --overview option to see what is currently present.")
-                else:
-                    # update cohort table sample_count column.
-                    batch_sample_count = session.query(Batch).filter(Batch.batch_name == batch_name,Batch.cohort_id == cohort_id).one().sample_count
-                    cohort_sample_count = session.query(Cohort).filter(Cohort.id == cohort_id).one().sample_count
-                    session.query(Cohort).filter(Cohort.id == cohort_id).one().sample_count = cohort_sample_count - batch_sample_count
-                    # update cohort table batch_count column.
-                    batch_count = session.query(Cohort).filter(Cohort.id == cohort_id).one().batch_count
-                    session.query(Cohort).filter(Cohort.id == cohort_id).one().batch_count = batch_count - 1
-                    # Delete all assoicated rows.
-                    session.query(Batch.id).filter(Batch.batch_name == batch_name,Batch.cohort_id == cohort_id).delete()
-            click.echo(f"Batch(s) {list(batch)} and all assoicated entries have been deleted.")
+
+    # Check everything exists before deleting anything.
+    batches = [] # (batch id, label, shard)
+    for cohort_id in cohort:
+        with session_scope(shard=cohort_shard(cohort_id)) as session:
+            if session.query(Cohort.id).filter(Cohort.id == cohort_id).scalar() is None:
+                raise Exception(f"No cohort {cohort_id} is present in the database. Nothing has been deleted."
+                                "\nRun --overview option to see what is currently present.")
+            batches.extend((batch_id, f"{cohort_id} {batch_name}", cohort_shard(cohort_id)) for batch_id, batch_name in
+                           session.query(Batch.id, Batch.batch_name).filter(Batch.cohort_id == cohort_id).order_by(Batch.id))
+    for cohort_id, batch_name in batch:
+        with session_scope(shard=cohort_shard(cohort_id)) as session:
+            batch_id = session.query(Batch.id).filter(Batch.batch_name == batch_name,Batch.cohort_id == cohort_id).scalar()
+            if batch_id is None:
+                raise Exception(f"No batch {batch_name} is present in the database. Nothing has been deleted."
+                                "\nRun --overview option to see what is currently present.")
+            batches.append((batch_id, f"{cohort_id} {batch_name}", cohort_shard(cohort_id)))
+
+    shards = list(dict.fromkeys([cohort_shard(cohort_id) for cohort_id in cohort] + [shard for _, _, shard in batches]))
+    if batches:
+        for shard in shards:
+            ensure_delete_indexes(shard)
+    for batch_id, label, shard in batches:
+        remove_batch(batch_id, label, chunk_size, shard)
+    for cohort_id in cohort:
+        delete_cohort_row(cohort_id, cohort_shard(cohort_id))
+
+    if cohort:
+        click.echo(f"Cohort(s) {list(cohort)} and all assoicated entries have been deleted.")
+    elif batch:
+        click.echo(f"Batch(s) {list(batch)} and all assoicated entries have been deleted.")
+
+    if (cohort or batch) and not no_vacuum:
+        click.echo("Vacuuming and analysing tables...")
+        try:
+            for shard in shards:
+                vacuum_analyze(shard=shard)
+        except Exception as e:
+            # e.g. VACUUM needs the table owner, the data has been deleted either way.
+            click.echo(click.style(f"Warning: VACUUM ANALYZE failed ({e}), run it as the table owner.", fg="yellow"))
+
     if overview:
-        print_overview(session)
+        with session_scope() as session:
+            print_overview(session, PRIMARY)
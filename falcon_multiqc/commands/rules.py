@@ -0,0 +1,100 @@
+import click
+import time
+from database.crud import session_scope, shard_names, REPLICA
+from database.federation import fan_out
+from database.models import QcRuleSet, SampleQcFlag
+from database.rules import OPERATORS, evaluate, remove_rules, rule_set_ids, set_rule
+from sqlalchemy import func
+
+"""
+Manages the stored QC rule sets (see database/rules.py), which save evaluates against each new batch.
+Samples failing a rule set are found with: falcon_multiqc query --failed-rule <name>
+
+rules add <name> <tool> <metric> <operator> <value> -- adds a threshold samples have to meet to pass the rule set
+    (created if new), or changes its value. E.g. falcon_multiqc rules add wgs verifybamid AVG_DP '>=' 20
+    --cohort / --platform / --reference <value> Only applies the threshold to those samples, overriding the
+        rule set's threshold of the same tool, metric and operator.
+    --description <text> Describes the rule set.
+rules remove <name> -- removes the rule set and its flags, or with --tool / --metric only those thresholds.
+rules list -- prints the rule sets, their thresholds and number of failed samples.
+rules reevaluate [<name> ...] -- re-scores every saved sample against the rule sets (all without names),
+    replacing their flags. Run it after changing a rule set, the flags of samples saved before are otherwise
+    those of the rule set at the time.
+With shards (see database/crud.py), rule sets are stored in (and evaluated by) every shard.
+"""
+
+REEVALUATE_NOTE = "Run 'falcon_multiqc rules reevaluate {name}' to re-score the saved samples."
+
+@click.group()
+def cli():
+    """Manages the stored QC rule sets that save evaluates against each new batch."""
+
+@cli.command()
+@click.argument("name")
+@click.argument("tool")
+@click.argument("metric")
+@click.argument("operator", type=click.Choice(list(OPERATORS)))
+@click.argument("value", type=float)
+@click.option("-c", "--cohort", required=False, help="Only apply the threshold to samples of this cohort.")
+@click.option("-pl", "--platform", required=False, help="Only apply the threshold to samples of this platform.")
+@click.option("-rf", "--reference", required=False, help="Only apply the threshold to samples of this reference genome.")
+@click.option("-d", "--description", required=False, help="Description of the rule set.")
+def add(name, tool, metric, operator, value, cohort, platform, reference, description):
+    """Adds a threshold to a rule set, or changes its value."""
+    for shard in shard_names():
+        with session_scope(shard=shard) as session:
+            set_rule(session, name, tool, metric, operator, value, cohort, platform, reference, description)
+    click.echo(f"Rule set {name}: {tool}.{metric} {operator} {value}" +
+               "".join(f" ({label} {scope})" for label, scope in [("cohort", cohort), ("platform", platform), ("reference", reference)] if scope))
+    click.echo(REEVALUATE_NOTE.format(name=name))
+
+@cli.command()
+@click.argument("name")
+@click.option("-t", "--tool", required=False, help="Only remove the thresholds of this tool.")
+@click.option("-m", "--metric", required=False, help="Only remove the thresholds of this metric.")
+def remove(name, tool, metric):
+    """Removes a rule set (and its flags), or its thresholds of a tool / metric."""
+    for shard in shard_names():
+        with session_scope(shard=shard) as session:
+            removed = remove_rules(session, name, tool, metric)
+    if tool or metric:
+        click.echo(f"Removed {removed} thresholds of rule set {name}.")
+        click.echo(REEVALUATE_NOTE.format(name=name))
+    else:
+        click.echo(f"Removed rule set {name}.")
+
+@cli.command("list")
+def list_rules():
+    """Prints the rule sets, their thresholds and number of failed samples."""
+    from tabulate import tabulate
+    def failed_counts(session, shard):
+        return dict(session.query(QcRuleSet.name, func.count(SampleQcFlag.sample_id))
+                    .outerjoin(SampleQcFlag, SampleQcFlag.rule_set_id == QcRuleSet.id).group_by(QcRuleSet.name))
+    failed = {}
+    for counts in fan_out(failed_counts):
+        for name, count in counts.items():
+            failed[name] = failed.get(name, 0) + count
+
+    with session_scope(REPLICA) as session:
+        rows = []
+        for rule_set in session.query(QcRuleSet).order_by(QcRuleSet.name):
+            for rule in sorted(rule_set.rules, key=lambda rule: (rule.qc_tool, rule.metric, rule.operator, rule.id)):
+                rows.append([rule_set.name, rule_set.description or "", f"{rule.qc_tool}.{rule.metric} {rule.operator} {rule.value}",
+                             rule.cohort_id or "", rule.platform or "", rule.reference_genome or "", failed.get(rule_set.name, 0)])
+        if not rows:
+            click.echo("There are no rule sets, add one with: falcon_multiqc rules add")
+            return
+        click.echo(tabulate(rows, ["Rule Set", "Description", "Threshold", "Cohort", "Platform", "Reference", "Failed Samples"],
+                            tablefmt="pretty"))
+
+@cli.command()
+@click.argument("names", nargs=-1)
+def reevaluate(names):
+    """Re-scores every saved sample against the rule sets (all without names), replacing their flags."""
+    start = time.perf_counter()
+    failed = 0
+    for shard in shard_names():
+        with session_scope(shard=shard) as session:
+            failed += evaluate(session, rule_set_ids(session, list(names)) if names else None)
+    click.echo(f"Reevaluated {', '.join(names) if names else 'every rule set'} in {time.perf_counter() - start:.1f}s: "
+               f"{failed} failures (rule set, sample).")
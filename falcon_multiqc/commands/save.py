@@ -4,16 +4,32 @@ import csv
 import datetime
 import sys
 from os.path import abspath, basename, exists
-from database.crud import session_scope
-from database.models import Base, RawData, Batch, Sample, Cohort
+from database.crud import session_scope, cohort_shard, shard_names
+from database.models import Base, RawData, Batch, Sample, Cohort, MetricSummary
+from database.ingest import ensure_batch_constraint, insert_cohort, insert_batch, update_cohorts
+from database.rules import evaluate as evaluate_rules
+from database.baselines import DRIFT_THRESHOLD, save_baselines
+from database.sketch import TDigest, moments, is_numeric
 from sqlalchemy.orm.exc import NoResultFound
+from collections import defaultdict
+from contextlib import ExitStack
+from falcon_multiqc.daemon import client_path
+from falcon_multiqc.inputs import open_multiqc_data
+from database.stats import file_io
 
 """
 This command saves input multiqc data to the falcon multiqc database.
 It supports saving 1 cohort at a time.
+Several saves can run at once (e.g. from different pipeline nodes), see database/ingest.py.
+With shards (see database/crud.py), each cohort is saved to the shard it is mapped to.
+The saved samples are evaluated against the stored QC rule sets (see the rules command).
+Each saved batch is compared with the running baselines of its samples' centre / platform / reference genome and
+merged into them (see database/baselines.py), printing the metrics whose mean drifted.
 
 Required Arguments:
     directory {path/file} -- Multiqc cohort directory to save. May also be a list of directories.
+        Or its multiqc_data.json (compressed as .json.gz / .json.zst), or a tar archive of the directory
+        (.tar, .tar.gz, .tar.zst ...), read without unpacking it (see falcon_multiqc/inputs.py).
 
     sample_metadata {file} -- A csv with the header (or list of paths to sample_metadata files):
     "Sample,Name,Cohort,Name,Batch,Name,Flowcell.Lane,Library ID,Platform,Centre of Sequencing,Reference Genome,Type,Description"
@@ -23,17 +39,57 @@ Optional Description Arguments:
     batch_description {string} -- Set this if the input is 1 batch.
     cohort_description {string} -- Set this if the input is 1 cohort.
     batch_metadata {file} -- A csv with header "Batch Name,Description". Set this if the input is multiple batches.
+    drift_threshold {number} -- Report metrics whose batch mean shifted by this many baseline standard deviations (default 1).
 """
 
 
-def save_sample(directory, sample_metadata, session, cohort_description, batch_description):
-    """Saves one result directory and sample_metadatadata to the falcon_multiqc database"""
+def save_metric_summaries(session, metric_values):
+    """Saves a moment summary and t-digest sketch for each (batch, qc_tool, numeric metric) of a saved batch."""
+    for (batch_id, qc_tool), metrics in metric_values.items():
+        for metric, values in metrics.items():
+            if not values:
+                continue
+            count, mean, m2, minimum, maximum = moments(values)
+            session.add(MetricSummary(
+                batch_id=batch_id,
+                qc_tool=qc_tool,
+                metric=metric,
+                count=count,
+                mean=mean,
+                m2=m2,
+                min=minimum,
+                max=maximum,
+                sketch=TDigest.from_values(values).to_list()
+            ))
+
+
+# Prints the drift report (see database/baselines.py) of the saved batches ({batch name: batch id}).
+def print_drift(report, batches, threshold):
+    if not report:
+        return
+    from tabulate import tabulate
+    batch_names = {batch_id: batch_name for batch_name, batch_id in batches.items()}
+    click.echo(click.style(f"{len(report)} metrics drifted from their baseline by {threshold:g} or more standard deviations:", fg="yellow"))
+    table = [[batch_names[batch_id], centre, platform, reference_genome, qc_tool, metric, count, mean,
+              baseline_count, baseline_mean, sd, f"{shift:+.2f}"]
+             for batch_id, centre, platform, reference_genome, qc_tool, metric, count, mean, baseline_count, baseline_mean, sd, shift
+             in report[:DRIFT_REPORT_ROWS]]
+    click.echo(tabulate(table, ["Batch", "Centre", "Platform", "Reference", "Tool", "Metric", "Count", "Mean",
+                                "Baseline Count", "Baseline Mean", "Baseline SD", "Shift (SD)"], tablefmt="pretty"))
+    if len(report) > DRIFT_REPORT_ROWS:
+        click.echo(f"... and {len(report) - DRIFT_REPORT_ROWS} more.")
+
+
+def save_sample(directory, sample_metadata, session, cohort_description, batch_description, drift_threshold=DRIFT_THRESHOLD):
+    """Saves one result directory and sample_metadatadata to the falcon_multiqc database.
+    Returns (cohort id, number of samples, number of batches, types) to add to the cohort (see update_cohorts)."""
 
     directory_name = basename(directory)
     sample_metadata_name = basename(sample_metadata)
     click.echo(f'Saving: {directory_name} with sample metadata: {sample_metadata_name}...')
                 
-    with open(directory + "/multiqc_data/multiqc_data.json") as multiqc_data:
+    # The directory's json, or an archive's, read as a stream (see falcon_multiqc/inputs.py).
+    with open_multiqc_data(directory) as multiqc_data:
 
         with open(sample_metadata) as sample_metadata:
             # Skip header
@@ -41,8 +97,11 @@ def save_sample(directory, sample_metadata, session, cohort_description, batch_d
 
             # Keep track of samples added, so we know its primary key, when saving raw data later.
             samples = {}  # name : primary key id
-            batches = {} # batches within given metadata 
-            types = {} # stores number of types in a given cohort 
+            sample_batches = {}  # name : batch primary key id
+            sample_groups = {}  # name : (centre, platform, reference genome), of its metric baselines
+            batches = {} # batch name : batch primary key id, of batches within given metadata
+            batch_sample_counts = defaultdict(int) # batch primary key id : number of samples
+            types = [] # types of samples within given metadata
 
             # Cohort id for this input. Cohort id must be the same for every batch of this input.
             cohort_id = None
@@ -66,43 +125,23 @@ def save_sample(directory, sample_metadata, session, cohort_description, batch_d
                 if not cohort_id:
                     # Get cohort id / name from the first data row (assuming the metadata is for 1 cohort).
                     cohort_id = split[1].strip(stripChars)
-                    if session.query(Cohort.id).filter_by(id=cohort_id).scalar() is None:
-                        # Cohort does not exist in database.
-                        cohort_row = Cohort(
-                            id=cohort_id,
-                            description=cohort_description
-                        )
-                        session.add(cohort_row)
-                    batches[cohort_id] = [] 
-                    types[cohort_id] = []
+                    # Create the cohort if it does not exist in database (or is being created by another save).
+                    insert_cohort(session, cohort_id, cohort_description)
                 elif split[1].strip(stripChars) != cohort_id:
                     raise Exception(f"Metadata input has multiple cohort ids ({cohort_id} and {split[1]}). Save supports one cohort at a time.")
                 
-                batch_id = None
-                if batch_name not in batches[cohort_id]:
+                batch_id = batches.get(batch_name)
+                if batch_id is None:
                     # First time this batch_name is seen from this given metadata.csv
-                    batches[cohort_id].append(batch_name) 
-                    if session.query(Batch.id).filter(Batch.batch_name == batch_name, Batch.cohort_id == cohort_id).scalar() is None:
-                        # Batch does not exist in database.
-                        batch_row = Batch(
-                            cohort_id=cohort_id,
-                            batch_name=batch_name,
-                            path=directory,
-                            description=batch_description
-                        )
-                        session.add(batch_row)
-                        session.flush()
-                        batch_id = batch_row.id
-                    else:
+                    batch_id = insert_batch(session, cohort_id, batch_name, directory, batch_description)
+                    batches[batch_name] = batch_id
+                    if batch_id is None:
                         # batch/cohort already existed in database, meaning duplicate entry - envoke traceback.
                         num_samples = session.query(Sample).join(Batch, Batch.id == Sample.batch_id).filter(Batch.batch_name == batch_name,
                         Sample.cohort_id == cohort_id).count()
                         raise Exception(f"Duplicate data entry detected.\nIn metadata file {sample_metadata_name}, batch {batch_name}"
                             f" from cohort {cohort_id} already exists in the database with {num_samples} sample entries"
                             f"\nAll entries added during this session will be rollbacked and nothing has been added to the database, please retry.")
-                else:
-                    batch_id = session.query(Batch).filter(
-                        Batch.batch_name == batch_name, Batch.cohort_id == cohort_id).one().id
 
                 sample_row = Sample(
                     batch_id=batch_id,
@@ -119,45 +158,23 @@ def save_sample(directory, sample_metadata, session, cohort_description, batch_d
                 session.add(sample_row)
                 session.flush()
                 samples[sample_name] = sample_row.id
-                if type not in types[cohort_id]:
-                    types[cohort_id].append(type)
-
-            # Enter sample counts for batch/cohort.
-            for cohort_id in batches:
-                cohort_sample_count = session.query(Cohort).filter(Cohort.id == cohort_id).one().sample_count
-                batch_count = session.query(Cohort).filter(Cohort.id == cohort_id).one().batch_count
-                if cohort_sample_count == None:
-                    cohort_sample_count = 0
-                if batch_count == None:
-                    batch_count = 0
-                for batch_name in batches[cohort_id]:
-                    # Count number of samples in given batch.
-                    batch_sample_count = session.query(Sample).join(Batch, Batch.id == Sample.batch_id).\
-                    filter(Batch.batch_name == batch_name, Sample.cohort_id == cohort_id).count()
-                    # Update Batch count column.
-                    session.query(Batch).filter(Batch.batch_name == batch_name, Batch.cohort_id == cohort_id).one().sample_count = batch_sample_count
-                    cohort_sample_count += batch_sample_count
-                batch_count = batch_count + len(batches[cohort_id]) # Update the batch count. 
-                session.query(Cohort).filter(Cohort.id == cohort_id).one().sample_count = cohort_sample_count
-                session.query(Cohort).filter(Cohort.id == cohort_id).one().batch_count = batch_count
-                
-            # Update cohort tables with types if needed
-            for cohort_id in types:
-                old_type_list = session.query(Cohort).filter(Cohort.id == cohort_id).one().type
-                if old_type_list == None:
-                    session.query(Cohort).filter(Cohort.id == cohort_id).one().type = ','.join(types[cohort_id])
-                    continue
-                # Update cohort with new type info.
-                new_type_list = []
-                for type in types[cohort_id]:
-                    if type not in old_type_list:
-                        new_type_list.append(type)
-                if new_type_list != []:
-                    new_type_list = ',' + ','.join(new_type_list)
-                    new_type_list = old_type_list + new_type_list
-                    session.query(Cohort).filter(Cohort.id == cohort_id).one().type = new_type_list
-
-            multiqc_data_json = json.load(multiqc_data)
+                sample_batches[sample_name] = batch_id
+                sample_groups[sample_name] = (centre, platform, reference)
+                batch_sample_counts[batch_id] += 1
+                if type not in types:
+                    types.append(type)
+
+            # Enter sample counts for batch (the cohort's are added once the whole input is saved, see update_cohorts).
+            for batch_id, batch_sample_count in batch_sample_counts.items():
+                session.query(Batch).filter(Batch.id == batch_id).update({Batch.sample_count: batch_sample_count}, synchronize_session=False)
+
+            with file_io():
+                multiqc_data_json = json.load(multiqc_data)
+
+            # Numeric metric values of this input, for the metric summaries.
+            metric_values = defaultdict(lambda: defaultdict(list)) # (batch id, qc_tool) : metric : values
+            # And for the metric baselines.
+            group_values = defaultdict(lambda: defaultdict(list)) # (batch id, centre, platform, reference genome, qc_tool) : metric : values
 
             for tool in multiqc_data_json["report_saved_raw_data"]:
                 if tool == 'multiqc_general_stats':
@@ -165,38 +182,75 @@ def save_sample(directory, sample_metadata, session, cohort_description, batch_d
                 for sample in multiqc_data_json["report_saved_raw_data"][tool]:
                     sample_name = sample.split("_")[0].strip(stripChars)
                     try:
+                        metrics = multiqc_data_json["report_saved_raw_data"][tool][sample]
                         if tool == "multiqc_picard_varientCalling":
                             tool2 = "multiqc_picard_variantCalling" # Correct historical typo from multiqc JSON.
                             raw_data_row = RawData(
                                 sample_id=samples[sample_name],
                                 qc_tool=tool2[8:],
-                                metrics=multiqc_data_json["report_saved_raw_data"][tool][sample]
+                                metrics=metrics
                             )
                         else:
                             raw_data_row = RawData(
                                 sample_id=samples[sample_name],
                                 qc_tool=tool[8:],
-                                metrics=multiqc_data_json["report_saved_raw_data"][tool][sample]
+                                metrics=metrics
                             )
                         session.add(raw_data_row)
+                        values = metric_values[(sample_batches[sample_name], raw_data_row.qc_tool)]
+                        baseline_values = group_values[(sample_batches[sample_name], *sample_groups[sample_name], raw_data_row.qc_tool)]
+                        for metric, value in metrics.items():
+                            if is_numeric(value):
+                                values[metric].append(value)
+                                baseline_values[metric].append(value)
                     except KeyError:
                         raise Exception(f"Metadata file {sample_metadata_name} does not match with multiqc folder {directory} data JSON file"
                             f"\nThe sample {sample_name} appears in the JSON, but not in the metadata file."
                             " Please ensure the metadata file and multiqc directories are from the same batch/cohort."
                             f"\nAll entries added during this session will be rollbacked and nothing has been added to the database, please retry.")
 
+            save_metric_summaries(session, metric_values)
+            print_drift(save_baselines(session, group_values, drift_threshold), batches, drift_threshold)
+            # Flag the new samples failing the stored QC rule sets (see the rules command).
+            failed = evaluate_rules(session, batch_ids=list(batches.values()))
+            if failed:
+                click.echo(f"{failed} samples of {directory_name} failed QC rule sets, see: falcon_multiqc query --failed-rule <name>")
+
+    return cohort_id, sum(batch_sample_counts.values()), len(batches), types
+
 
 stripChars = " \n\r\t\'\""
+# Rows of the drift report printed.
+DRIFT_REPORT_ROWS = 20
+
+# Returns the cohort id of the sample metadata's first row (see save_sample), to save it to the cohort's shard.
+def metadata_cohort(sample_metadata):
+    with open(sample_metadata) as metadata:
+        next(metadata, None)
+        for line in metadata:
+            split = line.split(",")
+            if len(split) > 1:
+                return split[1].strip(stripChars)
+    return None
+
+# Returns the batch of that name, from the shard that has it.
+def find_batch(shard_session, batch_name):
+    for shard in shard_names():
+        batch = shard_session(shard).query(Batch).filter(Batch.batch_name == batch_name).one_or_none()
+        if batch is not None:
+            return batch
+    raise NoResultFound()
 
 @click.command()
-@click.option("-d", "--directory", type=click.Path(exists=True), required=False, help="Path to multiqc_output directory.") 
+@click.option("-d", "--directory", type=click.Path(exists=True), required=False, help="Path to multiqc_output directory (or its multiqc_data.json[.gz/.zst], or a tar archive of it).") 
 @click.option("-s", "--sample_metadata", type=click.Path(exists=True), required=False, help="Sample metadata file.")
 @click.option("-i", "--input_csv", type=click.Path(exists=True), required=False, help="CSV of paths in the format directory,sample_metadata for bulk saving.")
 @click.option("-b", "--batch_description", type=click.STRING, required=False, help="Give every new batch this description.")
 @click.option("-c", "--cohort_description", type=click.STRING, required=False, help="Give every new cohort this description.")
 @click.option("-bm", "--batch_metadata", type=click.File(), required=False, help="Batch metadata file (with descriptions).")
 @click.option("-cm", "--cohort_metadata", type=click.File(), required=False, help="Cohort metadata file (with descriptions).")
-def cli(directory, sample_metadata, input_csv, batch_description, cohort_description, batch_metadata, cohort_metadata):
+@click.option("--drift-threshold", type=click.FloatRange(0), default=DRIFT_THRESHOLD, help="Report metrics whose batch mean shifted by this many baseline standard deviations.")
+def cli(directory, sample_metadata, input_csv, batch_description, cohort_description, batch_metadata, cohort_metadata, drift_threshold):
     """Saves the given cohort directory to the falcon_multiqc database"""
 
     if (not directory and not input_csv) and not (batch_metadata or cohort_metadata):
@@ -204,7 +258,32 @@ def cli(directory, sample_metadata, input_csv, batch_description, cohort_descrip
     if directory and input_csv:
        raise Exception("Save requires only one of input --directory OR --input_csv, not both.")
 
-    with session_scope() as session:
+    # Cohort id : [number of samples, number of batches, types] saved, added to the cohorts at the end (see update_cohorts).
+    cohort_counts = defaultdict(lambda: [0, 0, []])
+
+    def add_counts(cohort_id, sample_count, batch_count, types):
+        if cohort_id is None:
+            return
+        counts = cohort_counts[cohort_id]
+        counts[0] += sample_count
+        counts[1] += batch_count
+        counts[2] += [type for type in types if type not in counts[2]]
+
+    with ExitStack() as stack:
+        # Session of each shard written to (see database/crud.py), opened on first use. Every shard's rows are
+        # written before any of them is committed.
+        sessions = {}
+
+        def shard_session(shard):
+            if shard not in sessions:
+                if directory or input_csv:
+                    ensure_batch_constraint(shard)
+                sessions[shard] = stack.enter_context(session_scope(shard=shard))
+            return sessions[shard]
+
+        def commit():
+            for session in sessions.values():
+                session.commit()
 
         # Did we get a csv?
         if input_csv:
@@ -218,20 +297,22 @@ def cli(directory, sample_metadata, input_csv, batch_description, cohort_descrip
 
                     # Check the headers of the csv are directory,sample_metadata
                     if header[0] == "directory" and header[1] == "sample_metadata":
-                        with session_scope() as session:
-                            for row in csv_reader:
-                                # Check that the files in the csv actually exist
-                                if not exists(row[0]):
-                                    click.echo(f"Error: Directory {directory} does not exist."
-                                    "\nAll database entries have been rolled back, please retry after fixing")
-                                    sys.exit(1)
-                                elif not exists(row[1]):
-                                    click.echo(f"Error: Sample metadata {sample_metadata} does not exist."
-                                    "\nAll database entries have been rolled back, please retry after fixing")
-                                    sys.exit(1)
-                                else:
-                                    # save the info in that row
-                                    save_sample(abspath(row[0]), row[1], session, cohort_description, batch_description)
+                        for row in csv_reader:
+                            # Check that the files in the csv actually exist
+                            # Relative to the caller's working directory (which isn't the daemon's, see daemon.py).
+                            row = [client_path(row[0]), client_path(row[1])]
+                            if not exists(row[0]):
+                                click.echo(f"Error: Directory {row[0]} does not exist."
+                                "\nAll database entries have been rolled back, please retry after fixing")
+                                sys.exit(1)
+                            elif not exists(row[1]):
+                                click.echo(f"Error: Sample metadata {row[1]} does not exist."
+                                "\nAll database entries have been rolled back, please retry after fixing")
+                                sys.exit(1)
+                            else:
+                                # save the info in that row
+                                session = shard_session(cohort_shard(metadata_cohort(row[1])))
+                                add_counts(*save_sample(abspath(row[0]), row[1], session, cohort_description, batch_description, drift_threshold))
                     else:
                         click.echo("CSV requires directory and sample_metadata headers.")
                         sys.exit(1)
@@ -245,11 +326,14 @@ def cli(directory, sample_metadata, input_csv, batch_description, cohort_descrip
                 sys.exit(1)
 
             # Default: when a single directory or file is provided
-            save_sample(abspath(directory), sample_metadata, session, cohort_description, batch_description)
-            
-                
+            session = shard_session(cohort_shard(metadata_cohort(sample_metadata)))
+            add_counts(*save_sample(abspath(directory), sample_metadata, session, cohort_description, batch_description, drift_threshold))
+
+        for shard, session in sessions.items():
+            update_cohorts(session, {cohort_id: counts for cohort_id, counts in cohort_counts.items() if cohort_shard(cohort_id) == shard})
+
         click.echo(f"All multiqc and metadata results have been saved.")
-        session.commit() # commit (save to db) all rows saved during transaction for given metadata/multic_JSON to database
+        commit() # commit (save to db) all rows saved during transaction for given metadata/multic_JSON to database
 
 
         # Save batch metadata.
@@ -266,11 +350,11 @@ def cli(directory, sample_metadata, input_csv, batch_description, cohort_descrip
                     "\n'Batch_Name' 'Number_of_samples' 'Batch_description'")
                 # Update each batch with the given batch description.
                 try:
-                    (session.query(Batch).filter(Batch.batch_name == batch_name).one().description) = batch_description
+                    find_batch(shard_session, batch_name).description = batch_description
                 except NoResultFound:
                     raise Exception(f"Batch '{batch_name}' is not present in the database so description cannot be added."
                     "\nAll batch description entries have been rolled back, please retry after fixing")
-            session.commit()
+            commit()
             click.echo(f"Batch descriptions has been saved.")
 
         # Save Cohort metadata
@@ -286,9 +370,10 @@ def cli(directory, sample_metadata, input_csv, batch_description, cohort_descrip
                     "\n'Cohort_Name' 'Number_of_samples' 'Number_of_Batches' 'type' 'Cohort_description'")
                 # Update each Cohort with the given Cohort description.
                 try:
+                    session = shard_session(cohort_shard(cohort_name))
                     (session.query(Cohort).filter(Cohort.id == cohort_name).one().description) = cohort_description
                 except NoResultFound:
                     raise Exception(f"Cohort '{cohort_name}' is not present in the database so description cannot be added, exiting."
                     "\nAll cohort description entries have been rolled back, please retry after fixing")
-            session.commit()
+            commit()
             click.echo(f"Cohort descriptions has been saved.")
@@ -0,0 +1,24 @@
+import click
+from falcon_multiqc.daemon import serve, socket_path
+
+"""
+Runs a local falcon_multiqc daemon on a Unix socket.
+
+The daemon keeps the commands imported, the database connection pool open and the metric catalog cached.
+While it is running, the query, sql, save, remove and distribution commands of the same user are sent
+to it instead of starting up and connecting from scratch (it handles many requests at once).
+Commands fall back to running normally when no daemon is running.
+
+--socket <path> Socket to listen on (default $FALCON_MULTIQC_SOCKET, else falcon_multiqc.sock in $XDG_RUNTIME_DIR,
+                or in a private falcon_multiqc-<uid> directory in the temp directory).
+                Clients use $FALCON_MULTIQC_SOCKET, so set it for both when changing it.
+
+Set FALCON_MULTIQC_DAEMON=0 to run a command without the daemon.
+Stop the daemon with Ctrl-C or SIGTERM.
+"""
+
+@click.command()
+@click.option("-s", "--socket", type=click.Path(), required=False, help="Unix socket path to listen on.")
+def cli(socket):
+    """Runs a local daemon that keeps database connections and imports warm."""
+    serve(socket or socket_path())
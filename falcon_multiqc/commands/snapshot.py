@@ -0,0 +1,38 @@
+import click
+import os
+import time
+from database.crud import session_scope, REPLICA
+from database.snapshot import snapshot_dir, take_snapshot
+
+"""
+Exports the database to a local columnar (Parquet) snapshot, for heavy analytical queries without loading the
+database server: query, sql and chart run against it with --engine duckdb (see database/snapshot.py).
+Exports cohort, batch, sample and raw_data, with each tool's JSONB metrics flattened into a column per metric.
+
+Incremental by default: only batches whose samples changed since the last snapshot are exported again, and batches
+no longer in the database are removed from it. Reads from the read replica when there is one (see database/crud.py).
+
+--snapshot-dir <path> Where the snapshot is written. Defaults to $FALCON_MULTIQC_SNAPSHOT, else
+    $XDG_CACHE_HOME/falcon_multiqc/snapshot (~/.cache by default).
+--full Export every batch again.
+
+Requires the duckdb package (pip install duckdb).
+"""
+
+@click.command()
+@click.option("-d", "--snapshot-dir", "directory", type=click.Path(file_okay=False), required=False, help="Directory of the snapshot.")
+@click.option("--full", is_flag=True, required=False, help="Export every batch again, not only the changed ones.")
+def cli(directory, full):
+    """Exports a local Parquet snapshot of the database for the duckdb engine (--engine duckdb)."""
+
+    directory = os.path.abspath(directory or snapshot_dir())
+    os.makedirs(directory, exist_ok=True)
+
+    def on_batch(action, batch_id):
+        click.echo(f"{'Exported' if action == 'write' else 'Removed'} batch {batch_id}")
+
+    start = time.perf_counter()
+    with session_scope(REPLICA) as session:
+        written, deleted, unchanged = take_snapshot(session, directory, full, on_batch)
+    click.echo(f"Snapshot in {directory} is up to date ({written} batches exported, {deleted} removed, "
+               f"{unchanged} unchanged) in {time.perf_counter() - start:.1f}s.")
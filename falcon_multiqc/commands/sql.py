@@ -1,10 +1,11 @@
 import click
 import sys
 import os
-from database.crud import session_scope
-from database.process_query import create_new_multiqc, create_csv, print_csv
-from .query import print_overview
-from tabulate import tabulate
+from database.crud import session_scope, REPLICA
+from database.federation import fan_out, merge_aggregates, merge_order, merge_limit, AGGREGATES
+from database.process_query import create_new_multiqc, create_csv, print_csv, print_overview, print_overview_rows
+from database import snapshot
+from contextlib import nullcontext
 
 """
 This command allows you to query the falcon multiqc database using raw SQL.
@@ -29,6 +30,20 @@ Options:
 
 --overview Prints an overview of the number of samples in each batch/cohort.
 
+--engine duckdb Runs the SQL against the local snapshot (see the snapshot command) instead of the database, with
+    --snapshot-dir <path> (default $FALCON_MULTIQC_SNAPSHOT or ~/.cache/falcon_multiqc/snapshot). The snapshot has
+    the cohort, batch, sample and raw_data tables (metrics as JSON, so ->> works as it does in PostgreSQL), and a
+    raw_data_<tool> table per tool with a column per metric, which is much faster to scan.
+
+--federated Runs the SQL on every shard (see database/crud.py) at once and combines their rows, otherwise it only
+    runs on the DATABASE_URI shard. Each shard's ORDER BY, LIMIT and aggregates only see its own cohorts, those
+    spanning cohorts of several shards are merged with:
+    --merge-aggregate <column> <sum|count|min|max> Combines the rows equal in every other column, e.g. for
+        "SELECT sample.type, count(*) AS samples ... GROUP BY sample.type": --merge-aggregate samples count
+        (for an average, select the sum and count and divide them).
+    --merge-order-by <column> Orders the combined rows by the result column ("<column> desc" for descending).
+    --merge-limit <number> Keeps the first rows of the combined (ordered) rows.
+
 NOTE: If --multiqc or --csv flags are not used, result will print to stdout as csv.
 
 Example_1 (Stdout): 
@@ -89,6 +104,18 @@ Where sql2.txt contains the following (need to select for both sample.sample_nam
 
 """
 
+# Returns the header and rows of the SQL's result.
+def execute_sql(session, sql):
+    result = session.execute(sql)
+    return list(result.keys()), result.fetchall()
+
+# Returns (column, descending) of a --merge-order-by.
+def order_column(order_by):
+    column, _, direction = order_by.strip().rpartition(" ")
+    if direction.lower() in ("asc", "desc") and column:
+        return column.strip(), direction.lower() == "desc"
+    return order_by.strip(), False
+
 @click.command()
 @click.option("-s", "--sql", type=click.Path(exists=True), required=False, help="Path to txt containing correct raw SQL") 
 @click.option("-o", "--output", type=click.STRING, required=False, help="where query result will be saved")
@@ -97,7 +124,14 @@ Where sql2.txt contains the following (need to select for both sample.sample_nam
 @click.option("-c", "--csv", is_flag=True, required=False, help="Create a csv report.")
 @click.option("--overview", is_flag=True, required=False, help="Prints an overview of the number of samples in each batch/cohort.")
 @click.option("--pretty", is_flag=True, required=False, help="Prints a formatted table. Cannot be used with the plot command.")
-def cli(output, filename, sql, multiqc, csv, overview, pretty):
+@click.option("--engine", type=click.Choice(["postgres", "duckdb"], case_sensitive=False), default="postgres", help="Run against the database (postgres) or the local snapshot (duckdb, see the snapshot command).")
+@click.option("--snapshot-dir", type=click.Path(exists=True, file_okay=False), required=False, help="Snapshot directory for --engine duckdb.")
+@click.option("--federated", is_flag=True, required=False, help="Run the SQL on every shard and combine the results.")
+@click.option("--merge-aggregate", multiple=True, type=(str, click.Choice(list(AGGREGATES), case_sensitive=False)), required=False,
+              help="With --federated, combine this aggregate column of the shards' rows, e.g. 'samples count'.")
+@click.option("--merge-order-by", multiple=True, required=False, help="With --federated, order the combined rows by this column ('<column> desc' for descending).")
+@click.option("--merge-limit", "limit", type=click.IntRange(0), required=False, help="With --federated, keep this many of the combined rows.")
+def cli(output, filename, sql, multiqc, csv, overview, pretty, engine, snapshot_dir, federated, merge_aggregate, merge_order_by, limit):
     """SQL query tool: ensure all queries SELECT for sample_name from sample table AND path from batch table"""
 
     if (multiqc or csv) and not output:
@@ -113,8 +147,15 @@ def cli(output, filename, sql, multiqc, csv, overview, pretty):
         if not filename:
             raise Exception("--output requires --filename (no extension) to name the csv or multiqc report")
 
+    duckdb = engine.lower() == "duckdb"
+    if (merge_aggregate or merge_order_by or limit is not None) and not federated:
+        raise Exception("--merge-aggregate, --merge-order-by and --merge-limit combine the shards' results of --federated.")
+    if federated and duckdb:
+        raise Exception("--federated runs on the shards' databases, the snapshot (--engine duckdb) is of DATABASE_URI only.")
+
     click.echo("Processing sql query!") 
-    with session_scope() as session:
+    connection = snapshot.connect(snapshot_dir or snapshot.snapshot_dir()) if duckdb else None
+    with (nullcontext() if duckdb else session_scope(REPLICA)) as session:
         if sql:
             if sql[-4:] != '.txt':
                 click.echo("When using --sql option, please supply path to .txt containing the raw SQL statement like in the examples.")
@@ -124,14 +165,30 @@ def cli(output, filename, sql, multiqc, csv, overview, pretty):
                 # Copy raw SQL statement as string.
                 sql = '\n'.join(sql_file.readlines())
             
-            falcon_query = session.execute(sql) # Executes SQL query against database.
-            query_header = falcon_query.keys() # Create header from the current query (falcon_query).
-            click.echo(f"Query returned {falcon_query.rowcount} samples.")
+            if duckdb:
+                query_header, falcon_query = snapshot.execute_sql(connection, sql) # Executes SQL query against the snapshot.
+            elif federated:
+                # Executes SQL query against every shard at once (see database/federation.py), then merges them.
+                results = fan_out(lambda shard_session, shard: execute_sql(shard_session, sql))
+                query_header = results[0][0]
+                falcon_query = [row for _, rows in results for row in rows]
+                if merge_aggregate:
+                    falcon_query = merge_aggregates(query_header, falcon_query, merge_aggregate)
+                if merge_order_by:
+                    falcon_query = merge_order(query_header, falcon_query, [order_column(column) for column in merge_order_by])
+                falcon_query = merge_limit(falcon_query, limit)
+            else:
+                result = session.execute(sql) # Executes SQL query against database.
+                query_header = result.keys() # Create header from the current query (falcon_query).
+                falcon_query = result.fetchall()
+            click.echo(f"Query returned {len(falcon_query)} samples.")
 
             if multiqc:
                 if len([col for col in query_header if 'sample_name' in col or 'path' in col]) == 2:
                     click.echo("Creating multiqc report...")
-                    create_new_multiqc([(row.sample_name, row.path) for row in falcon_query], output, filename)
+                    sample_name = [i for i, col in enumerate(query_header) if 'sample_name' in col][0]
+                    path = [i for i, col in enumerate(query_header) if 'path' in col][0]
+                    create_new_multiqc([(row[sample_name], row[path]) for row in falcon_query], output, filename)
                 else:
                     click.echo("When using --multiqc option, please select for sample.sample_name AND batch.path (see example_3).")
                     sys.exit(1)
@@ -141,6 +198,7 @@ def cli(output, filename, sql, multiqc, csv, overview, pretty):
                 create_csv(query_header, falcon_query, output, filename)
             
             if pretty and not csv and not multiqc and not overview:
+                from tabulate import tabulate
                 # Print result.
                 click.echo(tabulate(falcon_query, query_header, tablefmt="pretty")) 
 
@@ -149,4 +207,7 @@ def cli(output, filename, sql, multiqc, csv, overview, pretty):
                 print_csv(query_header, falcon_query)       
 
         if overview:
-            print_overview(session)
+            if duckdb:
+                print_overview_rows(snapshot.overview(connection))
+            else:
+                print_overview(session)
@@ -0,0 +1,55 @@
+import click
+from database.baselines import DRIFT_THRESHOLD
+from database.crud import session_scope
+from database.jobs import recent_jobs
+from falcon_multiqc.watcher import watch
+
+"""
+Watches a landing area and saves each finished multiqc output directory that lands in it, as save would
+(see falcon_multiqc/watcher.py). Each directory needs its multiqc_data/multiqc_data.json and its sample metadata csv
+(the only file of the directory matching --metadata). Saves and their outcome are recorded in the ingest_job table.
+
+--workers <n> Directories saved at once (2 by default).
+--settle <seconds> How long a directory's files must be left unchanged before it is saved (5 by default).
+--metadata <glob> The sample metadata file of a directory (*.csv by default).
+--poll-interval <seconds> Rescan period when inotify isn't available (10 by default). --poll always rescans.
+--once Save the directories that have settled and exit (e.g. from cron), rather than watching.
+--retry-failed Queue the failed jobs of the landing area again (e.g. after the database was unavailable).
+--jobs Print the last jobs (--status to choose failed / saved / queued / running ones) and exit.
+--drift-threshold <number> As save's.
+
+Run one watcher per landing area. Stop it with Ctrl-C or SIGTERM, it waits for the running saves to finish.
+
+Example:
+    falcon_multiqc watch /data/landing --workers 4
+"""
+
+@click.command()
+@click.argument("directory", type=click.Path(exists=True, file_okay=False), required=False)
+@click.option("-w", "--workers", type=click.IntRange(1), default=2, help="Directories saved at once.")
+@click.option("--settle", type=click.FloatRange(0), default=5, help="Seconds a directory's files must be unchanged before saving it.")
+@click.option("-m", "--metadata", "metadata_pattern", default="*.csv", help="Glob of a directory's sample metadata file.")
+@click.option("--poll-interval", type=click.FloatRange(0.1), default=10, help="Rescan period (seconds) without inotify.")
+@click.option("--poll", is_flag=True, required=False, help="Rescan the landing area rather than use inotify.")
+@click.option("--once", is_flag=True, required=False, help="Save the settled directories and exit.")
+@click.option("--retry-failed", is_flag=True, required=False, help="Queue the failed jobs again.")
+@click.option("--jobs", is_flag=True, required=False, help="Print the last jobs and exit.")
+@click.option("--status", type=click.Choice(["queued", "running", "saved", "failed"]), required=False, help="Only print jobs of this status (with --jobs).")
+@click.option("--drift-threshold", type=click.FloatRange(0), default=DRIFT_THRESHOLD, help="Report metrics whose batch mean shifted by this many baseline standard deviations.")
+def cli(directory, workers, settle, metadata_pattern, poll_interval, poll, once, retry_failed, jobs, status, drift_threshold):
+    """Watches a landing directory and saves the multiqc output directories that land in it, recording each as a job."""
+
+    if jobs:
+        from tabulate import tabulate
+        with session_scope() as session:
+            table = [[job.id, job.status, job.directory, job.cohort_id, job.sample_count, job.queued_at.strftime("%Y-%m-%d %H:%M:%S"),
+                      job.finished_at and job.finished_at.strftime("%Y-%m-%d %H:%M:%S"), job.error]
+                     for job in recent_jobs(session, status=status)]
+        click.echo(tabulate(table, ["Job", "Status", "Directory", "Cohort", "Samples", "Queued", "Finished", "Error"], tablefmt="pretty")
+                   if table else "No jobs.")
+        return
+    if not directory:
+        raise Exception("Watch requires the landing DIRECTORY (or --jobs).")
+
+    counts = watch(directory, workers, settle, metadata_pattern, drift_threshold, poll_interval, once, not poll, retry_failed)
+    click.echo(f"{counts.get('saved', 0)} directories saved, {counts.get('failed', 0)} failed (see falcon_multiqc watch --jobs).")
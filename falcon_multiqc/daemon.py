@@ -0,0 +1,264 @@
+import os
+import sys
+import json
+import stat
+import socket
+import tempfile
+import threading
+
+"""
+Local falcon_multiqc daemon (see the serve command) and its thin client.
+
+The daemon keeps one process running with the commands imported, the engines' connection pools open
+and the metric catalog (database/catalog.py) cached, and runs commands sent to it over a Unix socket,
+one thread per request.
+
+Protocol (one JSON document per line):
+    client -> daemon: {"args": ["query", "--batch", "AAA"], "cwd": "/home/user", "tty": false}
+    daemon -> client: {"out": "..."} / {"err": "..."} as the command writes, then {"exit": 0}
+
+The client is used by safe_entry_point for DAEMON_COMMANDS (see cli.py) when the socket exists and belongs to this user,
+falling back to running the command in-process when no daemon is available.
+Set FALCON_MULTIQC_DAEMON=0 to never use the daemon.
+
+The socket lives in $XDG_RUNTIME_DIR, or else in a falcon_multiqc-<uid> directory (mode 0700) in the temp directory.
+"""
+
+# Working directory of the client whose request the current thread is running (daemon only).
+_request = threading.local()
+
+def socket_path():
+    if os.environ.get("FALCON_MULTIQC_SOCKET"):
+        return os.environ["FALCON_MULTIQC_SOCKET"]
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or os.path.join(tempfile.gettempdir(), f"falcon_multiqc-{os.getuid()}")
+    return os.path.join(runtime_dir, "falcon_multiqc.sock")
+
+def daemon_enabled():
+    return os.environ.get("FALCON_MULTIQC_DAEMON", "1") != "0"
+
+# Resolves a path relative to the working directory of the command's caller.
+# The same as os.path.abspath, except inside the daemon where it is relative to the client's cwd.
+def client_path(path):
+    return os.path.abspath(os.path.join(getattr(_request, "cwd", None) or os.getcwd(), path))
+
+# True when path exists and is owned by this user (and, for a socket, is a socket).
+def _owned(path, is_socket=False):
+    try:
+        status = os.stat(path)
+    except OSError:
+        return False
+    if is_socket and not stat.S_ISSOCK(status.st_mode):
+        return False
+    return status.st_uid == os.getuid()
+
+### ================================= CLIENT  ==========================================####
+
+# Runs the command through the daemon, printing its output as it arrives.
+# Returns the command's exit code, or None if no daemon is available.
+def run_remote(args):
+    path = socket_path()
+    # Never talk to a socket another user could have put there.
+    if not _owned(path, is_socket=True):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except OSError:
+        client.close()
+        return None
+
+    request = {"args": args, "cwd": os.getcwd(), "tty": sys.stdout.isatty()}
+    with client, client.makefile("rwb") as stream:
+        stream.write(json.dumps(request).encode() + b"\n")
+        stream.flush()
+        for line in stream:
+            message = json.loads(line)
+            if "out" in message:
+                sys.stdout.write(message["out"])
+                sys.stdout.flush()
+            elif "err" in message:
+                sys.stderr.write(message["err"])
+                sys.stderr.flush()
+            elif "exit" in message:
+                return message["exit"]
+    # Daemon went away mid command.
+    raise Exception("Lost connection to the falcon_multiqc daemon.")
+
+### ================================= DAEMON  ==========================================####
+
+# Stands in for sys.stdout / sys.stderr, sending each thread's writes
+# to that thread's request (or to the real stream outside of a request).
+class ThreadLocalStream:
+    def __init__(self, original, local, name):
+        self._original = original
+        self._local = local
+        self._name = name
+        self.encoding = "utf-8"
+        self.errors = "strict"
+
+    def _stream(self):
+        return getattr(self._local, self._name, None) or self._original
+
+    def write(self, text):
+        return self._stream().write(text)
+
+    def __getattr__(self, attr):
+        return getattr(self._stream(), attr)
+
+# Writes a request's stdout / stderr back to its client as {"out"/"err": text} lines.
+class ClientWriter:
+    def __init__(self, stream, key, tty, lock):
+        self._stream = stream
+        self._key = key
+        self._tty = tty
+        self._lock = lock
+
+    def write(self, text):
+        if not isinstance(text, str):
+            raise TypeError("write() argument must be str")
+        if text:
+            with self._lock:
+                self._stream.write(json.dumps({self._key: text}).encode() + b"\n")
+                self._stream.flush()
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return self._tty
+
+# Makes relative click.Path / click.File arguments absolute, relative to the client's cwd.
+# The daemon's own working directory is shared by all requests so it is never changed.
+def absolute_args(command, args, cwd):
+    import click
+
+    path_opts = set()
+    for param in command.params:
+        if isinstance(param, click.Option) and isinstance(param.type, (click.Path, click.File)):
+            path_opts.update(param.opts)
+
+    args = list(args)
+    for i, arg in enumerate(args):
+        value_index = None
+        if arg in path_opts and i + 1 < len(args):
+            value_index = i + 1
+        elif "=" in arg and arg.split("=", 1)[0] in path_opts:
+            opt, value = arg.split("=", 1)
+            if value != "-":
+                args[i] = f"{opt}={os.path.join(cwd, os.path.expanduser(value))}"
+        if value_index is not None and args[value_index] != "-":
+            args[value_index] = os.path.join(cwd, os.path.expanduser(args[value_index]))
+    return args
+
+# Creates the socket's directory if needed, refusing one where other users could replace the socket
+# (owned by someone else, or writable by others without the sticky bit like /tmp has).
+def _socket_dir(path):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    status = os.lstat(directory)
+    if not stat.S_ISDIR(status.st_mode):
+        raise Exception(f"Socket directory {directory} is not a directory.")
+    if not status.st_mode & stat.S_ISVTX and (status.st_uid != os.getuid() or status.st_mode & 0o022):
+        raise Exception(f"Socket directory {directory} can be written by other users, choose another with --socket.")
+
+def serve(path):
+    import signal
+    import traceback
+    import socketserver
+    import click
+    from click.exceptions import ClickException, Abort, Exit
+    from .cli import cli, COMMANDS, DAEMON_COMMANDS
+    from database import crud
+    from database import catalog
+
+    local = threading.local()
+    sys.stdout = ThreadLocalStream(sys.stdout, local, "stdout")
+    sys.stderr = ThreadLocalStream(sys.stderr, local, "stderr")
+
+    # Import every daemon command up front, so requests never pay for imports.
+    commands = {name: cli.get_command(None, name) for name in DAEMON_COMMANDS if name in COMMANDS}
+
+    def run(request):
+        args = request["args"]
+        if not args or args[0] not in commands:
+            click.echo(f"Command {args[0] if args else ''} can't be run through the daemon.", err=True)
+            return 1
+        args = [args[0]] + absolute_args(commands[args[0]], args[1:], request["cwd"])
+        _request.cwd = request["cwd"]
+        try:
+            return cli.main(args=args, prog_name="falcon_multiqc", standalone_mode=False) or 0
+        except Exit as e:
+            return e.exit_code
+        except ClickException as e:
+            e.show()
+            return e.exit_code
+        except Abort:
+            click.echo("Aborted!", err=True)
+            return 1
+        except SystemExit as e:
+            if e.code is None:
+                return 0
+            return e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            # Same output as safe_entry_point.
+            click.echo(traceback.format_exc())
+            click.echo(click.style(str(e), fg="red"))
+            return 1
+        finally:
+            _request.cwd = None
+            if args[0] in ["save", "remove"]:
+                catalog.invalidate()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline()
+            if not line:
+                return
+            request = json.loads(line)
+            lock = threading.Lock()
+            local.stdout = ClientWriter(self.wfile, "out", request.get("tty", False), lock)
+            local.stderr = ClientWriter(self.wfile, "err", request.get("tty", False), lock)
+            try:
+                exit_code = run(request)
+                with lock:
+                    self.wfile.write(json.dumps({"exit": exit_code}).encode() + b"\n")
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                local.stdout = local.stderr = None
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    # Warm the engines (and their pools) and the metric catalog before accepting requests.
+    engines = [crud.get_engine(crud.PRIMARY), crud.get_engine(crud.REPLICA)]
+    for engine in engines:
+        connections = [engine.connect() for _ in range(engine.pool.size())]
+        for connection in connections:
+            connection.close()
+    with crud.session_scope(crud.REPLICA) as session:
+        catalog.get_catalog(session)
+
+    _socket_dir(path)
+    if os.path.exists(path):
+        os.remove(path)
+    old_umask = os.umask(0o077) # Only this user can connect.
+    server = Server(path, Handler)
+    os.umask(old_umask)
+
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    click.echo(f"falcon_multiqc daemon listening on {path} (pid {os.getpid()}).")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+        for engine in engines:
+            engine.dispose()
+        click.echo("falcon_multiqc daemon stopped.")
@@ -0,0 +1,76 @@
+import os
+import gzip
+import posixpath
+import tarfile
+from contextlib import ExitStack, contextmanager
+
+"""
+Reads save's multiqc output (its multiqc_data.json) from wherever an archive keeps it, as a stream, without
+unpacking it to scratch space first. The path given to save (--directory, or the directory column of --input_csv) is
+one of:
+    a multiqc output directory -- its multiqc_data/multiqc_data.json, or multiqc_data.json.gz / .json.zst.
+    a multiqc_data.json file, plain or compressed (.json, .json.gz, .json.zst).
+    a tar archive of the output (.tar, .tar.gz / .tgz, .tar.bz2, .tar.xz, .tar.zst / .tzst) -- the archive is read
+        in order until its first multiqc_data/multiqc_data.json (or multiqc_data.json[.gz / .zst]), which is decompressed
+        as it is parsed. Nothing is written to disk, and the rest of the archive (plots, reports) isn't read.
+
+zstd needs the standard library's compression.zstd (Python 3.14+) or the zstandard package (pip install zstandard).
+"""
+
+MULTIQC_JSON = os.path.join("multiqc_data", "multiqc_data.json")
+JSON_NAMES = ["multiqc_data.json", "multiqc_data.json.gz", "multiqc_data.json.zst"]
+TAR_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz", ".tar.zst", ".tar.zstd", ".tzst")
+ZSTD_SUFFIXES = (".zst", ".zstd", ".tzst")
+
+# A decompressing reader of the zstd stream.
+def zstd_reader(stream):
+    try:
+        from compression import zstd
+        return zstd.ZstdFile(stream)
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception("Reading zstd compressed input requires the zstandard package (pip install zstandard).")
+    return zstandard.ZstdDecompressor().stream_reader(stream)
+
+def is_archive(path):
+    return path.lower().endswith(TAR_SUFFIXES)
+
+# True when the archive member is a multiqc_data.json (see above).
+def is_multiqc_json(name):
+    parts = posixpath.normpath(name).split("/")
+    return parts[-1] in JSON_NAMES and parts[-2:-1] in ([], ["multiqc_data"])
+
+# Opens the (possibly compressed, see JSON_NAMES) json stream, named name, in the stack.
+def json_stream(stack, stream, name):
+    if name.lower().endswith(".gz"):
+        return stack.enter_context(gzip.GzipFile(fileobj=stream))
+    if name.lower().endswith(ZSTD_SUFFIXES):
+        return stack.enter_context(zstd_reader(stream))
+    return stream
+
+# Yields a binary stream of the multiqc_data.json of path (see above).
+@contextmanager
+def open_multiqc_data(path):
+    with ExitStack() as stack:
+        if os.path.isdir(path):
+            candidates = [os.path.join(path, "multiqc_data", name) for name in JSON_NAMES]
+            # The plain json when there's none (a missing file error, as before).
+            json_path = next((candidate for candidate in candidates if os.path.isfile(candidate)), candidates[0])
+            yield json_stream(stack, stack.enter_context(open(json_path, "rb")), json_path)
+        elif is_archive(path):
+            if path.lower().endswith(ZSTD_SUFFIXES):
+                archive = tarfile.open(fileobj=stack.enter_context(zstd_reader(stack.enter_context(open(path, "rb")))), mode="r|")
+            else:
+                # Stream mode: members are read in order, never seeking back.
+                archive = tarfile.open(path, mode="r|*")
+            stack.enter_context(archive)
+            for member in archive:
+                if member.isfile() and is_multiqc_json(member.name):
+                    yield json_stream(stack, archive.extractfile(member), member.name)
+                    return
+            raise Exception(f"The archive {path} has no multiqc_data/multiqc_data.json.")
+        else:
+            yield json_stream(stack, stack.enter_context(open(path, "rb")), path)
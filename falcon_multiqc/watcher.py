@@ -0,0 +1,297 @@
+import os
+import time
+import errno
+import select
+import struct
+import fnmatch
+import threading
+import click
+
+"""
+Watches a landing area for finished multiqc output directories and saves them (see the watch command).
+
+A batch directory is a directory with a multiqc_data/multiqc_data.json, and its sample metadata csv (the one file
+of the directory matching the metadata pattern, *.csv by default). It's saved once it is complete and settled: both
+files exist and none of their sizes / modification times changed for `settle` seconds, so directories still being
+copied or written (a partial json, a metadata file yet to come) are left until they're done.
+
+Changes are found with Linux's inotify (through libc, see Inotify), on every directory of the landing area: only
+the directories written to are looked at again, however large the landing area, so a new batch is saved within
+seconds of landing. Without inotify (other systems, or too few inotify watches, see
+/proc/sys/fs/inotify/max_user_watches) the landing area is rescanned every poll interval instead, only stat-ing
+the files.
+
+Directories are queued in the ingest_job table (see database/jobs.py) and saved by a pool of worker threads, each
+directory in its own transaction through save_sample, as save -d <directory> -s <metadata> would. A job's outcome
+(saved with its cohort / sample / batch counts, or failed with the error) is recorded in the job table.
+A directory is saved again when its files change (a new job), e.g. after fixing the metadata of a failed job.
+"""
+
+MULTIQC_JSON = os.path.join("multiqc_data", "multiqc_data.json")
+
+# inotify event masks (see inotify(7)).
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT = struct.Struct("iIII") # wd, mask, cookie, name length
+
+
+class Inotify:
+    """Linux inotify (through libc with ctypes) on every directory of a tree. Raises OSError when unavailable."""
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available on this system")
+        self.get_errno = ctypes.get_errno
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(self.get_errno(), os.strerror(self.get_errno()))
+        self.paths = {} # watch descriptor : directory
+
+    def close(self):
+        os.close(self.fd)
+
+    # Watches the directory and every directory under it.
+    def add_tree(self, root):
+        for directory, _, _ in os.walk(root):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                error = self.get_errno()
+                # Gone (or replaced by a file) since it was listed.
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise OSError(error, f"Can't watch {directory}: {os.strerror(error)}")
+            self.paths[wd] = directory
+
+    # Waits up to timeout seconds for events. Returns [(path, mask)] of the files / directories changed,
+    # or None when events were lost (the queue overflowed). New directories are watched as they appear.
+    def read(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, offset)
+                name = os.fsdecode(data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0"))
+                offset += EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                if mask & IN_IGNORED:
+                    self.paths.pop(wd, None)
+                    continue
+                if wd not in self.paths:
+                    continue
+                path = os.path.join(self.paths[wd], name)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(path)
+                events.append((path, mask))
+
+
+# Returns the batch directories under root (see above).
+def find_directories(root):
+    for directory, _, files in os.walk(root):
+        if os.path.basename(directory) == "multiqc_data" and "multiqc_data.json" in files:
+            yield os.path.dirname(directory)
+
+# Returns (sample metadata files, fingerprint, newest modification time) of the batch directory,
+# or None while it is incomplete.
+def directory_state(directory, metadata_pattern):
+    try:
+        files = [MULTIQC_JSON] + sorted(name for name in fnmatch.filter(os.listdir(directory), metadata_pattern)
+                                        if os.path.isfile(os.path.join(directory, name)))
+        stats = [os.stat(os.path.join(directory, name)) for name in files]
+    except OSError:
+        return None
+    if len(files) == 1:
+        return None
+    fingerprint = ";".join(f"{name}:{stat.st_size}:{stat.st_mtime_ns}" for name, stat in zip(files, stats))
+    return [os.path.join(directory, name) for name in files[1:]], fingerprint, max(stat.st_mtime for stat in stats)
+
+# The batch directory a change at path belongs to (its directory, or the directory of its multiqc_data).
+def changed_directory(path):
+    directory = os.path.dirname(path)
+    return os.path.dirname(directory) if os.path.basename(directory) == "multiqc_data" else directory
+
+
+class LandingArea:
+    """The batch directories of a landing area waiting to settle (see above)."""
+
+    def __init__(self, metadata_pattern="*.csv", settle=5):
+        self.metadata_pattern = metadata_pattern
+        self.settle = settle
+        self.pending = {} # directory : (state, settling since)
+        self.queued = {} # directory : fingerprint last queued
+
+    # Looks at the directory again (after a change).
+    def touch(self, directory):
+        state = directory_state(directory, self.metadata_pattern)
+        if state is None or self.queued.get(directory) == state[1]:
+            self.pending.pop(directory, None)
+        elif directory not in self.pending or self.pending[directory][0] != state:
+            # A directory seen for the first time has settled since its files were last written.
+            self.pending[directory] = (state, min(state[2], time.time()) if directory not in self.pending else time.time())
+
+    # Returns [(directory, sample metadata files, fingerprint)] of the settled directories, now queued.
+    def settled(self):
+        now = time.time()
+        ready = []
+        for directory, (state, since) in list(self.pending.items()):
+            current = directory_state(directory, self.metadata_pattern)
+            if current != state:
+                if current is None:
+                    del self.pending[directory]
+                else:
+                    self.pending[directory] = (current, now)
+            elif now - since >= self.settle:
+                del self.pending[directory]
+                self.queued[directory] = state[1]
+                ready.append((directory, state[0], state[1]))
+        return ready
+
+
+# Saves the job's directory (see above). Returns (status, message).
+def run_job(job_id, directory, sample_metadata, drift_threshold):
+    from database import catalog
+    from database.crud import session_scope, cohort_shard, DEFAULT_SHARD
+    from database.ingest import ensure_batch_constraint, update_cohorts
+    from database.jobs import claim_job, finish_job, SAVED, FAILED
+    from falcon_multiqc.commands.save import save_sample, metadata_cohort
+
+    with session_scope() as session:
+        if not claim_job(session, job_id):
+            return None, "already taken by another worker"
+    try:
+        if len(sample_metadata) != 1:
+            raise Exception(f"Several files of {directory} match the sample metadata pattern: "
+                            f"{', '.join(os.path.basename(path) for path in sample_metadata)}.")
+        shard = cohort_shard(metadata_cohort(sample_metadata[0]))
+        ensure_batch_constraint(shard)
+        with session_scope(shard=shard) as session:
+            cohort_id, samples, batches, types = save_sample(directory, sample_metadata[0], session, None, None, drift_threshold)
+            update_cohorts(session, {cohort_id: (samples, batches, types)})
+            if shard == DEFAULT_SHARD:
+                # Saved with the rows (see database/jobs.py).
+                finish_job(session, job_id, SAVED, cohort_id, samples, batches)
+        if shard != DEFAULT_SHARD:
+            with session_scope() as session:
+                finish_job(session, job_id, SAVED, cohort_id, samples, batches)
+    except Exception as e:
+        with session_scope() as session:
+            finish_job(session, job_id, FAILED, error=str(e))
+        return FAILED, str(e)
+    finally:
+        catalog.invalidate()
+    return SAVED, f"{samples} samples of cohort {cohort_id}"
+
+# Watches root and saves its batch directories (see above) with workers threads, until stopped (SIGINT / SIGTERM, or
+# the stopping threading.Event set). With once, saves the settled directories found by one scan and returns.
+# poll_interval is the rescan period without inotify (or with use_inotify False). Returns {status: number of jobs}.
+def watch(root, workers=2, settle=5, metadata_pattern="*.csv", drift_threshold=None, poll_interval=10, once=False,
+          use_inotify=True, retry_failed=False, stopping=None):
+    import signal
+    from concurrent.futures import ThreadPoolExecutor
+    from database.crud import session_scope, is_sharded
+    from database.jobs import queue_job, recover_jobs, QUEUED
+    from database.baselines import DRIFT_THRESHOLD
+
+    root = os.path.abspath(root)
+    drift_threshold = DRIFT_THRESHOLD if drift_threshold is None else drift_threshold
+    with session_scope() as session:
+        failed, queued = recover_jobs(session, root, is_sharded(), retry_failed)
+    if failed or queued:
+        click.echo(f"Recovered earlier jobs: {queued} queued again, {failed} failed (interrupted).")
+
+    area = LandingArea(metadata_pattern, settle)
+    counts = {}
+    lock = threading.Lock()
+    stopping = stopping or threading.Event()
+    inotify = None
+    if use_inotify and not once:
+        try:
+            inotify = Inotify()
+            inotify.add_tree(root)
+        except OSError as e:
+            if inotify:
+                inotify.close()
+            inotify = None
+            click.echo(f"inotify is unavailable ({e}), rescanning {root} every {poll_interval:g}s instead.")
+
+    def finished(future, directory):
+        status, message = future.result()
+        if status is None:
+            return
+        with lock:
+            counts[status] = counts.get(status, 0) + 1
+        click.echo(click.style(f"{status.capitalize()} {directory}: {message}", fg="green" if status == "saved" else "red"))
+
+    def queue(executor):
+        for directory, sample_metadata, fingerprint in area.settled():
+            with session_scope() as session:
+                job_id, status = queue_job(session, directory, ", ".join(sample_metadata), fingerprint)
+            if status != QUEUED:
+                continue
+            click.echo(f"Queued {directory} (job {job_id}).")
+            future = executor.submit(run_job, job_id, directory, sample_metadata, drift_threshold)
+            future.add_done_callback(lambda future, directory=directory: finished(future, directory))
+
+    def stop(signum, frame):
+        stopping.set()
+    if not once and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+    # Every directory already there (e.g. landed while the watcher wasn't running), then only the changed ones.
+    for directory in find_directories(root):
+        area.touch(directory)
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="falcon_multiqc_watch")
+    try:
+        if once:
+            queue(executor)
+            if area.pending:
+                click.echo(f"{len(area.pending)} directories haven't settled yet, they're left for the next run.")
+            executor.shutdown(wait=True)
+            return counts
+        click.echo(f"Watching {root} with {workers} workers ({'inotify' if inotify else 'polling'}), Ctrl-C to stop.")
+        last_scan = time.time()
+        while not stopping.is_set():
+            if inotify:
+                events = inotify.read(timeout=min(1, settle / 2) if area.pending else 1)
+                if events is None:
+                    # Events were lost, look at everything again.
+                    for directory in find_directories(root):
+                        area.touch(directory)
+                for path, mask in events or []:
+                    if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                        # A directory moved in whole has no events of its own files.
+                        for directory in find_directories(path):
+                            area.touch(directory)
+                    area.touch(changed_directory(path))
+            else:
+                stopping.wait(min(1, settle / 2) if area.pending else poll_interval - (time.time() - last_scan))
+                if time.time() - last_scan >= poll_interval:
+                    for directory in find_directories(root):
+                        area.touch(directory)
+                    last_scan = time.time()
+            queue(executor)
+        click.echo("Stopping, waiting for the running saves to finish...")
+        return counts
+    finally:
+        executor.shutdown(wait=True)
+        if inotify:
+            inotify.close()
@@ -0,0 +1,36 @@
+import os
+import pytest
+from database import catalog, config, crud
+
+# PostgreSQL database for the tests that need one, e.g. postgres+psycopg2://postgres@/falcon_test?host=/tmp
+# Those tests are skipped when it isn't set. Its tables are created if missing, and its data may be deleted.
+TEST_DATABASE_URI = os.environ.get("FALCON_MULTIQC_TEST_DATABASE_URI")
+# Another database on the same server, the second shard of the sharding tests (skipped when it isn't set).
+TEST_SHARD_URI = os.environ.get("FALCON_MULTIQC_TEST_SHARD_URI")
+
+
+# Points database.crud at the test database (both roles), with fresh engines.
+@pytest.fixture
+def test_database(monkeypatch):
+    if not TEST_DATABASE_URI:
+        pytest.skip("FALCON_MULTIQC_TEST_DATABASE_URI is not set.")
+    monkeypatch.setenv("FALCON_MULTIQC_DATABASE_URI", TEST_DATABASE_URI)
+    monkeypatch.delenv("FALCON_MULTIQC_REPLICA_URI", raising=False)
+    monkeypatch.setattr(crud, "engines", {})
+    crud.create_database()
+    yield crud
+    for engine in crud.engines.values():
+        engine.dispose()
+
+
+# The test database sharded: the default shard and "shard1" (cohorts are mapped with config.COHORT_SHARDS).
+@pytest.fixture
+def test_shards(test_database, monkeypatch):
+    if not TEST_SHARD_URI:
+        pytest.skip("FALCON_MULTIQC_TEST_SHARD_URI is not set.")
+    monkeypatch.setattr(config, "SHARDS", {"shard1": TEST_SHARD_URI})
+    monkeypatch.setattr(config, "COHORT_SHARDS", {})
+    crud.create_database()
+    catalog.invalidate()
+    yield crud
+    catalog.invalidate()
@@ -0,0 +1,65 @@
+import math
+import pytest
+from database import catalog
+from database.models import Batch, Cohort, MetricSummary, RawData, Sample
+from falcon_multiqc.api import Client, rows_chunk, typed_values
+
+
+def test_rows_chunk():
+    assert typed_values(["30.25", "NA", None, 10], "float") == [30.25, None, None, 10.0]
+    assert typed_values(["NA"], "string") == ["NA"]
+
+    header = ["sample.id", "sample.sample_name", "raw_data.AVG_DP"]
+    frame = rows_chunk([(1, "S1", "30.25"), (None, "S2", "NA")], header, ["integer", "string", "float"], "pandas")
+    assert [str(dtype) for dtype in frame.dtypes] == ["Int64", "object", "float64"]
+    assert frame["raw_data.AVG_DP"][0] == 30.25 and math.isnan(frame["raw_data.AVG_DP"][1])
+    # An empty result still has the columns.
+    assert list(rows_chunk([], header, ["integer", "string", "float"], "pandas").columns) == header
+
+    pytest.importorskip("pyarrow")
+    batch = rows_chunk([(1, "S1", "30.25")], header, ["integer", "string", "float"], "arrow")
+    assert [str(field.type) for field in batch.schema] == ["int64", "string", "double"]
+
+
+def test_client_query(test_database):
+    with test_database.session_scope() as session:
+        session.query(Cohort).filter(Cohort.id == "API_TEST").delete()
+        session.add(Cohort(id="API_TEST"))
+        batch = Batch(cohort_id="API_TEST", batch_name="API", path="/data")
+        session.add(batch)
+        session.flush()
+        for i, metrics in enumerate([{"AVG_DP": 30.25, "CHIPMIX": "NA"}, {"CHIPMIX": "0.1"}, {"AVG_DP": 12}]):
+            sample = Sample(sample_name=f"API{i}", cohort_id="API_TEST", batch_id=batch.id, flowcell_lane="FC1",
+                            library_id="LIB", platform="HiSeqX", centre="KCCG", reference_genome="hs37d5", type="healthy")
+            session.add(sample)
+            session.flush()
+            session.add(RawData(sample_id=sample.id, qc_tool="api_test", metrics=metrics))
+        session.add(MetricSummary(batch_id=batch.id, qc_tool="api_test", metric="AVG_DP", count=2, mean=0, m2=0, min=0, max=0,
+                                  sketch=[]))
+    catalog.invalidate()
+    try:
+        client = Client()
+        # A row at a time, so the result is combined from several chunks.
+        frame = client.query(select=["sample", "tool-metric"], tool_metric=[("api_test", "AVG_DP")], cohort=["API_TEST"],
+                             batch_size=1).sort_values("sample.sample_name")
+        assert frame["sample.sample_name"].tolist() == ["API0", "API1", "API2"]
+        assert str(frame["sample.id"].dtype) == "Int64" and str(frame["raw_data.AVG_DP"].dtype) == "float64"
+        assert frame["raw_data.AVG_DP"].tolist()[0::2] == [30.25, 12.0]
+
+        # Same filters as the query command, non-numeric metrics stay text.
+        frame = client.query(select=["sample", "tool-metric"], tool_metric=[("api_test", "AVG_DP", ">", 20)], cohort=["API_TEST"])
+        assert frame["sample.sample_name"].tolist() == ["API0"]
+        frame = client.query(select=["sample", "tool-metric"], tool_metric=[("api_test", "CHIPMIX")], sample_list=["API0", "API1"])
+        assert sorted(frame["raw_data.CHIPMIX"]) == ["0.1", "NA"]
+        frame = client.query(select_tool=["api_test"], cohort=["API_TEST"], sample_list=["API2"])
+        assert frame["api_test.AVG_DP"].tolist() == [12.0]
+        assert client.query(cohort=["API_TEST_X"]).empty
+
+        pytest.importorskip("pyarrow")
+        table = client.query(select=["sample", "tool-metric"], tool_metric=[("api_test", "AVG_DP")], cohort=["API_TEST"],
+                             output="arrow", batch_size=2)
+        assert table.num_rows == 3 and str(table.schema.field("raw_data.AVG_DP").type) == "double"
+    finally:
+        with test_database.session_scope() as session:
+            session.query(Cohort).filter(Cohort.id == "API_TEST").delete()
+        catalog.invalidate()
@@ -0,0 +1,103 @@
+import json
+import math
+import pytest
+from click.testing import CliRunner
+from database.baselines import MIN_BASELINE_COUNT, drift, rebuild_baselines
+from database.models import BatchMetricBaseline, Cohort, MetricBaseline
+from database.sketch import moments
+from falcon_multiqc.commands import baseline, remove, save
+
+CENTRE = "BASELINE_TEST"
+# fastqc totals of the saved batches.
+TOTALS = {"BA": list(range(10, 21)), "BB": [12, 14, 16], "BC": [40, 42, "NA"]}
+
+
+def write_batch(tmp_path, batch_name, totals):
+    directory = tmp_path / batch_name
+    (directory / "multiqc_data").mkdir(parents=True)
+    names = [f"{batch_name}S{i}" for i in range(len(totals))]
+    raw_data = {"multiqc_fastqc": {f"{name}_L001": {"total": total, "name": name} for name, total in zip(names, totals)}}
+    (directory / "multiqc_data" / "multiqc_data.json").write_text(json.dumps({"report_saved_raw_data": raw_data}))
+    metadata = tmp_path / f"{batch_name}.csv"
+    metadata.write_text("Sample Name,Cohort Name,Batch Name,Flowcell.Lane,Library ID,Platform,Centre,Reference,Type,Description\n" +
+                        "".join(f"{name},{CENTRE},{batch_name},FC1,LIB,HiSeqX,{CENTRE},hs37d5,healthy,\n" for name in names))
+    return str(directory), str(metadata)
+
+
+def invoke(command, args):
+    result = CliRunner().invoke(command, args)
+    if result.exception and not isinstance(result.exception, SystemExit):
+        raise result.exception
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def total_baseline(test_database):
+    with test_database.session_scope() as session:
+        row = session.query(MetricBaseline).filter(MetricBaseline.centre == CENTRE, MetricBaseline.metric == "total").one_or_none()
+        return row and (row.count, row.mean, row.m2, row.min, row.max)
+
+
+def assert_baseline(test_database, values):
+    count, mean, m2, minimum, maximum = total_baseline(test_database)
+    expected = moments(values)
+    assert count == expected[0]
+    assert mean == pytest.approx(expected[1])
+    assert m2 == pytest.approx(expected[2])
+    assert (minimum, maximum) == expected[3:]
+
+
+def clean(test_database):
+    with test_database.session_scope() as session:
+        session.query(Cohort).filter(Cohort.id == CENTRE).delete(synchronize_session=False)
+        session.query(MetricBaseline).filter(MetricBaseline.centre == CENTRE).delete(synchronize_session=False)
+
+
+def test_drift():
+    group = ("KCCG", "HiSeqX", "hs37d5", "fastqc", "total")
+    baselines = {group: (20, 10.0, 19 * 4.0)} # sd 2
+    shares = {(1, *group): (5, 13.0, 0.0, 12, 14), (2, *group): (5, 11.0, 0.0, 10, 12), (3, *group): (5, 5.0, 0.0, 4, 6),
+              (1, "BGI", "HiSeqX", "hs37d5", "fastqc", "total"): (5, 99.0, 0.0, 99, 99)}
+    report = drift(shares, baselines)
+    assert [(row[0], row[-1]) for row in report] == [(3, -2.5), (1, 1.5)]
+    assert report[0][6:11] == (5, 5.0, 20, 10.0, 2.0)
+    assert [row[0] for row in drift(shares, baselines, threshold=2)] == [3]
+
+    # Too few samples to compare with.
+    assert drift(shares, {group: (MIN_BASELINE_COUNT - 1, 10.0, 4.0)}) == []
+    # A constant baseline drifts with any change.
+    report = drift(shares, {group: (20, 11.0, 0.0)})
+    assert [(row[0], row[-1]) for row in report] == [(1, math.inf), (3, -math.inf)]
+
+
+def test_baselines_save_remove(test_database, tmp_path):
+    clean(test_database)
+    try:
+        outputs = {}
+        for batch_name, totals in TOTALS.items():
+            directory, metadata = write_batch(tmp_path, batch_name, totals)
+            outputs[batch_name] = invoke(save.cli, ["-d", directory, "-s", metadata])
+        assert "drifted" not in outputs["BA"] + outputs["BB"]
+        assert "1 metrics drifted" in outputs["BC"] and "BC" in outputs["BC"]
+        # Non-numeric values ('NA', names) aren't part of the baselines.
+        assert_baseline(test_database, TOTALS["BA"] + TOTALS["BB"] + [40, 42])
+        assert "BASELINE_TEST" in invoke(baseline.cli, ["-tm", "fastqc", "total", "--centre", CENTRE])
+
+        # The removed batch is taken out, min / max come from the other batches.
+        invoke(remove.cli, ["-b", CENTRE, "BC", "--no-vacuum"])
+        assert_baseline(test_database, TOTALS["BA"] + TOTALS["BB"])
+        invoke(remove.cli, ["-b", CENTRE, "BA", "--no-vacuum"])
+        assert_baseline(test_database, TOTALS["BB"])
+
+        # Batches without shares (e.g. saved before baselines) are rebuilt from raw_data.
+        with test_database.session_scope() as session:
+            session.query(BatchMetricBaseline).filter(BatchMetricBaseline.centre == CENTRE).delete(synchronize_session=False)
+            session.query(MetricBaseline).filter(MetricBaseline.centre == CENTRE).delete(synchronize_session=False)
+        with test_database.session_scope() as session:
+            assert rebuild_baselines(session) >= 1
+        assert_baseline(test_database, TOTALS["BB"])
+
+        invoke(remove.cli, ["-c", CENTRE, "--no-vacuum"])
+        assert total_baseline(test_database) is None
+    finally:
+        clean(test_database)
@@ -0,0 +1,33 @@
+import time
+from falcon_multiqc.commands import check_db
+
+
+def test_check_paths(tmp_path):
+    (tmp_path / "a").mkdir()
+    paths = [str(tmp_path / "a"), str(tmp_path / "missing")]
+    assert check_db.check_paths(paths, workers=2) == {paths[0]: True, paths[1]: False}
+    assert check_db.check_paths([]) == {}
+
+
+def test_check_paths_timeout(monkeypatch):
+    def exists(path):
+        if path == "hung":
+            time.sleep(5)
+        return True
+    monkeypatch.setattr(check_db, "exists", exists)
+    paths = ["hung"] + [f"ok{i}" for i in range(20)]
+    start = time.monotonic()
+    results = check_db.check_paths(paths, workers=1, timeout=0.2)
+    # The hung check is given up on, and the remaining paths are still checked.
+    assert time.monotonic() - start < 2
+    assert results["hung"] is None
+    assert all(results[f"ok{i}"] for i in range(20))
+
+
+def test_cache(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    assert check_db.read_cache() == {}
+    check_db.write_cache({"/data/a": 1.0})
+    assert check_db.read_cache() == {"/data/a": 1.0}
+    (tmp_path / "falcon_multiqc" / "path_check.json").write_text("not json")
+    assert check_db.read_cache() == {}
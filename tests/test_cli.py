@@ -0,0 +1,25 @@
+import os
+import pytest
+from click.testing import CliRunner
+from falcon_multiqc.cli import COMMANDS, cli
+
+COMMANDS_DIR = os.path.join(os.path.dirname(__file__), "..", "falcon_multiqc", "commands")
+
+
+def test_every_command_module_is_registered():
+    modules = {os.path.splitext(f)[0] for f in os.listdir(COMMANDS_DIR) if f.endswith(".py")} - {"__init__"}
+    assert modules == {module for module, _ in COMMANDS.values()}
+
+
+@pytest.mark.parametrize("name", sorted(COMMANDS))
+def test_registry_help_is_docstring_prefix(name):
+    module, short_help = COMMANDS[name]
+    mod = __import__(f"falcon_multiqc.commands.{module}", None, None, ["cli"])
+    assert mod.cli.help.startswith(short_help)
+
+
+def test_help_lists_registry():
+    result = CliRunner().invoke(cli, ["--help"])
+    assert result.exit_code == 0
+    for name in COMMANDS:
+        assert name in result.output
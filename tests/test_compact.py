@@ -0,0 +1,78 @@
+from decimal import Decimal
+from sqlalchemy import func, text
+from database import compact
+from database.models import Batch, Cohort, RawData, Sample
+from falcon_multiqc.commands.query import metric_text, tool_table
+
+METRICS = [
+    {"AVG_DP": 30.25, "#READS": 2441001, "CHIPMIX": "NA"},
+    {"AVG_DP": 0.1, "BIG": 2 ** 60, "EMPTY": None, "PASS": True, "NESTED": {"a": [1, 2]}},
+    {},
+]
+
+
+def delete_cohort(test_database, cohort_id):
+    with test_database.session_scope() as session:
+        session.query(Cohort).filter(Cohort.id == cohort_id).delete()
+
+
+def raw_rows(session):
+    return sorted(((row.sample_id, row.qc_tool, row.metrics) for row in session.query(RawData).join(Sample)
+                   .filter(Sample.cohort_id == "COMPACT_TEST")), key=str)
+
+
+def test_compact_round_trip(test_database):
+    delete_cohort(test_database, "COMPACT_TEST")
+    with test_database.session_scope() as session:
+        session.add(Cohort(id="COMPACT_TEST"))
+        batch = Batch(cohort_id="COMPACT_TEST", batch_name="B0", path="/data")
+        session.add(batch)
+        session.flush()
+        sample = Sample(sample_name="S0", cohort_id="COMPACT_TEST", batch_id=batch.id, flowcell_lane="FC1", library_id="LIB",
+                        platform="HiSeqX", centre="KCCG", reference_genome="hs37d5", type="healthy")
+        session.add(sample)
+        session.flush()
+        sample_id = sample.id
+        session.add_all([RawData(sample_id=sample_id, qc_tool=f"tool{i % 2}", metrics=metrics) for i, metrics in enumerate(METRICS)])
+    with test_database.session_scope() as session:
+        before = raw_rows(session)
+
+    with test_database.get_engine().begin() as connection:
+        compact.compact(connection)
+    try:
+        with test_database.session_scope() as session:
+            assert compact.is_compact(session)
+            assert raw_rows(session) == before
+            # Numbers a double can't hold exactly stay in the JSONB sidecar.
+            assert session.execute(text("SELECT extra ? 'BIG' FROM raw_data_compact WHERE extra ? 'PASS'")).scalar()
+            values = session.query(metric_text("AVG_DP", True), metric_text("CHIPMIX", True)).filter(RawData.sample_id == sample_id)
+            assert sorted(values, key=str) == sorted([("30.25", "NA"), ("0.1", None), (None, None)], key=str)
+            table = tool_table("tool0", ["#READS", "AVG_DP", "BIG", "CHIPMIX"], compact=True)
+            assert sorted(session.query(*list(table.c)[1:]).filter(table.c.sample_id == sample_id), key=str) == \
+                sorted([(2441001, Decimal("30.25"), None, None), (None, None, None, None)], key=str)
+            table = tool_table("tool1", ["BIG"], compact=True)
+            assert session.query(table.c.BIG).filter(table.c.sample_id == sample_id).scalar() == 2 ** 60
+
+        # Writes go through the view's triggers, new metric names are appended to the tool's keys.
+        with test_database.session_scope() as session:
+            session.add(RawData(sample_id=sample_id, qc_tool="tool0", metrics={"NEW": 1.5, "AVG_DP": 3}))
+            session.query(RawData).filter(RawData.sample_id == sample_id, RawData.metrics == {}).delete(synchronize_session=False)
+            session.query(RawData).filter(RawData.sample_id == sample_id, RawData.metrics["AVG_DP"].astext == "0.1") \
+                .update({"metrics": {"AVG_DP": 0.2}}, synchronize_session=False)
+        with test_database.session_scope() as session:
+            keys = session.execute(text("SELECT metrics FROM raw_data_key WHERE qc_tool = 'tool0'")).scalar()
+            assert keys[-1] == "NEW" and keys.count("AVG_DP") == 1
+            expected = sorted([(sample_id, "tool0", METRICS[0]), (sample_id, "tool0", {"NEW": 1.5, "AVG_DP": 3}),
+                               (sample_id, "tool1", {"AVG_DP": 0.2})], key=str)
+            assert raw_rows(session) == expected
+            assert session.query(func.count(RawData.id)).filter(RawData.sample_id == sample_id).scalar() == 3
+    finally:
+        with test_database.get_engine().begin() as connection:
+            compact.expand(connection)
+
+    with test_database.session_scope() as session:
+        assert not compact.is_compact(session)
+        assert raw_rows(session) == expected
+    delete_cohort(test_database, "COMPACT_TEST")
+    with test_database.session_scope() as session:
+        assert session.query(RawData).filter(RawData.sample_id == sample_id).count() == 0
@@ -0,0 +1,25 @@
+from database import config, crud
+
+
+def test_database_uri(monkeypatch):
+    monkeypatch.delenv("FALCON_MULTIQC_DATABASE_URI", raising=False)
+    monkeypatch.delenv("FALCON_MULTIQC_REPLICA_URI", raising=False)
+    monkeypatch.setattr(config, "DATABASE_URI", "postgres+psycopg2://u@primary/db")
+    monkeypatch.setattr(config, "REPLICA_URI", None)
+    # Without a replica, read-only work goes to the primary.
+    assert crud.database_uri(crud.REPLICA) == "postgres+psycopg2://u@primary/db"
+    monkeypatch.setattr(config, "REPLICA_URI", "postgres+psycopg2://u@replica/db")
+    assert crud.database_uri(crud.REPLICA) == "postgres+psycopg2://u@replica/db"
+    assert crud.database_uri(crud.PRIMARY) == "postgres+psycopg2://u@primary/db"
+    monkeypatch.setenv("FALCON_MULTIQC_DATABASE_URI", "postgres+psycopg2://u@env/db")
+    assert crud.database_uri() == "postgres+psycopg2://u@env/db"
+
+
+def test_profile_defaults(monkeypatch):
+    monkeypatch.setattr(config, "PROFILES", {"replica": {"statement_timeout_ms": 60000}})
+    assert crud.profile(crud.REPLICA)["statement_timeout_ms"] == 60000
+    assert crud.profile(crud.REPLICA)["pool_size"] == crud.DEFAULT_PROFILE["pool_size"]
+    assert crud.profile(crud.PRIMARY) == crud.DEFAULT_PROFILE
+    # config.py written by an older version has no PROFILES.
+    monkeypatch.delattr(config, "PROFILES")
+    assert crud.profile(crud.PRIMARY) == crud.DEFAULT_PROFILE
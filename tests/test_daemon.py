@@ -0,0 +1,157 @@
+import os
+import sys
+import json
+import time
+import socket
+import subprocess
+import threading
+import click
+import pytest
+from falcon_multiqc import daemon
+
+"""
+Daemon tests. The end to end tests start `falcon_multiqc serve` against the PostgreSQL database in
+$FALCON_MULTIQC_TEST_DATABASE_URI (e.g. postgres+psycopg2://postgres@/falcon_test?host=/tmp) and are skipped without it.
+"""
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+TEST_DATABASE_URI = os.environ.get("FALCON_MULTIQC_TEST_DATABASE_URI")
+
+
+@click.command()
+@click.option("-o", "--output", type=click.Path())
+@click.option("-d", "--data", type=click.File("r"))
+@click.option("-n", "--name")
+def command(output, data, name):
+    pass
+
+
+def test_absolute_args():
+    args = ["-o", "out", "--data=in.csv", "-n", "rel", "-d", "-", "--output", "/abs"]
+    assert daemon.absolute_args(command, args, "/home/user") == \
+        ["-o", "/home/user/out", "--data=/home/user/in.csv", "-n", "rel", "-d", "-", "--output", "/abs"]
+
+
+def test_client_path_uses_request_cwd():
+    assert daemon.client_path("a/b") == os.path.abspath("a/b")
+    results = []
+    def request():
+        daemon._request.cwd = "/home/user"
+        results.append(daemon.client_path("a/b"))
+        results.append(daemon.client_path("/abs/c"))
+    thread = threading.Thread(target=request)
+    thread.start()
+    thread.join()
+    assert results == ["/home/user/a/b", "/abs/c"]
+    # Other threads are unaffected.
+    assert daemon.client_path("a/b") == os.path.abspath("a/b")
+
+
+def test_socket_path(monkeypatch):
+    monkeypatch.delenv("FALCON_MULTIQC_SOCKET", raising=False)
+    monkeypatch.setenv("XDG_RUNTIME_DIR", "/run/user/1000")
+    assert daemon.socket_path() == "/run/user/1000/falcon_multiqc.sock"
+    monkeypatch.delenv("XDG_RUNTIME_DIR")
+    assert daemon.socket_path().endswith(f"falcon_multiqc-{os.getuid()}/falcon_multiqc.sock")
+    monkeypatch.setenv("FALCON_MULTIQC_SOCKET", "/x/y.sock")
+    assert daemon.socket_path() == "/x/y.sock"
+
+
+def test_run_remote_without_daemon(monkeypatch, tmp_path):
+    monkeypatch.setenv("FALCON_MULTIQC_SOCKET", str(tmp_path / "missing.sock"))
+    assert daemon.run_remote(["query"]) is None
+    # A regular file is never treated as the daemon's socket.
+    (tmp_path / "file.sock").write_text("")
+    monkeypatch.setenv("FALCON_MULTIQC_SOCKET", str(tmp_path / "file.sock"))
+    assert daemon.run_remote(["query"]) is None
+
+
+def test_socket_dir_refuses_shared_directory(tmp_path):
+    shared = tmp_path / "shared"
+    shared.mkdir()
+    shared.chmod(0o777)
+    with pytest.raises(Exception):
+        daemon._socket_dir(str(shared / "falcon_multiqc.sock"))
+    private = tmp_path / "private" / "falcon_multiqc.sock"
+    daemon._socket_dir(str(private))
+    assert os.stat(private.parent).st_mode & 0o777 == 0o700
+
+
+# Sends one request to the daemon, returning (exit code, stdout, stderr).
+def request(path, args, cwd="/"):
+    out, err = [], []
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        stream = client.makefile("rwb")
+        stream.write(json.dumps({"args": args, "cwd": cwd, "tty": False}).encode() + b"\n")
+        stream.flush()
+        for line in stream:
+            message = json.loads(line)
+            if "exit" in message:
+                return message["exit"], "".join(out), "".join(err)
+            (out if "out" in message else err).append(message.get("out", message.get("err")))
+    raise Exception("No exit code from the daemon.")
+
+
+@pytest.fixture(scope="module")
+def daemon_socket(tmp_path_factory):
+    if not TEST_DATABASE_URI:
+        pytest.skip("FALCON_MULTIQC_TEST_DATABASE_URI is not set.")
+    path = str(tmp_path_factory.mktemp("daemon") / "falcon_multiqc.sock")
+    code = ("import sys, database.config as config; config.DATABASE_URI = sys.argv[1]; "
+            "from database.crud import create_database; create_database(); "
+            "from falcon_multiqc.daemon import serve; serve(sys.argv[2])")
+    process = subprocess.Popen([sys.executable, "-c", code, TEST_DATABASE_URI, path], cwd=REPO_ROOT,
+                               env=dict(os.environ, PYTHONPATH=REPO_ROOT), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    for _ in range(200):
+        if os.path.exists(path) or process.poll() is not None:
+            break
+        time.sleep(0.05)
+    if not os.path.exists(path):
+        process.kill()
+        raise Exception(f"Daemon did not start:\n{process.stdout.read().decode()}")
+    yield path
+    process.terminate()
+    process.wait(10)
+
+
+def test_daemon_help(daemon_socket):
+    exit_code, out, _ = request(daemon_socket, ["query", "--help"])
+    assert exit_code == 0
+    assert "Usage: falcon_multiqc query" in out
+
+
+def test_daemon_failed_command_exit_code(daemon_socket):
+    exit_code, out, _ = request(daemon_socket, ["query", "--batch", "no_such_batch"])
+    assert exit_code == 1
+    assert "No results from query" in out
+
+
+def test_daemon_refuses_other_commands(daemon_socket):
+    exit_code, _, err = request(daemon_socket, ["recreate_tables"])
+    assert exit_code == 1
+    assert "can't be run through the daemon" in err
+
+
+def test_daemon_concurrent_requests(daemon_socket):
+    _, expected, _ = request(daemon_socket, ["query", "--batch", "no_such_batch"])
+    results = [None] * 16
+    def run(i):
+        results[i] = request(daemon_socket, ["query", "--batch", f"no_such_batch_{i}"])
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(results))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Each client only gets its own output.
+    for i, (exit_code, out, _) in enumerate(results):
+        assert exit_code == 1
+        assert out == expected
+
+
+def test_daemon_resolves_paths_against_client_cwd(daemon_socket, tmp_path):
+    # A relative directory inside --input_csv is resolved against the client's cwd, not the daemon's.
+    (tmp_path / "batches.csv").write_text("directory,sample_metadata\nno_such_dir,meta.csv\n")
+    exit_code, out, _ = request(daemon_socket, ["save", "--input_csv", "batches.csv"], cwd=str(tmp_path))
+    assert exit_code == 1
+    assert f"Directory {tmp_path / 'no_such_dir'} does not exist" in out
@@ -0,0 +1,47 @@
+from database import delete
+from database.models import Batch, Cohort, Sample, RawData
+
+
+def add_batch(session, cohort_id, batch_name, samples):
+    cohort = session.query(Cohort).filter(Cohort.id == cohort_id).one_or_none()
+    if cohort is None:
+        cohort = Cohort(id=cohort_id, sample_count=0, batch_count=0)
+        session.add(cohort)
+    cohort.sample_count += samples
+    cohort.batch_count += 1
+    batch = Batch(cohort_id=cohort_id, batch_name=batch_name, path=f"/data/{batch_name}", sample_count=samples)
+    session.add(batch)
+    session.flush()
+    for i in range(samples):
+        sample = Sample(batch_id=batch.id, cohort_id=cohort_id, sample_name=f"{batch_name}_{i}", flowcell_lane="FC1",
+                        library_id="LIB", platform="HiSeqX", centre="KCCG", reference_genome="hs37d5", type="healthy")
+        session.add(sample)
+        session.flush()
+        session.add_all([RawData(sample_id=sample.id, qc_tool=tool, metrics={"value": i}) for tool in ["a", "b"]])
+    return batch.id
+
+
+def test_delete_batch_in_chunks(test_database):
+    with test_database.session_scope() as session:
+        session.query(Cohort).filter(Cohort.id == "DELETE_TEST").delete()
+        keep = add_batch(session, "DELETE_TEST", "KEEP", 3)
+        remove = add_batch(session, "DELETE_TEST", "REMOVE", 10)
+
+    chunks = []
+    delete.ensure_delete_indexes()
+    delete.delete_batch(remove, chunk_size=4, on_chunk=lambda table, deleted: chunks.append((table, deleted)))
+    assert chunks == [("raw_data", 4)] * 5 + [("sample", 4), ("sample", 4), ("sample", 2)]
+
+    with test_database.session_scope() as session:
+        cohort = session.query(Cohort).filter(Cohort.id == "DELETE_TEST").one()
+        assert (cohort.sample_count, cohort.batch_count) == (3, 1)
+        assert session.query(Batch.id).filter(Batch.cohort_id == "DELETE_TEST").all() == [(keep,)]
+        assert delete.batch_row_counts(session, keep) == {"raw_data": 6, "sample": 3}
+        assert delete.batch_row_counts(session, remove) == {"raw_data": 0, "sample": 0}
+
+    # Resuming an already finished delete does nothing.
+    delete.delete_batch(remove)
+    delete.delete_batch(keep)
+    delete.delete_cohort_row("DELETE_TEST")
+    with test_database.session_scope() as session:
+        assert session.query(Cohort).filter(Cohort.id == "DELETE_TEST").count() == 0
@@ -0,0 +1,126 @@
+import csv
+import io
+import json
+import pytest
+from click.testing import CliRunner
+from database import config
+from database.federation import column_index, merge_aggregates, merge_limit, merge_order
+from database.models import Batch, Cohort, Sample
+from falcon_multiqc.api import Client
+from falcon_multiqc.commands import export_cohort, import_cohort, query, remove, save, sql
+
+HEADER = ["cohort", "type", "samples"]
+ROWS = [("A", "healthy", 2), ("B", "healthy", 3), ("B", None, 1), ("C", "cancer", None)]
+
+
+def test_merge_aggregates():
+    assert merge_aggregates(HEADER, ROWS, [("samples", "count")]) == ROWS
+    rows = [(t, n) for _, t, n in ROWS] + [("cancer", 4)]
+    assert merge_aggregates(["type", "samples"], rows, [("SAMPLES", "sum")]) == [("healthy", 5), (None, 1), ("cancer", 4)]
+    assert merge_aggregates(["type", "samples"], rows, [("samples", "max")]) == [("healthy", 3), (None, 1), ("cancer", 4)]
+
+
+def test_merge_order():
+    assert [row[0] for row in merge_order(HEADER, ROWS, [("samples", False)])] == ["B", "A", "B", "C"]
+    # NULLs first when descending, as in PostgreSQL.
+    assert [row[2] for row in merge_order(HEADER, ROWS, [("samples", True)])] == [None, 3, 2, 1]
+    assert merge_order(HEADER, ROWS, [("cohort", True), ("samples", False)]) == [ROWS[3], ROWS[2], ROWS[1], ROWS[0]]
+    assert merge_limit(ROWS, 2) == ROWS[:2] and merge_limit(ROWS, None) == ROWS
+    with pytest.raises(Exception, match="No column batch"):
+        column_index(HEADER, "batch")
+
+
+def test_order_column():
+    assert sql.order_column("samples") == ("samples", False)
+    assert sql.order_column(" samples DESC ") == ("samples", True)
+    assert sql.order_column("batch asc") == ("batch", False)
+
+
+# Writes a batch directory and sample metadata csv for save, returns (directory, metadata path).
+def write_batch(tmp_path, cohort_id, batch_name, samples):
+    directory = tmp_path / batch_name
+    (directory / "multiqc_data").mkdir(parents=True)
+    names = [f"{batch_name}S{i}" for i in range(samples)]
+    raw_data = {"multiqc_fastqc": {f"{name}_L001": {"total": i} for i, name in enumerate(names)}}
+    (directory / "multiqc_data" / "multiqc_data.json").write_text(json.dumps({"report_saved_raw_data": raw_data}))
+    metadata = tmp_path / f"{batch_name}.csv"
+    metadata.write_text("Sample Name,Cohort Name,Batch Name,Flowcell.Lane,Library ID,Platform,Centre,Reference,Type,Description\n" +
+                        "".join(f"{name},{cohort_id},{batch_name},FC1,LIB,HiSeqX,KCCG,hs37d5,healthy,\n" for name in names))
+    return str(directory), str(metadata)
+
+
+def invoke(command, args):
+    result = CliRunner().invoke(command, args)
+    if result.exception and not isinstance(result.exception, SystemExit):
+        raise result.exception
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def delete_cohorts(test_shards, cohort_ids):
+    for shard in test_shards.shard_names():
+        with test_shards.session_scope(shard=shard) as session:
+            session.query(Cohort).filter(Cohort.id.in_(cohort_ids)).delete(synchronize_session=False)
+
+
+def cohort_counts(test_shards, shard):
+    with test_shards.session_scope(shard=shard) as session:
+        return {cohort_id: (samples, batches) for cohort_id, samples, batches in
+                session.query(Cohort.id, Cohort.sample_count, Cohort.batch_count).filter(Cohort.id.like("SHARD_TEST%"))}
+
+
+def test_sharded_save_query_remove(test_shards, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "COHORT_SHARDS", {"SHARD_TEST_B": "shard1"})
+    delete_cohorts(test_shards, ["SHARD_TEST_A", "SHARD_TEST_B"])
+    batches = [write_batch(tmp_path, "SHARD_TEST_A", "BA", 2), write_batch(tmp_path, "SHARD_TEST_B", "BB", 3)]
+    input_csv = tmp_path / "input.csv"
+    input_csv.write_text("directory,sample_metadata\n" + "".join(f"{directory},{metadata}\n" for directory, metadata in batches))
+    try:
+        # One save of both cohorts, each to its shard.
+        invoke(save.cli, ["-i", str(input_csv)])
+        assert cohort_counts(test_shards, "default") == {"SHARD_TEST_A": (2, 1)}
+        assert cohort_counts(test_shards, "shard1") == {"SHARD_TEST_B": (3, 1)}
+
+        output = invoke(query.cli, ["-s", "sample", "-s", "tool-metric", "-tm", "fastqc", "total", ">=", "1",
+                                    "-c", "SHARD_TEST_A", "-c", "SHARD_TEST_B"])
+        rows = list(csv.DictReader(io.StringIO(output[output.index("sample.id"):])))
+        assert sorted((row["sample.sample_name"], row["raw_data.total"]) for row in rows) == \
+            [("BAS1", "1"), ("BBS1", "1"), ("BBS2", "2")]
+        output = invoke(query.cli, ["-st", "fastqc", "-c", "SHARD_TEST_A", "-c", "SHARD_TEST_B"])
+        rows = list(csv.DictReader(io.StringIO(output[output.index("sample.id"):])))
+        assert sorted((row["sample.sample_name"], row["fastqc.total"]) for row in rows) == \
+            [("BAS0", "0"), ("BAS1", "1"), ("BBS0", "0"), ("BBS1", "1"), ("BBS2", "2")]
+        frame = Client().query(select_tool=["fastqc"], cohort=["SHARD_TEST_A", "SHARD_TEST_B"])
+        assert sorted(zip(frame["sample.sample_name"], frame["fastqc.total"])) == \
+            [("BAS0", 0), ("BAS1", 1), ("BBS0", 0), ("BBS1", 1), ("BBS2", 2)]
+        # The matrix cache has every shard's samples.
+        cached = Client().matrix(tool_metric=[("fastqc", "total")], matrix_dir=str(tmp_path / "matrix"))
+        with test_shards.session_scope(shard="shard1") as session:
+            ids = [sample.id for sample in session.query(Sample).filter(Sample.cohort_id == "SHARD_TEST_B").order_by(Sample.sample_name)]
+        assert cached.values[cached.rows(ids, "shard1"), 0].tolist() == [0, 1, 2]
+        with pytest.raises(Exception, match="The tool fastqcc is not present"):
+            invoke(query.cli, ["-tm", "fastqcc", "total", ">", "0", "-c", "SHARD_TEST_A"])
+
+        sql_file = tmp_path / "types.txt"
+        sql_file.write_text("SELECT sample.type, count(*) AS samples, max(sample.sample_name) AS last FROM sample "
+                            "WHERE sample.cohort_id IN ('SHARD_TEST_A', 'SHARD_TEST_B') GROUP BY sample.type")
+        output = invoke(sql.cli, ["-s", str(sql_file), "--federated", "--merge-aggregate", "samples", "count",
+                                  "--merge-aggregate", "last", "max", "--merge-order-by", "samples desc"])
+        assert output.splitlines()[-2:] == ["type,samples,last", "healthy,5,BBS2"]
+
+        output = invoke(sql.cli, ["--overview"])
+        assert "SHARD_TEST_A" in output and "SHARD_TEST_B" in output
+
+        archive = str(tmp_path / "SHARD_TEST_B.falcon.tar")
+        invoke(export_cohort.cli, ["--cohort", "SHARD_TEST_B", "-o", archive, "--compression", "gzip"])
+        invoke(remove.cli, ["-c", "SHARD_TEST_B", "--no-vacuum"])
+        assert cohort_counts(test_shards, "shard1") == {}
+        with test_shards.session_scope(shard="shard1") as session:
+            assert session.query(Sample).filter(Sample.cohort_id == "SHARD_TEST_B").count() == 0
+            assert session.query(Batch).filter(Batch.cohort_id == "SHARD_TEST_B").count() == 0
+        assert cohort_counts(test_shards, "default") == {"SHARD_TEST_A": (2, 1)}
+        # Imported back into its shard.
+        invoke(import_cohort.cli, [archive])
+        assert cohort_counts(test_shards, "shard1") == {"SHARD_TEST_B": (3, 1)}
+    finally:
+        delete_cohorts(test_shards, ["SHARD_TEST_A", "SHARD_TEST_B"])
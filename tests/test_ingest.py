@@ -0,0 +1,102 @@
+import json
+import threading
+import pytest
+from database import ingest
+from database.models import Batch, Cohort
+from falcon_multiqc.commands.save import save_sample
+
+
+# Writes a batch directory and sample metadata csv for save_sample, returns (directory, metadata path).
+def write_batch(tmp_path, cohort_id, batch_name, samples, type="healthy"):
+    directory = tmp_path / batch_name
+    (directory / "multiqc_data").mkdir(parents=True)
+    names = [f"{batch_name}S{i}" for i in range(samples)]
+    raw_data = {"multiqc_fastqc": {f"{name}_L001": {"total": i} for i, name in enumerate(names)}}
+    (directory / "multiqc_data" / "multiqc_data.json").write_text(json.dumps({"report_saved_raw_data": raw_data}))
+    metadata = tmp_path / f"{batch_name}.csv"
+    metadata.write_text("Sample Name,Cohort Name,Batch Name,Flowcell.Lane,Library ID,Platform,Centre,Reference,Type,Description\n" +
+                        "".join(f"{name},{cohort_id},{batch_name},FC1,LIB,HiSeqX,KCCG,hs37d5,{type},\n" for name in names))
+    return str(directory), str(metadata)
+
+
+# Saves the batches in parallel, one transaction each. Returns the exceptions raised.
+def save_concurrently(test_database, batches):
+    errors = []
+    barrier = threading.Barrier(len(batches))
+
+    def save(directory, metadata):
+        try:
+            with test_database.session_scope() as session:
+                barrier.wait()
+                cohort_id, samples, batch_count, types = save_sample(directory, metadata, session, None, None)
+                ingest.update_cohorts(session, {cohort_id: (samples, batch_count, types)})
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=save, args=batch) for batch in batches]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def delete_cohort(test_database, cohort_id):
+    with test_database.session_scope() as session:
+        session.query(Cohort).filter(Cohort.id == cohort_id).delete()
+
+
+def test_merge_types():
+    assert ingest.merge_types(None, []) is None
+    assert ingest.merge_types(None, ["healthy", "cancer"]) == "healthy,cancer"
+    assert ingest.merge_types("healthy", ["cancer", "healthy"]) == "healthy,cancer"
+    assert ingest.merge_types("healthy,cancer", ["can"]) == "healthy,cancer,can"
+
+
+def test_concurrent_saves_of_one_cohort(test_database, tmp_path):
+    delete_cohort(test_database, "INGEST_TEST")
+    ingest.ensure_batch_constraint()
+    batches = [write_batch(tmp_path, "INGEST_TEST", f"B{i}", i + 1, "healthy" if i % 2 else "cancer") for i in range(4)]
+    assert save_concurrently(test_database, batches) == []
+
+    with test_database.session_scope() as session:
+        cohort = session.query(Cohort).filter(Cohort.id == "INGEST_TEST").one()
+        assert (cohort.sample_count, cohort.batch_count) == (1 + 2 + 3 + 4, 4)
+        assert sorted(cohort.type.split(",")) == ["cancer", "healthy"]
+        assert sorted(session.query(Batch.batch_name, Batch.sample_count).filter(Batch.cohort_id == "INGEST_TEST")) == \
+            [("B0", 1), ("B1", 2), ("B2", 3), ("B3", 4)]
+    delete_cohort(test_database, "INGEST_TEST")
+
+
+def test_concurrent_saves_of_one_batch(test_database, tmp_path):
+    delete_cohort(test_database, "INGEST_TEST")
+    ingest.ensure_batch_constraint()
+    batch = write_batch(tmp_path, "INGEST_TEST", "B0", 3)
+    errors = save_concurrently(test_database, [batch, batch])
+    assert len(errors) == 1 and "Duplicate data entry detected" in str(errors[0])
+
+    with test_database.session_scope() as session:
+        cohort = session.query(Cohort).filter(Cohort.id == "INGEST_TEST").one()
+        assert (cohort.sample_count, cohort.batch_count) == (3, 1)
+    delete_cohort(test_database, "INGEST_TEST")
+
+
+def test_ensure_batch_constraint(test_database):
+    delete_cohort(test_database, "INGEST_TEST")
+    with test_database.get_engine().connect() as connection:
+        connection.execute(f"ALTER TABLE batch DROP CONSTRAINT IF EXISTS {ingest.BATCH_CONSTRAINT}")
+    with test_database.session_scope() as session:
+        session.add(Cohort(id="INGEST_TEST"))
+        session.add_all([Batch(cohort_id="INGEST_TEST", batch_name="B0", path="/data") for _ in range(2)])
+
+    with pytest.raises(Exception, match="INGEST_TEST B0"):
+        ingest.ensure_batch_constraint()
+
+    with test_database.session_scope() as session:
+        duplicate = session.query(Batch.id).filter(Batch.cohort_id == "INGEST_TEST").order_by(Batch.id).first().id
+        session.query(Batch).filter(Batch.id == duplicate).delete()
+    ingest.ensure_batch_constraint()
+    ingest.ensure_batch_constraint()
+    with test_database.get_engine().connect() as connection:
+        assert connection.execute("SELECT count(*) FROM pg_constraint WHERE conname = %s", ingest.BATCH_CONSTRAINT).scalar() == 1
+    delete_cohort(test_database, "INGEST_TEST")
@@ -0,0 +1,83 @@
+import gzip
+import io
+import json
+import tarfile
+import pytest
+from click.testing import CliRunner
+from database.models import Batch, Cohort, RawData, Sample
+from falcon_multiqc.commands import save
+from falcon_multiqc.inputs import is_multiqc_json, open_multiqc_data
+
+COHORT = "INPUTS_TEST"
+DATA = {"report_saved_raw_data": {"multiqc_fastqc": {"IN0_L001": {"total": 1}, "IN1_L001": {"total": 2}}}}
+
+
+def zstd_compress(data):
+    zstandard = pytest.importorskip("zstandard")
+    return zstandard.ZstdCompressor().compress(data)
+
+
+# Writes a tar archive of a multiqc output (with a plot before the json) to path, compressed with compress.
+def write_archive(path, json_name="out/multiqc_data/multiqc_data.json", compress=lambda data: data, compress_json=lambda data: data):
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w") as tar:
+        for name, data in [("out/multiqc_plots/plot.png", b"\0" * 1000), (json_name, compress_json(json.dumps(DATA).encode()))]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    path.write_bytes(compress(archive.getvalue()))
+    return str(path)
+
+
+def read(path):
+    with open_multiqc_data(path) as multiqc_data:
+        return json.load(multiqc_data)
+
+
+def test_is_multiqc_json():
+    assert is_multiqc_json("out/multiqc_data/multiqc_data.json")
+    assert is_multiqc_json("./multiqc_data/multiqc_data.json.gz")
+    assert is_multiqc_json("multiqc_data.json.zst")
+    assert not is_multiqc_json("out/multiqc_data.json")
+    assert not is_multiqc_json("out/multiqc_data/multiqc_general_stats.json")
+
+
+def test_open_multiqc_data(tmp_path):
+    (tmp_path / "out" / "multiqc_data").mkdir(parents=True)
+    (tmp_path / "out" / "multiqc_data" / "multiqc_data.json.gz").write_bytes(gzip.compress(json.dumps(DATA).encode()))
+    assert read(str(tmp_path / "out")) == DATA
+    (tmp_path / "plain.json").write_text(json.dumps(DATA))
+    assert read(str(tmp_path / "plain.json")) == DATA
+
+    assert read(write_archive(tmp_path / "out.tar")) == DATA
+    assert read(write_archive(tmp_path / "out.tar.gz", compress=gzip.compress)) == DATA
+    # A compressed json inside the archive.
+    assert read(write_archive(tmp_path / "gz.tar", "multiqc_data/multiqc_data.json.gz", compress_json=gzip.compress)) == DATA
+    with pytest.raises(Exception, match="has no multiqc_data/multiqc_data.json"):
+        read(write_archive(tmp_path / "none.tar", "out/multiqc_data/other.json"))
+    with pytest.raises(FileNotFoundError):
+        read(str(tmp_path))
+
+    (tmp_path / "data.json.zst").write_bytes(zstd_compress(json.dumps(DATA).encode()))
+    assert read(str(tmp_path / "data.json.zst")) == DATA
+    assert read(write_archive(tmp_path / "out.tar.zst", compress=zstd_compress)) == DATA
+
+
+def test_save_archive(test_database, tmp_path):
+    def clean():
+        with test_database.session_scope() as session:
+            session.query(Cohort).filter(Cohort.id == COHORT).delete(synchronize_session=False)
+    clean()
+    archive = write_archive(tmp_path / "IN.tar.gz", compress=gzip.compress)
+    metadata = tmp_path / "IN.csv"
+    metadata.write_text("Sample Name,Cohort Name,Batch Name,Flowcell.Lane,Library ID,Platform,Centre,Reference,Type,Description\n" +
+                        "".join(f"IN{i},{COHORT},IN,FC1,LIB,HiSeqX,KCCG,hs37d5,healthy,\n" for i in range(2)))
+    try:
+        result = CliRunner().invoke(save.cli, ["-d", archive, "-s", str(metadata)])
+        assert result.exit_code == 0, result.output
+        with test_database.session_scope() as session:
+            assert session.query(Batch.path).filter(Batch.cohort_id == COHORT).scalar() == archive
+            totals = session.query(RawData.metrics["total"].astext).join(Sample).filter(Sample.cohort_id == COHORT).all()
+            assert sorted(int(total) for total, in totals) == [1, 2]
+    finally:
+        clean()
@@ -0,0 +1,51 @@
+from database import maintenance
+
+
+def table(name, live, dead, modified):
+    return {"table": name, "live_rows": live, "dead_rows": dead, "modified_rows": modified}
+
+
+def test_plan_maintenance():
+    tables = [table("raw_data", 800, 200, 0), table("sample", 1000, 0, 500), table("batch", 10, 0, 0), table("patient", 0, 0, 0)]
+    indexes = [{"index": "ix_raw_data_sample_id", "leaf_density": 30.0}, {"index": "sample_pkey", "leaf_density": 90.0},
+               {"index": "batch_pkey", "leaf_density": None}]
+    assert maintenance.plan_maintenance(tables, indexes) == [
+        ('VACUUM (ANALYZE) "raw_data"', "200 dead rows (20%)"),
+        ('ANALYZE "sample"', "500 rows changed since the last analyze"),
+        ('REINDEX INDEX CONCURRENTLY "ix_raw_data_sample_id"', "leaf density 30%"),
+    ]
+    assert maintenance.plan_maintenance(tables, indexes, can_reindex_concurrently=False)[-1][0] == 'ANALYZE "sample"'
+
+
+def test_unused_indexes():
+    indexes = [{"index": "a", "idx_scan": 0, "is_unique": False, "is_primary": False},
+               {"index": "b", "idx_scan": 0, "is_unique": True, "is_primary": False},
+               {"index": "c", "idx_scan": 5, "is_unique": False, "is_primary": False}]
+    assert [index["index"] for index in maintenance.unused_indexes(indexes)] == ["a"]
+
+
+def test_plan_trigram_indexes():
+    actions = maintenance.plan_trigram_indexes([{"index": "ix_batch_description_trgm"}], has_pg_trgm=False)
+    assert [statement for statement, _ in actions] == [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS "ix_sample_description_trgm" ON "sample" USING gin ("description" gin_trgm_ops)',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS "ix_cohort_description_trgm" ON "cohort" USING gin ("description" gin_trgm_ops)',
+    ]
+    existing = [{"index": name} for name, _, _ in maintenance.TRIGRAM_INDEXES]
+    assert maintenance.plan_trigram_indexes(existing, has_pg_trgm=True) == []
+
+
+def test_human_bytes():
+    assert maintenance.human_bytes(512) == "512 B"
+    assert maintenance.human_bytes(1536) == "1.5 kB"
+    assert maintenance.human_bytes(3 * 1024 ** 3) == "3.0 GB"
+
+
+def test_stats(test_database):
+    with maintenance.maintenance_connection() as connection:
+        tables = maintenance.table_stats(connection)
+        indexes = maintenance.index_stats(connection)
+        failed = maintenance.run_maintenance(connection, [('ANALYZE "sample"', "test")])
+    assert {"raw_data", "sample", "batch", "cohort"} <= {t["table"] for t in tables}
+    assert "ix_raw_data_sample_id" in {i["index"] for i in indexes}
+    assert failed == []
@@ -0,0 +1,87 @@
+import json
+import math
+import struct
+import numpy as np
+from click.testing import CliRunner
+from database import catalog
+from database.matrix import parse_copy
+from database.models import Cohort
+from falcon_multiqc.api import Client
+from falcon_multiqc.commands import matrix, remove, save
+
+COHORT = "MATRIX_TEST"
+
+
+def binary_copy(rows):
+    # PostgreSQL's binary COPY format: header, rows of (field count, (length, value) per field), trailer.
+    data = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+    for sample_id, *values in rows:
+        data += struct.pack(">hiq", 1 + len(values), 8, sample_id)
+        data += b"".join(struct.pack(">id", 8, value) for value in values)
+    return data + struct.pack(">h", -1)
+
+
+def test_parse_copy():
+    sample_ids, values = parse_copy(binary_copy([(3, 1.5, math.nan), (7, -2.0, 1e300)]), 2)
+    assert sample_ids.tolist() == [3, 7]
+    assert values[:, 0].tolist() == [1.5, -2.0] and math.isnan(values[0, 1]) and values[1, 1] == 1e300
+    assert parse_copy(binary_copy([]), 2)[1].shape == (0, 2)
+
+
+def write_batch(tmp_path, batch_name, totals):
+    directory = tmp_path / batch_name
+    (directory / "multiqc_data").mkdir(parents=True)
+    names = [f"{batch_name}S{i}" for i in range(len(totals))]
+    raw_data = {"multiqc_fastqc": {name: {"total": total, "gc": 40} for name, total in zip(names, totals)}}
+    (directory / "multiqc_data" / "multiqc_data.json").write_text(json.dumps({"report_saved_raw_data": raw_data}))
+    metadata = tmp_path / f"{batch_name}.csv"
+    metadata.write_text("Sample Name,Cohort Name,Batch Name,Flowcell.Lane,Library ID,Platform,Centre,Reference,Type,Description\n" +
+                        "".join(f"{name},{COHORT},{batch_name},FC1,LIB,HiSeqX,KCCG,hs37d5,healthy,\n" for name in names))
+    return ["-d", str(directory), "-s", str(metadata)]
+
+
+def invoke(command, args):
+    result = CliRunner().invoke(command, args)
+    if result.exception and not isinstance(result.exception, SystemExit):
+        raise result.exception
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def test_matrix_refresh(test_database, tmp_path):
+    def clean():
+        with test_database.session_scope() as session:
+            session.query(Cohort).filter(Cohort.id == COHORT).delete(synchronize_session=False)
+        catalog.invalidate()
+    clean()
+    try:
+        invoke(save.cli, write_batch(tmp_path, "MA", [10, 11, 12]))
+        invoke(save.cli, write_batch(tmp_path, "MB", [20, "NA"]))
+        catalog.invalidate()
+        directory = str(tmp_path / "matrix")
+        output = invoke(matrix.cli, ["-tm", "fastqc", "total", "-st", "fastqc:g*", "-d", directory])
+        assert "2 metrics" in output and "0 removed" in output
+
+        client = Client()
+        cached = client.matrix(tool_metric=[("fastqc", "total")], select_tool=["fastqc:g*"], matrix_dir=directory)
+        assert cached.refreshed[0] == 0 and cached.columns == ["fastqc.total", "fastqc.gc"]
+        assert isinstance(cached.values, np.memmap) and cached.values.dtype == np.float32
+        with test_database.session_scope() as session:
+            ids = dict(session.execute("SELECT sample_name, id FROM sample WHERE cohort_id = :cohort", {"cohort": COHORT}).fetchall())
+        rows = cached.rows([ids["MAS2"], ids["MBS1"], -1])
+        assert rows[2] == -1
+        assert cached.values[rows[0]].tolist() == [12.0, 40.0]
+        # Non-numeric values are NaN.
+        assert math.isnan(cached.values[rows[1], 0])
+
+        # Removing a batch drops its rows, the other batches are copied from the cache.
+        invoke(remove.cli, ["-b", COHORT, "MA", "--no-vacuum"])
+        refreshed = client.matrix(tool_metric=[("fastqc", "total")], select_tool=["fastqc:g*"], matrix_dir=directory)
+        assert refreshed.refreshed[:2] == (0, 1)
+        assert (refreshed.rows([ids["MAS0"], ids["MBS0"]]) == [-1, refreshed.rows([ids["MBS0"]])[0]]).all()
+        assert refreshed.values[refreshed.rows([ids["MBS0"]])[0]].tolist() == [20.0, 40.0]
+        assert len(list((tmp_path / "matrix").glob("*/values-*.npy"))) == 1
+        # The previous generation's arrays stay readable while mapped.
+        assert cached.values[rows[0]].tolist() == [12.0, 40.0]
+    finally:
+        clean()
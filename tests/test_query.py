@@ -0,0 +1,83 @@
+import csv
+import io
+import pytest
+from click.testing import CliRunner
+from sqlalchemy.dialects import postgresql
+from database import catalog
+from database.models import Batch, Cohort, MetricSummary, RawData, Sample
+from falcon_multiqc.commands import query
+from falcon_multiqc.commands.query import description_filter, select_tool_metrics, tool_table
+
+
+def compile(clause):
+    return str(clause.compile(dialect=postgresql.psycopg2.dialect(), compile_kwargs={"literal_binds": True}))
+
+
+def test_description_filter():
+    condition, ranking = description_filter(Sample.description, ["50%_a/b"], "contains")
+    assert ranking is None and "LIKE" in compile(condition) and "ILIKE" not in compile(condition)
+
+    condition, ranking = description_filter(Sample.description, ["50%_a/b"], "icontains")
+    assert ranking is None
+    assert compile(condition) == "sample.description ILIKE '%%50/%%/_a//b%%' ESCAPE '/'"
+
+    condition, ranking = description_filter(Sample.description, ["healthy", "elderly"], "similar")
+    assert compile(condition) == "('healthy' <%% sample.description) OR ('elderly' <%% sample.description)"
+    assert compile(ranking) == ("greatest(word_similarity('healthy', sample.description), "
+                                "word_similarity('elderly', sample.description))")
+
+
+def test_select_tool_metrics():
+    catalog = {"picard": {"PCT_A", "PCT_B", "MEAN"}, "verifybamid": {"AVG_DP"}}
+    assert select_tool_metrics(catalog, ["picard:PCT_*", "verifybamid", "picard:MEAN"]) == \
+        {"picard": ["MEAN", "PCT_A", "PCT_B"], "verifybamid": ["AVG_DP"]}
+    with pytest.raises(Exception, match="Did you mean picard"):
+        select_tool_metrics(catalog, ["picrd"])
+    with pytest.raises(Exception, match="No metric of tool picard matches X"):
+        select_tool_metrics(catalog, ["picard:X"])
+
+
+def test_tool_table():
+    long_name = "M" * 64
+    table = tool_table("picard", ["A:B", long_name])
+    sql = str(table.element.compile(dialect=postgresql.psycopg2.dialect()))
+    # Colons aren't bind parameters, names too long for a record column are read with ->.
+    assert 'jsonb_to_record(raw_data.metrics) AS record("A:B" jsonb)' in sql
+    assert f"raw_data.metrics -> '{long_name}'" in sql and table.name == "tool:picard"
+    assert "array_position(raw_data.metric_keys, 'A:B')" in str(tool_table("picard", ["A:B"], compact=True).element)
+
+
+def test_select_tool_query(test_database):
+    with test_database.session_scope() as session:
+        session.query(Cohort).filter(Cohort.id == "SELECT_TOOL_TEST").delete()
+        session.add(Cohort(id="SELECT_TOOL_TEST"))
+        batch = Batch(cohort_id="SELECT_TOOL_TEST", batch_name="STT", path="/data")
+        session.add(batch)
+        session.flush()
+        for i, metrics in enumerate([{"AVG_DP": 30.25, "#READS": 2441001, "CHIPMIX": "NA"}, {"AVG_DP": "NA", "#READS": 10}]):
+            sample = Sample(sample_name=f"STT{i}", cohort_id="SELECT_TOOL_TEST", batch_id=batch.id, flowcell_lane="FC1",
+                            library_id="LIB", platform="HiSeqX", centre="KCCG", reference_genome="hs37d5", type="healthy")
+            session.add(sample)
+            session.flush()
+            session.add(RawData(sample_id=sample.id, qc_tool="select_tool_test", metrics=metrics))
+        for metric in ["AVG_DP", "#READS"]:
+            session.add(MetricSummary(batch_id=batch.id, qc_tool="select_tool_test", metric=metric, count=1, mean=0, m2=0,
+                                      min=0, max=0, sketch=[]))
+    catalog.invalidate()
+    try:
+        result = CliRunner().invoke(query.cli, ["-st", "select_tool_test", "-c", "SELECT_TOOL_TEST"])
+        assert result.exit_code == 0, result.output
+        rows = list(csv.DictReader(io.StringIO(result.output[result.output.index("sample.id"):])))
+        # Numeric metrics only, a value that isn't a number is empty.
+        assert [(row["sample.sample_name"], row["select_tool_test.#READS"], row["select_tool_test.AVG_DP"]) for row in
+                sorted(rows, key=lambda row: row["sample.sample_name"])] == [("STT0", "2441001", "30.25"), ("STT1", "10", "")]
+        assert "select_tool_test.CHIPMIX" not in rows[0]
+
+        # With --tool-metric filters (grouped).
+        result = CliRunner().invoke(query.cli, ["-st", "select_tool_test:AVG*", "-tm", "select_tool_test", "#READS", ">", "100"])
+        assert result.exit_code == 0, result.output
+        assert result.output.splitlines()[-1].endswith(",STT0,FC1,LIB,HiSeqX,KCCG,hs37d5,,30.25")
+    finally:
+        with test_database.session_scope() as session:
+            session.query(Cohort).filter(Cohort.id == "SELECT_TOOL_TEST").delete()
+        catalog.invalidate()
@@ -0,0 +1,104 @@
+import json
+import pytest
+from click.testing import CliRunner
+from database import rules
+from database.models import Cohort, QcRule, QcRuleSet, SampleQcFlag, Sample
+from falcon_multiqc.commands import query, save
+from falcon_multiqc.commands import rules as rules_command
+
+# fastqc totals of the saved samples.
+TOTALS = {"RA": [10, 25, 40], "RB": [10, 25, "NA"]}
+
+
+def write_batch(tmp_path, cohort_id, batch_name, totals):
+    directory = tmp_path / batch_name
+    (directory / "multiqc_data").mkdir(parents=True)
+    names = [f"{batch_name}S{i}" for i in range(len(totals))]
+    raw_data = {"multiqc_fastqc": {f"{name}_L001": {"total": total} for name, total in zip(names, totals)}}
+    (directory / "multiqc_data" / "multiqc_data.json").write_text(json.dumps({"report_saved_raw_data": raw_data}))
+    metadata = tmp_path / f"{batch_name}.csv"
+    metadata.write_text("Sample Name,Cohort Name,Batch Name,Flowcell.Lane,Library ID,Platform,Centre,Reference,Type,Description\n" +
+                        "".join(f"{name},{cohort_id},{batch_name},FC1,LIB,HiSeqX,KCCG,hs37d5,healthy,\n" for name in names))
+    return str(directory), str(metadata)
+
+
+def invoke(command, args):
+    result = CliRunner().invoke(command, args)
+    if result.exception and not isinstance(result.exception, SystemExit):
+        raise result.exception
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def flags(test_database):
+    with test_database.session_scope() as session:
+        return {(name, sample_name): sorted(failed) for name, sample_name, failed in
+                session.query(QcRuleSet.name, Sample.sample_name, SampleQcFlag.failed)
+                .join(SampleQcFlag, SampleQcFlag.rule_set_id == QcRuleSet.id).join(Sample, Sample.id == SampleQcFlag.sample_id)
+                .filter(QcRuleSet.name.like("RULES_TEST%"))}
+
+
+def clean(test_database):
+    with test_database.session_scope() as session:
+        session.query(Cohort).filter(Cohort.id.in_(["RULES_TEST_A", "RULES_TEST_B"])).delete(synchronize_session=False)
+        session.query(QcRuleSet).filter(QcRuleSet.name.like("RULES_TEST%")).delete(synchronize_session=False)
+
+
+def test_set_rule(test_database):
+    clean(test_database)
+    try:
+        with test_database.session_scope() as session:
+            rules.set_rule(session, "RULES_TEST", "fastqc", "total", ">=", 20)
+            rules.set_rule(session, "RULES_TEST", "fastqc", "total", ">=", 30, cohort_id="RULES_TEST_B")
+            # Same threshold, new value.
+            rules.set_rule(session, "RULES_TEST", "fastqc", "total", ">=", 15)
+            with pytest.raises(Exception, match="Invalid operator =>"):
+                rules.set_rule(session, "RULES_TEST", "fastqc", "total", "=>", 15)
+        with test_database.session_scope() as session:
+            assert sorted((rule.value, rule.cohort_id) for rule in session.query(QcRule).join(QcRuleSet)
+                          .filter(QcRuleSet.name == "RULES_TEST")) == [(15, None), (30, "RULES_TEST_B")]
+            with pytest.raises(Exception, match="The rule set RULES_TEST_X is not present"):
+                rules.rule_set_ids(session, ["RULES_TEST", "RULES_TEST_X"])
+    finally:
+        clean(test_database)
+
+
+def test_rules_save_query_reevaluate(test_database, tmp_path):
+    clean(test_database)
+    try:
+        invoke(rules_command.cli, ["add", "RULES_TEST", "fastqc", "total", ">=", "20"])
+        # Stricter for cohort B, a non-numeric value ('NA') doesn't fail.
+        invoke(rules_command.cli, ["add", "RULES_TEST", "fastqc", "total", ">=", "30", "--cohort", "RULES_TEST_B"])
+        invoke(rules_command.cli, ["add", "RULES_TEST_UPPER", "fastqc", "total", "<", "30"])
+
+        for cohort_id, batch_name in [("RULES_TEST_A", "RA"), ("RULES_TEST_B", "RB")]:
+            directory, metadata = write_batch(tmp_path, cohort_id, batch_name, TOTALS[batch_name])
+            invoke(save.cli, ["-d", directory, "-s", metadata])
+        assert flags(test_database) == {
+            ("RULES_TEST", "RAS0"): ["fastqc.total >= 20"],
+            ("RULES_TEST", "RBS0"): ["fastqc.total >= 30"],
+            ("RULES_TEST", "RBS1"): ["fastqc.total >= 30"],
+            ("RULES_TEST_UPPER", "RAS2"): ["fastqc.total < 30"],
+        }
+
+        output = invoke(query.cli, ["--failed-rule", "RULES_TEST", "-c", "RULES_TEST_A", "-c", "RULES_TEST_B"])
+        assert sorted(line.split(",")[1] for line in output.splitlines()[2:]) == ["RAS0", "RBS0", "RBS1"]
+        with pytest.raises(Exception, match="The rule set RULES_TEST_X is not present"):
+            invoke(query.cli, ["--failed-rule", "RULES_TEST_X"])
+
+        # Changes only apply to saved samples once reevaluated.
+        invoke(rules_command.cli, ["remove", "RULES_TEST", "--metric", "total"])
+        invoke(rules_command.cli, ["add", "RULES_TEST", "fastqc", "total", "!=", "25"])
+        assert ("RULES_TEST", "RAS0") in flags(test_database)
+        invoke(rules_command.cli, ["reevaluate", "RULES_TEST"])
+        assert flags(test_database) == {
+            ("RULES_TEST", "RAS1"): ["fastqc.total != 25"],
+            ("RULES_TEST", "RBS1"): ["fastqc.total != 25"],
+            ("RULES_TEST_UPPER", "RAS2"): ["fastqc.total < 30"],
+        }
+        assert "RULES_TEST_UPPER" in invoke(rules_command.cli, ["list"])
+
+        invoke(rules_command.cli, ["remove", "RULES_TEST_UPPER"])
+        assert ("RULES_TEST_UPPER", "RAS2") not in flags(test_database)
+    finally:
+        clean(test_database)
@@ -0,0 +1,71 @@
+import random
+import pytest
+from database.sketch import TDigest, moments, merge_moments, std_dev, is_numeric
+
+"""
+Tests for the mergeable distribution summaries in database/sketch.py.
+"""
+
+def exact_quantile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+@pytest.fixture
+def values():
+    rng = random.Random(1)
+    return [rng.gauss(30, 5) for _ in range(20000)]
+
+@pytest.mark.parametrize("q", [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99])
+def test_quantile_accuracy(values, q):
+    digest = TDigest.from_values(values)
+    assert digest.quantile(q) == pytest.approx(exact_quantile(values, q), abs=0.2)
+
+def test_merge_matches_single_digest(values):
+    rng = random.Random(2)
+    other = [rng.gauss(40, 5) for _ in range(10000)]
+    # Round trip through the stored list form, like the metric_summary table.
+    merged = TDigest.merge([TDigest.from_list(TDigest.from_values(values).to_list()), TDigest.from_values(other)])
+    assert merged.total == len(values) + len(other)
+    for q in [0.05, 0.5, 0.95]:
+        assert merged.quantile(q) == pytest.approx(exact_quantile(values + other, q), abs=0.3)
+
+def test_digest_is_compact(values):
+    assert len(TDigest.from_values(values).centroids) < 200
+
+def test_cdf_and_histogram(values):
+    digest = TDigest.from_values(values)
+    assert digest.cdf(30) == pytest.approx(sum(v <= 30 for v in values) / len(values), abs=0.01)
+    counts = digest.histogram([0, 30, 100])
+    assert sum(counts) == pytest.approx(len(values))
+    assert counts[0] == pytest.approx(sum(v < 30 for v in values), rel=0.02)
+
+def test_single_value():
+    digest = TDigest.from_values([7])
+    assert digest.quantile(0.5) == 7
+    assert digest.histogram([6.5, 7.5]) == [1.0]
+
+def test_empty_digest():
+    digest = TDigest.from_values([])
+    assert digest.quantile(0.5) is None
+    assert digest.cdf(1) is None
+
+def test_moments():
+    count, mean, m2, minimum, maximum = moments([1, 2, 3, 4])
+    assert (count, mean, minimum, maximum) == (4, 2.5, 1, 4)
+    assert std_dev(count, m2) == pytest.approx(1.2909944)
+    assert moments([]) == (0, 0.0, 0.0, None, None)
+
+def test_merge_moments(values):
+    a, b = values[:5000], values[5000:]
+    merged = merge_moments(moments(a)[:3], moments(b)[:3])
+    expected = moments(values)[:3]
+    assert merged[0] == expected[0]
+    assert merged[1] == pytest.approx(expected[1])
+    assert merged[2] == pytest.approx(expected[2])
+    assert merge_moments((0, 0.0, 0.0), (0, 0.0, 0.0)) == (0, 0.0, 0.0)
+
+def test_is_numeric():
+    assert is_numeric(1) and is_numeric(0.5)
+    assert not is_numeric(True)
+    assert not is_numeric("1")
+    assert not is_numeric(float("nan"))
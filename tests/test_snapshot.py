@@ -0,0 +1,63 @@
+import pytest
+from sqlalchemy import Float
+from sqlalchemy.orm import Query
+from database import snapshot
+from database.models import Batch, Cohort, Sample, RawData
+
+
+def test_flatten_metrics():
+    rows = [(1, "verifybamid", {"AVG_DP": 30.5, "CHIPMIX": "NA"}), (2, "verifybamid", {"AVG_DP": 28, "#READS": 10}),
+            (1, "fastqc", {"pass": True})]
+    tools = snapshot.flatten_metrics(rows)
+    assert tools["verifybamid"] == {"sample_id": [1, 2], "AVG_DP": [30.5, 28], "CHIPMIX": ["NA", None], "#READS": [None, 10]}
+    assert tools["fastqc"] == {"sample_id": [1], "pass": ["True"]}
+    assert snapshot.metric_dtype([30.5, 28, None]) == "Float64"
+    assert snapshot.metric_dtype([10, None]) == "Int64"
+    assert snapshot.metric_dtype(["NA", None]) == "string"
+
+
+def test_postgres_casts():
+    assert snapshot.postgres_casts("(m ->> 'A')::numeric::float < 1 AND CAST(x AS FLOAT) AND y::numeric(5, 2)") == \
+        "(m ->> 'A')::DOUBLE::DOUBLE < 1 AND CAST(x AS DOUBLE) AND y::numeric(5, 2)"
+    assert snapshot.postgres_casts("SELECT 1 AS numeric_value") == "SELECT 1 AS numeric_value"
+
+
+def add_batch(session, batch_name, values):
+    batch = Batch(cohort_id="SNAPSHOT_TEST", batch_name=batch_name, path=f"/data/{batch_name}", sample_count=len(values))
+    session.add(batch)
+    session.flush()
+    for i, value in enumerate(values):
+        sample = Sample(batch_id=batch.id, cohort_id="SNAPSHOT_TEST", sample_name=f"{batch_name}{i}", flowcell_lane="FC1",
+                        library_id="LIB", platform="HiSeqX", centre="KCCG", reference_genome="hs37d5", type="WGS")
+        session.add(sample)
+        session.flush()
+        session.add(RawData(sample_id=sample.id, qc_tool="verifybamid", metrics={"AVG_DP": value, "CHIPMIX": "NA"}))
+    return batch.id
+
+
+def test_snapshot(test_database, tmp_path):
+    pytest.importorskip("duckdb")
+    with test_database.session_scope() as session:
+        session.query(Cohort).delete()
+        session.add(Cohort(id="SNAPSHOT_TEST", sample_count=5, batch_count=2))
+        add_batch(session, "A", [25.5, 35.0, 40.25])
+        removed = add_batch(session, "B", [20.0, 50.0])
+
+    directory = str(tmp_path)
+    with test_database.session_scope() as session:
+        assert snapshot.take_snapshot(session, directory) == (2, 0, 0)
+    with test_database.session_scope() as session:
+        assert snapshot.take_snapshot(session, directory) == (0, 0, 2)
+        session.query(Batch).filter(Batch.id == removed).delete()
+    with test_database.session_scope() as session:
+        assert snapshot.take_snapshot(session, directory) == (0, 1, 1)
+
+        connection = snapshot.connect(directory)
+        query = Query([Sample.sample_name]).join(RawData, RawData.sample_id == Sample.id).\
+            filter(RawData.metrics["AVG_DP"].astext.cast(Float) > 30).order_by(Sample.sample_name)
+        assert snapshot.execute_query(connection, query) == [("A1",), ("A2",)]
+        header, rows = snapshot.execute_sql(connection,
+            "SELECT s.sample_name, v.\"AVG_DP\" FROM sample s JOIN raw_data_verifybamid v ON v.sample_id = s.id ORDER BY 1")
+        assert header == ["sample_name", "AVG_DP"] and rows == [("A0", 25.5), ("A1", 35.0), ("A2", 40.25)]
+        assert snapshot.snapshot_catalog(connection) == {"verifybamid": {"AVG_DP", "CHIPMIX"}}
+        assert snapshot.overview(connection) == [["SNAPSHOT_TEST", "A", 3]]
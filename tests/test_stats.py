@@ -0,0 +1,52 @@
+import json
+import threading
+from sqlalchemy import text
+from database import stats, crud
+
+
+def test_summary():
+    recorded = stats.Stats("query")
+    recorded.add_statement("SELECT 1", 0.002, 1)
+    recorded.add_statement("SELECT 1", 0.001, 1)
+    recorded.add_statement("SELECT 2", 0.005, 10)
+    recorded.round_trips += 1 # a commit
+    summary = recorded.summary(top=1)
+    assert (summary["statements"], summary["round_trips"], summary["rows"]) == (3, 4, 12)
+    assert summary["slowest"] == [{"ms": 5.0, "rows": 10, "sql": "SELECT 2"}]
+    assert summary["repeated"] == [{"count": 2, "ms": 3.0, "sql": "SELECT 1"}]
+    assert summary["python_s"] >= 0
+    text_summary = stats.format_summary(summary)
+    assert text_summary.startswith("query: 3 statements, 4 round trips, 12 rows")
+    assert "SELECT 2" in text_summary
+
+
+def test_file_io_and_threads(tmp_path):
+    recorded = stats.start_stats("save")
+    try:
+        with stats.file_io():
+            (tmp_path / "data.json").write_text("{}")
+        # Other threads' commands aren't recorded in this one.
+        other = threading.Thread(target=lambda: stats.current() is None or stats.current().add_statement("x", 1, 1))
+        other.start()
+        other.join()
+    finally:
+        assert stats.stop_stats() is recorded
+    assert stats.current() is None
+    assert recorded.io_seconds > 0 and recorded.statements == 0
+    log = tmp_path / "stats.jsonl"
+    stats.append_log(str(log), recorded.summary())
+    stats.append_log(str(log), recorded.summary())
+    assert [json.loads(line)["command"] for line in log.read_text().splitlines()] == ["save", "save"]
+
+
+def test_statement_counts(test_database):
+    recorded = stats.start_stats("sql")
+    try:
+        with crud.session_scope() as session:
+            for _ in range(3):
+                session.execute(text("SELECT 1"))
+    finally:
+        stats.stop_stats()
+    assert recorded.statements >= 3
+    assert recorded.round_trips >= recorded.statements + 1 # the commit
+    assert recorded.by_sql["SELECT 1"][0] == 3
@@ -0,0 +1,115 @@
+import io
+import json
+import tarfile
+import pytest
+from sqlalchemy import text
+from database.models import Batch, Cohort, MetricBaseline, Sample
+from database.transfer import MANIFEST, archive_manifest
+from falcon_multiqc.commands import export_cohort, import_cohort, save
+from test_matrix import invoke, write_batch, COHORT
+
+COPY = "TRANSFER_TEST"
+
+
+def raw_data(session, cohort_id):
+    return session.execute(text("SELECT b.batch_name, s.sample_name, r.qc_tool, r.metrics::text FROM raw_data r "
+                                "JOIN sample s ON s.id = r.sample_id JOIN batch b ON b.id = s.batch_id "
+                                "WHERE s.cohort_id = :cohort ORDER BY 1, 2, 3"), {"cohort": cohort_id}).fetchall()
+
+
+# The count of the saved batches' baseline of total.
+def baseline_count(session):
+    return session.query(MetricBaseline.count).filter(
+        MetricBaseline.centre == "KCCG", MetricBaseline.platform == "HiSeqX", MetricBaseline.reference_genome == "hs37d5",
+        MetricBaseline.qc_tool == "fastqc", MetricBaseline.metric == "total").scalar() or 0
+
+
+# Rewrites the archive with the manifest changed by change(manifest).
+def change_manifest(path, change):
+    with tarfile.open(path) as archive:
+        members = [(member, archive.extractfile(member).read()) for member in archive]
+    with tarfile.open(path, "w") as archive:
+        for member, data in members:
+            if member.name == MANIFEST:
+                manifest = json.loads(data)
+                change(manifest)
+                data = json.dumps(manifest).encode()
+                member.size = len(data)
+            archive.addfile(member, io.BytesIO(data))
+
+
+@pytest.mark.parametrize("compression", ["zstd", "gzip"])
+def test_export_import(test_database, tmp_path, compression):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+
+    def clean():
+        with test_database.session_scope() as session:
+            session.query(Cohort).filter(Cohort.id.in_([COHORT, COPY])).delete(synchronize_session=False)
+    clean()
+    path = str(tmp_path / "export.falcon.tar")
+    try:
+        with test_database.session_scope() as session:
+            before = baseline_count(session)
+        invoke(save.cli, write_batch(tmp_path, "TA", [10, 11, 12]))
+        invoke(save.cli, write_batch(tmp_path, "TB", [20, "NA"]))
+        with test_database.session_scope() as session:
+            exported = raw_data(session, COHORT)
+            count = baseline_count(session) - before
+        assert count == 4
+        invoke(export_cohort.cli, ["--cohort", COHORT, "-o", path, "--compression", compression])
+        manifest = archive_manifest(path)
+        assert (manifest["cohort"], manifest["compression"]) == (COHORT, compression)
+        assert {table: info["rows"] for table, info in manifest["tables"].items() if info["rows"]} == \
+            {"cohort": 1, "batch": 2, "sample": 5, "raw_data": 5, "metric_summary": 4, "batch_metric_baseline": 4}
+
+        with pytest.raises(Exception, match="already exists"):
+            invoke(import_cohort.cli, [path])
+        output = invoke(import_cohort.cli, [path, "--cohort", COPY])
+        assert f"Imported cohort {COPY} (2 batches, 5 samples, 5 raw_data rows)" in output
+        with test_database.session_scope() as session:
+            assert raw_data(session, COPY) == exported
+            # New ids, the exported cohort's rows are untouched.
+            assert session.query(Sample).filter(Sample.cohort_id == COPY).count() == 5
+            assert not set(session.query(Batch.id).filter(Batch.cohort_id == COHORT)) & \
+                set(session.query(Batch.id).filter(Batch.cohort_id == COPY))
+            assert session.query(Cohort.sample_count).filter(Cohort.id == COPY).scalar() == 5
+            # Merged into the baselines.
+            assert baseline_count(session) - before == 2 * count
+
+        # Deleted (without unmerging its baselines) and imported again under its own id.
+        clean()
+        invoke(import_cohort.cli, [path])
+        with test_database.session_scope() as session:
+            assert raw_data(session, COHORT) == exported
+            assert baseline_count(session) - before == 3 * count
+    finally:
+        clean()
+
+
+def test_import_corrupt(test_database, tmp_path):
+    def clean():
+        with test_database.session_scope() as session:
+            session.query(Cohort).filter(Cohort.id.in_([COHORT, COPY])).delete(synchronize_session=False)
+    clean()
+    path = str(tmp_path / "export.falcon.tar")
+    try:
+        invoke(save.cli, write_batch(tmp_path, "TA", [10, 11, 12]))
+        invoke(export_cohort.cli, ["--cohort", COHORT, "-o", path, "--compression", "gzip"])
+
+        def corrupt(manifest):
+            manifest["tables"]["raw_data"]["sha256"] = "0" * 64
+        change_manifest(path, corrupt)
+        with pytest.raises(Exception, match="raw_data data of .* is corrupt"):
+            invoke(import_cohort.cli, [path, "--cohort", COPY])
+
+        def retype(manifest):
+            manifest["tables"]["sample"]["types"][-1] = "integer"
+        change_manifest(path, retype)
+        with pytest.raises(Exception, match="sample table of the export"):
+            invoke(import_cohort.cli, [path, "--cohort", COPY])
+        # Nothing was imported.
+        with test_database.session_scope() as session:
+            assert session.query(Cohort).filter(Cohort.id == COPY).count() == 0
+    finally:
+        clean()
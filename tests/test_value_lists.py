@@ -0,0 +1,34 @@
+import pytest
+from sqlalchemy import text
+from database import value_lists
+
+VALUES = ["SAMPLE1", "back\\slash", "tab\tbed", "quote's"]
+
+
+def test_read_values(tmp_path):
+    path = tmp_path / "samples.txt"
+    path.write_text("SAMPLE1\n\n  SAMPLE2 \r\n\"SAMPLE3\"\nSAMPLE1\n")
+    assert value_lists.read_values(str(path)) == ["SAMPLE1", "SAMPLE2", "SAMPLE3"]
+
+
+def test_copy_text():
+    assert value_lists.copy_text("a\\b\tc") == "a\\\\b\\tc"
+
+
+def test_load_values(test_database):
+    value_lists.ensure_list_indexes()
+    with test_database.session_scope() as session:
+        table = value_lists.load_values(session, "sample_name_list", VALUES)
+        assert sorted(value for value, in session.query(table.c.value)) == sorted(VALUES)
+        indexes = {name for name, in session.execute(text("SELECT indexname FROM pg_indexes WHERE tablename = 'sample'"))}
+        assert {name for name, _, _ in value_lists.LIST_INDEXES} <= indexes
+    # The temp table is dropped with the transaction.
+    with test_database.session_scope() as session:
+        assert session.execute(text("SELECT to_regclass('pg_temp.sample_name_list')")).scalar() is None
+
+
+def test_load_duckdb_values():
+    duckdb = pytest.importorskip("duckdb")
+    connection = duckdb.connect()
+    value_lists.load_duckdb_values(connection, "sample_name_list", VALUES)
+    assert sorted(value for value, in connection.execute("SELECT value FROM sample_name_list").fetchall()) == sorted(VALUES)
@@ -0,0 +1,118 @@
+import json
+import os
+import threading
+import time
+import pytest
+from database.jobs import FAILED, SAVED
+from database.models import Cohort, IngestJob, Sample
+from falcon_multiqc.watcher import Inotify, LandingArea, watch
+
+COHORT = "WATCH_TEST"
+
+
+# Writes a batch directory with its sample metadata (samples named in the metadata, which may differ from the json's).
+def write_batch(root, batch_name, samples, metadata_samples=None):
+    directory = root / batch_name
+    (directory / "multiqc_data").mkdir(parents=True, exist_ok=True)
+    names = [f"{batch_name}S{i}" for i in range(samples)]
+    raw_data = {"multiqc_fastqc": {f"{name}_L001": {"total": i} for i, name in enumerate(names)}}
+    (directory / "multiqc_data" / "multiqc_data.json").write_text(json.dumps({"report_saved_raw_data": raw_data}))
+    (directory / "sample_metadata.csv").write_text(
+        "Sample Name,Cohort Name,Batch Name,Flowcell.Lane,Library ID,Platform,Centre,Reference,Type,Description\n" +
+        "".join(f"{name},{COHORT},{batch_name},FC1,LIB,HiSeqX,KCCG,hs37d5,healthy,\n" for name in (metadata_samples or names)))
+    return str(directory)
+
+
+def test_landing_area(tmp_path):
+    area = LandingArea(settle=60)
+    directory = tmp_path / "B1"
+    (directory / "multiqc_data").mkdir(parents=True)
+    (directory / "multiqc_data" / "multiqc_data.json").write_text("{}")
+    # No sample metadata yet.
+    area.touch(str(directory))
+    assert area.pending == {}
+
+    (directory / "sample_metadata.csv").write_text("Sample Name\n")
+    area.touch(str(directory))
+    assert str(directory) in area.pending and area.settled() == []
+    # Settled since it was last written.
+    old = time.time() - 120
+    for path in [directory / "sample_metadata.csv", directory / "multiqc_data" / "multiqc_data.json"]:
+        os.utime(path, (old, old))
+    area.pending.clear()
+    area.touch(str(directory))
+    [(ready, metadata, _)] = area.settled()
+    assert ready == str(directory) and metadata == [str(directory / "sample_metadata.csv")]
+    # Queued once, until it changes again, when it has to settle again.
+    area.touch(str(directory))
+    assert area.pending == {}
+    (directory / "sample_metadata.csv").write_text("Sample Name\nS1\n")
+    area.touch(str(directory))
+    assert area.settled() == [] and str(directory) in area.pending
+
+
+def test_inotify(tmp_path):
+    try:
+        inotify = Inotify()
+    except OSError:
+        pytest.skip("inotify is not available.")
+    try:
+        inotify.add_tree(str(tmp_path))
+        (tmp_path / "B1").mkdir()
+        events = inotify.read(timeout=1)
+        assert [path for path, _ in events] == [str(tmp_path / "B1")]
+        # New directories are watched.
+        (tmp_path / "B1" / "sample_metadata.csv").write_text("Sample Name\n")
+        assert str(tmp_path / "B1" / "sample_metadata.csv") in [path for path, _ in inotify.read(timeout=1)]
+        assert inotify.read(timeout=0) == []
+    finally:
+        inotify.close()
+
+
+def jobs(test_database, root):
+    with test_database.session_scope() as session:
+        return sorted((os.path.basename(job.directory), job.status, job.sample_count) for job in
+                      session.query(IngestJob).filter(IngestJob.directory.like(f"{root}/%")))
+
+
+def test_watch(test_database, tmp_path):
+    def clean():
+        with test_database.session_scope() as session:
+            session.query(Cohort).filter(Cohort.id == COHORT).delete(synchronize_session=False)
+            session.query(IngestJob).filter(IngestJob.directory.like(f"{tmp_path}/%")).delete(synchronize_session=False)
+    clean()
+    root = tmp_path / "landing"
+    try:
+        write_batch(root, "WA", 2)
+        # The json has a sample the metadata doesn't.
+        write_batch(root / "nested", "WB", 2, ["WBS0"])
+        assert watch(str(root), settle=0, once=True) == {SAVED: 1, FAILED: 1}
+        assert jobs(test_database, root) == [("WA", SAVED, 2), ("WB", FAILED, None)]
+        # Nothing changed, nothing to do.
+        assert watch(str(root), settle=0, once=True) == {}
+
+        # Fixing the failed directory's metadata is a new job.
+        write_batch(root / "nested", "WB", 2)
+        assert watch(str(root), settle=0, once=True) == {SAVED: 1}
+
+        # Watching: a directory saved once it lands.
+        stopping = threading.Event()
+        counts = {}
+        watcher = threading.Thread(target=lambda: counts.update(watch(str(root), settle=0.2, poll_interval=0.2, stopping=stopping)))
+        watcher.start()
+        try:
+            time.sleep(0.5)
+            write_batch(root, "WC", 3)
+            deadline = time.time() + 10
+            while ("WC", SAVED, 3) not in jobs(test_database, root) and time.time() < deadline:
+                time.sleep(0.1)
+        finally:
+            stopping.set()
+            watcher.join()
+        assert counts == {SAVED: 1}
+        with test_database.session_scope() as session:
+            assert session.query(Sample).filter(Sample.cohort_id == COHORT).count() == 7
+            cohort = session.query(Cohort).filter(Cohort.id == COHORT).one()
+            assert (cohort.sample_count, cohort.batch_count) == (7, 3)
+    finally:
+        clean()